@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Benchmark fast-exif-rs-py reading throughput per file format
+
+Usage:
+    python benchmark.py PATH [PATH ...] [--depth basic standard full] [--repeat N]
+    python benchmark.py PATH [PATH ...] --alloc
+
+PATH may be an image file or a directory, which is searched recursively.
+
+--alloc reports heap allocations per file with a fresh reader per file and
+no scratch buffer reuse (before) against the cached thread-local reader with
+scratch buffers (after). It needs an extension built with the alloc-stats
+feature:
+
+    maturin develop --release --features alloc-stats
+"""
+
+import argparse
+import os
+import sys
+import time
+from collections import defaultdict
+
+import fast_exif_rs_py
+
+DEPTHS = ["basic", "standard", "full"]
+
+
+def collect_files(paths):
+    """Group the given files (and files under given directories) by extension"""
+    by_format = defaultdict(list)
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _dirs, names in os.walk(path):
+                for name in names:
+                    by_format[os.path.splitext(name)[1].lstrip(".").upper()].append(os.path.join(root, name))
+        elif os.path.isfile(path):
+            by_format[os.path.splitext(path)[1].lstrip(".").upper()].append(path)
+    by_format.pop("", None)
+    return by_format
+
+
+def bench_depth(files, depth, repeat):
+    """Return (files per second, mean tags per file) for one depth level
+
+    Below "full" only the blocks within the level are read and parsed, so
+    the gain is largest for RAW files with big MakerNotes. Files are read
+    from the page cache after the first pass, which hides the I/O saved on
+    cold or network storage.
+    """
+    reader = fast_exif_rs_py.PyFastExifReader(depth=depth)
+    tags = 0
+    count = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for path in files:
+            try:
+                tags += len(reader.read_file(path))
+                count += 1
+            except RuntimeError:
+                pass
+    elapsed = time.perf_counter() - start
+    if count == 0:
+        return 0.0, 0.0
+    return count / elapsed, tags / count
+
+
+def count_allocations(files, read):
+    """Return heap allocations per file made while calling read on each file"""
+    count = 0
+    allocations, _ = fast_exif_rs_py.allocation_stats()
+    for path in files:
+        try:
+            read(path)
+            count += 1
+        except RuntimeError:
+            pass
+    if count == 0:
+        return 0.0
+    return (fast_exif_rs_py.allocation_stats()[0] - allocations) / count
+
+
+def bench_allocations(files):
+    """Return allocations per file before and after reader and buffer reuse"""
+    fast_exif_rs_py.configure_scratch_buffers(0)
+    before = count_allocations(files, lambda path: fast_exif_rs_py.PyFastExifReader().read_file(path))
+    fast_exif_rs_py.configure_scratch_buffers(None)
+    # Warm the thread-local reader and its buffer before counting
+    count_allocations(files, fast_exif_rs_py.read_exif_file)
+    after = count_allocations(files, fast_exif_rs_py.read_exif_file)
+    return before, after
+
+
+def main_alloc(by_format):
+    """Print allocations per file for each format"""
+    if not hasattr(fast_exif_rs_py, "allocation_stats"):
+        print("Rebuild with `maturin develop --release --features alloc-stats` to count allocations")
+        return 1
+    print(f"{'format':<8}{'files':>7}{'before':>10}{'after':>10}{'saved':>8}")
+    for fmt in sorted(by_format):
+        files = by_format[fmt]
+        before, after = bench_allocations(files)
+        saved = 1 - after / before if before else 0.0
+        print(f"{fmt:<8}{len(files):>7}{before:>10.1f}{after:>10.1f}{saved:>7.0%}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark EXIF reading per format")
+    parser.add_argument("paths", nargs="+", help="Image files or directories")
+    parser.add_argument("--depth", nargs="+", choices=DEPTHS, default=DEPTHS,
+                        help="Parse depth levels to compare")
+    parser.add_argument("--repeat", type=int, default=3, help="Passes over each file set")
+    parser.add_argument("--alloc", action="store_true",
+                        help="Report allocations per file before and after buffer reuse")
+    args = parser.parse_args()
+
+    by_format = collect_files(args.paths)
+    if not by_format:
+        print("No files found")
+        return 1
+
+    print(f"fast-exif-rs-py {fast_exif_rs_py.get_version()}")
+    if args.alloc:
+        return main_alloc(by_format)
+    print(f"{'format':<8}{'files':>7}  {'depth':<10}{'files/s':>10}{'tags/file':>11}{'speedup':>9}")
+    for fmt in sorted(by_format):
+        files = by_format[fmt]
+        results = {depth: bench_depth(files, depth, args.repeat) for depth in args.depth}
+        baseline = results.get("full", results[args.depth[-1]])[0]
+        for depth in args.depth:
+            rate, tags = results[depth]
+            speedup = rate / baseline if baseline else 0.0
+            print(f"{fmt:<8}{len(files):>7}  {depth:<10}{rate:>10.0f}{tags:>11.1f}{speedup:>8.2f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
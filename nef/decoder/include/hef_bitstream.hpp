@@ -5,6 +5,31 @@
 
 namespace hefraw {
 
+// Prefix code decoded with a single table lookup for codes up to
+// kLookupBits long; longer codes fall back to a canonical bit-by-bit walk.
+// Codes are read LSB-first like everything else in BitReader, so the first
+// bit of a code is the lowest bit of the stream.
+class VlcTable {
+public:
+    static constexpr unsigned kLookupBits = 11;
+    static constexpr unsigned kMaxLength = 24;
+
+    // Canonical code from per-symbol lengths (0 = unused), assigned in
+    // symbol order the way deflate does. Returns false if the lengths are
+    // longer than kMaxLength or over-subscribe the code space.
+    bool build(const std::vector<uint8_t>& lengths);
+
+    unsigned maxLength() const noexcept { return max_; }
+
+private:
+    friend class BitReader;
+    // Symbol << 8 | length for codes that fit the table, 0 otherwise
+    std::vector<uint32_t> lut_;
+    std::vector<uint16_t> count_;   // codes of each length
+    std::vector<uint16_t> sorted_;  // symbols in canonical order
+    unsigned max_ = 0;
+};
+
 class BitReader {
 public:
     BitReader(const uint8_t* data, size_t size) noexcept;
@@ -13,14 +38,32 @@ public:
     void alignToByte() noexcept;
     bool exhausted() const noexcept;
 
+    // Decode one symbol; -1 if the stream ends or holds no valid code
+    int decode(const VlcTable& table) noexcept
+    {
+        if (bits_ < table.max_) refill();
+        const uint32_t e = table.lut_[cache_ & ((1u << VlcTable::kLookupBits) - 1)];
+        const unsigned len = e & 0xFF;
+        if (!len) return decodeSlow(table);
+        if (len > bits_) return -1;
+        cache_ >>= len;
+        bits_ -= len;
+        return (int)(e >> 8);
+    }
+
+    // Decode up to `count` symbols into `out`, refilling once for as many
+    // symbols as the cache holds. Returns the number decoded, which is less
+    // than `count` only at the end of the stream or on an invalid code.
+    size_t decodeMany(const VlcTable& table, uint16_t* out, size_t count) noexcept;
+
 private:
     const uint8_t* ptr_;
     const uint8_t* end_;
+    // Bits above bits_ are zero or the stream's next bits, never garbage
     uint64_t cache_;
     unsigned bits_; // number of valid bits in cache
     void refill() noexcept;
+    int decodeSlow(const VlcTable& table) noexcept;
 };
 
 } // namespace hefraw
-
-
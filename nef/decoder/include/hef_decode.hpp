@@ -1,11 +1,35 @@
 #pragma once
 #include <cstdint>
 #include <cstddef>
+#include <functional>
 #include <vector>
 #include "hef_format.hpp"
 
 namespace hefraw {
 
+struct DecodeOptions {
+    unsigned threads = 0;   // worker threads; 0 = one per available core
+    unsigned scale = 1;     // 1 = full CFA frame; 2, 4 or 8 = binned RGB
+    uint8_t cfaPattern = 0; // 0=RGGB, 1=BGGR, 2=GRBG, 3=GBRG, for binning
+};
+
+// Size of the image assemble_image_cfa16 produces at a given scale
+void scaled_size(uint32_t width, uint32_t height, unsigned scale,
+                 uint32_t& out_width, uint32_t& out_height);
+
+// Window of a caller's 16-bit frame that a tile is decoded into: the tile's
+// top-left pixel and the distance between rows, in pixels.
+struct CfaRegion {
+    uint16_t* data;
+    size_t stride;
+};
+
+// Decode a single HE* tile row by row into a region of at least
+// th.width x th.height pixels. Pixels past the end of the bitstream are left
+// untouched. Returns true on success.
+bool decode_tile_into(const uint8_t* bitstream, size_t len,
+                      const TileHeader& th, CfaRegion out);
+
 // Decode a single HE* tile into a 16-bit CFA buffer (RGGB order assumed).
 // Returns true on success.
 bool decode_tile_to_cfa16(const uint8_t* bitstream, size_t len,
@@ -14,10 +38,46 @@ bool decode_tile_to_cfa16(const uint8_t* bitstream, size_t len,
                           uint32_t stride_px);
 
 // Assemble full image CFA from tiles into 16-bit buffer of size width*height.
+// Tiles decode directly into the buffer; where tiles overlap, a pixel comes
+// from the first tile in header order that decoded it. Tiles that share no
+// pixels are decoded concurrently.
+//
+// With opts.scale at 2, 4 or 8 the buffer instead receives scaled_size()
+// interleaved 16-bit RGB pixels: each scale x scale block is binned into
+// the means of its red, green and blue sites as it decodes, so the
+// full-size frame is never held. Half size is exact; at quarter and eighth
+// size the sums are shifted to fit 16 bits, which can cost a mean its
+// lowest bit.
 bool assemble_image_cfa16(const ImageHeader& ih,
                           const uint8_t* file_data, size_t file_len,
-                          std::vector<uint16_t>& out_cfa);
+                          std::vector<uint16_t>& out_cfa,
+                          const DecodeOptions& opts = DecodeOptions());
 
-} // namespace hefraw
+// Decode the width x height region of the frame at (x, y) into a CFA buffer
+// of that size, decoding only the tiles that reach into it. The pixels are
+// the ones assemble_image_cfa16 produces there; any part of the region
+// outside the frame is zero. Full scale only.
+bool decode_region(const ImageHeader& ih,
+                   const uint8_t* file_data, size_t file_len,
+                   uint32_t x, uint32_t y, uint32_t width, uint32_t height,
+                   std::vector<uint16_t>& out_cfa,
+                   const DecodeOptions& opts = DecodeOptions());
 
+// Receives rows [y, y + rows) of the frame as rows x width pixels. The data
+// is only valid during the call. Return false to stop decoding.
+using RowSink = std::function<bool(uint32_t y, uint32_t rows, const uint16_t* data)>;
 
+// Decode the full-scale CFA frame and pass it to `sink` top to bottom, at
+// most band_rows rows at a time, every row exactly once. The pixels are the
+// ones assemble_image_cfa16 produces, but the frame is never held whole:
+// a TicoRAW tile that no other tile shares rows with is handed on as it
+// decodes, holding at most an eighth of its rows, and other tiles a
+// stretch of rows at a time. The sink runs on the calling thread; with
+// more than one thread, decoding continues on a worker while it does.
+// Returns false if no tile decodes or the sink stops early.
+bool decode_rows(const ImageHeader& ih,
+                 const uint8_t* file_data, size_t file_len,
+                 uint32_t band_rows, const RowSink& sink,
+                 const DecodeOptions& opts = DecodeOptions());
+
+} // namespace hefraw
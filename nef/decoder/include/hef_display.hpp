@@ -0,0 +1,31 @@
+#pragma once
+#include <cstdint>
+#include <cstddef>
+#include <vector>
+
+namespace hefraw {
+
+struct DisplayOptions {
+    uint16_t black = 0;       // sensor black level, maps to 0
+    uint16_t white = 0x3FFF;  // saturation level, maps to 255
+    float gamma = 2.2f;       // display gamma applied after scaling
+    bool half_size = false;   // one pixel per 2x2 quad instead of bilinear
+    uint8_t cfaPattern = 0;   // 0=RGGB, 1=BGGR, 2=GRBG, 3=GBRG
+    unsigned threads = 0;     // worker threads; 0 = one per available core
+};
+
+// Size of the display image for a width x height CFA frame
+void display_size(uint32_t width, uint32_t height, const DisplayOptions& opts,
+                  uint32_t& out_width, uint32_t& out_height);
+
+// Demosaic a 14-bit CFA frame and tone map it into 0xAARRGGBB pixels, the
+// layout imlib2 uses. `out` must hold display_size() pixels. Full size is
+// bilinear; half size averages the two greens of each quad. Rows are
+// processed in bands across worker threads.
+bool cfa16_to_argb(const uint16_t* cfa, uint32_t width, uint32_t height,
+                   const DisplayOptions& opts, uint32_t* out);
+
+// The 16K-entry lookup from a 14-bit sample to an 8-bit display value
+std::vector<uint8_t> tone_curve(const DisplayOptions& opts);
+
+} // namespace hefraw
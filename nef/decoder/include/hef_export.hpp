@@ -6,12 +6,38 @@
 
 namespace hefraw {
 
-// Export 16-bit CFA to DNG (lossless) for validation in open tools
+enum class Compression {
+    None,
+    Deflate,       // zlib with the horizontal differencing predictor
+    LosslessJpeg,  // DNG only: 256x256 tiles of lossless JPEG
+};
+
+struct ExportOptions {
+    Compression compression = Compression::None;
+    int deflate_level = 1;        // 1 = fastest to 9 = smallest
+    uint32_t rows_per_strip = 0;  // 0 = strips of about 256 KiB
+    unsigned threads = 0;         // worker threads; 0 = one per available core
+};
+
+// The exporters stream the file: strips or tiles are compressed a batch at
+// a time across worker threads and written in order, with the IFD last, so
+// beyond the frame only a batch of compressed data is held.
+
+// Export 16-bit CFA to DNG (lossless) for validation in open tools. The
+// CFA pattern uses the ImageHeader encoding (0=RGGB, 1=BGGR, 2=GRBG,
+// 3=GBRG) and is recorded with 14-bit black and white levels.
 bool export_cfa16_to_dng(const std::vector<uint16_t>& cfa, uint32_t width, uint32_t height,
-                         uint8_t cfa_pattern, const std::string& output_path);
+                         uint8_t cfa_pattern, const std::string& output_path,
+                         const ExportOptions& opts = ExportOptions());
 
 // Export 16-bit CFA to 16-bit TIFF for quick viewing/testing
 bool export_cfa16_to_tiff(const std::vector<uint16_t>& cfa, uint32_t width, uint32_t height,
-                          const std::string& output_path);
+                          const std::string& output_path,
+                          const ExportOptions& opts = ExportOptions());
+
+// Export interleaved 16-bit RGB, as a scaled decode produces, to TIFF
+bool export_rgb16_to_tiff(const std::vector<uint16_t>& rgb, uint32_t width, uint32_t height,
+                          const std::string& output_path,
+                          const ExportOptions& opts = ExportOptions());
 
 } // namespace hefraw
@@ -1,6 +1,7 @@
 #pragma once
 #include <cstdint>
 #include <cstddef>
+#include <cstdio>
 #include <vector>
 #include <string>
 
@@ -13,6 +14,8 @@ struct TileHeader {
     uint16_t height;
     uint8_t  bitDepth; // e.g., 14
     uint8_t  cfaPattern; // 0=RGGB etc.
+    uint32_t x;          // top-left pixel in the frame
+    uint32_t y;
 };
 
 struct ImageHeader {
@@ -24,9 +27,24 @@ struct ImageHeader {
 };
 
 // Parse HE* container structures from a NEF file buffer and populate headers.
-// Returns true on success.
+// Every strip or tile of each SubIFD of the frame's size becomes a tile with
+// its position in the frame, in file order. Returns true on success.
 bool parse_hef_headers(const uint8_t* data, size_t size, ImageHeader& out);
 
+// Whether a NEF file buffer holds HE* data: a tile from parse_hef_headers
+// starts with the TicoRAW signature, or the Nikon MakerNote marks the file as
+// High Efficiency. Only the IFDs, the first bytes of each tile and the
+// MakerNote header are read, a few kilobytes regardless of file size.
+bool detect_hef(const uint8_t* data, size_t size);
+
+// Same check on an open file, reading only those few kilobytes. The file
+// position is restored.
+bool detect_hef_file(FILE* fp);
+
+// Locate the largest embedded JPEG preview in IFD0, the IFDs chained after
+// it and their SubIFDs. Returns false if there is none.
+bool find_jpeg_preview(const uint8_t* data, size_t size, uint32_t& offset, uint32_t& length);
+
 } // namespace hefraw
 
 
@@ -0,0 +1,70 @@
+#pragma once
+#include <cstdint>
+#include <cstddef>
+#include <string>
+#include <vector>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+namespace hefraw {
+
+// Read-only view of a whole file. It is memory-mapped where the file allows,
+// so only the pages the decoder touches are read and nothing is copied onto
+// the heap; otherwise, as for pipes, it is read into memory.
+class MappedFile {
+public:
+    MappedFile() = default;
+    explicit MappedFile(const std::string& path) { open(path); }
+    ~MappedFile() { close(); }
+    MappedFile(const MappedFile&) = delete;
+    MappedFile& operator=(const MappedFile&) = delete;
+
+    bool open(const std::string& path)
+    {
+        close();
+        const int fd = ::open(path.c_str(), O_RDONLY);
+        if (fd < 0) return false;
+        struct stat st;
+        if (fstat(fd, &st) == 0 && S_ISREG(st.st_mode) && st.st_size > 0) {
+            void* p = mmap(nullptr, (size_t)st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+            if (p != MAP_FAILED) {
+                // Tiles are read front to back
+                madvise(p, (size_t)st.st_size, MADV_SEQUENTIAL);
+                data_ = static_cast<const uint8_t*>(p);
+                size_ = (size_t)st.st_size;
+                mapped_ = true;
+                ::close(fd);
+                return true;
+            }
+        }
+        uint8_t buf[65536];
+        for (ssize_t n; (n = ::read(fd, buf, sizeof(buf))) > 0;) copy_.insert(copy_.end(), buf, buf + n);
+        ::close(fd);
+        data_ = copy_.data();
+        size_ = copy_.size();
+        return size_ > 0;
+    }
+
+    void close()
+    {
+        if (mapped_) munmap(const_cast<uint8_t*>(data_), size_);
+        std::vector<uint8_t>().swap(copy_);
+        data_ = nullptr;
+        size_ = 0;
+        mapped_ = false;
+    }
+
+    const uint8_t* data() const { return data_; }
+    size_t size() const { return size_; }
+    bool is_open() const { return data_ != nullptr; }
+
+private:
+    const uint8_t* data_ = nullptr;
+    size_t size_ = 0;
+    bool mapped_ = false;
+    std::vector<uint8_t> copy_;
+};
+
+} // namespace hefraw
@@ -0,0 +1,58 @@
+#pragma once
+#include <algorithm>
+#include <atomic>
+#include <cstddef>
+#include <exception>
+#include <mutex>
+#include <system_error>
+#include <thread>
+#include <vector>
+
+namespace hefraw {
+
+// Number of workers to use for a requested count; 0 means one per core.
+inline unsigned resolve_threads(unsigned requested)
+{
+    if (requested) return requested;
+    unsigned cores = std::thread::hardware_concurrency();
+    return cores ? cores : 1;
+}
+
+// Run fn(i) for every i in [0, count) on up to `threads` workers.
+// Indices are handed out one at a time, so uneven items balance out; the
+// calling thread works too and the call returns once every item is done.
+// If fn throws, no further items are started and the first exception is
+// rethrown on the calling thread after every worker has finished.
+template <typename Fn>
+void parallel_for(size_t count, unsigned threads, Fn&& fn)
+{
+    const size_t workers = std::min<size_t>(resolve_threads(threads), count);
+    if (workers <= 1) {
+        for (size_t i = 0; i < count; i++) fn(i);
+        return;
+    }
+    std::atomic<size_t> next{0};
+    std::mutex mutex;
+    std::exception_ptr error;
+    auto work = [&]() {
+        try {
+            for (size_t i; (i = next.fetch_add(1, std::memory_order_relaxed)) < count;) fn(i);
+        } catch (...) {
+            next.store(count, std::memory_order_relaxed);
+            std::lock_guard<std::mutex> lock(mutex);
+            if (!error) error = std::current_exception();
+        }
+    };
+    std::vector<std::thread> pool;
+    pool.reserve(workers - 1);
+    try {
+        for (size_t t = 1; t < workers; t++) pool.emplace_back(work);
+    } catch (const std::system_error&) {
+        // Out of threads: the workers already started share the items
+    }
+    work();
+    for (auto& thread : pool) thread.join();
+    if (error) std::rethrow_exception(error);
+}
+
+} // namespace hefraw
@@ -0,0 +1,26 @@
+/* C interface to the row-streaming decoder (hefraw::decode_rows) */
+#pragma once
+#include <stddef.h>
+#include <stdint.h>
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+/* Receives rows [y, y + rows) of a width-pixel-wide 16-bit CFA frame, which
+ * are only valid during the call. Return nonzero to go on, 0 to stop. */
+typedef int (*hefraw_row_sink)(void* user, uint32_t y, uint32_t rows, uint32_t width, const uint16_t* data);
+
+/* Size of the frame in an HE* NEF file buffer. Returns 1 on success. */
+int hefraw_frame_size(const uint8_t* data, size_t size, uint32_t* width, uint32_t* height);
+
+/* Decode the HE* NEF in a file buffer, handing the frame to sink top to
+ * bottom, at most band_rows rows at a time. threads = 0 uses every core.
+ * Returns 1 on success, 0 if the file cannot be decoded or the sink
+ * stopped. */
+int hefraw_decode_rows(const uint8_t* data, size_t size, uint32_t band_rows, unsigned threads,
+                       hefraw_row_sink sink, void* user);
+
+#ifdef __cplusplus
+}
+#endif
@@ -0,0 +1,483 @@
+// Python bindings for libhefraw. Frames come back as hefraw.Frame objects
+// that own the decoded pixels and export them through the buffer protocol,
+// so numpy.asarray(frame) or memoryview(frame) views them without a copy.
+// Files are mapped and decoded with the GIL released.
+//
+// C++ exceptions must not unwind into CPython: every entry point runs its
+// body under try and raises what escapes as MemoryError for std::bad_alloc
+// or RuntimeError otherwise. Work done without the GIL goes through
+// without_gil(), which carries an exception back to the thread holding it.
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <structmember.h>
+#include <cerrno>
+#include <cstring>
+#include <exception>
+#include <new>
+#include <string>
+#include <vector>
+#include "hef_format.hpp"
+#include "hef_decode.hpp"
+#include "hef_mmap.hpp"
+#include "hef_parallel.hpp"
+
+namespace {
+
+// Python exception type for a C++ exception, with the message to raise
+PyObject* error_type(std::exception_ptr error, const char*& message)
+{
+    try {
+        std::rethrow_exception(error);
+    } catch (const std::bad_alloc&) {
+        message = "out of memory";
+        return PyExc_MemoryError;
+    } catch (const std::exception& e) {
+        // Kept alive by `error`
+        message = e.what();
+    } catch (...) {
+        message = "unknown C++ exception";
+    }
+    return PyExc_RuntimeError;
+}
+
+// Raise a caught C++ exception in Python; returns nullptr
+PyObject* set_error(std::exception_ptr error)
+{
+    const char* message;
+    PyObject* type = error_type(error, message);
+    PyErr_SetString(type, message);
+    return nullptr;
+}
+
+// Run fn with the GIL released, rethrowing anything it throws once the GIL
+// is held again
+template <typename Fn>
+void without_gil(Fn&& fn)
+{
+    std::exception_ptr error;
+    Py_BEGIN_ALLOW_THREADS
+    try {
+        fn();
+    } catch (...) {
+        error = std::current_exception();
+    }
+    Py_END_ALLOW_THREADS
+    if (error) std::rethrow_exception(error);
+}
+
+struct FrameObject {
+    PyObject_HEAD
+    std::vector<uint16_t>* pixels;
+    unsigned width, height, channels, cfa_pattern;
+    Py_ssize_t shape[3], strides[3];
+};
+
+void frame_dealloc(FrameObject* self)
+{
+    PyTypeObject* type = Py_TYPE(self);
+    delete self->pixels;
+    type->tp_free((PyObject*)self);
+    Py_DECREF(type);
+}
+
+int frame_getbuffer(FrameObject* self, Py_buffer* view, int flags)
+{
+    const int ndim = self->channels == 1 ? 2 : 3;
+    if ((flags & PyBUF_F_CONTIGUOUS) == PyBUF_F_CONTIGUOUS) {
+        PyErr_SetString(PyExc_BufferError, "hefraw.Frame is C-contiguous");
+        return -1;
+    }
+    view->obj = (PyObject*)self;
+    Py_INCREF(self);
+    view->buf = self->pixels->data();
+    view->len = (Py_ssize_t)(self->pixels->size() * sizeof(uint16_t));
+    view->readonly = 0;
+    view->itemsize = sizeof(uint16_t);
+    view->format = (flags & PyBUF_FORMAT) ? (char*)"H" : nullptr;
+    view->ndim = (flags & PyBUF_ND) ? ndim : 1;
+    view->shape = (flags & PyBUF_ND) ? self->shape : nullptr;
+    view->strides = (flags & PyBUF_STRIDES) == PyBUF_STRIDES ? self->strides : nullptr;
+    view->suboffsets = nullptr;
+    view->internal = nullptr;
+    return 0;
+}
+
+PyObject* frame_shape(FrameObject* self, void*)
+{
+    if (self->channels == 1) return Py_BuildValue("(II)", self->height, self->width);
+    return Py_BuildValue("(III)", self->height, self->width, self->channels);
+}
+
+PyObject* frame_repr(FrameObject* self)
+{
+    return PyUnicode_FromFormat("<hefraw.Frame %ux%u, %u channel%s>", self->width, self->height,
+                                self->channels, self->channels == 1 ? "" : "s");
+}
+
+PyMemberDef frame_members[] = {
+    {"width", T_UINT, offsetof(FrameObject, width), READONLY, "Width in pixels"},
+    {"height", T_UINT, offsetof(FrameObject, height), READONLY, "Height in pixels"},
+    {"channels", T_UINT, offsetof(FrameObject, channels), READONLY, "1 for CFA, 3 for binned RGB"},
+    {"cfa_pattern", T_UINT, offsetof(FrameObject, cfa_pattern), READONLY, "0=RGGB, 1=BGGR, 2=GRBG, 3=GBRG"},
+    {nullptr, 0, 0, 0, nullptr},
+};
+
+PyGetSetDef frame_getset[] = {
+    {"shape", (getter)frame_shape, nullptr, "(height, width) or (height, width, 3)", nullptr},
+    {nullptr, nullptr, nullptr, nullptr, nullptr},
+};
+
+PyType_Slot frame_slots[] = {
+    {Py_tp_dealloc, (void*)frame_dealloc},
+    {Py_tp_repr, (void*)frame_repr},
+    {Py_tp_doc, (void*)"A decoded frame: uint16 pixels of shape (height, width) or (height, width, 3)"},
+    {Py_tp_members, frame_members},
+    {Py_tp_getset, frame_getset},
+    {Py_bf_getbuffer, (void*)frame_getbuffer},
+    {0, nullptr},
+};
+
+PyType_Spec frame_spec = {"hefraw.Frame", sizeof(FrameObject), 0, Py_TPFLAGS_DEFAULT, frame_slots};
+
+PyTypeObject* frame_type;
+
+// Wrap a decoded frame, taking its pixels
+PyObject* make_frame(std::vector<uint16_t>& pixels, uint32_t width, uint32_t height, unsigned channels,
+                     unsigned cfa_pattern)
+{
+    std::vector<uint16_t>* owned = new (std::nothrow) std::vector<uint16_t>(std::move(pixels));
+    if (!owned) return PyErr_NoMemory();
+    FrameObject* self = PyObject_New(FrameObject, frame_type);
+    if (!self) {
+        delete owned;
+        return nullptr;
+    }
+    self->pixels = owned;
+    self->width = width;
+    self->height = height;
+    self->channels = channels;
+    self->cfa_pattern = cfa_pattern;
+    self->shape[0] = height;
+    self->shape[1] = width;
+    self->shape[2] = channels;
+    self->strides[2] = sizeof(uint16_t);
+    self->strides[1] = sizeof(uint16_t) * channels;
+    self->strides[0] = self->strides[1] * width;
+    return (PyObject*)self;
+}
+
+// Filesystem encoding of a str or os.PathLike path; false with a Python
+// exception set if it has none
+bool fs_path(PyObject* obj, std::string& path)
+{
+    PyObject* encoded = nullptr;
+    if (!PyUnicode_FSConverter(obj, &encoded)) return false;
+    try {
+        path = PyBytes_AS_STRING(encoded);
+    } catch (...) {
+        Py_DECREF(encoded);
+        throw;
+    }
+    Py_DECREF(encoded);
+    return true;
+}
+
+// The bytes of a file path or a bytes-like object, held while decoding
+struct Source {
+    hefraw::MappedFile file;
+    Py_buffer view{};
+    bool has_view = false;
+    const uint8_t* data = nullptr;
+    size_t size = 0;
+
+    ~Source()
+    {
+        if (has_view) PyBuffer_Release(&view);
+    }
+
+    // Takes a str or os.PathLike path, or anything with the buffer protocol
+    bool init(PyObject* obj)
+    {
+        if (PyObject_CheckBuffer(obj)) {
+            if (PyObject_GetBuffer(obj, &view, PyBUF_SIMPLE) < 0) return false;
+            has_view = true;
+            data = static_cast<const uint8_t*>(view.buf);
+            size = (size_t)view.len;
+            return true;
+        }
+        std::string path;
+        if (!fs_path(obj, path)) return false;
+        bool ok = false;
+        int error = 0;
+        without_gil([&] {
+            errno = 0;
+            ok = file.open(path);
+            error = errno;
+        });
+        if (!ok) {
+            errno = error;
+            if (errno) PyErr_SetFromErrnoWithFilename(PyExc_OSError, path.c_str());
+            else PyErr_Format(PyExc_ValueError, "%s is empty", path.c_str());
+            return false;
+        }
+        data = file.data();
+        size = file.size();
+        return true;
+    }
+};
+
+bool check_scale(unsigned scale)
+{
+    if (scale == 1 || scale == 2 || scale == 4 || scale == 8) return true;
+    PyErr_SetString(PyExc_ValueError, "scale must be 1, 2, 4 or 8");
+    return false;
+}
+
+PyObject* parse_hef_headers(PyObject* args)
+{
+    PyObject* obj;
+    if (!PyArg_ParseTuple(args, "O:parse_hef_headers", &obj)) return nullptr;
+    Source src;
+    if (!src.init(obj)) return nullptr;
+    hefraw::ImageHeader header;
+    bool ok = false;
+    without_gil([&] { ok = hefraw::parse_hef_headers(src.data, src.size, header); });
+    if (!ok) {
+        PyErr_SetString(PyExc_ValueError, "not an HE* NEF");
+        return nullptr;
+    }
+    PyObject* tiles = PyList_New((Py_ssize_t)header.tiles.size());
+    if (!tiles) return nullptr;
+    for (size_t i = 0; i < header.tiles.size(); i++) {
+        const hefraw::TileHeader& t = header.tiles[i];
+        PyObject* tile = Py_BuildValue("{sIsIsIsIsIsI}", "offset", t.offset, "length", t.length, "x", t.x,
+                                       "y", t.y, "width", (unsigned)t.width, "height", (unsigned)t.height);
+        if (!tile) {
+            Py_DECREF(tiles);
+            return nullptr;
+        }
+        PyList_SET_ITEM(tiles, (Py_ssize_t)i, tile);
+    }
+    return Py_BuildValue("{sIsIsIsIsN}", "width", header.width, "height", header.height,
+                         "bit_depth", (unsigned)header.bitDepth, "cfa_pattern", (unsigned)header.cfaPattern,
+                         "tiles", tiles);
+}
+
+PyObject* py_parse_hef_headers(PyObject*, PyObject* args)
+{
+    try {
+        return parse_hef_headers(args);
+    } catch (...) {
+        return set_error(std::current_exception());
+    }
+}
+
+PyObject* assemble_image_cfa16(PyObject* args, PyObject* kwargs)
+{
+    static const char* kwlist[] = {"source", "scale", "threads", nullptr};
+    PyObject* obj;
+    hefraw::DecodeOptions opts;
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|II:assemble_image_cfa16", (char**)kwlist, &obj,
+                                     &opts.scale, &opts.threads) ||
+        !check_scale(opts.scale)) {
+        return nullptr;
+    }
+    Source src;
+    if (!src.init(obj)) return nullptr;
+    hefraw::ImageHeader header;
+    std::vector<uint16_t> pixels;
+    bool ok = false;
+    without_gil([&] {
+        ok = hefraw::parse_hef_headers(src.data, src.size, header);
+        if (ok) {
+            opts.cfaPattern = header.cfaPattern;
+            ok = hefraw::assemble_image_cfa16(header, src.data, src.size, pixels, opts);
+        }
+    });
+    if (!ok) {
+        PyErr_SetString(PyExc_ValueError, "cannot decode HE* data");
+        return nullptr;
+    }
+    uint32_t width, height;
+    hefraw::scaled_size(header.width, header.height, opts.scale, width, height);
+    return make_frame(pixels, width, height, opts.scale == 1 ? 1 : 3, header.cfaPattern);
+}
+
+PyObject* py_assemble_image_cfa16(PyObject*, PyObject* args, PyObject* kwargs)
+{
+    try {
+        return assemble_image_cfa16(args, kwargs);
+    } catch (...) {
+        return set_error(std::current_exception());
+    }
+}
+
+// One file of a decode_many batch
+struct Decoded {
+    std::vector<uint16_t> pixels;
+    uint32_t width = 0, height = 0;
+    uint8_t cfa_pattern = 0;
+    bool opened = false, ok = false;
+    // errno from a failed open, 0 for an empty file
+    int open_error = 0;
+    std::exception_ptr error;
+};
+
+// New exception object for a file that was not decoded
+PyObject* decode_error(const Decoded& d, const std::string& path)
+{
+    PyObject* filename = PyUnicode_DecodeFSDefault(path.c_str());
+    if (!filename) return nullptr;
+    PyObject* exc;
+    if (d.error) {
+        const char* message;
+        PyObject* type = error_type(d.error, message);
+        exc = PyObject_CallFunction(type, "N", PyUnicode_FromFormat("%U: %s", filename, message));
+    } else if (!d.opened && d.open_error) {
+        exc = PyObject_CallFunction(PyExc_OSError, "isO", d.open_error, std::strerror(d.open_error), filename);
+    } else if (!d.opened) {
+        exc = PyObject_CallFunction(PyExc_ValueError, "N", PyUnicode_FromFormat("%U is empty", filename));
+    } else {
+        exc = PyObject_CallFunction(PyExc_ValueError, "N", PyUnicode_FromFormat("cannot decode %U", filename));
+    }
+    Py_DECREF(filename);
+    return exc;
+}
+
+PyObject* decode_many(PyObject* args, PyObject* kwargs)
+{
+    static const char* kwlist[] = {"paths", "threads", "scale", "errors", nullptr};
+    PyObject* seq;
+    unsigned threads = 0, scale = 1;
+    const char* errors = "raise";
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|IIs:decode_many", (char**)kwlist, &seq, &threads, &scale,
+                                     &errors) ||
+        !check_scale(scale)) {
+        return nullptr;
+    }
+    const bool return_errors = std::strcmp(errors, "return") == 0;
+    if (!return_errors && std::strcmp(errors, "raise") != 0) {
+        PyErr_SetString(PyExc_ValueError, "errors must be \"raise\" or \"return\"");
+        return nullptr;
+    }
+    PyObject* fast = PySequence_Fast(seq, "paths must be a sequence");
+    if (!fast) return nullptr;
+    std::vector<std::string> paths;
+    try {
+        paths.resize((size_t)PySequence_Fast_GET_SIZE(fast));
+        for (size_t i = 0; i < paths.size(); i++) {
+            if (!fs_path(PySequence_Fast_GET_ITEM(fast, (Py_ssize_t)i), paths[i])) {
+                Py_DECREF(fast);
+                return nullptr;
+            }
+        }
+    } catch (...) {
+        Py_DECREF(fast);
+        throw;
+    }
+    Py_DECREF(fast);
+
+    // Files are decoded side by side, each on one thread; a failure, even
+    // an exception, only affects its own file
+    std::vector<Decoded> results(paths.size());
+    without_gil([&] {
+        hefraw::parallel_for(paths.size(), threads, [&](size_t i) {
+            Decoded& d = results[i];
+            try {
+                hefraw::MappedFile file;
+                errno = 0;
+                d.opened = file.open(paths[i]);
+                if (!d.opened) {
+                    d.open_error = errno;
+                    return;
+                }
+                hefraw::ImageHeader header;
+                if (!hefraw::parse_hef_headers(file.data(), file.size(), header)) return;
+                hefraw::DecodeOptions opts;
+                opts.threads = 1;
+                opts.scale = scale;
+                opts.cfaPattern = header.cfaPattern;
+                if (!hefraw::assemble_image_cfa16(header, file.data(), file.size(), d.pixels, opts)) return;
+                hefraw::scaled_size(header.width, header.height, scale, d.width, d.height);
+                d.cfa_pattern = header.cfaPattern;
+                d.ok = true;
+            } catch (...) {
+                d.pixels = std::vector<uint16_t>();
+                d.error = std::current_exception();
+            }
+        });
+    });
+
+    PyObject* frames = PyList_New((Py_ssize_t)paths.size());
+    if (!frames) return nullptr;
+    for (size_t i = 0; i < paths.size(); i++) {
+        Decoded& d = results[i];
+        PyObject* item;
+        if (d.ok) {
+            item = make_frame(d.pixels, d.width, d.height, scale == 1 ? 1 : 3, d.cfa_pattern);
+        } else {
+            item = decode_error(d, paths[i]);
+            if (item && !return_errors) {
+                PyErr_SetObject((PyObject*)Py_TYPE(item), item);
+                Py_CLEAR(item);
+            }
+        }
+        if (!item) {
+            Py_DECREF(frames);
+            return nullptr;
+        }
+        PyList_SET_ITEM(frames, (Py_ssize_t)i, item);
+    }
+    return frames;
+}
+
+PyObject* py_decode_many(PyObject*, PyObject* args, PyObject* kwargs)
+{
+    try {
+        return decode_many(args, kwargs);
+    } catch (...) {
+        return set_error(std::current_exception());
+    }
+}
+
+PyMethodDef methods[] = {
+    {"parse_hef_headers", py_parse_hef_headers, METH_VARARGS,
+     "parse_hef_headers(source) -> dict\n\n"
+     "Frame size, bit depth, CFA pattern and tiles of an HE* NEF. source is\n"
+     "a path or the file's bytes."},
+    {"assemble_image_cfa16", (PyCFunction)(void (*)(void))py_assemble_image_cfa16, METH_VARARGS | METH_KEYWORDS,
+     "assemble_image_cfa16(source, scale=1, threads=0) -> Frame\n\n"
+     "Decode an HE* NEF, given as a path or the file's bytes, into a 16-bit\n"
+     "CFA frame, or binned RGB at scale 2, 4 or 8. threads=0 uses every core."},
+    {"decode_many", (PyCFunction)(void (*)(void))py_decode_many, METH_VARARGS | METH_KEYWORDS,
+     "decode_many(paths, threads=0, scale=1, errors=\"raise\") -> list of Frame\n\n"
+     "Decode several files, up to `threads` at once (0 = one per core).\n"
+     "Every file is attempted; then the first failure in path order is\n"
+     "raised, or with errors=\"return\" each failed file's exception\n"
+     "object takes its place in the list."},
+    {nullptr, nullptr, 0, nullptr},
+};
+
+PyModuleDef module = {
+    PyModuleDef_HEAD_INIT, "hefraw",
+    "Nikon HE* decoding. Frames support the buffer protocol, so\n"
+    "numpy.asarray(frame) is a uint16 array sharing the decoded pixels.",
+    -1, methods, nullptr, nullptr, nullptr, nullptr,
+};
+
+} // namespace
+
+PyMODINIT_FUNC PyInit_hefraw(void)
+{
+    frame_type = (PyTypeObject*)PyType_FromSpec(&frame_spec);
+    if (!frame_type) return nullptr;
+    PyObject* m = PyModule_Create(&module);
+    if (!m) return nullptr;
+    Py_INCREF(frame_type);
+    if (PyModule_AddObject(m, "Frame", (PyObject*)frame_type) < 0) {
+        Py_DECREF(frame_type);
+        Py_DECREF(m);
+        return nullptr;
+    }
+    return m;
+}
@@ -1,11 +1,71 @@
 #include "../include/hef_bitstream.hpp"
+#include <cstring>
 
 using namespace hefraw;
 
+static inline uint64_t load_le64(const uint8_t* p) noexcept {
+    uint64_t v;
+    std::memcpy(&v, p, 8);
+#if defined(__BYTE_ORDER__) && __BYTE_ORDER__ == __ORDER_BIG_ENDIAN__
+    v = __builtin_bswap64(v);
+#endif
+    return v;
+}
+
+bool VlcTable::build(const std::vector<uint8_t>& lengths) {
+    max_ = 0;
+    for (uint8_t len : lengths) max_ = len > max_ ? len : max_;
+    if (max_ > kMaxLength || lengths.size() > 0x10000) return false;
+    count_.assign(max_ + 1, 0);
+    for (uint8_t len : lengths) if (len) count_[len]++;
+
+    // Reject over-subscribed lengths; incomplete codes are fine
+    int64_t left = 1;
+    for (unsigned len = 1; len <= max_; len++) {
+        left = 2 * left - count_[len];
+        if (left < 0) return false;
+    }
+
+    // Canonical codes: shorter first, then by symbol
+    std::vector<uint32_t> next(max_ + 2, 0);
+    std::vector<uint32_t> offset(max_ + 2, 0);
+    for (unsigned len = 1, code = 0; len <= max_; len++) {
+        code = (code + count_[len - 1]) << 1;
+        next[len] = code;
+        offset[len + 1] = offset[len] + count_[len];
+    }
+    sorted_.assign(offset[max_ + 1], 0);
+    lut_.assign(1u << kLookupBits, 0);
+    for (size_t sym = 0; sym < lengths.size(); sym++) {
+        const unsigned len = lengths[sym];
+        if (!len) continue;
+        sorted_[offset[len]++] = (uint16_t)sym;
+        const uint32_t code = next[len]++;
+        if (len > kLookupBits) continue;
+        // The stream holds the code's first bit lowest, so reverse it and
+        // fill every entry whose low bits match
+        uint32_t rev = 0;
+        for (unsigned b = 0; b < len; b++) rev |= ((code >> b) & 1u) << (len - 1 - b);
+        for (uint32_t i = rev; i < lut_.size(); i += 1u << len) lut_[i] = (uint32_t)sym << 8 | len;
+    }
+    return true;
+}
+
 BitReader::BitReader(const uint8_t* data, size_t size) noexcept
     : ptr_(data), end_(data + size), cache_(0), bits_(0) {}
 
 void BitReader::refill() noexcept {
+    if (bits_ > 56) return;
+    if (end_ - ptr_ >= 8) {
+        // Whole-word refill: the partial byte that lands above the new bit
+        // count is the stream's next data, so OR-ing it in again later is
+        // harmless
+        cache_ |= load_le64(ptr_) << bits_;
+        const unsigned bytes = (63 - bits_) >> 3;
+        ptr_ += bytes;
+        bits_ += bytes * 8;
+        return;
+    }
     while (bits_ <= 56 && ptr_ < end_) {
         cache_ |= (uint64_t)(*ptr_++) << bits_;
         bits_ += 8;
@@ -16,6 +76,7 @@ uint32_t BitReader::peekBits(unsigned n) const noexcept {
     if (n == 0) return 0;
     if (n > 32) n = 32;
     uint64_t mask = (n == 64) ? ~0ull : ((1ull << n) - 1ull);
+    if (n > bits_) mask = bits_ ? ((1ull << bits_) - 1ull) : 0;
     return (uint32_t)(cache_ & mask);
 }
 
@@ -23,9 +84,16 @@ uint32_t BitReader::readBits(unsigned n) noexcept {
     if (n == 0) return 0;
     if (n > 32) n = 32;
     if (bits_ < n) refill();
+    if (bits_ < n) {
+        // Out of data: return what is left, zero-extended
+        uint32_t v = (uint32_t)(cache_ & (bits_ ? (1ull << bits_) - 1ull : 0));
+        cache_ = 0;
+        bits_ = 0;
+        return v;
+    }
     uint32_t v = (uint32_t)(cache_ & ((1ull << n) - 1ull));
     cache_ >>= n;
-    bits_ = (unsigned)(bits_ >= n ? bits_ - n : 0);
+    bits_ -= n;
     return v;
 }
 
@@ -36,4 +104,52 @@ void BitReader::alignToByte() noexcept {
 
 bool BitReader::exhausted() const noexcept { return ptr_ >= end_ && bits_ == 0; }
 
+int BitReader::decodeSlow(const VlcTable& table) noexcept {
+    // Canonical walk, one bit at a time: `first` is the first code of the
+    // current length and `index` its position in the sorted symbols
+    uint32_t code = 0, first = 0, index = 0;
+    for (unsigned len = 1; len <= table.max_ && len <= bits_; len++) {
+        code |= (uint32_t)(cache_ >> (len - 1)) & 1u;
+        const uint32_t count = table.count_[len];
+        if (code - first < count) {
+            cache_ >>= len;
+            bits_ -= len;
+            return table.sorted_[index + code - first];
+        }
+        index += count;
+        first = (first + count) << 1;
+        code <<= 1;
+    }
+    return -1;
+}
 
+size_t BitReader::decodeMany(const VlcTable& table, uint16_t* out, size_t count) noexcept {
+    const uint32_t* lut = table.lut_.data();
+    const uint64_t mask = (1u << VlcTable::kLookupBits) - 1;
+    size_t n = 0;
+    while (n < count) {
+        refill();
+        if (bits_ < table.max_) break;
+        // Every code fits in what is cached, so decode until it runs low
+        while (n < count && bits_ >= table.max_) {
+            const uint32_t e = lut[cache_ & mask];
+            const unsigned len = e & 0xFF;
+            if (!len) {
+                const int sym = decodeSlow(table);
+                if (sym < 0) return n;
+                out[n++] = (uint16_t)sym;
+                continue;
+            }
+            cache_ >>= len;
+            bits_ -= len;
+            out[n++] = (uint16_t)(e >> 8);
+        }
+    }
+    // Tail: fewer bits left than the longest code
+    while (n < count) {
+        const int sym = decode(table);
+        if (sym < 0) break;
+        out[n++] = (uint16_t)sym;
+    }
+    return n;
+}
@@ -1,20 +1,620 @@
 #include "../include/hef_decode.hpp"
 #include "../include/hef_bitstream.hpp"
+#include "../include/hef_parallel.hpp"
+#include "../include/hef_stream.h"
 #include <cstring>
 #include <algorithm>
+#include <condition_variable>
+#include <deque>
+#include <exception>
+#include <mutex>
+#include <thread>
 
 using namespace hefraw;
 
+namespace {
+
+// Columns [begin, end) of a tile row
+struct Span {
+    uint32_t begin, end;
+};
+
+// Part of the frame, in pixels
+struct Rect {
+    uint32_t x, y, width, height;
+};
+
+// Which parts of the frame earlier tiles have written.
+//
+// A tile fills its rectangle in raster order, so what it covers is a prefix:
+// some full rows and part of the next. Rows of a later tile are checked
+// against the prefixes of the earlier tiles that overlap it, and pixels
+// outside the frame or the window being decoded count as covered so that
+// they are never written. Tiles closer than `grain` pixels, sharing a
+// grain x grain block, are ordered as if they overlapped.
+class Coverage {
+public:
+    Coverage(const ImageHeader& ih, Rect window, uint32_t grain = 1)
+        : ih_(ih), written_(ih.tiles.size(), 0), earlier_(ih.tiles.size())
+    {
+        const uint64_t right = std::min<uint64_t>(ih.width, (uint64_t)window.x + window.width);
+        const uint64_t bottom = std::min<uint64_t>(ih.height, (uint64_t)window.y + window.height);
+        window_.x = std::min(window.x, ih.width);
+        window_.y = std::min(window.y, ih.height);
+        window_.width = (uint32_t)(right - std::min<uint64_t>(right, window_.x));
+        window_.height = (uint32_t)(bottom - std::min<uint64_t>(bottom, window_.y));
+        for (size_t t = 0; t < ih.tiles.size(); t++) {
+            for (size_t e = 0; e < t; e++) {
+                if (overlaps(ih.tiles[e], ih.tiles[t], grain)) earlier_[t].push_back(e);
+            }
+        }
+    }
+
+    // Pixels of tile t, in raster order, that it wrote into the frame
+    void set_written(size_t t, size_t pixels) { written_[t] = pixels; }
+
+    // Tiles ordered into waves: no two tiles in a wave overlap, and every
+    // tile comes after the earlier tiles it overlaps
+    std::vector<std::vector<size_t>> waves() const
+    {
+        std::vector<size_t> level(ih_.tiles.size(), 0);
+        std::vector<std::vector<size_t>> out;
+        for (size_t t = 0; t < ih_.tiles.size(); t++) {
+            for (size_t e : earlier_[t]) level[t] = std::max(level[t], level[e] + 1);
+            if (level[t] >= out.size()) out.resize(level[t] + 1);
+            out[level[t]].push_back(t);
+        }
+        return out;
+    }
+
+    // Covered columns of row y of tile t, sorted and merged into `spans`
+    void row(size_t t, uint32_t y, std::vector<Span>& spans) const
+    {
+        const TileHeader& th = ih_.tiles[t];
+        spans.clear();
+        const uint64_t fy = (uint64_t)th.y + y;
+        if (fy < window_.y || fy >= (uint64_t)window_.y + window_.height) {
+            spans.push_back({0, th.width});
+            return;
+        }
+        clip(th, 0, window_.x, spans);
+        clip(th, (uint64_t)window_.x + window_.width, UINT64_MAX, spans);
+        for (size_t e : earlier_[t]) {
+            const TileHeader& eh = ih_.tiles[e];
+            if (fy < eh.y || fy >= (uint64_t)eh.y + eh.height) continue;
+            const size_t ey = fy - eh.y, full = written_[e] / eh.width, part = written_[e] % eh.width;
+            const size_t end = ey < full ? eh.width : ey == full ? part : 0;
+            if (end) clip(th, eh.x, (uint64_t)eh.x + end, spans);
+        }
+        if (spans.size() < 2) return;
+        std::sort(spans.begin(), spans.end(), [](Span a, Span b) { return a.begin < b.begin; });
+        size_t n = 0;
+        for (size_t i = 1; i < spans.size(); i++) {
+            if (spans[i].begin <= spans[n].end) spans[n].end = std::max(spans[n].end, spans[i].end);
+            else spans[++n] = spans[i];
+        }
+        spans.resize(n + 1);
+    }
+
+    // Whether nothing of tile t is left for it to write
+    bool full(size_t t) const
+    {
+        const TileHeader& th = ih_.tiles[t];
+        if (!overlaps(th, Rect{window_.x, window_.y, window_.width, window_.height})) return true;
+        std::vector<Span> spans;
+        for (uint32_t y = 0; y < th.height; y++) {
+            row(t, y, spans);
+            if (spans.size() != 1 || spans[0].begin != 0 || spans[0].end < th.width) return false;
+        }
+        return true;
+    }
+
+private:
+    // Frame columns [begin, end) as columns of tile th, if any
+    static void clip(const TileHeader& th, uint64_t begin, uint64_t end, std::vector<Span>& spans)
+    {
+        begin = std::max<uint64_t>(begin, th.x);
+        end = std::min<uint64_t>(end, (uint64_t)th.x + th.width);
+        if (begin < end) spans.push_back({(uint32_t)(begin - th.x), (uint32_t)(end - th.x)});
+    }
+
+    static bool overlaps(const TileHeader& a, const TileHeader& b, uint32_t grain)
+    {
+        auto lo = [&](uint64_t v) { return v / grain * grain; };
+        auto hi = [&](uint64_t v) { return (v + grain - 1) / grain * grain; };
+        return a.width && a.height && b.width && b.height &&
+               lo(a.x) < hi((uint64_t)b.x + b.width) && lo(b.x) < hi((uint64_t)a.x + a.width) &&
+               lo(a.y) < hi((uint64_t)b.y + b.height) && lo(b.y) < hi((uint64_t)a.y + a.height);
+    }
+
+    static bool overlaps(const TileHeader& a, Rect r)
+    {
+        return a.width && a.height && r.width && r.height &&
+               a.x < (uint64_t)r.x + r.width && r.x < (uint64_t)a.x + a.width &&
+               a.y < (uint64_t)r.y + r.height && r.y < (uint64_t)a.y + a.height;
+    }
+
+    const ImageHeader& ih_;
+    Rect window_;
+    std::vector<size_t> written_;
+    std::vector<std::vector<size_t>> earlier_;
+};
+
+// Bins CFA pixels into an RGB frame `scale` times smaller each way.
+//
+// A tile sums one row of bins at a time into its own 32-bit accumulator and
+// adds that into the frame once the bin row is done, so samples of a bin
+// may come from several tiles in any order. The frame holds per-channel
+// sums until finish() turns them into means. Where a bin holds more than
+// four samples of a channel, sums are shifted down to fit 16 bits, which
+// can cost the mean its lowest bit. Pixels past the last whole bin are
+// dropped.
+class Binner {
+public:
+    Binner(uint16_t* rgb, uint32_t width, uint32_t height, unsigned scale, uint8_t cfa_pattern)
+        : rgb_(rgb)
+    {
+        // Offset of the red site within each quad
+        static const unsigned kRedX[4] = {0, 1, 1, 0}, kRedY[4] = {0, 1, 0, 1};
+        dx_ = kRedX[cfa_pattern & 3];
+        dy_ = kRedY[cfa_pattern & 3];
+        while ((1u << shift_) < scale) shift_++;
+        scaled_size(width, height, scale, out_width_, out_height_);
+        // Red and blue fill a quarter of a bin, green half
+        const unsigned quarter = shift_ * 2 - 2;
+        const unsigned log_count[3] = {quarter, quarter + 1, quarter};
+        for (int c = 0; c < 3; c++) {
+            drop_[c] = log_count[c] > 2 ? log_count[c] - 2 : 0;
+            log_count_[c] = log_count[c];
+        }
+    }
+
+    // Size of a tile's accumulator: one row of bins
+    size_t row_size() const { return (size_t)out_width_ * 3; }
+
+    uint32_t scale() const { return 1u << shift_; }
+
+    // Whether frame row y is the last one of its bin row
+    bool last_row(uint32_t y) const { return ((y + 1) & ((1u << shift_) - 1)) == 0; }
+
+    // Add frame columns [begin, end) of frame row y to the accumulator, where
+    // row[0] is the pixel at column x0
+    void add(uint32_t* acc, uint32_t y, const uint16_t* row, uint32_t x0, uint32_t begin, uint32_t end) const
+    {
+        if ((y >> shift_) >= out_height_) return;
+        end = std::min(end, out_width_ << shift_);
+        // Channel of even and odd columns: red rows hold red and green,
+        // blue rows green and blue
+        const unsigned first = ((y + dy_) & 1) ? 1 : 0;
+        const unsigned ch[2] = {first + (dx_ & 1), first + 1 - (dx_ & 1)};
+        auto single = [&](uint32_t x) { acc[(x >> shift_) * 3 + ch[x & 1]] += row[x - x0] & 0x3FFF; };
+        // Whole bins are summed in registers, even and odd columns apart
+        const uint32_t scale = 1u << shift_;
+        uint32_t x = begin;
+        for (; x < end && (x & (scale - 1)); x++) single(x);
+        for (; x + scale <= end; x += scale) {
+            uint32_t even = 0, odd = 0;
+            const uint16_t* r = row + (x - x0);
+            for (uint32_t k = 0; k < scale; k += 2) {
+                even += r[k] & 0x3FFF;
+                odd += r[k + 1] & 0x3FFF;
+            }
+            uint32_t* a = acc + (x >> shift_) * 3;
+            a[ch[0]] += even;
+            a[ch[1]] += odd;
+        }
+        for (; x < end; x++) single(x);
+    }
+
+    // Add the bins holding frame columns [begin, end) from the accumulator
+    // into the bin row holding frame row y, and clear them. Other bins of
+    // the row may belong to tiles decoding at the same time.
+    void flush(uint32_t* acc, uint32_t y, uint32_t begin, uint32_t end)
+    {
+        const size_t first = (size_t)(begin >> shift_) * 3;
+        const size_t last = std::min<size_t>(out_width_, ((uint64_t)end + (1u << shift_) - 1) >> shift_) * 3;
+        if (first >= last) return;
+        if ((y >> shift_) < out_height_) {
+            uint16_t* out = rgb_ + (size_t)(y >> shift_) * row_size();
+            for (size_t i = first; i < last; i += 3) {
+                for (int c = 0; c < 3; c++) out[i + c] += (uint16_t)(acc[i + c] >> drop_[c]);
+            }
+        }
+        std::fill(acc + first, acc + last, 0);
+    }
+
+    // Turn the sums into means
+    void finish(unsigned threads)
+    {
+        const size_t rows = out_height_, n = row_size();
+        parallel_for((rows + 63) / 64, threads, [&](size_t band) {
+            const size_t end = std::min<size_t>(rows, (band + 1) * 64) * n;
+            for (size_t i = band * 64 * n; i < end; i += 3) {
+                for (int c = 0; c < 3; c++) {
+                    const uint32_t sum = (uint32_t)rgb_[i + c] << drop_[c];
+                    rgb_[i + c] = (uint16_t)((sum + (1u << log_count_[c] >> 1)) >> log_count_[c]);
+                }
+            }
+        });
+    }
+
+    void clear() { std::fill_n(rgb_, (size_t)out_width_ * out_height_ * 3, 0); }
+
+private:
+    uint16_t* rgb_;
+    uint32_t out_width_ = 0, out_height_ = 0;
+    unsigned shift_ = 0, dx_ = 0, dy_ = 0;
+    unsigned drop_[3], log_count_[3]; // bins hold 1 << log_count_ samples
+};
+
+// Hands bands of decoded rows to a RowSink. Single-threaded, the sink is
+// called as each band is emitted; otherwise run() decodes on a worker that
+// queues copies of up to kQueued bands while the calling thread feeds them
+// to the sink, so decoding overlaps with whatever the sink does.
+class Emitter {
+public:
+    Emitter(uint32_t width, const RowSink& sink, bool threaded)
+        : width_(width), sink_(sink), threaded_(threaded) {}
+
+    // Pass on rows [y, y + rows); false once the sink has asked to stop
+    bool emit(uint32_t y, uint32_t rows, const uint16_t* data)
+    {
+        if (!threaded_) {
+            if (!stopped_ && !sink_(y, rows, data)) stopped_ = true;
+            return !stopped_;
+        }
+        std::unique_lock<std::mutex> lock(mutex_);
+        space_.wait(lock, [&] { return queue_.size() < kQueued || stopped_; });
+        if (stopped_) return false;
+        std::vector<uint16_t> band;
+        if (!free_.empty()) {
+            band = std::move(free_.back());
+            free_.pop_back();
+        }
+        band.assign(data, data + (size_t)rows * width_);
+        queue_.push_back({y, rows, std::move(band)});
+        ready_.notify_one();
+        return true;
+    }
+
+    // Zero rows [y, end), a band at a time
+    bool zeros(uint32_t y, uint32_t end, uint32_t band_rows)
+    {
+        if (y >= end) return !stopped();
+        zero_.resize((size_t)std::min(band_rows, end - y) * width_);
+        for (; y < end; y += band_rows) {
+            if (!emit(y, std::min(band_rows, end - y), zero_.data())) return false;
+        }
+        return true;
+    }
+
+    bool stopped()
+    {
+        std::lock_guard<std::mutex> lock(mutex_);
+        return stopped_;
+    }
+
+    // Run decode() and deliver what it emits. Returns its result, or false
+    // if the sink stopped; an exception from the sink or from decode() is
+    // rethrown here once the worker has finished.
+    bool run(const std::function<bool()>& decode)
+    {
+        if (!threaded_) return decode() && !stopped_;
+        bool result = false, done = false;
+        std::exception_ptr failure;
+        std::thread worker([&] {
+            bool ok = false;
+            try {
+                ok = decode();
+            } catch (...) {
+                failure = std::current_exception();
+            }
+            std::lock_guard<std::mutex> lock(mutex_);
+            result = ok;
+            done = true;
+            ready_.notify_one();
+        });
+        std::exception_ptr error;
+        for (;;) {
+            Band band;
+            {
+                std::unique_lock<std::mutex> lock(mutex_);
+                ready_.wait(lock, [&] { return !queue_.empty() || done; });
+                if (queue_.empty()) break;
+                band = std::move(queue_.front());
+                queue_.pop_front();
+                space_.notify_one();
+                if (stopped_) continue;
+            }
+            bool more = false;
+            try {
+                more = sink_(band.y, band.rows, band.data.data());
+            } catch (...) {
+                error = std::current_exception();
+            }
+            std::lock_guard<std::mutex> lock(mutex_);
+            if (!more) {
+                stopped_ = true;
+                space_.notify_all();
+            }
+            free_.push_back(std::move(band.data));
+        }
+        worker.join();
+        if (error) std::rethrow_exception(error);
+        if (failure) std::rethrow_exception(failure);
+        return result && !stopped_;
+    }
+
+private:
+    static const size_t kQueued = 2;
+
+    struct Band {
+        uint32_t y = 0, rows = 0;
+        std::vector<uint16_t> data;
+    };
+
+    const uint32_t width_;
+    const RowSink& sink_;
+    const bool threaded_;
+    bool stopped_ = false;
+    std::mutex mutex_;
+    std::condition_variable ready_, space_;
+    std::deque<Band> queue_;
+    std::vector<std::vector<uint16_t>> free_;
+    std::vector<uint16_t> zero_;
+};
+
+// Collects the frame rows [y0, y1) that one tile decodes and emits them in
+// bands of band_rows as they complete. Nothing goes out until the tile has
+// written more than an eighth of its pixels, past which decode_ticoraw
+// cannot fail, so a failed tile never emits rows that assemble would have
+// taken back; until then up to that many rows are held.
+class RowStream {
+public:
+    RowStream(uint32_t width, uint32_t y0, uint32_t y1, uint32_t band_rows, const TileHeader& tile, Emitter& out)
+        : width_(width), first_(y0), complete_(y0), end_(y1), band_rows_(band_rows),
+          threshold_((size_t)tile.width * tile.height / 8), out_(out)
+    {
+        const uint64_t held = threshold_ / std::max<uint32_t>(1, tile.width) + 1;
+        rows_.assign((size_t)std::min<uint64_t>(y1 - y0, held + band_rows) * width, 0);
+    }
+
+    // Frame row y, which must not have been emitted yet
+    uint16_t* row(uint32_t y) { return rows_.data() + offset_ + (size_t)(y - first_) * width_; }
+
+    // Frame row y is complete, with `written` pixels of the tile done
+    void done(uint32_t y, size_t written)
+    {
+        complete_ = std::min(y + 1, end_);
+        if (written > threshold_) released_ = true;
+        if (!released_ || complete_ - first_ < band_rows_) return;
+        while (complete_ - first_ >= band_rows_) emit(band_rows_);
+        // Move the partial band left over to the front
+        const size_t left = (size_t)(complete_ - first_) * width_;
+        std::copy(rows_.data() + offset_, rows_.data() + offset_ + left, rows_.data());
+        std::fill(rows_.begin() + left, rows_.begin() + std::min(rows_.size(), offset_ + left), 0);
+        offset_ = 0;
+    }
+
+    // Emit the remaining rows, or zeros in their place if the tile failed.
+    // Rows past the buffer were never reached and are zero too.
+    bool finish(bool decoded)
+    {
+        if (!decoded) std::fill(rows_.begin() + offset_, rows_.end(), 0);
+        const uint32_t held = first_ + (uint32_t)((rows_.size() - offset_) / width_);
+        while (first_ < std::min(end_, held) && !stopped_) emit(std::min(band_rows_, std::min(end_, held) - first_));
+        if (!stopped_ && !out_.zeros(first_, end_, band_rows_)) stopped_ = true;
+        first_ = end_;
+        return !stopped_;
+    }
+
+private:
+    void emit(uint32_t rows)
+    {
+        if (!stopped_ && !out_.emit(first_, rows, rows_.data() + offset_)) stopped_ = true;
+        first_ += rows;
+        offset_ += (size_t)rows * width_;
+    }
+
+    const uint32_t width_;
+    uint32_t first_, complete_;      // first row not yet emitted, first not complete
+    const uint32_t end_, band_rows_;
+    const size_t threshold_;
+    size_t offset_ = 0;              // where row first_ sits in rows_
+    bool released_ = false, stopped_ = false;
+    Emitter& out_;
+    std::vector<uint16_t> rows_;
+};
+
+// Writes a tile's pixels in raster order straight into the output frame, or
+// into a Binner or a RowStream. The tile's top-left pixel lands at (x, y) of the frame
+// buffer, which may lie outside it if those pixels count as covered.
+//
+// Rows that no earlier tile covers are written in place. A row that is
+// partly covered is decoded into a scratch row and only its uncovered
+// columns copied out; a fully covered row is decoded and dropped. Binned
+// and streamed rows always go through the scratch row.
+class RowWriter {
+public:
+    RowWriter(uint16_t* frame, size_t stride, int64_t x, int64_t y, uint32_t width, uint32_t height,
+              const Coverage* coverage = nullptr, size_t tile = 0, Binner* bin = nullptr,
+              RowStream* stream = nullptr)
+        : frame_(frame), stride_(stride), x_(x), top_(y), width_(width), height_(height),
+          coverage_(coverage), tile_(tile), bin_(bin), stream_(stream), scratch_(width)
+    {
+        if (bin_) acc_.assign(bin_->row_size(), 0);
+        start_row();
+    }
+
+    void put(uint16_t v)
+    {
+        row_[col_] = v;
+        if (++col_ == width_) next_row();
+    }
+
+    void fill(uint16_t v, size_t n)
+    {
+        while (n && y_ < height_) {
+            const size_t k = std::min<size_t>(n, width_ - col_);
+            std::fill_n(row_ + col_, k, v);
+            col_ += k;
+            n -= k;
+            if (col_ == width_) next_row();
+        }
+    }
+
+    // Pixels written so far, in raster order
+    size_t written() const { return (size_t)y_ * width_ + col_; }
+
+    // Copy out a staged partial last row
+    void finish()
+    {
+        flush(col_);
+        if (pending_) bin_->flush(acc_.data(), acc_row_, x_, x_ + width_);
+    }
+
+    // Undo every pixel this tile wrote, restoring the uncovered zeros. Binned
+    // pixels cannot be taken back.
+    void rollback()
+    {
+        for (uint32_t y = 0; y <= y_ && y < height_; y++) {
+            const uint32_t end = y < y_ ? width_ : col_;
+            if (coverage_) coverage_->row(tile_, y, spans_);
+            else spans_.clear();
+            gaps(end, [&](uint32_t a, uint32_t b) { std::fill(at(y, a), at(y, b), 0); });
+        }
+    }
+
+private:
+    void start_row()
+    {
+        col_ = 0;
+        staged_ = false;
+        if (y_ >= height_) {
+            row_ = scratch_.data();
+            return;
+        }
+        spans_.clear();
+        if (coverage_) coverage_->row(tile_, y_, spans_);
+        if (bin_ || stream_ || !spans_.empty()) {
+            row_ = scratch_.data();
+            staged_ = true;
+        } else {
+            row_ = at(y_, 0);
+        }
+    }
+
+    void next_row()
+    {
+        flush(width_);
+        y_++;
+        start_row();
+    }
+
+    // Calls fn(begin, end) for each run of columns [0, end) between the
+    // covered spans of the current row
+    template <class Fn>
+    void gaps(uint32_t end, Fn fn) const
+    {
+        uint32_t x = 0;
+        for (const Span& s : spans_) {
+            if (s.begin > x) fn(x, std::min(s.begin, end));
+            x = std::max(x, s.end);
+            if (x >= end) return;
+        }
+        if (x < end) fn(x, end);
+    }
+
+    // Copy columns [0, end) of a staged row into the gaps between covered spans
+    void flush(uint32_t end)
+    {
+        if (!staged_ || !end) return;
+        if (bin_) {
+            const uint32_t y = (uint32_t)(top_ + y_), x = (uint32_t)x_;
+            gaps(end, [&](uint32_t a, uint32_t b) { bin_->add(acc_.data(), y, row_, x, x + a, x + b); });
+            pending_ = !(end == width_ && bin_->last_row(y));
+            acc_row_ = y;
+            if (!pending_) bin_->flush(acc_.data(), y, x, x + width_);
+            return;
+        }
+        if (stream_) {
+            const uint32_t y = (uint32_t)(top_ + y_);
+            gaps(end, [&](uint32_t a, uint32_t b) { std::copy(row_ + a, row_ + b, stream_->row(y) + x_ + a); });
+            if (end == width_) stream_->done(y, written());
+            return;
+        }
+        gaps(end, [&](uint32_t a, uint32_t b) { std::copy(row_ + a, row_ + b, at(y_, a)); });
+    }
+
+    // Frame buffer pixel for column x of tile row y; only for pixels that
+    // are not covered, which lie inside the buffer
+    uint16_t* at(uint32_t y, uint32_t x) const
+    {
+        return frame_ + ((top_ + y) * (int64_t)stride_ + x_ + x);
+    }
+
+    uint16_t* frame_;
+    size_t stride_;
+    int64_t x_, top_;
+    uint32_t width_, height_;
+    const Coverage* coverage_;
+    size_t tile_;
+    Binner* bin_;
+    RowStream* stream_;
+    std::vector<uint32_t> acc_;
+    std::vector<uint16_t> scratch_;
+    std::vector<Span> spans_;
+    uint16_t* row_ = nullptr;
+    uint32_t y_ = 0, col_ = 0;
+    bool staged_ = false;
+    uint32_t acc_row_ = 0;  // frame row last added to the accumulator
+    bool pending_ = false;  // accumulator holds sums not yet flushed
+};
+
+// Per-byte lookups for the TicoRAW delta path
+struct ByteTables {
+    int16_t delta[256];   // signed delta a byte encodes
+    uint16_t direct[256]; // directly scaled 14-bit value
+};
+
+const ByteTables& byte_tables()
+{
+    static const ByteTables tables = [] {
+        ByteTables t{};
+        for (int b = 0; b < 256; b++) {
+            t.delta[b] = (int16_t)(b < 128 ? b : b - 256);
+            t.direct[b] = ((b << 6) | (b >> 2)) & 0x3FFF;
+        }
+        return t;
+    }();
+    return tables;
+}
+
+// Length of the run of p[0] starting at p, up to min(avail, cap) bytes,
+// compared a word at a time
+size_t run_length(const uint8_t* p, size_t avail, size_t cap)
+{
+    const size_t limit = std::min(avail, cap);
+    size_t n = 1;
+#if defined(__BYTE_ORDER__) && __BYTE_ORDER__ == __ORDER_LITTLE_ENDIAN__
+    const uint64_t pattern = 0x0101010101010101ull * p[0];
+    while (n + 8 <= limit) {
+        uint64_t w;
+        std::memcpy(&w, p + n, 8);
+        if (w != pattern) return n + (__builtin_ctzll(w ^ pattern) >> 3);
+        n += 8;
+    }
+#endif
+    while (n < limit && p[n] == p[0]) n++;
+    return n;
+}
+
 // HE* uses intoPIX TicoRAW - we can see "CONTACT_INTOPIX_" signature
 // This implements a more sophisticated decoder based on TicoRAW patterns
-bool hefraw::decode_tile_to_cfa16(const uint8_t* bitstream, size_t len,
-                                  const TileHeader& th,
-                                  std::vector<uint16_t>& out_cfa,
-                                  uint32_t stride_px)
+bool decode_ticoraw(const uint8_t* bitstream, size_t len, const TileHeader& th, RowWriter& out)
 {
     if (th.bitDepth != 14) return false;
     const size_t total = (size_t)th.width * (size_t)th.height;
-    out_cfa.assign(stride_px * (size_t)th.height, 0);
 
     // Look for TicoRAW signature
     if (len < 32) return false;
@@ -24,16 +624,11 @@ bool hefraw::decode_tile_to_cfa16(const uint8_t* bitstream, size_t len,
     // Parse TicoRAW header based on analysis
     const uint8_t* data = bitstream + 32;  // Skip signature
     size_t data_len = len - 32;
-    
-    // Check for TicoRAW header structure
+
+    // Check for TicoRAW header structure; the fields are header flags,
+    // tile width, tile height and compression info, 32 bits each
     if (data_len < 16) return false;
-    
-    // Parse header fields (based on analysis)
-    uint32_t header_flags = data[0] | (data[1] << 8) | (data[2] << 16) | (data[3] << 24);
-    uint32_t tile_width = data[4] | (data[5] << 8) | (data[6] << 16) | (data[7] << 24);
-    uint32_t tile_height = data[8] | (data[9] << 8) | (data[10] << 16) | (data[11] << 24);
-    uint32_t compression_info = data[12] | (data[13] << 8) | (data[14] << 16) | (data[15] << 24);
-    
+
     // Skip additional header data
     size_t header_size = 16;
     if (data_len > 32) {
@@ -45,165 +640,302 @@ bool hefraw::decode_tile_to_cfa16(const uint8_t* bitstream, size_t len,
             }
         }
     }
-    
+
     const uint8_t* compressed_data = data + header_size;
     size_t compressed_len = data_len - header_size;
-    
+
     // Implement TicoRAW decompression based on analysis
     // Uses run-length encoding, delta coding, and entropy coding
-    
-    uint32_t pixel_count = 0;
+    const ByteTables& tab = byte_tables();
+
+    size_t pixel_count = 0;
     uint16_t predictor = 0;
     size_t i = 0;
-    
+
     while (i < compressed_len && pixel_count < total) {
         uint8_t byte = compressed_data[i];
-        
-        // Handle run-length encoding for zeros
-        if (byte == 0x00) {
-            // Count consecutive zeros
-            uint32_t zero_count = 1;
-            while (i + zero_count < compressed_len && 
-                   compressed_data[i + zero_count] == 0x00 && 
-                   zero_count < 1000) {
-                zero_count++;
-            }
-            
-            // Fill with zeros
-            for (uint32_t j = 0; j < zero_count && pixel_count < total; j++) {
-                uint32_t row = pixel_count / th.width;
-                uint32_t col = pixel_count % th.width;
-                if (row < th.height && col < th.width) {
-                    out_cfa[row * stride_px + col] = 0;
-                }
-                pixel_count++;
-            }
-            
-            i += zero_count;
+
+        // Handle run-length encoding for zeros and for 0xFF pairs, which
+        // fill with the maximum value
+        if (byte == 0x00 || (byte == 0xFF && i + 1 < compressed_len && compressed_data[i + 1] == 0xFF)) {
+            const size_t run = run_length(compressed_data + i, compressed_len - i, 1000);
+            const size_t n = std::min<size_t>(run, total - pixel_count);
+            out.fill(byte ? 0x3FFF : 0, n);
+            pixel_count += n;
+            i += run;
             continue;
         }
-        
-        // Handle run-length encoding for 0xFF
-        if (byte == 0xFF) {
-            // Check if next byte is also 0xFF (run-length marker)
-            if (i + 1 < compressed_len && compressed_data[i + 1] == 0xFF) {
-                // Count consecutive 0xFF
-                uint32_t ff_count = 1;
-                while (i + ff_count < compressed_len && 
-                       compressed_data[i + ff_count] == 0xFF && 
-                       ff_count < 1000) {
-                    ff_count++;
-                }
-                
-                // Fill with maximum value
-                uint16_t max_val = 0x3FFF;
-                for (uint32_t j = 0; j < ff_count && pixel_count < total; j++) {
-                    uint32_t row = pixel_count / th.width;
-                    uint32_t col = pixel_count % th.width;
-                    if (row < th.height && col < th.width) {
-                        out_cfa[row * stride_px + col] = max_val;
-                    }
-                    pixel_count++;
-                }
-                
-                i += ff_count;
-                continue;
-            }
-        }
-        
-        // Handle delta coding
-        uint16_t val = 0;
-        
-        // Try delta coding first
-        if (byte < 128) {
-            // Positive delta
-            val = (predictor + byte) & 0x3FFF;
-        } else {
-            // Negative delta
-            val = (predictor - (256 - byte)) & 0x3FFF;
-        }
-        
-        // Fallback to direct scaling
-        if (val == 0 || val > 16000) {
-            val = (byte << 6) | (byte >> 2);
-            val = val & 0x3FFF;
-        }
-        
+
+        // Delta from the predictor, falling back to direct scaling
+        uint16_t val = (predictor + tab.delta[byte]) & 0x3FFF;
+        if (val == 0 || val > 16000) val = tab.direct[byte];
+
         // Accept reasonable values
-        if (val > 0 && val < 16000) {
-            uint32_t row = pixel_count / th.width;
-            uint32_t col = pixel_count % th.width;
-            if (row < th.height && col < th.width) {
-                out_cfa[row * stride_px + col] = val;
-            }
+        if (val - 1u < 15999u) {
+            out.put(val);
             pixel_count++;
             predictor = val;
         }
-        
+
         i++;
     }
-    
+
     return pixel_count > total / 8; // require at least 12.5% coverage
 }
 
-bool hefraw::assemble_image_cfa16(const ImageHeader& ih,
-                                  const uint8_t* file_data, size_t file_len,
-                                  std::vector<uint16_t>& out_cfa)
+// Where tiles decode to: a buffer holding the frame from pixel (x, y) on,
+// with rows `stride` pixels apart, or a binner
+struct Target {
+    uint16_t* data;
+    size_t stride;
+    uint32_t x, y;
+    Binner* bin;
+};
+
+// Whether a tile that is not TicoRAW may hold uncompressed samples
+bool has_raw_samples(const TileHeader& tile)
 {
-    if (ih.tiles.empty()) return false;
-    out_cfa.assign((size_t)ih.width * (size_t)ih.height, 0);
-    
-    // Process ALL tiles to maximize coverage
-    bool any_success = false;
-    
-    for (size_t tile_idx = 0; tile_idx < ih.tiles.size(); tile_idx++) {
-        const auto& tile = ih.tiles[tile_idx];
-        
-        if ((size_t)tile.offset + (size_t)tile.length > file_len) continue;
-        const uint8_t* bs = file_data + tile.offset;
-        
-        std::vector<uint16_t> tile_data;
-        
-        // Try TicoRAW decoding first
-        if (decode_tile_to_cfa16(bs, tile.length, tile, tile_data, ih.width)) {
-            // TicoRAW decoding succeeded - copy all data
-            for (size_t y = 0; y < ih.height && y < tile.height; y++) {
-                for (size_t x = 0; x < ih.width && x < tile.width; x++) {
-                    // Only overwrite zero pixels to avoid conflicts
-                    if (out_cfa[y * ih.width + x] == 0) {
-                        out_cfa[y * ih.width + x] = tile_data[y * ih.width + x];
-                    }
-                }
+    return tile.length < 1000000 && tile.length >= (size_t)tile.width * tile.height * 2;
+}
+
+// Decode tile t straight into the frame or binner, falling back to
+// uncompressed 14-bit little-endian samples for small tiles. Returns the
+// pixels written, or 0 if the tile could not be decoded. A failed TicoRAW
+// attempt is recorded in `tico_failed` and not made again; binned pixels
+// cannot be rolled back, so a binned tile then returns 0 straight away and
+// the caller starts over.
+size_t decode_tile(const ImageHeader& ih, size_t t, const uint8_t* file_data, size_t file_len,
+                   const Target& to, const Coverage& coverage, char& tico_failed)
+{
+    const TileHeader& tile = ih.tiles[t];
+    if ((size_t)tile.offset + (size_t)tile.length > file_len) return 0;
+    if (!tile.width || !tile.height) return 0;
+    const uint8_t* bs = file_data + tile.offset;
+    const int64_t x = (int64_t)tile.x - to.x, y = (int64_t)tile.y - to.y;
+
+    // Try TicoRAW decoding first
+    if (!tico_failed) {
+        RowWriter out(to.data, to.stride, x, y, tile.width, tile.height, &coverage, t, to.bin);
+        if (decode_ticoraw(bs, tile.length, tile, out)) {
+            out.finish();
+            return out.written();
+        }
+        tico_failed = 1;
+        if (to.bin) return 0;
+        out.rollback();
+    }
+
+    // Try uncompressed 14-bit data for smaller tiles
+    if (!has_raw_samples(tile)) return 0;
+    const size_t total = (size_t)tile.width * (size_t)tile.height;
+    RowWriter out(to.data, to.stride, x, y, tile.width, tile.height, &coverage, t, to.bin);
+    for (size_t i = 0; i < total; i++) {
+        out.put((bs[i * 2] | (bs[i * 2 + 1] << 8)) & 0x3FFF); // 14-bit mask
+    }
+    out.finish();
+    return total;
+}
+
+// Decode the tiles that reach into `window` of the frame into the target
+bool assemble(const ImageHeader& ih, const uint8_t* file_data, size_t file_len,
+              const Target& to, Rect window, unsigned threads)
+{
+    // Tiles write straight into the frame, each only where no earlier tile
+    // has. Tiles in a wave share no pixels, or no bins, and decode
+    // concurrently; a tile that earlier ones already cover completely, or
+    // that lies outside the window, is not decoded at all.
+    const size_t n = ih.tiles.size();
+    std::vector<char> tico_failed(n, 0); // not vector<bool>: workers write neighbours
+    for (;;) {
+        Coverage coverage(ih, window, to.bin ? to.bin->scale() : 1);
+        std::vector<char> ok(n, 0), retry(n, 0);
+        bool restart = false;
+        for (const auto& wave : coverage.waves()) {
+            parallel_for(wave.size(), threads, [&](size_t w) {
+                const size_t t = wave[w];
+                if (coverage.full(t)) return;
+                const char failed = tico_failed[t];
+                const size_t written = decode_tile(ih, t, file_data, file_len, to, coverage, tico_failed[t]);
+                coverage.set_written(t, written);
+                ok[t] = written > 0;
+                retry[t] = to.bin && tico_failed[t] != failed;
+            });
+            if (std::find(retry.begin(), retry.end(), 1) != retry.end()) {
+                restart = true;
+                break;
             }
-            any_success = true;
-        } else {
-            // Try uncompressed 14-bit data for smaller tiles
-            if (tile.length < 1000000) { // Smaller tiles might be uncompressed
-                tile_data.assign((size_t)tile.width * (size_t)tile.height, 0);
-                if (tile.length >= (size_t)tile.width * (size_t)tile.height * 2) {
-                    // Assume 14-bit little-endian data
-                    for (size_t i = 0; i < tile_data.size() && i * 2 + 1 < tile.length; i++) {
-                        uint16_t val = bs[i * 2] | (bs[i * 2 + 1] << 8);
-                        val = val & 0x3FFF; // 14-bit mask
-                        tile_data[i] = val;
-                    }
-                    
-                    // Copy uncompressed data
-                    for (size_t y = 0; y < ih.height && y < tile.height; y++) {
-                        for (size_t x = 0; x < ih.width && x < tile.width; x++) {
-                            // Only overwrite zero pixels
-                            if (out_cfa[y * ih.width + x] == 0) {
-                                out_cfa[y * ih.width + x] = tile_data[y * ih.width + x];
-                            }
-                        }
-                    }
-                    any_success = true;
-                }
+        }
+        if (!restart) return std::find(ok.begin(), ok.end(), 1) != ok.end();
+        to.bin->clear();
+    }
+}
+
+// Decode the frame in bands of rows, top to bottom. Tiles whose rows overlap
+// are grouped into one stretch of rows, which decodes exactly as assemble
+// would since only overlapping tiles affect each other. A stretch that is a
+// single TicoRAW tile emits its rows as they decode; any other is assembled
+// into a buffer of its rows first. Rows that no tile reaches are zero.
+bool stream_rows(const ImageHeader& ih, const uint8_t* file_data, size_t file_len, uint32_t band_rows,
+                 Emitter& out, unsigned threads)
+{
+    std::vector<size_t> order;
+    for (size_t t = 0; t < ih.tiles.size(); t++) {
+        const TileHeader& th = ih.tiles[t];
+        if (th.width && th.height && th.x < ih.width && th.y < ih.height) order.push_back(t);
+    }
+    std::stable_sort(order.begin(), order.end(), [&](size_t a, size_t b) { return ih.tiles[a].y < ih.tiles[b].y; });
+    struct Stretch {
+        uint32_t y0, y1;
+        std::vector<size_t> tiles;
+    };
+    std::vector<Stretch> stretches;
+    for (size_t t : order) {
+        const TileHeader& th = ih.tiles[t];
+        const uint32_t y1 = (uint32_t)std::min<uint64_t>(ih.height, (uint64_t)th.y + th.height);
+        if (stretches.empty() || th.y >= stretches.back().y1) stretches.push_back({th.y, y1, {}});
+        stretches.back().y1 = std::max(stretches.back().y1, y1);
+        stretches.back().tiles.push_back(t);
+    }
+
+    bool any = false;
+    uint32_t y = 0;
+    std::vector<uint16_t> rows;
+    for (Stretch& st : stretches) {
+        if (!out.zeros(y, st.y0, band_rows)) return false;
+        y = st.y1;
+        // Just this stretch's tiles, in header order
+        std::sort(st.tiles.begin(), st.tiles.end());
+        ImageHeader sub{ih.width, ih.height, ih.bitDepth, ih.cfaPattern, {}};
+        for (size_t t : st.tiles) sub.tiles.push_back(ih.tiles[t]);
+        const Rect window{0, st.y0, ih.width, st.y1 - st.y0};
+        const TileHeader& th = sub.tiles[0];
+
+        if (sub.tiles.size() == 1 && !has_raw_samples(th)) {
+            const Coverage coverage(sub, window);
+            RowStream stream(ih.width, st.y0, st.y1, band_rows, th, out);
+            bool decoded = false;
+            if ((size_t)th.offset + th.length <= file_len) {
+                RowWriter writer(nullptr, 0, th.x, th.y, th.width, th.height, &coverage, 0, nullptr, &stream);
+                decoded = decode_ticoraw(file_data + th.offset, th.length, th, writer);
+                if (decoded) writer.finish();
             }
+            any = any || decoded;
+            if (!stream.finish(decoded)) return false;
+            continue;
+        }
+
+        rows.assign((size_t)ih.width * window.height, 0);
+        const Target to{rows.data(), ih.width, 0, st.y0, nullptr};
+        any = assemble(sub, file_data, file_len, to, window, threads) || any;
+        for (uint32_t r = 0; r < window.height; r += band_rows) {
+            const uint32_t n = std::min(band_rows, window.height - r);
+            if (!out.emit(st.y0 + r, n, rows.data() + (size_t)r * ih.width)) return false;
         }
     }
-    
-    return any_success;
+    return out.zeros(y, ih.height, band_rows) && any;
+}
+
+} // namespace
+
+bool hefraw::decode_tile_into(const uint8_t* bitstream, size_t len,
+                              const TileHeader& th, CfaRegion out)
+{
+    RowWriter writer(out.data, out.stride, 0, 0, th.width, th.height);
+    if (!decode_ticoraw(bitstream, len, th, writer)) return false;
+    writer.finish();
+    return true;
+}
+
+bool hefraw::decode_tile_to_cfa16(const uint8_t* bitstream, size_t len,
+                                  const TileHeader& th,
+                                  std::vector<uint16_t>& out_cfa,
+                                  uint32_t stride_px)
+{
+    out_cfa.assign(stride_px * (size_t)th.height, 0);
+    if (stride_px < th.width) return false;
+    return decode_tile_into(bitstream, len, th, CfaRegion{out_cfa.data(), stride_px});
+}
+
+void hefraw::scaled_size(uint32_t width, uint32_t height, unsigned scale,
+                         uint32_t& out_width, uint32_t& out_height)
+{
+    out_width = scale ? width / scale : 0;
+    out_height = scale ? height / scale : 0;
+}
+
+bool hefraw::assemble_image_cfa16(const ImageHeader& ih,
+                                  const uint8_t* file_data, size_t file_len,
+                                  std::vector<uint16_t>& out_cfa,
+                                  const DecodeOptions& opts)
+{
+    if (ih.tiles.empty()) return false;
+    if (opts.scale == 1) {
+        out_cfa.assign((size_t)ih.width * (size_t)ih.height, 0);
+        const Target to{out_cfa.data(), ih.width, 0, 0, nullptr};
+        return assemble(ih, file_data, file_len, to, Rect{0, 0, ih.width, ih.height}, opts.threads);
+    }
+    if (opts.scale != 2 && opts.scale != 4 && opts.scale != 8) return false;
+
+    // Binned straight into the scaled frame: the full-size frame is never
+    // held, only a scratch row per tile
+    uint32_t width, height;
+    scaled_size(ih.width, ih.height, opts.scale, width, height);
+    out_cfa.assign((size_t)width * height * 3, 0);
+    Binner bin(out_cfa.data(), ih.width, ih.height, opts.scale, opts.cfaPattern);
+    const Target to{nullptr, 0, 0, 0, &bin};
+    if (!assemble(ih, file_data, file_len, to, Rect{0, 0, ih.width, ih.height}, opts.threads)) return false;
+    bin.finish(opts.threads);
+    return true;
 }
 
+bool hefraw::decode_region(const ImageHeader& ih,
+                           const uint8_t* file_data, size_t file_len,
+                           uint32_t x, uint32_t y, uint32_t width, uint32_t height,
+                           std::vector<uint16_t>& out_cfa,
+                           const DecodeOptions& opts)
+{
+    if (ih.tiles.empty() || opts.scale != 1) return false;
+    out_cfa.assign((size_t)width * height, 0);
+    const Target to{out_cfa.data(), width, x, y, nullptr};
+    return assemble(ih, file_data, file_len, to, Rect{x, y, width, height}, opts.threads);
+}
 
+bool hefraw::decode_rows(const ImageHeader& ih,
+                         const uint8_t* file_data, size_t file_len,
+                         uint32_t band_rows, const RowSink& sink,
+                         const DecodeOptions& opts)
+{
+    if (ih.tiles.empty() || opts.scale != 1 || !band_rows) return false;
+    Emitter out(ih.width, sink, resolve_threads(opts.threads) > 1);
+    return out.run([&] { return stream_rows(ih, file_data, file_len, band_rows, out, opts.threads); });
+}
+
+int hefraw_frame_size(const uint8_t* data, size_t size, uint32_t* width, uint32_t* height)
+{
+    ImageHeader ih;
+    try {
+        if (!parse_hef_headers(data, size, ih)) return 0;
+    } catch (...) {
+        return 0;
+    }
+    *width = ih.width;
+    *height = ih.height;
+    return 1;
+}
+
+int hefraw_decode_rows(const uint8_t* data, size_t size, uint32_t band_rows, unsigned threads,
+                       hefraw_row_sink sink, void* user)
+{
+    // Nothing may unwind into C
+    try {
+        ImageHeader ih;
+        if (!parse_hef_headers(data, size, ih)) return 0;
+        DecodeOptions opts;
+        opts.threads = threads;
+        return decode_rows(ih, data, size, band_rows, [&](uint32_t y, uint32_t rows, const uint16_t* pixels) {
+            return sink(user, y, rows, ih.width, pixels) != 0;
+        }, opts);
+    } catch (...) {
+        return 0;
+    }
+}
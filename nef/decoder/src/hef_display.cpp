@@ -0,0 +1,140 @@
+#include "../include/hef_display.hpp"
+#include "../include/hef_parallel.hpp"
+#include <algorithm>
+#include <cmath>
+
+using namespace hefraw;
+
+namespace {
+
+// Rows handed to a worker at a time
+const uint32_t kBandRows = 64;
+
+enum Site { kRed, kGreenOnRed, kGreenOnBlue, kBlue };
+
+inline uint32_t argb(const uint8_t* lut, uint32_t r, uint32_t g, uint32_t b)
+{
+    return 0xFF000000u | (uint32_t)lut[r & 0x3FFF] << 16 | (uint32_t)lut[g & 0x3FFF] << 8 | lut[b & 0x3FFF];
+}
+
+// Bilinear interpolation at column x of row c, with u and d the rows above
+// and below and xl, xr the columns either side
+template <int S>
+inline uint32_t bilinear(const uint8_t* lut, const uint16_t* u, const uint16_t* c, const uint16_t* d,
+                         uint32_t xl, uint32_t x, uint32_t xr)
+{
+    const uint32_t cross = (c[xl] + c[xr] + u[x] + d[x] + 2) >> 2;
+    const uint32_t diag = (u[xl] + u[xr] + d[xl] + d[xr] + 2) >> 2;
+    const uint32_t horiz = (c[xl] + c[xr] + 1) >> 1;
+    const uint32_t vert = (u[x] + d[x] + 1) >> 1;
+    switch (S) {
+    case kRed:        return argb(lut, c[x], cross, diag);
+    case kGreenOnRed: return argb(lut, horiz, c[x], vert);
+    case kGreenOnBlue:return argb(lut, vert, c[x], horiz);
+    default:          return argb(lut, diag, cross, c[x]);
+    }
+}
+
+inline uint32_t bilinear_at(int site, const uint8_t* lut, const uint16_t* u, const uint16_t* c,
+                            const uint16_t* d, uint32_t xl, uint32_t x, uint32_t xr)
+{
+    switch (site) {
+    case kRed:         return bilinear<kRed>(lut, u, c, d, xl, x, xr);
+    case kGreenOnRed:  return bilinear<kGreenOnRed>(lut, u, c, d, xl, x, xr);
+    case kGreenOnBlue: return bilinear<kGreenOnBlue>(lut, u, c, d, xl, x, xr);
+    default:           return bilinear<kBlue>(lut, u, c, d, xl, x, xr);
+    }
+}
+
+// Interior columns [x, end) of a row, two sites per step and no edge checks
+template <int A, int B>
+void bilinear_run(const uint8_t* lut, const uint16_t* u, const uint16_t* c, const uint16_t* d,
+                  uint32_t x, uint32_t end, uint32_t* out)
+{
+    for (; x + 1 < end; x += 2) {
+        out[x] = bilinear<A>(lut, u, c, d, x - 1, x, x + 1);
+        out[x + 1] = bilinear<B>(lut, u, c, d, x, x + 1, x + 2);
+    }
+    if (x < end) out[x] = bilinear<A>(lut, u, c, d, x - 1, x, x + 1);
+}
+
+void bilinear_row(const uint16_t* cfa, uint32_t width, uint32_t height, uint32_t y,
+                  unsigned dx, unsigned dy, const uint8_t* lut, uint32_t* out)
+{
+    // Edges mirror without repeating the edge pixel, which keeps the pattern
+    const uint16_t* c = cfa + (size_t)y * width;
+    const uint16_t* u = y ? c - width : c + width;
+    const uint16_t* d = y + 1 < height ? c + width : c - width;
+    const bool red_row = ((y + dy) & 1) == 0;
+    auto site = [&](uint32_t x) {
+        const bool even = ((x + dx) & 1) == 0;
+        return red_row ? (even ? kRed : kGreenOnRed) : (even ? kGreenOnBlue : kBlue);
+    };
+
+    out[0] = bilinear_at(site(0), lut, u, c, d, 1, 0, 1);
+    switch (site(1)) {
+    case kRed:         bilinear_run<kRed, kGreenOnRed>(lut, u, c, d, 1, width - 1, out); break;
+    case kGreenOnRed:  bilinear_run<kGreenOnRed, kRed>(lut, u, c, d, 1, width - 1, out); break;
+    case kGreenOnBlue: bilinear_run<kGreenOnBlue, kBlue>(lut, u, c, d, 1, width - 1, out); break;
+    default:           bilinear_run<kBlue, kGreenOnBlue>(lut, u, c, d, 1, width - 1, out); break;
+    }
+    const uint32_t x = width - 1;
+    out[x] = bilinear_at(site(x), lut, u, c, d, x - 1, x, x - 1);
+}
+
+// One pixel per 2x2 quad: red, the mean of the two greens, and blue
+void superpixel_row(const uint16_t* cfa, uint32_t width, uint32_t y,
+                    unsigned dx, unsigned dy, const uint8_t* lut, uint32_t* out, uint32_t out_width)
+{
+    const uint16_t* r = cfa + (size_t)(2 * y + dy) * width + dx;
+    const uint16_t* b = cfa + (size_t)(2 * y + 1 - dy) * width + (1 - dx);
+    const uint16_t* g1 = cfa + (size_t)(2 * y + dy) * width + (1 - dx);
+    const uint16_t* g2 = cfa + (size_t)(2 * y + 1 - dy) * width + dx;
+    for (uint32_t x = 0; x < out_width; x++) {
+        out[x] = argb(lut, r[2 * x], (g1[2 * x] + g2[2 * x] + 1) >> 1, b[2 * x]);
+    }
+}
+
+} // namespace
+
+std::vector<uint8_t> hefraw::tone_curve(const DisplayOptions& opts)
+{
+    std::vector<uint8_t> lut(0x4000);
+    const double black = opts.black, range = std::max<double>(1.0, (double)opts.white - black);
+    const double inv_gamma = opts.gamma > 0 ? 1.0 / opts.gamma : 1.0;
+    for (size_t v = 0; v < lut.size(); v++) {
+        const double t = std::min(1.0, std::max(0.0, ((double)v - black) / range));
+        lut[v] = (uint8_t)std::lround(255.0 * std::pow(t, inv_gamma));
+    }
+    return lut;
+}
+
+void hefraw::display_size(uint32_t width, uint32_t height, const DisplayOptions& opts,
+                          uint32_t& out_width, uint32_t& out_height)
+{
+    out_width = opts.half_size ? width / 2 : width;
+    out_height = opts.half_size ? height / 2 : height;
+}
+
+bool hefraw::cfa16_to_argb(const uint16_t* cfa, uint32_t width, uint32_t height,
+                           const DisplayOptions& opts, uint32_t* out)
+{
+    if (width < 2 || height < 2 || opts.cfaPattern > 3) return false;
+    // Offset of the red site within each quad
+    static const unsigned kRedX[4] = {0, 1, 1, 0}, kRedY[4] = {0, 1, 0, 1};
+    const unsigned dx = kRedX[opts.cfaPattern], dy = kRedY[opts.cfaPattern];
+    const std::vector<uint8_t> lut = tone_curve(opts);
+
+    uint32_t out_width, out_height;
+    display_size(width, height, opts, out_width, out_height);
+    const size_t bands = (out_height + kBandRows - 1) / kBandRows;
+    parallel_for(bands, opts.threads, [&](size_t band) {
+        const uint32_t end = std::min<uint32_t>(out_height, (band + 1) * kBandRows);
+        for (uint32_t y = band * kBandRows; y < end; y++) {
+            uint32_t* row = out + (size_t)y * out_width;
+            if (opts.half_size) superpixel_row(cfa, width, y, dx, dy, lut.data(), row, out_width);
+            else bilinear_row(cfa, width, height, y, dx, dy, lut.data(), row);
+        }
+    });
+    return true;
+}
@@ -1,22 +1,434 @@
 #include "../include/hef_export.hpp"
-#include <fstream>
+#include "../include/hef_parallel.hpp"
+#include <algorithm>
+#include <cstdio>
 #include <cstring>
+#include <zlib.h>
 
 using namespace hefraw;
 
-// Stub implementations - will be filled with proper TIFF/DNG writers
+namespace {
+
+// Little-endian TIFF written front to back: image data first, then the
+// IFD, whose offset is patched into the header when the file is finished
+class TiffFile {
+public:
+    ~TiffFile()
+    {
+        if (fp_) std::fclose(fp_);
+    }
+
+    bool open(const std::string& path)
+    {
+        fp_ = std::fopen(path.c_str(), "wb");
+        if (!fp_) return false;
+        std::setvbuf(fp_, nullptr, _IOFBF, 1 << 20);
+        static const uint8_t header[8] = {'I', 'I', 0x2A, 0x00, 0, 0, 0, 0};
+        return write(header, sizeof(header));
+    }
+
+    bool write(const uint8_t* p, size_t n)
+    {
+        if (offset_ + n > 0xFFFFFFFFull) return false; // classic TIFF offsets are 32 bits
+        offset_ += n;
+        return std::fwrite(p, 1, n, fp_) == n;
+    }
+
+    uint32_t offset() const { return (uint32_t)offset_; }
+
+    void bytes(uint16_t tag, const std::vector<uint8_t>& v) { add(tag, 1, (uint32_t)v.size(), v); }
+
+    void ascii(uint16_t tag, const std::string& s)
+    {
+        std::vector<uint8_t> v(s.begin(), s.end());
+        v.push_back(0);
+        add(tag, 2, (uint32_t)v.size(), v);
+    }
+
+    void shorts(uint16_t tag, const std::vector<uint16_t>& v)
+    {
+        std::vector<uint8_t> b;
+        for (uint16_t x : v) put(b, x, 2);
+        add(tag, 3, (uint32_t)v.size(), b);
+    }
+
+    void longs(uint16_t tag, const std::vector<uint32_t>& v)
+    {
+        std::vector<uint8_t> b;
+        for (uint32_t x : v) put(b, x, 4);
+        add(tag, 4, (uint32_t)v.size(), b);
+    }
+
+    // SRATIONAL values as numerator, denominator pairs
+    void srationals(uint16_t tag, const std::vector<int32_t>& v)
+    {
+        std::vector<uint8_t> b;
+        for (int32_t x : v) put(b, (uint32_t)x, 4);
+        add(tag, 10, (uint32_t)(v.size() / 2), b);
+    }
+
+    // Write the IFD after the data and point the header at it
+    bool finish()
+    {
+        static const uint8_t pad = 0;
+        if ((offset_ & 1) && !write(&pad, 1)) return false; // IFDs start on a word boundary
+        std::sort(tags_.begin(), tags_.end(), [](const Tag& a, const Tag& b) { return a.tag < b.tag; });
+        const uint32_t ifd = offset();
+        uint32_t extra = ifd + 2 + 12 * (uint32_t)tags_.size() + 4;
+        std::vector<uint8_t> out, values;
+        put(out, tags_.size(), 2);
+        for (const Tag& t : tags_) {
+            put(out, t.tag, 2);
+            put(out, t.type, 2);
+            put(out, t.count, 4);
+            if (t.data.size() <= 4) {
+                out.insert(out.end(), t.data.begin(), t.data.end());
+                out.insert(out.end(), 4 - t.data.size(), 0);
+                continue;
+            }
+            put(out, extra + (uint32_t)values.size(), 4);
+            values.insert(values.end(), t.data.begin(), t.data.end());
+            if (values.size() & 1) values.push_back(0);
+        }
+        put(out, 0, 4); // no next IFD
+        out.insert(out.end(), values.begin(), values.end());
+        if (!write(out.data(), out.size())) return false;
+
+        uint8_t at[4];
+        for (int i = 0; i < 4; i++) at[i] = (ifd >> (8 * i)) & 0xFF;
+        const bool ok = std::fseek(fp_, 4, SEEK_SET) == 0 && std::fwrite(at, 1, 4, fp_) == 4;
+        const bool closed = std::fclose(fp_) == 0;
+        fp_ = nullptr;
+        return ok && closed;
+    }
+
+private:
+    struct Tag {
+        uint16_t tag, type;
+        uint32_t count;
+        std::vector<uint8_t> data; // little-endian values
+    };
+
+    static void put(std::vector<uint8_t>& b, uint64_t v, int n)
+    {
+        for (int i = 0; i < n; i++) b.push_back((v >> (8 * i)) & 0xFF);
+    }
+
+    void add(uint16_t tag, uint16_t type, uint32_t count, const std::vector<uint8_t>& data)
+    {
+        tags_.push_back({tag, type, count, data});
+    }
+
+    FILE* fp_ = nullptr;
+    uint64_t offset_ = 0;
+    std::vector<Tag> tags_;
+};
+
+// MSB-first bit packer for JPEG entropy-coded data, with 0xFF bytes stuffed
+class JpegBits {
+public:
+    explicit JpegBits(std::vector<uint8_t>& out) : out_(out) {}
+
+    void put(uint32_t bits, unsigned n)
+    {
+        acc_ = (acc_ << n) | (bits & ((1u << n) - 1));
+        count_ += n;
+        while (count_ >= 8) {
+            count_ -= 8;
+            const uint8_t b = (uint8_t)(acc_ >> count_);
+            out_.push_back(b);
+            if (b == 0xFF) out_.push_back(0x00);
+        }
+    }
+
+    // Pad the last byte with one bits
+    void flush()
+    {
+        if (count_) put(0x7F, 8 - count_);
+    }
+
+private:
+    std::vector<uint8_t>& out_;
+    uint64_t acc_ = 0;
+    unsigned count_ = 0;
+};
+
+// Difference category: the bit length of a prediction difference
+inline unsigned category(int32_t diff)
+{
+    const uint32_t mag = (uint32_t)(diff < 0 ? -diff : diff);
+    return mag ? 32 - __builtin_clz(mag) : 0;
+}
+
+// Huffman code lengths of at most 16 bits for the 17 difference categories,
+// as in ITU T.81 Annex K.2 and K.3. Returns the DHT's BITS and HUFFVAL.
+void huffman_table(const uint64_t (&counts)[17], uint8_t (&bits)[17], std::vector<uint8_t>& values)
+{
+    // Symbol 17 stands in for the reserved all-ones code
+    uint64_t freq[18];
+    int size[18], others[18];
+    for (int i = 0; i < 17; i++) freq[i] = counts[i];
+    freq[17] = 1;
+    std::fill_n(size, 18, 0);
+    std::fill_n(others, 18, -1);
+    for (;;) {
+        int v1 = -1, v2 = -1;
+        for (int i = 0; i < 18; i++) {
+            if (freq[i] && (v1 < 0 || freq[i] <= freq[v1])) v1 = i;
+        }
+        for (int i = 0; i < 18; i++) {
+            if (freq[i] && i != v1 && (v2 < 0 || freq[i] <= freq[v2])) v2 = i;
+        }
+        if (v2 < 0) break;
+        freq[v1] += freq[v2];
+        freq[v2] = 0;
+        for (size[v1]++; others[v1] >= 0; size[v1]++) v1 = others[v1];
+        others[v1] = v2;
+        for (size[v2]++; others[v2] >= 0; size[v2]++) v2 = others[v2];
+    }
+
+    int count[40] = {0};
+    for (int i = 0; i < 18; i++) if (size[i]) count[size[i]]++;
+    for (int i = 39; i > 16; i--) {
+        while (count[i] > 0) {
+            int j = i - 2;
+            while (count[j] == 0) j--;
+            count[i] -= 2;
+            count[i - 1]++;
+            count[j + 1] += 2;
+            count[j]--;
+        }
+    }
+    int longest = 16;
+    while (count[longest] == 0) longest--;
+    count[longest]--; // drop the reserved code
+
+    for (int i = 0; i <= 16; i++) bits[i] = (uint8_t)count[i];
+    values.clear();
+    for (int len = 1; len < 40; len++) {
+        for (int i = 0; i < 17; i++) if (size[i] == len) values.push_back((uint8_t)i);
+    }
+}
+
+// A CFA tile as lossless JPEG (ITU T.81 process 14, predictor 1), coded as
+// two interleaved components half the tile wide, the way DNG stores CFA
+// data: each sample is predicted from the one two columns left, or at the
+// start of a row from the one above, so always from the same colour.
+std::vector<uint8_t> encode_ljpeg(const uint16_t* tile, uint32_t width, uint32_t height)
+{
+    auto diff = [&](uint32_t y, uint32_t x) -> int32_t {
+        const uint16_t* row = tile + (size_t)y * width;
+        uint16_t pred;
+        if (x >= 2) pred = row[x - 2];
+        else if (y) pred = (row - width)[x];
+        else pred = 1u << 15;
+        return (int16_t)(uint16_t)(row[x] - pred); // modulo 2^16
+    };
+
+    uint64_t counts[17] = {0};
+    for (uint32_t y = 0; y < height; y++) {
+        for (uint32_t x = 0; x < width; x++) counts[category(diff(y, x))]++;
+    }
+    uint8_t bits[17];
+    std::vector<uint8_t> values;
+    huffman_table(counts, bits, values);
+    uint16_t code[17] = {0};
+    uint8_t length[17] = {0};
+    uint32_t next = 0;
+    for (size_t len = 1, k = 0; len <= 16; len++, next <<= 1) {
+        for (int n = 0; n < bits[len]; n++, k++) {
+            code[values[k]] = (uint16_t)next++;
+            length[values[k]] = (uint8_t)len;
+        }
+    }
+
+    std::vector<uint8_t> out = {0xFF, 0xD8};
+    auto marker = [&](uint8_t m, size_t len) {
+        out.insert(out.end(), {0xFF, m, (uint8_t)(len >> 8), (uint8_t)len});
+    };
+    marker(0xC4, 2 + 1 + 16 + values.size()); // DHT, table 0
+    out.push_back(0x00);
+    out.insert(out.end(), bits + 1, bits + 17);
+    out.insert(out.end(), values.begin(), values.end());
+    marker(0xC3, 8 + 3 * 2); // SOF3: 16-bit, two components
+    out.insert(out.end(), {16, (uint8_t)(height >> 8), (uint8_t)height,
+                           (uint8_t)(width / 2 >> 8), (uint8_t)(width / 2), 2,
+                           1, 0x11, 0, 2, 0x11, 0});
+    marker(0xDA, 6 + 2 * 2); // SOS: predictor 1
+    out.insert(out.end(), {2, 1, 0x00, 2, 0x00, 1, 0, 0});
+
+    JpegBits bw(out);
+    for (uint32_t y = 0; y < height; y++) {
+        for (uint32_t x = 0; x < width; x++) {
+            const int32_t d = diff(y, x);
+            const unsigned c = category(d);
+            bw.put(code[c], length[c]);
+            if (c && c < 16) bw.put((uint32_t)(d < 0 ? d - 1 : d), c);
+        }
+    }
+    bw.flush();
+    out.insert(out.end(), {0xFF, 0xD9});
+    return out;
+}
+
+// How the frame is cut up: full-width strips, or tiles padded at the
+// right and bottom edges
+struct Layout {
+    uint32_t chunk_width, chunk_height, across, down;
+    bool tiled;
+};
+
+Layout layout(uint32_t width, uint32_t height, unsigned samples, const ExportOptions& opts)
+{
+    if (opts.compression == Compression::LosslessJpeg) {
+        const uint32_t t = 256;
+        return {t, t, (width + t - 1) / t, (height + t - 1) / t, true};
+    }
+    uint32_t rows = opts.rows_per_strip;
+    if (!rows) rows = (uint32_t)std::max<size_t>(1, (256 << 10) / ((size_t)width * samples * 2));
+    rows = std::min(rows, height);
+    return {width, rows, 1, (height + rows - 1) / rows, false};
+}
+
+// Compress chunk i of the frame
+std::vector<uint8_t> encode_chunk(const uint16_t* frame, uint32_t width, uint32_t height, unsigned samples,
+                                  const Layout& lay, size_t i, const ExportOptions& opts)
+{
+    const uint32_t x0 = (uint32_t)(i % lay.across) * lay.chunk_width;
+    const uint32_t y0 = (uint32_t)(i / lay.across) * lay.chunk_height;
+    const uint32_t w = lay.chunk_width, rows = lay.chunk_height;
+    const uint32_t h = lay.tiled ? rows : std::min(rows, height - y0);
+    const size_t stride = (size_t)w * samples;
+
+    // Copy the chunk out, padding a tile with the samples two columns left
+    // or two rows up, which keeps the CFA phase, or one back in a frame
+    // only one pixel wide or high
+    std::vector<uint16_t> buf(stride * h);
+    for (uint32_t y = 0; y < h; y++) {
+        uint16_t* dst = buf.data() + y * stride;
+        if (y0 + y >= height) {
+            std::copy_n(dst - (y >= 2 ? 2 : 1) * stride, stride, dst);
+            continue;
+        }
+        const uint32_t valid = std::min(w, width - x0);
+        std::copy_n(frame + ((size_t)(y0 + y) * width + x0) * samples, (size_t)valid * samples, dst);
+        for (size_t x = (size_t)valid * samples; x < stride; x++) dst[x] = dst[x - (x >= 2 * samples ? 2 : 1) * samples];
+    }
+
+    if (opts.compression == Compression::LosslessJpeg) return encode_ljpeg(buf.data(), w, h);
+
+    if (opts.compression == Compression::Deflate) {
+        // Horizontal differencing (TIFF predictor 2), right to left in place
+        for (uint32_t y = 0; y < h; y++) {
+            uint16_t* row = buf.data() + y * stride;
+            for (size_t x = stride; x-- > samples;) row[x] = (uint16_t)(row[x] - row[x - samples]);
+        }
+    }
+    std::vector<uint8_t> raw(buf.size() * 2);
+    for (size_t k = 0; k < buf.size(); k++) {
+        raw[2 * k] = buf[k] & 0xFF;
+        raw[2 * k + 1] = buf[k] >> 8;
+    }
+    if (opts.compression == Compression::None) return raw;
+
+    uLongf len = compressBound((uLong)raw.size());
+    std::vector<uint8_t> out(len);
+    if (compress2(out.data(), &len, raw.data(), (uLong)raw.size(), std::clamp(opts.deflate_level, 1, 9)) != Z_OK) {
+        return {};
+    }
+    out.resize(len);
+    return out;
+}
+
+// Tags shared by every export, then the image data, then the IFD
+bool write_image(TiffFile& tiff, const std::vector<uint16_t>& frame, uint32_t width, uint32_t height,
+                 unsigned samples, uint16_t photometric, const ExportOptions& opts)
+{
+    if (!width || !height || frame.size() < (size_t)width * height * samples) return false;
+    const Layout lay = layout(width, height, samples, opts);
+    const size_t chunks = (size_t)lay.across * lay.down;
+
+    // Compress a batch of chunks at a time and write them in order
+    const unsigned threads = resolve_threads(opts.threads);
+    const size_t batch = (size_t)threads * 4;
+    std::vector<std::vector<uint8_t>> encoded(std::min(batch, chunks));
+    std::vector<uint32_t> offsets, counts;
+    for (size_t first = 0; first < chunks; first += batch) {
+        const size_t n = std::min(batch, chunks - first);
+        parallel_for(n, threads, [&](size_t k) {
+            encoded[k] = encode_chunk(frame.data(), width, height, samples, lay, first + k, opts);
+        });
+        for (size_t k = 0; k < n; k++) {
+            if (encoded[k].empty()) return false;
+            offsets.push_back(tiff.offset());
+            counts.push_back((uint32_t)encoded[k].size());
+            if (!tiff.write(encoded[k].data(), encoded[k].size())) return false;
+            std::vector<uint8_t>().swap(encoded[k]);
+        }
+    }
+
+    static const uint16_t kCompression[] = {1, 8, 7}; // none, Adobe deflate, JPEG
+    tiff.longs(0x0100, {width});
+    tiff.longs(0x0101, {height});
+    tiff.shorts(0x0102, std::vector<uint16_t>(samples, 16));
+    tiff.shorts(0x0103, {kCompression[(int)opts.compression]});
+    tiff.shorts(0x0106, {photometric});
+    tiff.shorts(0x0115, {(uint16_t)samples});
+    tiff.shorts(0x011C, {1}); // chunky
+    if (opts.compression == Compression::Deflate) tiff.shorts(0x013D, {2}); // horizontal differencing
+    if (lay.tiled) {
+        tiff.longs(0x0142, {lay.chunk_width});
+        tiff.longs(0x0143, {lay.chunk_height});
+        tiff.longs(0x0144, offsets);
+        tiff.longs(0x0145, counts);
+    } else {
+        tiff.longs(0x0111, offsets);
+        tiff.longs(0x0116, {lay.chunk_height});
+        tiff.longs(0x0117, counts);
+    }
+    return true;
+}
+
+} // namespace
+
 bool hefraw::export_cfa16_to_dng(const std::vector<uint16_t>& cfa, uint32_t width, uint32_t height,
-                                 uint8_t cfa_pattern, const std::string& output_path)
+                                 uint8_t cfa_pattern, const std::string& output_path,
+                                 const ExportOptions& opts)
 {
-    (void)cfa; (void)width; (void)height; (void)cfa_pattern; (void)output_path;
-    // TODO: Implement DNG writer with proper CFA metadata
-    return false;
+    if (cfa_pattern > 3) return false;
+    TiffFile tiff;
+    if (!tiff.open(output_path) || !write_image(tiff, cfa, width, height, 1, 32803, opts)) return false;
+
+    // Colours of the 2x2 repeat: 0 = red, 1 = green, 2 = blue
+    static const uint8_t kPatterns[4][4] = {{0, 1, 1, 2}, {2, 1, 1, 0}, {1, 0, 2, 1}, {1, 2, 0, 1}};
+    tiff.longs(0x00FE, {0}); // full-resolution image
+    tiff.shorts(0x828D, {2, 2});
+    tiff.bytes(0x828E, std::vector<uint8_t>(kPatterns[cfa_pattern], kPatterns[cfa_pattern] + 4));
+    tiff.bytes(0xC612, {1, 4, 0, 0});
+    tiff.bytes(0xC613, {1, 1, 0, 0});
+    tiff.ascii(0xC614, "Nikon HE* (hefraw)");
+    tiff.bytes(0xC616, {0, 1, 2});
+    tiff.shorts(0xC617, {1}); // rectangular
+    tiff.longs(0xC61A, {0});
+    tiff.longs(0xC61D, {0x3FFF}); // 14-bit white level
+    // No calibration is known, so the camera is taken to see XYZ under D65
+    tiff.srationals(0xC621, {1, 1, 0, 1, 0, 1, 0, 1, 1, 1, 0, 1, 0, 1, 0, 1, 1, 1});
+    tiff.shorts(0xC65A, {21});
+    return tiff.finish();
 }
 
 bool hefraw::export_cfa16_to_tiff(const std::vector<uint16_t>& cfa, uint32_t width, uint32_t height,
-                                  const std::string& output_path)
+                                  const std::string& output_path, const ExportOptions& opts)
+{
+    if (opts.compression == Compression::LosslessJpeg) return false;
+    TiffFile tiff;
+    return tiff.open(output_path) && write_image(tiff, cfa, width, height, 1, 1, opts) && tiff.finish();
+}
+
+bool hefraw::export_rgb16_to_tiff(const std::vector<uint16_t>& rgb, uint32_t width, uint32_t height,
+                                  const std::string& output_path, const ExportOptions& opts)
 {
-    (void)cfa; (void)width; (void)height; (void)output_path;
-    // TODO: Implement 16-bit TIFF writer
-    return false;
+    if (opts.compression == Compression::LosslessJpeg) return false;
+    TiffFile tiff;
+    return tiff.open(output_path) && write_image(tiff, rgb, width, height, 3, 2, opts) && tiff.finish();
 }
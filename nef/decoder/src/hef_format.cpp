@@ -1,94 +1,366 @@
 #include "../include/hef_format.hpp"
+#include <algorithm>
+#include <climits>
 #include <cstring>
+#include <vector>
 
 using namespace hefraw;
 
-static bool is_tiff(const uint8_t* d, size_t n, bool& be, uint32_t& ifd0)
+namespace {
+
+const char kTicoSignature[] = "CONTACT_INTOPIX_"; // at offset 6 of a tile
+
+// Random access to the bytes of a file, in memory or on disk
+class ByteSource {
+public:
+    virtual ~ByteSource() = default;
+    virtual bool read(uint64_t offset, uint8_t* dst, size_t n) const = 0;
+};
+
+class MemorySource : public ByteSource {
+public:
+    MemorySource(const uint8_t* data, size_t size) : data_(data), size_(size) {}
+    bool read(uint64_t offset, uint8_t* dst, size_t n) const override
+    {
+        if (offset > size_ || n > size_ - offset) return false;
+        std::memcpy(dst, data_ + offset, n);
+        return true;
+    }
+private:
+    const uint8_t* data_;
+    size_t size_;
+};
+
+class FileSource : public ByteSource {
+public:
+    explicit FileSource(FILE* fp) : fp_(fp) {}
+    bool read(uint64_t offset, uint8_t* dst, size_t n) const override
+    {
+        if (offset > (uint64_t)LONG_MAX || fseek(fp_, (long)offset, SEEK_SET) != 0) return false;
+        return fread(dst, 1, n, fp_) == n;
+    }
+private:
+    FILE* fp_;
+};
+
+struct IfdEntry {
+    uint16_t tag, type;
+    uint32_t count, value; // value holds the data itself when it fits in 4 bytes
+    uint8_t raw[4];        // the value field as stored
+};
+
+// Reads IFDs of a TIFF structure whose offsets are relative to `base`
+class TiffWalker {
+public:
+    TiffWalker(const ByteSource& src, uint64_t base, bool be) : src_(src), base_(base), be_(be) {}
+
+    uint16_t rd16(const uint8_t* p) const { return be_ ? (p[0]<<8)|p[1] : (p[1]<<8)|p[0]; }
+    uint32_t rd32(const uint8_t* p) const
+    {
+        return be_ ? (uint32_t(p[0])<<24)|(uint32_t(p[1])<<16)|(uint32_t(p[2])<<8)|uint32_t(p[3])
+                   : (uint32_t(p[3])<<24)|(uint32_t(p[2])<<16)|(uint32_t(p[1])<<8)|uint32_t(p[0]);
+    }
+
+    bool read(uint32_t offset, uint8_t* dst, size_t n) const { return src_.read(base_ + offset, dst, n); }
+
+    // Entries of the IFD at `offset`, at most 512 of them, and the offset
+    // of the next IFD in the chain
+    bool ifd(uint32_t offset, std::vector<IfdEntry>& out, uint32_t* next = nullptr)
+    {
+        uint8_t c[2];
+        if (!read(offset, c, 2)) return false;
+        const size_t n = std::min<size_t>(rd16(c), 512);
+        buf_.resize(n * 12 + 4);
+        if (!read(offset + 2, buf_.data(), n * 12)) return false;
+        if (next) *next = read(offset + 2 + n * 12, buf_.data() + n * 12, 4) ? rd32(buf_.data() + n * 12) : 0;
+        out.clear();
+        for (size_t i = 0; i < n; i++) {
+            const uint8_t* p = buf_.data() + 12 * i;
+            IfdEntry e{rd16(p), rd16(p + 2), rd32(p + 4), 0, {p[8], p[9], p[10], p[11]}};
+            // SHORT values are left-justified in the value field
+            e.value = (e.type == 3 && e.count == 1) ? rd16(p + 8) : rd32(p + 8);
+            out.push_back(e);
+        }
+        return true;
+    }
+
+    // Element i of an array of SHORT or LONG values
+    bool element(const IfdEntry& e, uint32_t i, uint32_t& v) const
+    {
+        const size_t width = e.type == 3 ? 2 : 4;
+        if (i >= e.count) return false;
+        uint8_t b[4];
+        if ((size_t)e.count * width <= 4) std::memcpy(b, e.raw + i * width, width);
+        else if (!read(rd32(e.raw) + i * width, b, width)) return false;
+        v = width == 2 ? rd16(b) : rd32(b);
+        return true;
+    }
+
+private:
+    const ByteSource& src_;
+    uint64_t base_;
+    bool be_;
+    std::vector<uint8_t> buf_;
+};
+
+const IfdEntry* find_tag(const std::vector<IfdEntry>& entries, uint16_t tag)
 {
-    if (n < 8) return false;
-    if (d[0]=='I'&&d[1]=='I'&&d[2]==0x2A&&d[3]==0x00) { be=false; }
-    else if (d[0]=='M'&&d[1]=='M'&&d[2]==0x00&&d[3]==0x2A) { be=true; }
+    for (const auto& e : entries) if (e.tag == tag) return &e;
+    return nullptr;
+}
+
+bool has_tico_signature(const ByteSource& src, uint64_t offset)
+{
+    uint8_t head[22];
+    return src.read(offset, head, sizeof(head)) && std::memcmp(head + 6, kTicoSignature, 16) == 0;
+}
+
+// Nikon MakerNote: "Nikon\0", version, then a TIFF header that its offsets
+// are relative to. HE and HE* show in the Quality string (tag 0x0004) and
+// as NEFCompression 13/14 (tag 0x0093).
+bool nikon_says_hef(const ByteSource& src, uint64_t makernote)
+{
+    uint8_t h[18];
+    if (!src.read(makernote, h, sizeof(h)) || std::memcmp(h, "Nikon\0", 6) != 0) return false;
+    bool be;
+    if (h[10] == 'I' && h[11] == 'I') be = false;
+    else if (h[10] == 'M' && h[11] == 'M') be = true;
+    else return false;
+    TiffWalker mn(src, makernote + 10, be);
+    std::vector<IfdEntry> entries;
+    if (!mn.ifd(mn.rd32(h + 14), entries)) return false;
+
+    if (const IfdEntry* c = find_tag(entries, 0x0093)) {
+        if (c->value == 13 || c->value == 14) return true;
+    }
+    if (const IfdEntry* q = find_tag(entries, 0x0004)) {
+        char quality[33] = {0};
+        const size_t n = std::min<size_t>(q->count, 32);
+        if (n <= 4) std::memcpy(quality, q->raw, n);
+        else if (!mn.read(mn.rd32(q->raw), (uint8_t*)quality, n)) return false;
+        if (std::strstr(quality, "HE")) return true;
+    }
+    return false;
+}
+
+// Walk IFD0's SubIFDs for TicoRAW strips, then the Exif MakerNote
+bool detect(const ByteSource& src, bool check_strips)
+{
+    uint8_t h[8];
+    if (!src.read(0, h, 8)) return false;
+    bool be;
+    if (h[0]=='I'&&h[1]=='I'&&h[2]==0x2A&&h[3]==0x00) be = false;
+    else if (h[0]=='M'&&h[1]=='M'&&h[2]==0x00&&h[3]==0x2A) be = true;
     else return false;
-    auto rd32 = [&](const uint8_t* p){
-        return be ? (uint32_t(p[0])<<24)|(uint32_t(p[1])<<16)|(uint32_t(p[2])<<8)|uint32_t(p[3])
-                  : (uint32_t(p[3])<<24)|(uint32_t(p[2])<<16)|(uint32_t(p[1])<<8)|uint32_t(p[0]); };
-    ifd0 = rd32(d+4);
-    return ifd0 < n;
+    TiffWalker tiff(src, 0, be);
+    std::vector<IfdEntry> ifd0, sub;
+    if (!tiff.ifd(tiff.rd32(h + 4), ifd0)) return false;
+
+    const IfdEntry* subs = check_strips ? find_tag(ifd0, 0x014A) : nullptr;
+    for (uint32_t i = 0; subs && i < subs->count && i < 16; i++) {
+        uint32_t off, strip;
+        if (!tiff.element(*subs, i, off) || !tiff.ifd(off, sub)) continue;
+        const IfdEntry* so = find_tag(sub, 0x0111);
+        if (so && tiff.element(*so, 0, strip) && has_tico_signature(src, strip)) return true;
+    }
+
+    const IfdEntry* exif = find_tag(ifd0, 0x8769);
+    if (!exif || !tiff.ifd(exif->value, sub)) return false;
+    const IfdEntry* makernote = find_tag(sub, 0x927C);
+    return makernote && makernote->count >= 18 && nikon_says_hef(src, makernote->value);
+}
+
+// Largest JPEG referenced by an IFD, as JPEGInterchangeFormat or as a
+// single strip that starts with a JPEG SOI marker
+void consider_jpeg(const ByteSource& src, const std::vector<IfdEntry>& entries,
+                   uint32_t& offset, uint32_t& length)
+{
+    uint32_t off = 0, len = 0;
+    const IfdEntry* jo = find_tag(entries, 0x0201);
+    const IfdEntry* jl = find_tag(entries, 0x0202);
+    const IfdEntry* so = find_tag(entries, 0x0111);
+    const IfdEntry* sl = find_tag(entries, 0x0117);
+    if (jo && jl) { off = jo->value; len = jl->value; }
+    else if (so && sl && so->count == 1) { off = so->value; len = sl->value; }
+    if (len <= length || len < 4) return;
+    uint8_t soi[2];
+    if (src.read(off, soi, 2) && soi[0] == 0xFF && soi[1] == 0xD8 && src.read((uint64_t)off + len - 2, soi, 2)) {
+        offset = off;
+        length = len;
+    }
+}
+
+// Most SubIFDs indexed, however many IFD0 claims
+const uint32_t kMaxSubIfds = 256;
+
+// Pixel size of an IFD, 0 where it has no such tag
+void ifd_size(const std::vector<IfdEntry>& entries, uint32_t& width, uint32_t& height)
+{
+    const IfdEntry* w = find_tag(entries, 0x0100);
+    const IfdEntry* h = find_tag(entries, 0x0101);
+    width = w ? w->value : 0;
+    height = h ? h->value : 0;
 }
 
+// Whether an IFD holds strips or tiles
+bool has_strips(const std::vector<IfdEntry>& entries)
+{
+    return (find_tag(entries, 0x0111) && find_tag(entries, 0x0117)) ||
+           (find_tag(entries, 0x0144) && find_tag(entries, 0x0145));
+}
+
+// Whether an IFD's PhotometricInterpretation is CFA
+bool is_cfa(const std::vector<IfdEntry>& entries)
+{
+    const IfdEntry* p = find_tag(entries, 0x0106);
+    return p && p->value == 32803;
+}
+
+// Every strip or tile of a width x height IFD, with the rectangle of the
+// frame it covers. Strips span the width and RowsPerStrip rows, the last
+// one fewer; tiles are TileWidth x TileLength in raster order and may run
+// past the frame's right and bottom edges.
+void index_strips(const TiffWalker& tiff, const std::vector<IfdEntry>& entries,
+                  uint32_t width, uint32_t height, size_t size, std::vector<TileHeader>& out)
+{
+    const IfdEntry* offsets = find_tag(entries, 0x0144);
+    const IfdEntry* counts = find_tag(entries, 0x0145);
+    const IfdEntry* tw = find_tag(entries, 0x0142);
+    const IfdEntry* tl = find_tag(entries, 0x0143);
+    uint32_t tile_width, tile_height;
+    bool strips = false;
+    if (offsets && counts && tw && tl && tw->value && tl->value) {
+        tile_width = tw->value;
+        tile_height = tl->value;
+    } else {
+        offsets = find_tag(entries, 0x0111);
+        counts = find_tag(entries, 0x0117);
+        if (!offsets || !counts) return;
+        const IfdEntry* rows = find_tag(entries, 0x0116);
+        tile_width = width;
+        tile_height = rows && rows->value ? std::min(rows->value, height) : height;
+        strips = true;
+    }
+    if (tile_width > 0xFFFF || tile_height > 0xFFFF) return;
+
+    const uint32_t across = (width + tile_width - 1) / tile_width;
+    const uint32_t n = std::min(offsets->count, counts->count);
+    for (uint32_t i = 0; i < n; i++) {
+        const uint64_t y = (uint64_t)(i / across) * tile_height;
+        if (y >= height) break;
+        uint32_t off, len;
+        if (!tiff.element(*offsets, i, off) || !tiff.element(*counts, i, len)) break;
+        if (!off || !len || (uint64_t)off + len > size) continue;
+        TileHeader th{};
+        th.offset = off;
+        th.length = len;
+        th.width = (uint16_t)tile_width;
+        th.height = (uint16_t)(strips ? std::min<uint64_t>(tile_height, height - y) : tile_height);
+        th.bitDepth = 14;
+        th.cfaPattern = 0;
+        th.x = (i % across) * tile_width;
+        th.y = (uint32_t)y;
+        out.push_back(th);
+    }
+}
+
+} // namespace
+
 bool hefraw::parse_hef_headers(const uint8_t* data, size_t size, ImageHeader& out)
 {
-    bool be=false; uint32_t ifd0=0; if (!is_tiff(data,size,be,ifd0)) return false;
-    auto rd16 = [&](const uint8_t* p){ return be ? (p[0]<<8)|p[1] : (p[1]<<8)|p[0]; };
-    auto rd32 = [&](const uint8_t* p){ return be ? (uint32_t(p[0])<<24)|(uint32_t(p[1])<<16)|(uint32_t(p[2])<<8)|uint32_t(p[3]) : (uint32_t(p[3])<<24)|(uint32_t(p[2])<<16)|(uint32_t(p[1])<<8)|uint32_t(p[0]); };
-    if (ifd0 + 2 > size) return false;
-    const uint8_t* p = data + ifd0;
-    int num = rd16(p); p += 2;
-    uint32_t width=0, height=0, sub_ifds=0;
-    for (int i=0;i<num;i++) {
-        if (p + 12 > data + size) return false;
-        int tag = rd16(p+0);
-        int type = rd16(p+2); (void)type;
-        uint32_t count = rd32(p+4); (void)count;
-        uint32_t val = rd32(p+8);
-        if (tag == 0x0100) width = val;
-        else if (tag == 0x0101) height = val;
-        else if (tag == 0x014A) sub_ifds = val;
-        p += 12;
-    }
-    
-    // If width/height not in IFD0, look in SubIFDs
-    if ((width==0 || height==0) && sub_ifds && sub_ifds + 24 <= size) {
-        for (int sub_idx = 0; sub_idx < 6; sub_idx++) {
-            uint32_t sub_off = rd32(data + sub_ifds + 4 * sub_idx);
-            if (sub_off && sub_off + 2 <= size) {
-                const uint8_t* sp = data + sub_off;
-                int sn = rd16(sp); sp += 2;
-                for (int i=0;i<sn;i++) {
-                    if (sp + 12 > data + size) break;
-                    int tag = rd16(sp+0);
-                    int type = rd16(sp+2); (void)type;
-                    uint32_t count = rd32(sp+4); (void)count;
-                    uint32_t val = rd32(sp+8);
-                    if (tag == 0x0100 && width == 0) width = val;
-                    else if (tag == 0x0101 && height == 0) height = val;
-                    sp += 12;
-                }
-                if (width > 0 && height > 0) break;
-            }
+    if (size < 8) return false;
+    bool be;
+    if (data[0]=='I'&&data[1]=='I'&&data[2]==0x2A&&data[3]==0x00) be = false;
+    else if (data[0]=='M'&&data[1]=='M'&&data[2]==0x00&&data[3]==0x2A) be = true;
+    else return false;
+    MemorySource src(data, size);
+    TiffWalker tiff(src, 0, be);
+    std::vector<IfdEntry> ifd0;
+    if (!tiff.ifd(tiff.rd32(data + 4), ifd0)) return false;
+
+    // The SubIFDs, as many as IFD0 lists
+    std::vector<std::vector<IfdEntry>> subs;
+    if (const IfdEntry* list = find_tag(ifd0, 0x014A)) {
+        for (uint32_t i = 0; i < list->count && i < kMaxSubIfds; i++) {
+            uint32_t off;
+            subs.emplace_back();
+            if (!tiff.element(*list, i, off) || !off || !tiff.ifd(off, subs.back())) subs.pop_back();
         }
     }
-    
+
+    // The frame is the largest SubIFD image with strips, a CFA one if there
+    // is one, else IFD0's size
+    uint32_t width = 0, height = 0;
+    bool cfa = false;
+    for (const auto& sub : subs) {
+        uint32_t w, h;
+        ifd_size(sub, w, h);
+        if (!has_strips(sub) || !w || !h || (cfa && !is_cfa(sub))) continue;
+        if ((is_cfa(sub) && !cfa) || (uint64_t)w * h > (uint64_t)width * height) {
+            width = w;
+            height = h;
+            cfa = is_cfa(sub);
+        }
+    }
+    if (!width || !height) ifd_size(ifd0, width, height);
     if (width==0||height==0) return false;
     out.width = width; out.height = height; out.bitDepth = 14; out.cfaPattern = 0; // defaults
+    out.tiles.clear();
 
-    // Parse all SubIFDs to find tiles with valid StripOffsets/StripByteCounts
-    if (sub_ifds && sub_ifds + 24 <= size) { // 6 SubIFDs * 4 bytes each
-        for (int sub_idx = 0; sub_idx < 6; sub_idx++) {
-            uint32_t sub_off = rd32(data + sub_ifds + 4 * sub_idx);
-            if (sub_off && sub_off + 2 <= size) {
-                const uint8_t* sp = data + sub_off;
-                int sn = rd16(sp); sp += 2;
-                uint32_t so=0, sbc=0;
-                for (int i=0;i<sn;i++) {
-                    if (sp + 12 > data + size) break;
-                    int tag = rd16(sp+0);
-                    int type = rd16(sp+2); (void)type;
-                    uint32_t count = rd32(sp+4); (void)count;
-                    uint32_t val = rd32(sp+8);
-                    if (tag == 0x0111) so = val;
-                    else if (tag == 0x0117) sbc = val;
-                    sp += 12;
-                }
-                if (so && sbc && so + sbc <= size) {
-                    TileHeader th{};
-                    th.offset = so; th.length = sbc; th.width = (uint16_t)width; th.height=(uint16_t)height; th.bitDepth=14; th.cfaPattern=0;
-                    out.tiles.push_back(th);
-                }
-            }
-        }
+    // Index the strips of every SubIFD of the frame's size; one without a
+    // size of its own is taken to be the frame
+    for (const auto& sub : subs) {
+        uint32_t w, h;
+        ifd_size(sub, w, h);
+        if ((w && w != width) || (h && h != height)) continue;
+        index_strips(tiff, sub, width, height, size, out.tiles);
     }
     return !out.tiles.empty(); // require at least one tile
 }
 
+bool hefraw::find_jpeg_preview(const uint8_t* data, size_t size, uint32_t& offset, uint32_t& length)
+{
+    MemorySource src(data, size);
+    if (size < 8) return false;
+    bool be;
+    if (data[0]=='I'&&data[1]=='I'&&data[2]==0x2A&&data[3]==0x00) be = false;
+    else if (data[0]=='M'&&data[1]=='M'&&data[2]==0x00&&data[3]==0x2A) be = true;
+    else return false;
+    TiffWalker tiff(src, 0, be);
+    offset = length = 0;
+
+    // IFD0 and the IFDs chained after it, with the SubIFDs of each
+    std::vector<IfdEntry> entries, sub;
+    uint32_t next = tiff.rd32(data + 4);
+    for (int chain = 0; next && chain < 8; chain++) {
+        if (!tiff.ifd(next, entries, &next)) break;
+        consider_jpeg(src, entries, offset, length);
+        const IfdEntry* subs = find_tag(entries, 0x014A);
+        for (uint32_t i = 0; subs && i < subs->count && i < 16; i++) {
+            uint32_t off;
+            if (tiff.element(*subs, i, off) && tiff.ifd(off, sub)) consider_jpeg(src, sub, offset, length);
+        }
+    }
+    return length > 0;
+}
+
+bool hefraw::detect_hef(const uint8_t* data, size_t size)
+{
+    MemorySource src(data, size);
+    ImageHeader ih;
+    if (parse_hef_headers(data, size, ih)) {
+        for (const auto& tile : ih.tiles) {
+            if (has_tico_signature(src, tile.offset)) return true;
+        }
+    }
+    return detect(src, false);
+}
 
+bool hefraw::detect_hef_file(FILE* fp)
+{
+    const long cur = ftell(fp);
+    if (cur < 0) return false;
+    const bool found = detect(FileSource(fp), true);
+    (void)fseek(fp, cur, SEEK_SET);
+    return found;
+}
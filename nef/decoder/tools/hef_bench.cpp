@@ -0,0 +1,475 @@
+// Decoder benchmark: times assemble_image_cfa16 on one thread and on N
+// threads and reports the speedup. Without an input file it builds a
+// synthetic HE* container of the same shape as a Z-series NEF. With --micro
+// it measures the single-core throughput of the bitstream primitives, with
+// --display the CFA to RGB display conversion, with --region a region
+// decode against a full one, and with --stream a row-streamed decode.
+#include <algorithm>
+#include <chrono>
+#include <cstdint>
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
+#include <fstream>
+#include <iostream>
+#include <random>
+#include <string>
+#include <vector>
+#include <sys/resource.h>
+#include "hef_bitstream.hpp"
+#include "hef_format.hpp"
+#include "hef_decode.hpp"
+#include "hef_display.hpp"
+#include "hef_parallel.hpp"
+
+namespace {
+
+void put16(std::vector<uint8_t>& b, size_t at, uint32_t v)
+{
+    b[at] = v & 0xFF; b[at + 1] = (v >> 8) & 0xFF;
+}
+
+void put32(std::vector<uint8_t>& b, size_t at, uint32_t v)
+{
+    for (int i = 0; i < 4; i++) b[at + i] = (v >> (8 * i)) & 0xFF;
+}
+
+// TicoRAW-like payload: signature header followed by small deltas and runs,
+// long enough to cover width*height pixels.
+std::vector<uint8_t> synthetic_payload(uint32_t width, uint32_t height, std::mt19937& rng)
+{
+    static const uint8_t magic[6] = {0xFF, 0x10, 0xFF, 0x50, 0x00, 0x22};
+    std::vector<uint8_t> p(32 + 16, 0);
+    std::memcpy(p.data(), magic, 6);
+    std::memcpy(p.data() + 6, "CONTACT_INTOPIX_", 16);
+    put32(p, 36, width);
+    put32(p, 40, height);
+    const size_t total = (size_t)width * height;
+    std::uniform_int_distribution<int> delta(-24, 24), run(2, 24), pick(0, 63);
+    for (size_t pixels = 0; pixels < total + total / 16;) {
+        if (pick(rng) == 0) {
+            int n = run(rng);
+            p.insert(p.end(), n, 0x00);
+            pixels += n;
+        } else {
+            int d = delta(rng);
+            if (d == 0 || d == -1) d = 1; // keep clear of zero and 0xFF runs
+            p.push_back((uint8_t)d);
+            pixels++;
+        }
+    }
+    return p;
+}
+
+// Little-endian TIFF with IFD0 pointing at `tiles` SubIFDs, each holding
+// the full frame in `strips` strips.
+std::vector<uint8_t> synthetic_nef(uint32_t width, uint32_t height, unsigned tiles, unsigned strips = 1)
+{
+    std::mt19937 rng(2469);
+    const size_t ifd0 = 8, array = ifd0 + 2 + 12 + 4, subs = array + 4 * tiles;
+    const size_t sub_size = 2 + 5 * 12 + 4;
+    const uint32_t rows = (height + strips - 1) / strips;
+    strips = (height + rows - 1) / rows;
+    std::vector<uint8_t> b(subs + sub_size * tiles, 0);
+    std::memcpy(b.data(), "II*\0", 4);
+    put32(b, 4, ifd0);
+    put16(b, ifd0, 1);
+    put16(b, ifd0 + 2, 0x014A); put16(b, ifd0 + 4, 4);
+    put32(b, ifd0 + 6, tiles); put32(b, ifd0 + 10, tiles == 1 ? subs : array);
+
+    for (unsigned t = 0; t < tiles; t++) {
+        // Strip offsets and byte counts go in the entries' value fields, or
+        // out of line when there are several
+        const size_t sub = subs + sub_size * t;
+        size_t offsets = sub + 2 + 12 * 2 + 8, counts = sub + 2 + 12 * 4 + 8;
+        if (strips > 1) {
+            offsets = b.size();
+            counts = offsets + 4 * strips;
+            b.resize(counts + 4 * strips);
+        }
+        if (tiles > 1) put32(b, array + 4 * t, sub);
+        const uint32_t entries[5][3] = {
+            {0x0100, 1, width}, {0x0101, 1, height}, {0x0111, strips, (uint32_t)offsets},
+            {0x0116, 1, rows}, {0x0117, strips, (uint32_t)counts}};
+        put16(b, sub, 5);
+        for (int e = 0; e < 5; e++) {
+            const size_t at = sub + 2 + 12 * e;
+            put16(b, at, entries[e][0]);
+            put16(b, at + 2, 4);
+            put32(b, at + 4, entries[e][1]);
+            put32(b, at + 8, entries[e][2]);
+        }
+        for (unsigned s = 0; s < strips; s++) {
+            const uint32_t h = std::min(rows, height - s * rows);
+            std::vector<uint8_t> payload = synthetic_payload(width, h, rng);
+            put32(b, offsets + 4 * s, (uint32_t)b.size());
+            put32(b, counts + 4 * s, (uint32_t)payload.size());
+            b.insert(b.end(), payload.begin(), payload.end());
+        }
+    }
+    return b;
+}
+
+uint64_t checksum(const std::vector<uint16_t>& cfa)
+{
+    uint64_t h = 1469598103934665603ull; // FNV-1a
+    for (uint16_t v : cfa) {
+        h = (h ^ (v & 0xFF)) * 1099511628211ull;
+        h = (h ^ (v >> 8)) * 1099511628211ull;
+    }
+    return h;
+}
+
+// Best wall time of `repeat` decodes, in seconds
+double time_decode(const hefraw::ImageHeader& header, const std::vector<uint8_t>& data,
+                   unsigned threads, int repeat, std::vector<uint16_t>& cfa, unsigned scale = 1)
+{
+    hefraw::DecodeOptions opts;
+    opts.threads = threads;
+    opts.scale = scale;
+    double best = 1e30;
+    for (int r = 0; r < repeat; r++) {
+        auto start = std::chrono::steady_clock::now();
+        if (!hefraw::assemble_image_cfa16(header, data.data(), data.size(), cfa, opts)) return -1;
+        std::chrono::duration<double> took = std::chrono::steady_clock::now() - start;
+        best = std::min(best, took.count());
+    }
+    return best;
+}
+
+// Best wall time of `repeat` runs of fn, in seconds
+template <typename Fn>
+double best_of(int repeat, Fn&& fn)
+{
+    double best = 1e30;
+    for (int r = 0; r < repeat; r++) {
+        auto start = std::chrono::steady_clock::now();
+        fn();
+        std::chrono::duration<double> took = std::chrono::steady_clock::now() - start;
+        best = std::min(best, took.count());
+    }
+    return best;
+}
+
+// LSB-first bit packer matching BitReader
+struct BitWriter {
+    std::vector<uint8_t> bytes;
+    uint64_t acc = 0;
+    unsigned bits = 0;
+    void put(uint32_t v, unsigned n)
+    {
+        acc |= (uint64_t)v << bits;
+        for (bits += n; bits >= 8; bits -= 8, acc >>= 8) bytes.push_back(acc & 0xFF);
+    }
+    void flush()
+    {
+        if (bits) bytes.push_back(acc & 0xFF);
+        acc = bits = 0;
+    }
+};
+
+// Throughput of the bitstream primitives on one core
+int micro(int repeat)
+{
+    std::mt19937 rng(41);
+    const size_t size = 16u << 20;
+    std::vector<uint8_t> random(size);
+    for (auto& b : random) b = rng() & 0xFF;
+    auto report = [](const char* what, double bytes, double secs, const char* extra = "") {
+        std::printf("%-22s %8.1f MB/s%s\n", what, bytes / 1e6 / secs, extra);
+    };
+
+    // Fixed-width fields through the public readBits API
+    volatile uint32_t sink = 0;
+    double t = best_of(repeat, [&] {
+        hefraw::BitReader br(random.data(), random.size());
+        uint32_t acc = 0;
+        for (size_t n = size * 8 / 13; n; n--) acc += br.readBits(13);
+        sink = acc;
+    });
+    report("readBits(13)", size, t);
+
+    // Complete prefix code over 32 symbols, two of each length 2..16, with
+    // symbols skewed towards short codes like prediction residuals
+    std::vector<uint8_t> lengths(32, 16);
+    for (size_t s = 0; s < 30; s++) lengths[s] = (uint8_t)(2 + s / 2);
+    hefraw::VlcTable table;
+    if (!table.build(lengths)) {
+        std::cerr << "Failed to build VLC table\n";
+        return 1;
+    }
+    // Canonical codes as the table assigns them, to encode a test stream
+    std::vector<uint32_t> codes(lengths.size()), next(18, 0), count(18, 0);
+    for (uint8_t len : lengths) count[len]++;
+    for (unsigned len = 1, code = 0; len <= 16; len++) next[len] = code = (code + (len > 1 ? count[len - 1] : 0)) << 1;
+    for (size_t s = 0; s < lengths.size(); s++) codes[s] = next[lengths[s]]++;
+    std::geometric_distribution<int> skew(0.15);
+    std::vector<uint16_t> symbols(4u << 20);
+    BitWriter bw;
+    for (auto& sym : symbols) {
+        sym = (uint16_t)std::min<int>(skew(rng), 31);
+        for (int b = lengths[sym] - 1; b >= 0; b--) bw.put((codes[sym] >> b) & 1, 1);
+    }
+    bw.flush();
+    std::vector<uint16_t> decoded(symbols.size());
+    char extra[64];
+
+    t = best_of(repeat, [&] {
+        hefraw::BitReader br(bw.bytes.data(), bw.bytes.size());
+        for (auto& sym : decoded) sym = (uint16_t)br.decode(table);
+    });
+    std::snprintf(extra, sizeof(extra), "  %6.1f Msym/s", symbols.size() / 1e6 / t);
+    report("VLC decode", bw.bytes.size(), t, extra);
+    bool same = decoded == symbols;
+
+    size_t got = 0;
+    t = best_of(repeat, [&] {
+        hefraw::BitReader br(bw.bytes.data(), bw.bytes.size());
+        got = br.decodeMany(table, decoded.data(), decoded.size());
+    });
+    std::snprintf(extra, sizeof(extra), "  %6.1f Msym/s", symbols.size() / 1e6 / t);
+    report("VLC decodeMany", bw.bytes.size(), t, extra);
+    same = same && got == symbols.size() && decoded == symbols;
+
+    // TicoRAW payload of a 20 MP tile
+    std::vector<uint8_t> payload = synthetic_payload(5600, 3728, rng);
+    hefraw::TileHeader th{0, (uint32_t)payload.size(), 5600, 3728, 14, 0, 0, 0};
+    std::vector<uint16_t> cfa((size_t)th.width * th.height);
+    t = best_of(repeat, [&] {
+        hefraw::decode_tile_into(payload.data(), payload.size(), th, hefraw::CfaRegion{cfa.data(), th.width});
+    });
+    std::snprintf(extra, sizeof(extra), "  %6.1f MP/s", (double)cfa.size() / 1e6 / t);
+    report("TicoRAW tile", payload.size(), t, extra);
+
+    if (!same) {
+        std::cerr << "VLC round trip MISMATCH\n";
+        return 2;
+    }
+    return 0;
+}
+
+// Megapixels per second of the display conversion, against a plain
+// per-pixel grey conversion
+void display(const hefraw::ImageHeader& header, const std::vector<uint16_t>& cfa, unsigned threads, int repeat)
+{
+    const double mp = (double)header.width * header.height / 1e6;
+    std::vector<uint32_t> argb((size_t)header.width * header.height);
+    double t = best_of(repeat, [&] {
+        for (size_t i = 0; i < cfa.size(); i++) {
+            const uint32_t v = (cfa[i] >> 6) & 0xFF;
+            argb[i] = 0xFF000000u | v << 16 | v << 8 | v;
+        }
+    });
+    std::printf("%-24s %8.1f ms  %7.1f MP/s\n", "grey (val >> 6)", t * 1e3, mp / t);
+
+    for (bool half : {false, true}) {
+        for (unsigned n : {1u, threads}) {
+            hefraw::DisplayOptions opts;
+            opts.half_size = half;
+            opts.threads = n;
+            t = best_of(repeat, [&] {
+                hefraw::cfa16_to_argb(cfa.data(), header.width, header.height, opts, argb.data());
+            });
+            char what[64];
+            std::snprintf(what, sizeof(what), "%s, %u thread%s", half ? "superpixel" : "bilinear", n, n == 1 ? "" : "s");
+            std::printf("%-24s %8.1f ms  %7.1f MP/s\n", what, t * 1e3, mp / t);
+            if (n == threads && threads == 1) break;
+        }
+    }
+}
+
+// Time of a region decode against a full one, checking it against the crop
+int region(const hefraw::ImageHeader& header, const std::vector<uint8_t>& data, unsigned threads,
+           int repeat, uint32_t x, uint32_t y, uint32_t width, uint32_t height)
+{
+    hefraw::DecodeOptions opts;
+    opts.threads = threads;
+    std::vector<uint16_t> full, crop;
+    const double tf = time_decode(header, data, threads, repeat, full);
+    bool ok = tf >= 0;
+    const double tr = best_of(repeat, [&] {
+        ok = ok && hefraw::decode_region(header, data.data(), data.size(), x, y, width, height, crop, opts);
+    });
+    if (!ok) {
+        std::cerr << "Failed to decode CFA\n";
+        return 1;
+    }
+    bool same = true;
+    for (uint32_t r = 0; r < height && same; r++) {
+        for (uint32_t c = 0; c < width && same; c++) {
+            const bool inside = x + c < header.width && y + r < header.height;
+            same = crop[(size_t)r * width + c] == (inside ? full[(size_t)(y + r) * header.width + x + c] : 0);
+        }
+    }
+    std::printf("full frame: %8.1f ms\n", tf * 1e3);
+    std::printf("    region: %8.1f ms  %ux%u+%u+%u, %.1f%% of the frame%s\n", tr * 1e3, width, height, x, y,
+                100.0 * width * height / ((double)header.width * header.height), same ? "" : "  MISMATCH");
+    return same ? 0 : 2;
+}
+
+// Peak resident memory in MiB: since the last reset_peak() where Linux
+// allows resetting it, otherwise since the process started
+double peak_mib()
+{
+    std::ifstream status("/proc/self/status");
+    for (std::string line; std::getline(status, line);) {
+        if (line.compare(0, 6, "VmHWM:") == 0) return std::atof(line.c_str() + 6) / 1024.0;
+    }
+    struct rusage ru;
+    getrusage(RUSAGE_SELF, &ru);
+    return ru.ru_maxrss / 1024.0;
+}
+
+// Start measuring peak memory from the current resident size
+double reset_peak()
+{
+    std::ofstream("/proc/self/clear_refs") << "5";
+    return peak_mib();
+}
+
+// Time of a streamed decode against a full one, and how far each raises the
+// peak memory. A last streamed pass hashes the rows as they arrive, which
+// must match the full frame's checksum.
+int stream(const hefraw::ImageHeader& header, const std::vector<uint8_t>& data, unsigned threads,
+           int repeat, uint32_t band_rows)
+{
+    hefraw::DecodeOptions opts;
+    opts.threads = threads;
+    double base = reset_peak();
+    size_t bands = 0;
+    bool ok = true;
+    const double ts = best_of(repeat, [&] {
+        bands = 0;
+        ok = ok && hefraw::decode_rows(header, data.data(), data.size(), band_rows,
+                                       [&](uint32_t, uint32_t, const uint16_t*) { ++bands; return true; }, opts);
+    });
+    const double streamed_peak = peak_mib() - base;
+
+    uint64_t hash = 1469598103934665603ull;
+    const size_t width = header.width;
+    ok = ok && hefraw::decode_rows(header, data.data(), data.size(), band_rows,
+                                   [&](uint32_t, uint32_t rows, const uint16_t* px) {
+        for (size_t i = 0; i < rows * width; i++) {
+            hash = (hash ^ (px[i] & 0xFF)) * 1099511628211ull;
+            hash = (hash ^ (px[i] >> 8)) * 1099511628211ull;
+        }
+        return true;
+    }, opts);
+
+    std::vector<uint16_t> full;
+    base = reset_peak();
+    const double tf = time_decode(header, data, threads, repeat, full);
+    const double full_peak = peak_mib() - base;
+    if (!ok || tf < 0) {
+        std::cerr << "Failed to decode CFA\n";
+        return 1;
+    }
+    const bool same = hash == checksum(full);
+    std::printf("full frame: %8.1f ms  +%6.1f MiB peak\n", tf * 1e3, full_peak);
+    std::printf("  streamed: %8.1f ms  +%6.1f MiB peak  %zu bands of %u rows%s\n", ts * 1e3, streamed_peak,
+                bands, band_rows, same ? "" : "  MISMATCH");
+    return same ? 0 : 2;
+}
+
+void usage(const char* argv0)
+{
+    std::cerr << "Usage: " << argv0 << " [--threads N] [--repeat R] [--size WxH] [--tiles T] [--strips S]\n"
+              << "       " << std::string(std::strlen(argv0), ' ')
+              << " [--scale S | --region WxH+X+Y | --stream ROWS] [input.nef]\n"
+              << "       " << argv0 << " --micro [--repeat R]\n"
+              << "       " << argv0 << " --display [--threads N] [--repeat R] [--size WxH] [input.nef]\n"
+              << "  Without an input, decodes a synthetic WxH frame (default 5600x3728, 2 tiles\n"
+              << "  of one strip each).\n";
+}
+
+} // namespace
+
+int main(int argc, char* argv[])
+{
+    unsigned threads = 0, tiles = 2, strips = 1, scale = 1, band_rows = 0;
+    uint32_t rx = 0, ry = 0, rw = 0, rh = 0;
+    int repeat = 3;
+    bool run_micro = false, run_display = false;
+    uint32_t width = 5600, height = 3728;
+    const char* input = nullptr;
+    for (int i = 1; i < argc; i++) {
+        std::string arg = argv[i];
+        bool has_value = i + 1 < argc;
+        if (arg == "--micro") run_micro = true;
+        else if (arg == "--display") run_display = true;
+        else if (arg == "--threads" && has_value) threads = std::atoi(argv[++i]);
+        else if (arg == "--repeat" && has_value) repeat = std::max(1, std::atoi(argv[++i]));
+        else if (arg == "--scale" && has_value) scale = std::atoi(argv[++i]);
+        else if (arg == "--tiles" && has_value) tiles = std::max(1, std::atoi(argv[++i]));
+        else if (arg == "--strips" && has_value) strips = std::max(1, std::atoi(argv[++i]));
+        else if (arg == "--stream" && has_value) band_rows = std::max(1, std::atoi(argv[++i]));
+        else if (arg == "--region" && has_value) {
+            if (std::sscanf(argv[++i], "%ux%u+%u+%u", &rw, &rh, &rx, &ry) != 4 || !rw || !rh) {
+                usage(argv[0]);
+                return 1;
+            }
+        }
+        else if (arg == "--size" && has_value) {
+            if (std::sscanf(argv[++i], "%ux%u", &width, &height) != 2 || !width || !height) {
+                usage(argv[0]);
+                return 1;
+            }
+        }
+        else if (arg[0] != '-' && !input) input = argv[i];
+        else {
+            usage(argv[0]);
+            return 1;
+        }
+    }
+
+    if (run_micro) return micro(repeat);
+
+    std::vector<uint8_t> data;
+    if (input) {
+        std::ifstream file(input, std::ios::binary);
+        if (!file) {
+            std::cerr << "Cannot open " << input << "\n";
+            return 1;
+        }
+        data.assign(std::istreambuf_iterator<char>(file), std::istreambuf_iterator<char>());
+    } else {
+        data = synthetic_nef(width, height, tiles, strips);
+    }
+
+    hefraw::ImageHeader header;
+    if (!hefraw::parse_hef_headers(data.data(), data.size(), header)) {
+        std::cerr << "Failed to parse HE* headers\n";
+        return 1;
+    }
+    threads = hefraw::resolve_threads(threads);
+    const double mp = (double)header.width * header.height / 1e6;
+    std::cout << (input ? input : "synthetic") << ": " << header.width << "x" << header.height
+              << ", " << header.tiles.size() << " tiles, " << data.size() / 1048576.0 << " MiB\n";
+
+    if (rw) return region(header, data, threads, repeat, rx, ry, rw, rh);
+    if (band_rows) return stream(header, data, threads, repeat, band_rows);
+
+    std::vector<uint16_t> serial, parallel;
+    if (run_display) {
+        if (time_decode(header, data, threads, 1, serial) < 0) {
+            std::cerr << "Failed to decode CFA\n";
+            return 1;
+        }
+        display(header, serial, threads, repeat);
+        return 0;
+    }
+
+    double t1 = time_decode(header, data, 1, repeat, serial, scale);
+    double tn = time_decode(header, data, threads, repeat, parallel, scale);
+    if (t1 < 0 || tn < 0) {
+        std::cerr << "Failed to decode CFA\n";
+        return 1;
+    }
+    std::printf("  1 thread:  %8.1f ms  %7.1f MP/s\n", t1 * 1e3, mp / t1);
+    std::printf("%3u threads: %8.1f ms  %7.1f MP/s\n", threads, tn * 1e3, mp / tn);
+    std::printf("    speedup: %8.2fx\n", t1 / tn);
+    std::printf("     output: %8.1f MiB\n", parallel.size() * 2 / 1048576.0);
+    std::printf("   checksum: %016llx%s\n", (unsigned long long)checksum(parallel),
+                checksum(serial) == checksum(parallel) ? "" : "  MISMATCH");
+    return checksum(serial) == checksum(parallel) ? 0 : 2;
+}
@@ -1,37 +1,268 @@
 #include <iostream>
-#include <fstream>
+#include <string>
 #include <vector>
+#include <algorithm>
+#include <atomic>
+#include <chrono>
+#include <condition_variable>
+#include <deque>
+#include <filesystem>
+#include <memory>
+#include <mutex>
+#include <thread>
+#include <cstdio>
 #include <cstring>
+#include <cstdlib>
 #include "hef_format.hpp"
 #include "hef_decode.hpp"
+#include "hef_export.hpp"
+#include "hef_mmap.hpp"
+
+static bool ends_with(const std::string& s, const char* suffix)
+{
+    const size_t n = std::strlen(suffix);
+    return s.size() >= n && s.compare(s.size() - n, n, suffix) == 0;
+}
+
+// Write a decoded frame: a DNG, an RGB TIFF for scaled decodes, or a CFA TIFF
+static bool write_output(const std::vector<uint16_t>& frame, uint32_t width, uint32_t height,
+                         const hefraw::ImageHeader& header, const hefraw::DecodeOptions& opts, bool dng,
+                         const std::string& path, const hefraw::ExportOptions& export_opts)
+{
+    if (dng) return hefraw::export_cfa16_to_dng(frame, width, height, header.cfaPattern, path, export_opts);
+    if (opts.scale != 1) return hefraw::export_rgb16_to_tiff(frame, width, height, path, export_opts);
+    return hefraw::export_cfa16_to_tiff(frame, width, height, path, export_opts);
+}
+
+// Fixed-capacity FIFO between two pipeline stages. push() blocks while the
+// queue is full and pop() while it is empty; once closed, pop() drains what
+// is left and then returns false.
+template <typename T>
+class BoundedQueue {
+public:
+    explicit BoundedQueue(size_t capacity) : capacity_(capacity) {}
+
+    void push(T item)
+    {
+        std::unique_lock<std::mutex> lock(mutex_);
+        not_full_.wait(lock, [&] { return items_.size() < capacity_; });
+        items_.push_back(std::move(item));
+        not_empty_.notify_one();
+    }
+
+    bool pop(T& item)
+    {
+        std::unique_lock<std::mutex> lock(mutex_);
+        not_empty_.wait(lock, [&] { return !items_.empty() || closed_; });
+        if (items_.empty()) return false;
+        item = std::move(items_.front());
+        items_.pop_front();
+        not_full_.notify_one();
+        return true;
+    }
+
+    void close()
+    {
+        std::lock_guard<std::mutex> lock(mutex_);
+        closed_ = true;
+        not_empty_.notify_all();
+    }
+
+private:
+    const size_t capacity_;
+    std::deque<T> items_;
+    bool closed_ = false;
+    std::mutex mutex_;
+    std::condition_variable not_full_, not_empty_;
+};
+
+// One file on its way through the batch pipeline
+struct Job {
+    std::string input, output;
+    hefraw::MappedFile file;
+    hefraw::ImageHeader header;
+    std::vector<uint16_t> frame;
+    uint32_t width = 0, height = 0;
+    std::chrono::steady_clock::time_point start;
+};
+
+// Convert every NEF in in_dir into out_dir. A reader thread maps and parses
+// the next files, `jobs` decoders work on as many frames at once and as many
+// writers compress and write finished frames, so reading, decoding and
+// writing overlap. Queues of `jobs` entries between the stages bound the
+// frames in memory at about 4 x jobs. Outputs newer than their input are
+// skipped.
+static int convert_directory(const std::string& in_dir, const std::string& out_dir, unsigned jobs,
+                             hefraw::DecodeOptions opts, hefraw::ExportOptions export_opts, bool dng)
+{
+    namespace fs = std::filesystem;
+    std::error_code ec;
+    fs::create_directories(out_dir, ec);
+    std::vector<fs::path> inputs;
+    for (fs::directory_iterator it(in_dir, ec), end; !ec && it != end; it.increment(ec)) {
+        const std::string ext = it->path().extension().string();
+        if (it->is_regular_file() && (ext == ".nef" || ext == ".NEF")) inputs.push_back(it->path());
+    }
+    if (ec) {
+        std::cerr << "Cannot read " << in_dir << ": " << ec.message() << "\n";
+        return 1;
+    }
+    std::sort(inputs.begin(), inputs.end());
+
+    // Parallelism comes from converting several files at once, so each
+    // frame is decoded and compressed on one thread unless asked otherwise
+    if (!opts.threads) opts.threads = 1;
+    if (!export_opts.threads) export_opts.threads = 1;
+
+    std::mutex log_mutex;
+    size_t converted = 0, skipped = 0, failed = 0;
+    uint64_t bytes_in = 0, bytes_out = 0, pixels = 0;
+    auto report = [&](const Job& job, const char* error) {
+        std::lock_guard<std::mutex> lock(log_mutex);
+        if (error) {
+            failed++;
+            std::cerr << job.input << ": " << error << "\n";
+            return;
+        }
+        const double ms = std::chrono::duration<double, std::milli>(std::chrono::steady_clock::now() - job.start).count();
+        std::error_code size_ec;
+        converted++;
+        bytes_in += job.file.size();
+        bytes_out += fs::file_size(job.output, size_ec);
+        pixels += (uint64_t)job.header.width * job.header.height;
+        std::cout << job.input << " -> " << job.output << " (" << (long)ms << " ms)\n";
+    };
+
+    BoundedQueue<std::unique_ptr<Job>> to_decode(jobs), to_write(jobs);
+    const auto start = std::chrono::steady_clock::now();
+
+    std::thread reader([&] {
+        for (const fs::path& input : inputs) {
+            auto job = std::make_unique<Job>();
+            job->start = std::chrono::steady_clock::now();
+            job->input = input.string();
+            job->output = (fs::path(out_dir) / input.stem()).string() + (dng ? ".dng" : ".tiff");
+            std::error_code out_ec, in_ec;
+            const auto out_time = fs::last_write_time(job->output, out_ec);
+            const auto in_time = fs::last_write_time(input, in_ec);
+            if (!out_ec && !in_ec && out_time >= in_time) {
+                std::lock_guard<std::mutex> lock(log_mutex);
+                skipped++;
+                continue;
+            }
+            if (!job->file.open(job->input)) {
+                report(*job, "cannot open");
+                continue;
+            }
+            // Fault the pages in here so the decoders never wait on the disk
+            volatile uint8_t sink = 0;
+            for (size_t i = 0; i < job->file.size(); i += 4096) sink += job->file.data()[i];
+            (void)sink;
+            if (!hefraw::parse_hef_headers(job->file.data(), job->file.size(), job->header)) {
+                report(*job, "failed to parse HE* headers");
+                continue;
+            }
+            to_decode.push(std::move(job));
+        }
+        to_decode.close();
+    });
+
+    std::atomic<unsigned> decoding{jobs};
+    std::vector<std::thread> workers;
+    for (unsigned i = 0; i < jobs; i++) {
+        workers.emplace_back([&] {
+            for (std::unique_ptr<Job> job; to_decode.pop(job);) {
+                if (!hefraw::assemble_image_cfa16(job->header, job->file.data(), job->file.size(), job->frame, opts)) {
+                    report(*job, "failed to decode");
+                    continue;
+                }
+                hefraw::scaled_size(job->header.width, job->header.height, opts.scale, job->width, job->height);
+                to_write.push(std::move(job));
+            }
+            if (--decoding == 0) to_write.close();
+        });
+        workers.emplace_back([&] {
+            for (std::unique_ptr<Job> job; to_write.pop(job);) {
+                // Write beside the output and rename, so an interrupted run
+                // never leaves a partial file that looks up to date
+                const std::string part = job->output + ".part";
+                if (!write_output(job->frame, job->width, job->height, job->header, opts, dng, part, export_opts) ||
+                    std::rename(part.c_str(), job->output.c_str()) != 0) {
+                    std::remove(part.c_str());
+                    report(*job, "cannot write output");
+                    continue;
+                }
+                report(*job, nullptr);
+            }
+        });
+    }
+    reader.join();
+    for (auto& worker : workers) worker.join();
+
+    const double seconds = std::chrono::duration<double>(std::chrono::steady_clock::now() - start).count();
+    const double rate = seconds > 0 ? 1.0 / seconds : 0.0;
+    std::printf("%zu converted, %zu up to date, %zu failed in %.2f s with %u jobs\n",
+                converted, skipped, failed, seconds, jobs);
+    std::printf("%.2f files/s, %.1f MP/s, %.1f MB/s read, %.1f MB/s written\n",
+                converted * rate, pixels * rate / 1e6, bytes_in * rate / 1e6, bytes_out * rate / 1e6);
+    return failed ? 1 : 0;
+}
 
 int main(int argc, char* argv[]) {
-    if (argc != 3) {
-        std::cerr << "Usage: " << argv[0] << " <input.nef> <output.tiff>\n";
+    // --scale N: 2, 4 or 8 writes a binned RGB image instead of CFA.
+    // --deflate or --ljpeg compress the output, the latter for DNG only;
+    // an output name ending in .dng writes a DNG instead of a TIFF.
+    // --jobs N converts a directory, writing DNGs with --dng.
+    hefraw::DecodeOptions opts;
+    hefraw::ExportOptions export_opts;
+    int arg = 1, jobs = 0;
+    bool usage = false, dng_dir = false;
+    for (; arg < argc && std::strncmp(argv[arg], "--", 2) == 0; arg++) {
+        if (std::strcmp(argv[arg], "--deflate") == 0) {
+            export_opts.compression = hefraw::Compression::Deflate;
+        } else if (std::strcmp(argv[arg], "--ljpeg") == 0) {
+            export_opts.compression = hefraw::Compression::LosslessJpeg;
+        } else if (std::strcmp(argv[arg], "--scale") == 0 && arg + 1 < argc) {
+            opts.scale = std::atoi(argv[++arg]);
+        } else if (std::strcmp(argv[arg], "--threads") == 0 && arg + 1 < argc) {
+            opts.threads = export_opts.threads = std::atoi(argv[++arg]);
+        } else if (std::strcmp(argv[arg], "--jobs") == 0 && arg + 1 < argc) {
+            jobs = std::atoi(argv[++arg]);
+            usage |= jobs < 1;
+        } else if (std::strcmp(argv[arg], "--dng") == 0) {
+            dng_dir = true;
+        } else {
+            usage = true;
+        }
+    }
+    const bool dng = jobs ? dng_dir
+                          : arg + 1 < argc && (ends_with(argv[arg + 1], ".dng") || ends_with(argv[arg + 1], ".DNG"));
+    if (usage || argc - arg != 2 || (opts.scale != 1 && opts.scale != 2 && opts.scale != 4 && opts.scale != 8) ||
+        (dng && opts.scale != 1) || (!dng && export_opts.compression == hefraw::Compression::LosslessJpeg) ||
+        (dng_dir && !jobs)) {
+        std::cerr << "Usage: " << argv[0] << " [--scale 1|2|4|8] [--deflate | --ljpeg] [--threads N]"
+                  << " <input.nef> <output.tiff|output.dng>\n"
+                  << "       " << argv[0] << " --jobs N [--dng] [options] <in_dir> <out_dir>\n"
+                  << "  DNG output is full size; --ljpeg needs DNG output\n";
         return 1;
     }
+    if (jobs) return convert_directory(argv[arg], argv[arg + 1], jobs, opts, export_opts, dng);
     
-    const char* input_path = argv[1];
-    const char* output_path = argv[2];
+    const char* input_path = argv[arg];
+    const char* output_path = argv[arg + 1];
     
-    // Read file
-    std::ifstream file(input_path, std::ios::binary);
-    if (!file) {
+    // Map the file rather than reading it onto the heap
+    hefraw::MappedFile file;
+    if (!file.open(input_path)) {
         std::cerr << "Cannot open " << input_path << "\n";
         return 1;
     }
-    
-    file.seekg(0, std::ios::end);
-    size_t file_size = file.tellg();
-    file.seekg(0, std::ios::beg);
-    
-    std::vector<uint8_t> file_data(file_size);
-    file.read(reinterpret_cast<char*>(file_data.data()), file_size);
-    file.close();
+    const uint8_t* file_data = file.data();
+    const size_t file_size = file.size();
     
     // Parse headers
     hefraw::ImageHeader header;
-    if (!hefraw::parse_hef_headers(file_data.data(), file_size, header)) {
+    if (!hefraw::parse_hef_headers(file_data, file_size, header)) {
         std::cerr << "Failed to parse HE* headers\n";
         std::cerr << "File size: " << file_size << "\n";
         std::cerr << "First 8 bytes: ";
@@ -55,79 +286,23 @@ int main(int argc, char* argv[]) {
     std::cout << "Image: " << header.width << "x" << header.height << "\n";
     std::cout << "Tiles: " << header.tiles.size() << "\n";
     
-    // Decode CFA
+    // Decode CFA, or RGB when scaled
     std::vector<uint16_t> cfa;
-    if (!hefraw::assemble_image_cfa16(header, file_data.data(), file_size, cfa)) {
+    if (!hefraw::assemble_image_cfa16(header, file_data, file_size, cfa, opts)) {
         std::cerr << "Failed to decode CFA\n";
         return 1;
     }
     
-    std::cout << "Decoded " << cfa.size() << " pixels\n";
+    uint32_t width, height;
+    hefraw::scaled_size(header.width, header.height, opts.scale, width, height);
+    std::cout << "Decoded " << (size_t)width * height << " pixels";
+    if (opts.scale != 1) std::cout << " (1/" << opts.scale << " size RGB)";
+    std::cout << "\n";
     
-    // Simple 16-bit TIFF writer (minimal)
-    std::ofstream out(output_path, std::ios::binary);
-    if (!out) {
-        std::cerr << "Cannot create " << output_path << "\n";
+    if (!write_output(cfa, width, height, header, opts, dng, output_path, export_opts)) {
+        std::cerr << "Cannot write " << output_path << "\n";
         return 1;
     }
-    
-    // Write minimal TIFF header
-    uint8_t tiff_header[] = {
-        'I', 'I', 0x2A, 0x00,  // Little-endian TIFF magic
-        0x08, 0x00, 0x00, 0x00, // IFD offset
-    };
-    out.write(reinterpret_cast<char*>(tiff_header), sizeof(tiff_header));
-    
-    // Write IFD
-    uint16_t num_entries = 8;
-    out.write(reinterpret_cast<char*>(&num_entries), 2);
-    
-    // ImageWidth (0x0100) - write actual width
-    uint8_t width_entry[] = {0x00, 0x01, 0x03, 0x00, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00};
-    *reinterpret_cast<uint32_t*>(width_entry + 8) = header.width;
-    out.write(reinterpret_cast<char*>(width_entry), 12);
-    
-    // ImageLength (0x0101) - write actual height
-    uint8_t height_entry[] = {0x01, 0x01, 0x03, 0x00, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00};
-    *reinterpret_cast<uint32_t*>(height_entry + 8) = header.height;
-    out.write(reinterpret_cast<char*>(height_entry), 12);
-    
-    // BitsPerSample (0x0102) - 16 bits
-    uint8_t bps_entry[] = {0x02, 0x01, 0x03, 0x00, 0x01, 0x00, 0x00, 0x00, 0x10, 0x00, 0x00, 0x00};
-    out.write(reinterpret_cast<char*>(bps_entry), 12);
-    
-    // Compression (0x0103) - uncompressed
-    uint8_t comp_entry[] = {0x03, 0x01, 0x03, 0x00, 0x01, 0x00, 0x00, 0x00, 0x01, 0x00, 0x00, 0x00};
-    out.write(reinterpret_cast<char*>(comp_entry), 12);
-    
-    // PhotometricInterpretation (0x0106) - CFA
-    uint8_t photo_entry[] = {0x06, 0x01, 0x03, 0x00, 0x01, 0x00, 0x00, 0x00, 0x02, 0x00, 0x00, 0x00};
-    out.write(reinterpret_cast<char*>(photo_entry), 12);
-    
-    // StripOffsets (0x0111) - offset to image data
-    uint32_t data_offset = 8 + 2 + (8 * 12) + 4; // header + num_entries + entries + next_ifd
-    uint8_t so_entry[] = {0x11, 0x01, 0x04, 0x00, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00};
-    *reinterpret_cast<uint32_t*>(so_entry + 8) = data_offset;
-    out.write(reinterpret_cast<char*>(so_entry), 12);
-    
-    // SamplesPerPixel (0x0115)
-    uint8_t spp_entry[] = {0x15, 0x01, 0x03, 0x00, 0x01, 0x00, 0x00, 0x00, 0x01, 0x00, 0x00, 0x00};
-    out.write(reinterpret_cast<char*>(spp_entry), 12);
-    
-    // StripByteCounts (0x0117) - size of image data
-    uint32_t data_size = cfa.size() * 2;
-    uint8_t sbc_entry[] = {0x17, 0x01, 0x04, 0x00, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00};
-    *reinterpret_cast<uint32_t*>(sbc_entry + 8) = data_size;
-    out.write(reinterpret_cast<char*>(sbc_entry), 12);
-    
-    // Next IFD offset (0)
-    uint32_t next_ifd = 0;
-    out.write(reinterpret_cast<char*>(&next_ifd), 4);
-    
-    // Write image data
-    out.write(reinterpret_cast<char*>(cfa.data()), cfa.size() * 2);
-    
-    out.close();
     std::cout << "Exported to " << output_path << "\n";
     
     return 0;
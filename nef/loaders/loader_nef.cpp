@@ -3,14 +3,20 @@
 #include <string.h>
 #include <stdint.h>
 #include <stdio.h>
+#include <setjmp.h>
+#include <fnmatch.h>
+#include <string>
 #include <vector>
 
+#include <jpeglib.h>
+
 #include <Imlib2.h>
 #include <Imlib2_Loader.h>
 
 /* Include our decoder headers */
 #include "../decoder/include/hef_format.hpp"
 #include "../decoder/include/hef_decode.hpp"
+#include "../decoder/include/hef_display.hpp"
 
 using namespace hefraw;
 
@@ -27,51 +33,115 @@ static int is_tiff_magic(const uint8_t *b, int len)
     return 0;
 }
 
-/* Heuristic detection of Nikon HE* quality marker */
-static int looks_like_nikon_he_star(FILE *fp)
+/* Browse mode: HEFRAW_PREVIEW=1 shows the embedded JPEG preview instead of
+ * decoding the HE* data, which is only decoded for files without one.
+ * HEFRAW_PREVIEW=2, 4 or 8 also scales the preview down while decoding. */
+static int preview_scale(void)
 {
-    long cur = ftell(fp);
-    if (cur < 0) return 0;
-    if (fseek(fp, 0, SEEK_SET) != 0) return 0;
-    
-    /* Check for TicoRAW signature in the main payload area (around offset 4.5MB) */
-    if (fseek(fp, 4500000, SEEK_SET) == 0) {
-        uint8_t sig_check[32];
-        if (fread(sig_check, 1, 32, fp) == 32) {
-            if (memcmp(sig_check + 6, "CONTACT_INTOPIX_", 16) == 0) {
-                (void)fseek(fp, cur, SEEK_SET);
-                return 1; /* Found TicoRAW signature */
-            }
-        }
+    const char *v = getenv("HEFRAW_PREVIEW");
+    if (!v || !*v || strcmp(v, "0") == 0) return 0;
+    int n = atoi(v);
+    return (n == 2 || n == 4 || n == 8) ? n : 1;
+}
+
+/* HEFRAW_FULL=PATTERN[:PATTERN...] decodes matching files in full even in
+ * browse mode; a pattern matches the whole path or just the file name */
+static int force_full_decode(const char *path)
+{
+    const char *v = getenv("HEFRAW_FULL");
+    if (!v || !*v || !path) return 0;
+    const char *base = strrchr(path, '/');
+    base = base ? base + 1 : path;
+    std::string patterns(v);
+    size_t start = 0;
+    while (start <= patterns.size()) {
+        size_t end = patterns.find(':', start);
+        if (end == std::string::npos) end = patterns.size();
+        std::string pattern = patterns.substr(start, end - start);
+        if (!pattern.empty() &&
+            (fnmatch(pattern.c_str(), path, 0) == 0 || fnmatch(pattern.c_str(), base, 0) == 0))
+            return 1;
+        start = end + 1;
     }
-    
-    /* Fallback: scan entire file for HE* marker (but limit to reasonable size) */
-    if (fseek(fp, 0, SEEK_SET) != 0) return 0;
-    const size_t MAX_SCAN = 20 << 20; /* 20 MiB - enough for our test file */
-    uint8_t *buf = (uint8_t *)malloc(MAX_SCAN);
-    if (!buf) { (void)fseek(fp, cur, SEEK_SET); return 0; }
-    size_t n = fread(buf, 1, MAX_SCAN, fp);
-    /* Restore file position */
-    (void)fseek(fp, cur, SEEK_SET);
-    if (n == 0) { free(buf); return 0; }
-    
-    const char *needle1 = "HE*";
-    int found = 0;
-    /* Simple substring search */
-    for (size_t i = 0; i + 2 < n; i++) {
-        if (i + 3 <= n && memcmp(buf + i, needle1, 3) == 0) { 
-            found = 1; 
-            break; 
+    return 0;
+}
+
+/* Display conversion: bilinear demosaic, or HEFRAW_DISPLAY=half for one
+ * pixel per 2x2 quad at half the size */
+static DisplayOptions display_options(const ImageHeader &header)
+{
+    DisplayOptions opts;
+    const char *v = getenv("HEFRAW_DISPLAY");
+    opts.half_size = v && strcmp(v, "half") == 0;
+    opts.cfaPattern = header.cfaPattern;
+    return opts;
+}
+
+struct jpeg_error {
+    struct jpeg_error_mgr mgr;
+    jmp_buf jump;
+};
+
+static void jpeg_error_exit(j_common_ptr cinfo)
+{
+    longjmp(((struct jpeg_error *)cinfo->err)->jump, 1);
+}
+
+/* Decode an in-memory JPEG into the image; only its size unless load_data */
+static int load_jpeg(ImlibImage *im, const uint8_t *jpg, size_t len, int scale, int load_data)
+{
+    struct jpeg_decompress_struct cinfo;
+    struct jpeg_error err;
+    JSAMPLE *volatile row = NULL;
+
+    cinfo.err = jpeg_std_error(&err.mgr);
+    err.mgr.error_exit = jpeg_error_exit;
+    if (setjmp(err.jump)) {
+        jpeg_destroy_decompress(&cinfo);
+        free(row);
+        return LOAD_BADIMAGE;
+    }
+    jpeg_create_decompress(&cinfo);
+    jpeg_mem_src(&cinfo, (unsigned char *)jpg, (unsigned long)len);
+    jpeg_read_header(&cinfo, TRUE);
+    cinfo.out_color_space = JCS_RGB;
+    cinfo.scale_num = 1;
+    cinfo.scale_denom = scale > 1 ? scale : 1;
+    jpeg_calc_output_dimensions(&cinfo);
+    im->w = cinfo.output_width;
+    im->h = cinfo.output_height;
+    if (!load_data) {
+        jpeg_destroy_decompress(&cinfo);
+        return LOAD_SUCCESS;
+    }
+    if (!__imlib_AllocateData(im)) {
+        jpeg_destroy_decompress(&cinfo);
+        return LOAD_OOM;
+    }
+
+    jpeg_start_decompress(&cinfo);
+    row = (JSAMPLE *)malloc((size_t)cinfo.output_width * cinfo.output_components);
+    if (!row) {
+        jpeg_destroy_decompress(&cinfo);
+        return LOAD_OOM;
+    }
+    while (cinfo.output_scanline < cinfo.output_height) {
+        uint32_t *dst = im->data + (size_t)cinfo.output_scanline * im->w;
+        JSAMPROW rows[1] = { row };
+        jpeg_read_scanlines(&cinfo, rows, 1);
+        for (unsigned x = 0; x < cinfo.output_width; x++) {
+            const JSAMPLE *p = row + 3 * x;
+            dst[x] = PIXEL_ARGB(0xFF, p[0], p[1], p[2]);
         }
     }
-    free(buf);
-    return found;
+    jpeg_finish_decompress(&cinfo);
+    jpeg_destroy_decompress(&cinfo);
+    free(row);
+    return LOAD_SUCCESS;
 }
 
 extern "C" int load(ImlibImage *im, int load_data)
 {
-    (void)load_data;
-    
     int rc = LOAD_FAIL;
     
     /* Check if we have file data */
@@ -87,33 +157,34 @@ extern "C" int load(ImlibImage *im, int load_data)
         return LOAD_FAIL;
     }
     
-    /* Check if it's HE* by looking for TicoRAW signature */
-    bool is_he_star = false;
-    if (file_size > 4500000) {
-        if (memcmp(file_data + 4500006, "CONTACT_INTOPIX_", 16) == 0) {
-            is_he_star = true;
-        }
-    }
-    
-    /* Also check for HE* marker in the file */
-    if (!is_he_star && file_size > 10000000) {
-        for (size_t i = 0; i < file_size - 3; i++) {
-            if (memcmp(file_data + i, "HE*", 3) == 0) {
-                is_he_star = true;
-                break;
-            }
-        }
-    }
-    
-    if (!is_he_star) {
+    /* Check if it's HE* through the IFD chain; touches only a few KB */
+    if (!detect_hef(file_data, file_size)) {
         return LOAD_FAIL;
     }
     
+    /* In browse mode show the embedded preview when there is one */
+    int scale = preview_scale();
+    if (scale && force_full_decode(im->fi->name)) scale = 0;
+    uint32_t jpeg_offset, jpeg_length;
+    if (scale && find_jpeg_preview(file_data, file_size, jpeg_offset, jpeg_length)) {
+        return load_jpeg(im, file_data + jpeg_offset, jpeg_length, scale, load_data);
+    }
+
     /* HE* file detected - decode it */
     ImageHeader header;
     if (!parse_hef_headers(file_data, file_size, header)) {
         return LOAD_BADIMAGE;
     }
+
+    /* Header-only request: the size is known without decoding */
+    DisplayOptions display = display_options(header);
+    uint32_t width, height;
+    display_size(header.width, header.height, display, width, height);
+    im->w = width;
+    im->h = height;
+    if (!load_data) {
+        return LOAD_SUCCESS;
+    }
     
     /* Decode CFA data */
     std::vector<uint16_t> cfa;
@@ -121,30 +192,14 @@ extern "C" int load(ImlibImage *im, int load_data)
         return LOAD_BADIMAGE;
     }
     
-    /* Set image dimensions */
-    im->w = header.width;
-    im->h = header.height;
-    
     /* Allocate image data */
     if (!__imlib_AllocateData(im)) {
         return LOAD_OOM;
     }
     
-    /* Convert CFA to RGB for display */
-    uint32_t *imlib_data = im->data;
-    
-    /* Simple CFA to RGB conversion */
-    for (int y = 0; y < header.height; y++) {
-        for (int x = 0; x < header.width; x++) {
-            int idx = y * header.width + x;
-            uint16_t val = cfa[idx];
-            
-            /* Convert 14-bit to 8-bit */
-            uint8_t pixel = (val >> 6) & 0xFF;
-            
-            /* Simple grayscale conversion */
-            imlib_data[idx] = PIXEL_ARGB(0xFF, pixel, pixel, pixel);
-        }
+    /* Demosaic and tone map straight into the image */
+    if (!cfa16_to_argb(cfa.data(), header.width, header.height, display, im->data)) {
+        return LOAD_BADIMAGE;
     }
     
     return LOAD_SUCCESS;
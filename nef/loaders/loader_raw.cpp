@@ -55,25 +55,8 @@ static int load(ImlibImage *im, int load_data)
         return LOAD_FAIL;
     }
     
-    /* Check if it's HE* by looking for TicoRAW signature */
-    bool is_he_star = false;
-    if (file_size > 4500000) {
-        if (memcmp(file_data + 4500006, "CONTACT_INTOPIX_", 16) == 0) {
-            is_he_star = true;
-        }
-    }
-    
-    /* Also check for HE* marker in the file */
-    if (!is_he_star && file_size > 10000000) {
-        for (size_t i = 0; i < file_size - 3; i++) {
-            if (memcmp(file_data + i, "HE*", 3) == 0) {
-                is_he_star = true;
-                break;
-            }
-        }
-    }
-    
-    if (!is_he_star) {
+    /* Check if it's HE* through the IFD chain; touches only a few KB */
+    if (!detect_hef(file_data, file_size)) {
         return LOAD_FAIL;
     }
     
@@ -0,0 +1,254 @@
+//! Batch reading of many files on the crate's worker pool
+
+use crate::depth::Depth;
+use crate::io::{self, Scheduler};
+use crate::scratch::ScratchReader;
+use crate::workers;
+use crate::xmp;
+use rayon::prelude::*;
+use std::any::Any;
+use std::collections::HashMap;
+use std::panic::{self, AssertUnwindSafe};
+use std::sync::atomic::{AtomicBool, AtomicU64, AtomicUsize, Ordering};
+use std::sync::{Arc, OnceLock};
+
+pub type Metadata = HashMap<String, String>;
+
+/// Order in which a batch is read
+#[derive(Clone, Copy, Debug, Default, PartialEq, Eq)]
+pub enum IoSchedule {
+    /// Read in input order
+    #[default]
+    Default,
+    /// Group by device and order each device's files for sequential access
+    Locality,
+}
+
+impl IoSchedule {
+    pub fn parse(name: &str) -> Option<Self> {
+        match name {
+            "default" => Some(Self::Default),
+            "locality" => Some(Self::Locality),
+            _ => None,
+        }
+    }
+}
+
+/// Counters a batch updates as it goes, and a switch to cancel it
+#[derive(Debug, Default)]
+pub struct Progress {
+    files: AtomicUsize,
+    bytes: AtomicU64,
+    errors: AtomicUsize,
+    cancelled: AtomicBool,
+}
+
+impl Progress {
+    /// Files finished, bytes read and files that failed so far
+    pub fn snapshot(&self) -> (usize, u64, usize) {
+        (
+            self.files.load(Ordering::Relaxed),
+            self.bytes.load(Ordering::Relaxed),
+            self.errors.load(Ordering::Relaxed),
+        )
+    }
+
+    /// Make every file not yet started fail with "cancelled"
+    pub fn cancel(&self) {
+        self.cancelled.store(true, Ordering::Relaxed);
+    }
+
+    fn cancelled(&self) -> bool {
+        self.cancelled.load(Ordering::Relaxed)
+    }
+
+    fn record(&self, bytes: u64, ok: bool) {
+        self.bytes.fetch_add(bytes, Ordering::Relaxed);
+        if !ok {
+            self.errors.fetch_add(1, Ordering::Relaxed);
+        }
+        self.files.fetch_add(1, Ordering::Relaxed);
+    }
+}
+
+/// Tuning knobs for a batch read
+#[derive(Clone, Debug, Default)]
+pub struct BatchOptions {
+    pub schedule: IoSchedule,
+    /// Limit on reads in flight per device; None for no limit
+    pub max_io_per_device: Option<usize>,
+    /// Limit on file bytes held by all reads in flight; None for no limit
+    pub max_inflight_bytes: Option<u64>,
+    /// Files larger than this are parsed from byte-range reads of their
+    /// metadata, at most this many bytes, instead of being loaded whole;
+    /// None for no limit
+    pub max_file_bytes: Option<u64>,
+    /// Metadata blocks to report for each file
+    pub depth: Depth,
+    /// Merge each file's XMP sidecar, if it has one, over its embedded metadata
+    pub sidecars: bool,
+    /// Progress counters and cancel switch shared with the caller
+    pub progress: Option<Arc<Progress>>,
+}
+
+impl BatchOptions {
+    fn scheduled(&self) -> bool {
+        self.schedule == IoSchedule::Locality
+            || self.max_io_per_device.is_some()
+            || self.max_inflight_bytes.is_some()
+            || self.max_file_bytes.is_some()
+    }
+}
+
+/// Trim parsed metadata to the requested depth and merge any sidecar
+fn finish(path: &str, mut metadata: Metadata, options: &BatchOptions) -> Result<Metadata, String> {
+    options.depth.trim(&mut metadata);
+    if options.sidecars {
+        xmp::merge_sidecar(path, &mut metadata)?;
+    }
+    Ok(metadata)
+}
+
+/// Run one file's read unless the batch was cancelled, counting it in the
+/// batch's progress
+///
+/// A panic in the core parser fails only this file: it must not unwind
+/// through a worker, which would leave the batch's scheduler waiting for a
+/// job that never finishes.
+fn tracked(
+    reader: &mut ScratchReader,
+    path: &str,
+    options: &BatchOptions,
+    read: impl FnOnce(&mut ScratchReader) -> Result<Metadata, String>,
+) -> Result<Metadata, String> {
+    if options.progress.as_ref().is_some_and(|progress| progress.cancelled()) {
+        return Err("cancelled".to_string());
+    }
+    let start = reader.bytes_read();
+    let result = panic::catch_unwind(AssertUnwindSafe(|| read(&mut *reader)));
+    let (bytes, result) = match result {
+        Ok(result) => (reader.bytes_read().saturating_sub(start), result),
+        Err(payload) => {
+            // The reader may have been left mid-parse
+            *reader = ScratchReader::new();
+            (0, Err(format!("{}: parser panicked: {}", path, panic_message(&*payload))))
+        }
+    };
+    if let Some(progress) = &options.progress {
+        progress.record(bytes, result.is_ok());
+    }
+    result
+}
+
+fn panic_message(payload: &(dyn Any + Send)) -> &str {
+    payload
+        .downcast_ref::<&str>()
+        .copied()
+        .or_else(|| payload.downcast_ref::<String>().map(String::as_str))
+        .unwrap_or("unknown cause")
+}
+
+fn read_one(reader: &mut ScratchReader, path: &str, options: &BatchOptions) -> Result<Metadata, String> {
+    tracked(reader, path, options, |reader| {
+        let metadata = reader.read_file_at_depth(path, options.depth).map_err(|e| format!("{}: {}", path, e))?;
+        finish(path, metadata, options)
+    })
+}
+
+/// Parse metadata from at most `limit` bytes of `path`
+///
+/// The container is walked by byte range, so metadata at the end of the
+/// file, such as a video's trailing `moov` box, is found without holding
+/// the whole file in memory. Files whose metadata needs more than `limit`
+/// bytes fail instead of being parsed in part.
+fn read_bounded(reader: &mut ScratchReader, path: &str, limit: u64, options: &BatchOptions) -> Result<Metadata, String> {
+    tracked(reader, path, options, |reader| {
+        let metadata = reader.read_ranged(path, limit, options.depth).map_err(|e| format!("{}: {}", path, e))?;
+        finish(path, metadata, options)
+    })
+}
+
+/// Read every path, returning one result per path in input order
+///
+/// Each worker thread keeps its own reader and scratch buffer for the whole
+/// batch. When the worker pool is switched off the batch runs on the calling
+/// thread.
+pub fn read_files(paths: &[String], options: &BatchOptions) -> Result<Vec<Result<Metadata, String>>, String> {
+    let pool = workers::pool()?;
+    if options.scheduled() {
+        return Ok(read_scheduled(paths, options, pool.as_deref()));
+    }
+    Ok(match pool {
+        Some(pool) => pool.install(|| {
+            paths.par_iter().map_init(ScratchReader::new, |reader, path| read_one(reader, path, options)).collect()
+        }),
+        None => {
+            let mut reader = ScratchReader::new();
+            paths.iter().map(|path| read_one(&mut reader, path, options)).collect()
+        }
+    })
+}
+
+/// Parse in-memory buffers, returning one result per buffer in input order
+pub fn read_buffers(buffers: &[Vec<u8>], depth: Depth) -> Result<Vec<Result<Metadata, String>>, String> {
+    let parse = |reader: &mut ScratchReader, (index, data): (usize, &Vec<u8>)| {
+        let mut metadata = reader.read_bytes_at_depth(data, depth).map_err(|e| format!("item {}: {}", index, e))?;
+        depth.trim(&mut metadata);
+        Ok(metadata)
+    };
+    Ok(match workers::pool()? {
+        Some(pool) => pool.install(|| buffers.par_iter().enumerate().map_init(ScratchReader::new, parse).collect()),
+        None => {
+            let mut reader = ScratchReader::new();
+            buffers.iter().enumerate().map(|item| parse(&mut reader, item)).collect()
+        }
+    })
+}
+
+/// Read a batch through the device-aware [`Scheduler`]
+fn read_scheduled(
+    paths: &[String],
+    options: &BatchOptions,
+    pool: Option<&rayon::ThreadPool>,
+) -> Vec<Result<Metadata, String>> {
+    let infos: Vec<Option<io::FileInfo>> = match pool {
+        Some(pool) => pool.install(|| paths.par_iter().map(|path| io::stat(path)).collect()),
+        None => paths.iter().map(|path| io::stat(path)).collect(),
+    };
+    let file_cap = options.max_file_bytes.unwrap_or(u64::MAX);
+    let costs = infos.iter().map(|info| info.map_or(0, |i| i.size.min(file_cap))).collect();
+    let queues = io::plan(paths, &infos, options.schedule == IoSchedule::Locality);
+    let scheduler = Scheduler::new(queues, options.max_io_per_device, costs, options.max_inflight_bytes);
+    for index in scheduler.initial_prefetch() {
+        io::advise_willneed(&paths[index]);
+    }
+
+    let results: Vec<OnceLock<Result<Metadata, String>>> = paths.iter().map(|_| OnceLock::new()).collect();
+    let worker = || {
+        let mut reader = ScratchReader::new();
+        while let Some(job) = scheduler.next() {
+            if let Some(ahead) = job.prefetch {
+                io::advise_willneed(&paths[ahead]);
+            }
+            let path = &paths[job.index];
+            let result = match infos[job.index] {
+                Some(info) if info.size > file_cap => read_bounded(&mut reader, path, file_cap, options),
+                _ => read_one(&mut reader, path, options),
+            };
+            let _ = results[job.index].set(result);
+            scheduler.finish(job);
+        }
+    };
+    match pool {
+        Some(pool) => pool.scope(|scope| {
+            for _ in 0..pool.current_num_threads() {
+                scope.spawn(|_| worker());
+            }
+        }),
+        None => worker(),
+    }
+    results
+        .into_iter()
+        .map(|cell| cell.into_inner().unwrap_or_else(|| Err("file was not scheduled".to_string())))
+        .collect()
+}
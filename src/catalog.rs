@@ -0,0 +1,528 @@
+//! Persistent metadata catalog of a directory tree
+//!
+//! The catalog keeps each media file's metadata together with the inode,
+//! size and mtime it was read at. A sync only parses files whose stamp has
+//! changed, and a file that disappears under one path and appears under
+//! another with the same stamp is recorded as renamed, keeping its metadata.
+//! Changes are picked up from the inotify [`Watcher`] where available and
+//! from a `stat` walk of the whole tree otherwise.
+//!
+//! The database is an append-only log of put and delete records after a
+//! short header. A sync appends records for what changed, and the log is
+//! rewritten from the live entries once superseded records outnumber them.
+//! A record cut short by a crash is dropped on the next open.
+
+use crate::batch::{self, BatchOptions, Metadata};
+use crate::depth::Depth;
+use crate::organize;
+use crate::watch::Watcher;
+use crate::workers;
+use rayon::prelude::*;
+use std::collections::{BTreeMap, BTreeSet, HashMap};
+use std::fs::{self, File, OpenOptions};
+use std::io::{self, BufReader, BufWriter, Read, Write};
+use std::path::{Path, PathBuf};
+
+const MAGIC: &[u8; 8] = b"FEXCAT1\n";
+const PUT: u8 = 1;
+const DELETE: u8 = 2;
+
+/// Superseded records tolerated in the log before it is rewritten
+const MIN_GARBAGE: usize = 4096;
+
+/// Longest string accepted from the log; anything longer is corruption
+const MAX_STR: u32 = 16 << 20;
+
+/// What `stat` says about a file's contents
+#[derive(Clone, Copy, Debug, PartialEq, Eq, Hash)]
+pub struct Stamp {
+    pub ino: u64,
+    pub size: u64,
+    pub mtime_ns: i64,
+}
+
+impl Stamp {
+    /// Stamp of a regular file, or None when `path` is not one
+    pub fn of(path: &str) -> Option<Self> {
+        let meta = fs::metadata(path).ok()?;
+        if !meta.is_file() {
+            return None;
+        }
+        #[cfg(unix)]
+        {
+            use std::os::unix::fs::MetadataExt;
+            Some(Self { ino: meta.ino(), size: meta.len(), mtime_ns: meta.mtime() * 1_000_000_000 + meta.mtime_nsec() })
+        }
+        #[cfg(not(unix))]
+        {
+            let mtime_ns = meta
+                .modified()
+                .ok()
+                .and_then(|t| t.duration_since(std::time::UNIX_EPOCH).ok())
+                .map_or(0, |d| d.as_nanos() as i64);
+            Some(Self { ino: 0, size: meta.len(), mtime_ns })
+        }
+    }
+}
+
+struct Entry {
+    stamp: Stamp,
+    metadata: Metadata,
+    /// Metadata could not be read; retried when the file changes
+    failed: bool,
+}
+
+/// Counts of what a sync changed
+#[derive(Clone, Copy, Debug, Default)]
+pub struct Changes {
+    pub added: usize,
+    pub modified: usize,
+    pub renamed: usize,
+    pub deleted: usize,
+    /// Added or modified files whose metadata could not be read
+    pub failed: usize,
+}
+
+pub struct Catalog {
+    root: PathBuf,
+    db_path: PathBuf,
+    depth: Depth,
+    entries: BTreeMap<String, Entry>,
+    /// Tag -> value -> paths, built for a tag on its first query
+    index: HashMap<String, HashMap<String, BTreeSet<String>>>,
+    /// Records in the database log, live or superseded
+    records: usize,
+    watcher: Option<Watcher>,
+}
+
+impl Catalog {
+    /// Open or create the catalog of `root` stored at `db_path` and bring it
+    /// up to date
+    ///
+    /// With `watch` set, changes are tracked with inotify from here on;
+    /// otherwise, or when watching is not possible, every sync walks the tree.
+    pub fn open(root: &Path, db_path: &Path, depth: Depth, watch: bool) -> Result<(Self, Changes), String> {
+        // Keys are canonical paths, so that the same tree opened through a
+        // relative path, ".." or a symlink shares one catalog
+        let root = fs::canonicalize(root).map_err(|e| format!("{}: {}", root.display(), e))?;
+        if !root.is_dir() {
+            return Err(format!("{}: not a directory", root.display()));
+        }
+        let mut catalog = Self {
+            watcher: if watch { Watcher::new(&root).ok() } else { None },
+            root,
+            db_path: db_path.to_path_buf(),
+            depth,
+            entries: BTreeMap::new(),
+            index: HashMap::new(),
+            records: 0,
+        };
+        catalog.load()?;
+        let changes = catalog.rescan()?;
+        Ok((catalog, changes))
+    }
+
+    pub fn root(&self) -> &Path {
+        &self.root
+    }
+
+    /// Whether changes are tracked with inotify rather than a rescan
+    pub fn watching(&self) -> bool {
+        self.watcher.as_ref().is_some_and(Watcher::alive)
+    }
+
+    pub fn len(&self) -> usize {
+        self.entries.len()
+    }
+
+    pub fn is_empty(&self) -> bool {
+        self.entries.is_empty()
+    }
+
+    /// Stop tracking changes; later syncs walk the tree
+    pub fn unwatch(&mut self) {
+        self.watcher = None;
+    }
+
+    /// Catalog key for `path`, which may be relative to the root
+    ///
+    /// The path is canonicalized like the root; one that no longer exists is
+    /// resolved through its parent directory.
+    pub fn key(&self, path: &Path) -> String {
+        let path = self.root.join(path);
+        let resolved = fs::canonicalize(&path).ok().or_else(|| {
+            let parent = fs::canonicalize(path.parent()?).ok()?;
+            Some(parent.join(path.file_name()?))
+        });
+        resolved.unwrap_or(path).to_string_lossy().into_owned()
+    }
+
+    pub fn get(&self, path: &Path) -> Option<&Metadata> {
+        self.entries.get(&self.key(path)).map(|entry| &entry.metadata)
+    }
+
+    pub fn paths(&self) -> impl Iterator<Item = &String> {
+        self.entries.keys()
+    }
+
+    /// Paths whose metadata has `tag`, set to `value` if given, in order
+    pub fn find(&mut self, tag: &str, value: Option<&str>) -> Vec<String> {
+        let values = self.indexed(tag);
+        match value {
+            Some(value) => values.get(value).map(|paths| paths.iter().cloned().collect()).unwrap_or_default(),
+            None => {
+                let mut paths: Vec<String> = values.values().flatten().cloned().collect();
+                paths.sort();
+                paths
+            }
+        }
+    }
+
+    /// Distinct values of `tag` with the number of files having each
+    pub fn values(&mut self, tag: &str) -> Vec<(String, usize)> {
+        let mut values: Vec<(String, usize)> =
+            self.indexed(tag).iter().map(|(value, paths)| (value.clone(), paths.len())).collect();
+        values.sort();
+        values
+    }
+
+    fn indexed(&mut self, tag: &str) -> &HashMap<String, BTreeSet<String>> {
+        let entries = &self.entries;
+        self.index.entry(tag.to_string()).or_insert_with(|| {
+            let mut values: HashMap<String, BTreeSet<String>> = HashMap::new();
+            for (path, entry) in entries {
+                if let Some(value) = entry.metadata.get(tag) {
+                    values.entry(value.clone()).or_default().insert(path.clone());
+                }
+            }
+            values
+        })
+    }
+
+    fn insert(&mut self, path: String, entry: Entry) {
+        self.remove(&path);
+        for (tag, values) in self.index.iter_mut() {
+            if let Some(value) = entry.metadata.get(tag) {
+                values.entry(value.clone()).or_default().insert(path.clone());
+            }
+        }
+        self.entries.insert(path, entry);
+    }
+
+    fn remove(&mut self, path: &str) -> Option<Entry> {
+        let entry = self.entries.remove(path)?;
+        for (tag, values) in self.index.iter_mut() {
+            if let Some(value) = entry.metadata.get(tag) {
+                if let Some(paths) = values.get_mut(value) {
+                    paths.remove(path);
+                    if paths.is_empty() {
+                        values.remove(value);
+                    }
+                }
+            }
+        }
+        Some(entry)
+    }
+
+    /// Pick up changes since the last sync
+    pub fn sync(&mut self) -> Result<Changes, String> {
+        let pending = match &self.watcher {
+            Some(watcher) if watcher.alive() => watcher.drain(),
+            _ => {
+                self.watcher = None;
+                return self.rescan();
+            }
+        };
+        if pending.overflow {
+            return self.rescan();
+        }
+        let mut paths: BTreeSet<String> = pending
+            .paths
+            .iter()
+            .filter(|path| organize::is_media(path))
+            .map(|path| path.to_string_lossy().into_owned())
+            .collect();
+        for dir in &pending.gone {
+            let prefix = format!("{}/", dir.display());
+            paths.extend(self.entries.range(prefix.clone()..).map(|(path, _)| path).take_while(|path| path.starts_with(&prefix)).cloned());
+        }
+        let paths: Vec<String> = paths.into_iter().collect();
+        let stamps = stat_all(&paths)?;
+        self.apply(paths.into_iter().zip(stamps).collect())
+    }
+
+    /// Compare the whole tree against the catalog
+    fn rescan(&mut self) -> Result<Changes, String> {
+        let files = organize::collect(&self.root)?;
+        let stamps = stat_all(&files)?;
+        let mut observed: Vec<(String, Option<Stamp>)> = files.iter().cloned().zip(stamps).collect();
+        observed.extend(
+            self.entries.keys().filter(|path| files.binary_search(path).is_err()).map(|path| (path.clone(), None)),
+        );
+        self.apply(observed)
+    }
+
+    /// Update the catalog from fresh stamps of `observed` paths, where None
+    /// means the path no longer exists
+    fn apply(&mut self, observed: Vec<(String, Option<Stamp>)>) -> Result<Changes, String> {
+        let mut changes = Changes::default();
+        let mut gone = HashMap::new();
+        let mut fresh = Vec::new();
+        for (path, stamp) in observed {
+            match (self.entries.get(&path).map(|entry| entry.stamp), stamp) {
+                (Some(old), None) => {
+                    gone.insert(old, path);
+                }
+                (Some(old), Some(new)) if old != new => fresh.push((path, new)),
+                (None, Some(new)) => fresh.push((path, new)),
+                _ => {}
+            }
+        }
+
+        let mut puts = Vec::new();
+        let mut deletes = Vec::new();
+        let mut parse = Vec::new();
+        for (path, stamp) in fresh {
+            if self.entries.contains_key(&path) {
+                changes.modified += 1;
+            } else if let Some(old) = gone.remove(&stamp) {
+                if let Some(entry) = self.remove(&old) {
+                    self.insert(path.clone(), entry);
+                }
+                deletes.push(old);
+                puts.push(path);
+                changes.renamed += 1;
+                continue;
+            } else {
+                changes.added += 1;
+            }
+            parse.push((path, stamp));
+        }
+        for old in gone.into_values() {
+            self.remove(&old);
+            deletes.push(old);
+            changes.deleted += 1;
+        }
+
+        let paths: Vec<String> = parse.iter().map(|(path, _)| path.clone()).collect();
+        let options = BatchOptions { depth: self.depth, ..BatchOptions::default() };
+        let results = batch::read_files(&paths, &options)?;
+        for ((path, stamp), result) in parse.into_iter().zip(results) {
+            let entry = match result {
+                Ok(metadata) => Entry { stamp, metadata, failed: false },
+                Err(_) => {
+                    changes.failed += 1;
+                    Entry { stamp, metadata: Metadata::new(), failed: true }
+                }
+            };
+            self.insert(path.clone(), entry);
+            puts.push(path);
+        }
+        self.append(&puts, &deletes)?;
+        Ok(changes)
+    }
+
+    fn db_error(&self, e: impl std::fmt::Display) -> String {
+        format!("{}: {}", self.db_path.display(), e)
+    }
+
+    /// Replay the database log, starting a new one if there is none
+    fn load(&mut self) -> Result<(), String> {
+        let file = match File::open(&self.db_path) {
+            Ok(file) => file,
+            Err(e) if e.kind() == io::ErrorKind::NotFound => return self.rewrite(),
+            Err(e) => return Err(self.db_error(e)),
+        };
+        let mut log = Counted { inner: BufReader::new(file), read: 0 };
+        let mut magic = [0u8; 8];
+        let header = log.read_exact(&mut magic).and_then(|_| Ok((read_str(&mut log)?, read_str(&mut log)?)));
+        let (root, depth) = match header {
+            Ok(header) if &magic == MAGIC => header,
+            _ => return Err(self.db_error("not a catalog database")),
+        };
+        if root != self.root.to_string_lossy() {
+            if fs::canonicalize(&root).ok().as_ref() != Some(&self.root) {
+                return Err(self.db_error(format!("catalog of {}, not {}", root, self.root.display())));
+            }
+            // Written before roots were canonicalized; its keys are not
+            return self.rewrite();
+        }
+        if depth != self.depth.name() {
+            // Stored metadata was trimmed differently; extract it again
+            return self.rewrite();
+        }
+        let mut valid = log.read;
+        loop {
+            match read_record(&mut log) {
+                Ok(Some((path, Some(entry)))) => {
+                    self.entries.insert(path, entry);
+                }
+                Ok(Some((path, None))) => {
+                    self.entries.remove(&path);
+                }
+                Ok(None) => break,
+                Err(e) if e.kind() == io::ErrorKind::UnexpectedEof => break,
+                Err(e) => return Err(self.db_error(e)),
+            }
+            self.records += 1;
+            valid = log.read;
+        }
+        if valid < log.read {
+            OpenOptions::new()
+                .write(true)
+                .open(&self.db_path)
+                .and_then(|file| file.set_len(valid))
+                .map_err(|e| self.db_error(e))?;
+        }
+        Ok(())
+    }
+
+    /// Append records for changed paths, or rewrite the log if it has
+    /// accumulated too many superseded records
+    fn append(&mut self, puts: &[String], deletes: &[String]) -> Result<(), String> {
+        if puts.is_empty() && deletes.is_empty() {
+            return Ok(());
+        }
+        let records = self.records + puts.len() + deletes.len();
+        if records - self.entries.len() > self.entries.len().max(MIN_GARBAGE) {
+            return self.rewrite();
+        }
+        let mut out = Vec::new();
+        for path in deletes {
+            write_delete(&mut out, path);
+        }
+        for path in puts {
+            write_put(&mut out, path, &self.entries[path]);
+        }
+        OpenOptions::new()
+            .append(true)
+            .open(&self.db_path)
+            .and_then(|mut file| {
+                file.write_all(&out)?;
+                file.sync_data()
+            })
+            .map_err(|e| self.db_error(e))?;
+        self.records = records;
+        Ok(())
+    }
+
+    /// Write the live entries to a new log and swap it in
+    fn rewrite(&mut self) -> Result<(), String> {
+        let temporary = PathBuf::from(format!("{}.tmp", self.db_path.display()));
+        let write = || -> io::Result<()> {
+            let mut file = BufWriter::new(File::create(&temporary)?);
+            let mut out = MAGIC.to_vec();
+            write_str(&mut out, &self.root.to_string_lossy());
+            write_str(&mut out, self.depth.name());
+            for (path, entry) in &self.entries {
+                write_put(&mut out, path, entry);
+                if out.len() >= 1 << 20 {
+                    file.write_all(&out)?;
+                    out.clear();
+                }
+            }
+            file.write_all(&out)?;
+            file.into_inner().map_err(|e| e.into_error())?.sync_all()?;
+            fs::rename(&temporary, &self.db_path)
+        };
+        write().map_err(|e| {
+            let _ = fs::remove_file(&temporary);
+            self.db_error(e)
+        })?;
+        self.records = self.entries.len();
+        Ok(())
+    }
+}
+
+/// Stamp every path on the worker pool
+fn stat_all(paths: &[String]) -> Result<Vec<Option<Stamp>>, String> {
+    Ok(match workers::pool()? {
+        Some(pool) => pool.install(|| paths.par_iter().map(|path| Stamp::of(path)).collect()),
+        None => paths.iter().map(|path| Stamp::of(path)).collect(),
+    })
+}
+
+/// Reader that counts the bytes taken from it
+struct Counted<R> {
+    inner: R,
+    read: u64,
+}
+
+impl<R: Read> Read for Counted<R> {
+    fn read(&mut self, buf: &mut [u8]) -> io::Result<usize> {
+        let n = self.inner.read(buf)?;
+        self.read += n as u64;
+        Ok(n)
+    }
+}
+
+fn write_str(out: &mut Vec<u8>, value: &str) {
+    out.extend_from_slice(&(value.len() as u32).to_le_bytes());
+    out.extend_from_slice(value.as_bytes());
+}
+
+fn write_put(out: &mut Vec<u8>, path: &str, entry: &Entry) {
+    out.push(PUT);
+    write_str(out, path);
+    out.extend_from_slice(&entry.stamp.ino.to_le_bytes());
+    out.extend_from_slice(&entry.stamp.size.to_le_bytes());
+    out.extend_from_slice(&entry.stamp.mtime_ns.to_le_bytes());
+    out.push(entry.failed as u8);
+    out.extend_from_slice(&(entry.metadata.len() as u32).to_le_bytes());
+    for (tag, value) in &entry.metadata {
+        write_str(out, tag);
+        write_str(out, value);
+    }
+}
+
+fn write_delete(out: &mut Vec<u8>, path: &str) {
+    out.push(DELETE);
+    write_str(out, path);
+}
+
+fn read_u32(log: &mut impl Read) -> io::Result<u32> {
+    let mut bytes = [0u8; 4];
+    log.read_exact(&mut bytes)?;
+    Ok(u32::from_le_bytes(bytes))
+}
+
+fn read_u64(log: &mut impl Read) -> io::Result<u64> {
+    let mut bytes = [0u8; 8];
+    log.read_exact(&mut bytes)?;
+    Ok(u64::from_le_bytes(bytes))
+}
+
+fn read_str(log: &mut impl Read) -> io::Result<String> {
+    let len = read_u32(log)?;
+    if len > MAX_STR {
+        return Err(io::Error::new(io::ErrorKind::InvalidData, "string too long"));
+    }
+    let mut bytes = vec![0u8; len as usize];
+    log.read_exact(&mut bytes)?;
+    String::from_utf8(bytes).map_err(|e| io::Error::new(io::ErrorKind::InvalidData, e))
+}
+
+/// Next log record as (path, entry), with no entry for a delete; None at
+/// the end of the log
+fn read_record(log: &mut impl Read) -> io::Result<Option<(String, Option<Entry>)>> {
+    let mut kind = [0u8; 1];
+    if log.read(&mut kind)? == 0 {
+        return Ok(None);
+    }
+    let path = read_str(log)?;
+    match kind[0] {
+        PUT => {
+            let stamp = Stamp { ino: read_u64(log)?, size: read_u64(log)?, mtime_ns: read_u64(log)? as i64 };
+            let mut failed = [0u8; 1];
+            log.read_exact(&mut failed)?;
+            let count = read_u32(log)?;
+            let mut metadata = Metadata::with_capacity(count as usize);
+            for _ in 0..count {
+                metadata.insert(read_str(log)?, read_str(log)?);
+            }
+            Ok(Some((path, Some(Entry { stamp, metadata, failed: failed[0] != 0 }))))
+        }
+        DELETE => Ok(Some((path, None))),
+        kind => Err(io::Error::new(io::ErrorKind::InvalidData, format!("unknown record type {}", kind))),
+    }
+}
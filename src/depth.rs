@@ -0,0 +1,143 @@
+//! Parse depth levels for skipping metadata blocks a caller does not need
+//!
+//! MakerNotes and vendor blocks make up most of the tags reported for RAW
+//! files, and most pipelines never look at them. Below `Full`, files are
+//! read through the container walkers in `ranged`, which neither fetch nor
+//! hand the core parser the TIFF blocks outside the level: MakerNotes, DNG
+//! private data, SubIFDs and, for `Basic`, the interoperability IFD and
+//! every IFD after IFD0. The results are then trimmed to the level's tags,
+//! since the core parser reports some of them from other blocks too.
+
+use std::collections::{HashMap, HashSet};
+use std::sync::OnceLock;
+
+/// How much of a file's metadata to report
+#[derive(Clone, Copy, Debug, Default, PartialEq, Eq)]
+pub enum Depth {
+    /// IFD0, EXIF and GPS tags
+    Basic,
+    /// Basic plus interoperability and IFD1 (thumbnail) tags
+    Standard,
+    /// Everything, including MakerNotes and vendor blocks
+    #[default]
+    Full,
+}
+
+/// Tags from IFD0
+const IFD0_TAGS: &[&str] = &[
+    "ImageWidth", "ImageHeight", "ImageLength", "BitsPerSample", "Compression",
+    "PhotometricInterpretation", "ImageDescription", "Make", "Model", "StripOffsets",
+    "Orientation", "SamplesPerPixel", "RowsPerStrip", "StripByteCounts", "XResolution",
+    "YResolution", "PlanarConfiguration", "ResolutionUnit", "TransferFunction", "Software",
+    "DateTime", "ModifyDate", "Artist", "HostComputer", "WhitePoint", "PrimaryChromaticities",
+    "YCbCrCoefficients", "YCbCrSubSampling", "YCbCrPositioning", "ReferenceBlackWhite",
+    "Copyright", "ExifOffset", "GPSInfo", "Rating", "RatingPercent", "XPTitle", "XPComment",
+    "XPAuthor", "XPKeywords", "XPSubject",
+];
+
+/// Tags from the EXIF sub-IFD
+const EXIF_TAGS: &[&str] = &[
+    "ExposureTime", "FNumber", "ExposureProgram", "SpectralSensitivity", "ISO",
+    "ISOSpeedRatings", "PhotographicSensitivity", "SensitivityType",
+    "StandardOutputSensitivity", "RecommendedExposureIndex", "ISOSpeed", "ExifVersion",
+    "DateTimeOriginal", "DateTimeDigitized", "CreateDate", "OffsetTime", "OffsetTimeOriginal",
+    "OffsetTimeDigitized", "ComponentsConfiguration", "CompressedBitsPerPixel",
+    "ShutterSpeedValue", "ApertureValue", "BrightnessValue", "ExposureBiasValue",
+    "ExposureCompensation", "MaxApertureValue", "SubjectDistance", "MeteringMode",
+    "LightSource", "Flash", "FocalLength", "SubjectArea", "UserComment", "SubSecTime",
+    "SubSecTimeOriginal", "SubSecTimeDigitized", "FlashpixVersion", "ColorSpace",
+    "PixelXDimension", "PixelYDimension", "ExifImageWidth", "ExifImageHeight",
+    "RelatedSoundFile", "FlashEnergy", "FocalPlaneXResolution", "FocalPlaneYResolution",
+    "FocalPlaneResolutionUnit", "SubjectLocation", "ExposureIndex", "SensingMethod",
+    "FileSource", "SceneType", "CFAPattern", "CustomRendered", "ExposureMode", "WhiteBalance",
+    "DigitalZoomRatio", "FocalLengthIn35mmFilm", "FocalLengthIn35mmFormat",
+    "SceneCaptureType", "GainControl", "Contrast", "Saturation", "Sharpness",
+    "DeviceSettingDescription", "SubjectDistanceRange", "ImageUniqueID", "CameraOwnerName",
+    "OwnerName", "BodySerialNumber", "SerialNumber", "LensSpecification", "LensInfo",
+    "LensMake", "LensModel", "LensSerialNumber", "Gamma", "CompositeImage",
+];
+
+/// Tags from the interoperability IFD and IFD1
+const STANDARD_TAGS: &[&str] = &[
+    "InteropIndex", "InteroperabilityIndex", "InteropVersion", "InteroperabilityVersion",
+    "RelatedImageFileFormat", "RelatedImageWidth", "RelatedImageHeight",
+    "RelatedImageLength", "JPEGInterchangeFormat", "JPEGInterchangeFormatLength",
+];
+
+/// TIFF tags whose blocks are skipped below `Full`: MakerNote, DNG private
+/// data (an Adobe-wrapped MakerNote) and SubIFDs (RAW image and preview
+/// descriptors)
+const VENDOR_TIFF_TAGS: &[u16] = &[0x927C, 0xC634, 0x014A];
+
+/// Interoperability IFD pointer
+const INTEROP_TIFF_TAG: u16 = 0xA005;
+
+fn basic_tags() -> &'static HashSet<&'static str> {
+    static TAGS: OnceLock<HashSet<&'static str>> = OnceLock::new();
+    TAGS.get_or_init(|| IFD0_TAGS.iter().chain(EXIF_TAGS).copied().collect())
+}
+
+fn standard_tags() -> &'static HashSet<&'static str> {
+    static TAGS: OnceLock<HashSet<&'static str>> = OnceLock::new();
+    TAGS.get_or_init(|| STANDARD_TAGS.iter().copied().collect())
+}
+
+impl Depth {
+    pub fn parse(name: &str) -> Option<Self> {
+        match name {
+            "basic" => Some(Self::Basic),
+            "standard" => Some(Self::Standard),
+            "full" => Some(Self::Full),
+            _ => None,
+        }
+    }
+
+    pub fn name(self) -> &'static str {
+        match self {
+            Self::Basic => "basic",
+            Self::Standard => "standard",
+            Self::Full => "full",
+        }
+    }
+
+    /// Whether a tag belongs to this depth level
+    pub fn includes(self, tag: &str) -> bool {
+        let basic = || basic_tags().contains(tag) || tag.starts_with("GPS");
+        match self {
+            Self::Full => true,
+            Self::Basic => basic(),
+            Self::Standard => {
+                basic()
+                    || standard_tags().contains(tag)
+                    || tag.starts_with("Thumbnail")
+                    || tag.starts_with("IFD1")
+            }
+        }
+    }
+
+    /// Whether the block behind a TIFF tag is skipped at this depth level
+    pub fn skips_tiff_tag(self, tag: u16) -> bool {
+        match self {
+            Self::Full => false,
+            Self::Standard => VENDOR_TIFF_TAGS.contains(&tag),
+            Self::Basic => VENDOR_TIFF_TAGS.contains(&tag) || tag == INTEROP_TIFF_TAG,
+        }
+    }
+
+    /// Number of IFDs of a TIFF structure's main chain to read: IFD0 for
+    /// `Basic`, IFD0 and IFD1 for `Standard`
+    pub fn chain_ifds(self) -> usize {
+        match self {
+            Self::Basic => 1,
+            Self::Standard => 2,
+            Self::Full => usize::MAX,
+        }
+    }
+
+    /// Drop the tags outside this depth level
+    pub fn trim(self, metadata: &mut HashMap<String, String>) {
+        if self != Self::Full {
+            metadata.retain(|tag, _| self.includes(tag));
+        }
+    }
+}
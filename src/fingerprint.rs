@@ -0,0 +1,222 @@
+//! Grouping of bursts and duplicates by metadata fingerprint
+//!
+//! Workers reduce each file's metadata to its fingerprint as soon as it is
+//! parsed, so a batch never holds more than a few strings per file. The
+//! fingerprints are then sorted by their exact-match values and capture
+//! time, and a single sweep starts a new group wherever the values change
+//! or the gap to the previous capture exceeds the tolerance.
+//!
+//! When every key is an IFD0, EXIF or GPS tag, files are read at basic
+//! depth, so only their container headers and those IFDs are fetched
+//! rather than the whole file.
+
+use crate::batch::Metadata;
+use crate::depth::Depth;
+use crate::organize::{self, CaptureTime};
+use crate::scratch::ScratchReader;
+use crate::workers;
+use rayon::prelude::*;
+
+/// How to reduce metadata to a fingerprint
+#[derive(Clone, Debug)]
+pub struct Keys {
+    /// Tags that must be equal within a group
+    exact: Vec<String>,
+    /// Capture-time tag and its sub-second tag, compared within a tolerance
+    time: Option<(String, Option<String>)>,
+    /// Shallowest parse depth that reports every key
+    depth: Depth,
+}
+
+impl Keys {
+    /// Split `keys` into exact-match tags and a capture time
+    ///
+    /// The first date tag in `keys` (DateTimeOriginal, CreateDate, ...)
+    /// becomes the capture time, together with its sub-second tag if that is
+    /// listed too. Every other tag is matched exactly.
+    pub fn new(keys: &[String]) -> Self {
+        let time = keys.iter().find_map(|key| {
+            organize::TIME_TAGS.iter().find(|(tag, _)| tag == key).map(|(tag, subsec)| {
+                let subsec = subsec.filter(|subsec| keys.iter().any(|key| key == subsec));
+                (tag.to_string(), subsec.map(str::to_string))
+            })
+        });
+        let exact = keys
+            .iter()
+            .filter(|key| {
+                time.as_ref().map_or(true, |(tag, subsec)| *key != tag && subsec.as_ref() != Some(key))
+            })
+            .cloned()
+            .collect();
+        let depth = [Depth::Basic, Depth::Standard]
+            .into_iter()
+            .find(|depth| keys.iter().all(|key| depth.includes(key)))
+            .unwrap_or(Depth::Full);
+        Self { exact, time, depth }
+    }
+
+    fn fingerprint(&self, metadata: &Metadata) -> Print {
+        let values: Vec<Option<String>> = self.exact.iter().map(|key| metadata.get(key).map(|v| v.trim().to_string())).collect();
+        let time = match &self.time {
+            Some((tag, subsec)) => metadata.get(tag).and_then(|v| CaptureTime::parse(v)).map(|mut time| {
+                if let Some(subsec) = subsec.as_ref().and_then(|t| metadata.get(t)) {
+                    time.nanos = organize::subsec_nanos(subsec.trim());
+                }
+                time.millis()
+            }),
+            None => None,
+        };
+        // A file with none of the exact tags, or without a capture time when
+        // one is asked for, cannot be matched with anything
+        let matchable =
+            (self.exact.is_empty() || values.iter().any(Option::is_some)) && (self.time.is_none() || time.is_some());
+        Print { values, time, matchable }
+    }
+}
+
+#[derive(Debug)]
+struct Print {
+    values: Vec<Option<String>>,
+    time: Option<i64>,
+    matchable: bool,
+}
+
+/// Group `paths` by the fingerprint `keys` picks out of their metadata
+///
+/// Files in a group have equal exact-match values, with a missing tag equal
+/// only to another missing one, and captures no more than `tolerance_ms`
+/// apart from the previous one in the group. Returns one group ID per path,
+/// numbered from 0 in order of first appearance, or None for files whose
+/// metadata could not be read.
+pub fn group(paths: &[String], keys: &Keys, tolerance_ms: u64) -> Result<Vec<Option<usize>>, String> {
+    let read = |reader: &mut ScratchReader, path: &String| {
+        reader.read_file_at_depth(path, keys.depth).ok().map(|m| keys.fingerprint(&m))
+    };
+    let prints: Vec<Option<Print>> = match workers::pool()? {
+        Some(pool) => pool.install(|| paths.par_iter().map_init(ScratchReader::new, read).collect()),
+        None => {
+            let mut reader = ScratchReader::new();
+            paths.iter().map(|path| read(&mut reader, path)).collect()
+        }
+    };
+    Ok(assign(&prints, tolerance_ms))
+}
+
+/// Group IDs for fingerprints, with None for files that were not read
+fn assign(prints: &[Option<Print>], tolerance_ms: u64) -> Vec<Option<usize>> {
+    let mut order: Vec<usize> =
+        (0..prints.len()).filter(|&i| prints[i].as_ref().is_some_and(|print| print.matchable)).collect();
+    let print = |i: usize| prints[i].as_ref().expect("only parsed files are ordered");
+    order.sort_unstable_by(|&a, &b| {
+        let (a, b) = (print(a), print(b));
+        a.values.cmp(&b.values).then(a.time.cmp(&b.time))
+    });
+
+    // Provisional group of each file: the index of the group's earliest capture
+    let mut leader: Vec<Option<usize>> = (0..prints.len()).map(|i| prints[i].as_ref().map(|_| i)).collect();
+    for pair in order.windows(2) {
+        let (previous, current) = (print(pair[0]), print(pair[1]));
+        let close = match (previous.time, current.time) {
+            (Some(a), Some(b)) => b.abs_diff(a) <= tolerance_ms,
+            _ => true,
+        };
+        if previous.values == current.values && close {
+            leader[pair[1]] = leader[pair[0]];
+        }
+    }
+
+    // Renumber compactly in input order
+    let mut ids = vec![usize::MAX; prints.len()];
+    let mut next = 0;
+    leader
+        .into_iter()
+        .map(|leader| {
+            leader.map(|leader| {
+                if ids[leader] == usize::MAX {
+                    ids[leader] = next;
+                    next += 1;
+                }
+                ids[leader]
+            })
+        })
+        .collect()
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn keys(keys: &[&str]) -> Keys {
+        Keys::new(&keys.iter().map(|key| key.to_string()).collect::<Vec<_>>())
+    }
+
+    fn print(keys: &Keys, tags: &[(&str, &str)]) -> Option<Print> {
+        let metadata: Metadata = tags.iter().map(|(tag, value)| (tag.to_string(), value.to_string())).collect();
+        Some(keys.fingerprint(&metadata))
+    }
+
+    fn shot(keys: &Keys, model: &str, time: &str, subsec: &str) -> Option<Print> {
+        print(keys, &[("Model", model), ("DateTimeOriginal", time), ("SubSecTimeOriginal", subsec)])
+    }
+
+    #[test]
+    fn depth_covers_every_key() {
+        assert_eq!(keys(&["Model", "DateTimeOriginal", "GPSLatitude"]).depth, Depth::Basic);
+        assert_eq!(keys(&["Model", "ThumbnailOffset"]).depth, Depth::Standard);
+        assert_eq!(keys(&["BodySerialNumber", "ShutterCount"]).depth, Depth::Full);
+    }
+
+    #[test]
+    fn time_window_chains_within_a_group() {
+        let keys = keys(&["Model", "DateTimeOriginal", "SubSecTimeOriginal"]);
+        let prints = vec![
+            shot(&keys, "A", "2024:01:02 03:04:05", "00"),
+            // 400 ms after the previous shot, 800 ms after the first
+            shot(&keys, "A", "2024:01:02 03:04:05", "80"),
+            shot(&keys, "A", "2024:01:02 03:04:05", "40"),
+            // 600 ms after the last one: a new burst
+            shot(&keys, "A", "2024:01:02 03:04:06", "40"),
+            // Within the window but from another camera
+            shot(&keys, "B", "2024:01:02 03:04:05", "00"),
+        ];
+        assert_eq!(assign(&prints, 500), [Some(0), Some(0), Some(0), Some(1), Some(2)]);
+        assert_eq!(assign(&prints, 0), [Some(0), Some(1), Some(2), Some(3), Some(4)]);
+        assert_eq!(assign(&prints, 1000), [Some(0), Some(0), Some(0), Some(0), Some(1)]);
+    }
+
+    #[test]
+    fn missing_tags_match_only_missing_tags() {
+        let keys = keys(&["BodySerialNumber", "ImageUniqueID"]);
+        let prints = vec![
+            print(&keys, &[("BodySerialNumber", "123"), ("ImageUniqueID", "x")]),
+            print(&keys, &[("BodySerialNumber", "123")]),
+            print(&keys, &[("BodySerialNumber", " 123 "), ("ImageUniqueID", "x")]),
+            print(&keys, &[("BodySerialNumber", "123")]),
+            // None of the tags: matched with nothing
+            print(&keys, &[]),
+            print(&keys, &[]),
+        ];
+        assert_eq!(assign(&prints, 0), [Some(0), Some(1), Some(0), Some(1), Some(2), Some(3)]);
+    }
+
+    #[test]
+    fn unparsed_files_and_files_without_a_time_stand_alone() {
+        let keys = keys(&["Model", "DateTimeOriginal"]);
+        let prints = vec![
+            None,
+            print(&keys, &[("Model", "A")]),
+            print(&keys, &[("Model", "A"), ("DateTimeOriginal", "2024:01:02 03:04:05")]),
+            print(&keys, &[("Model", "A")]),
+            None,
+            print(&keys, &[("Model", "A"), ("DateTimeOriginal", "2024:01:02 03:04:05")]),
+        ];
+        assert_eq!(assign(&prints, 1000), [None, Some(0), Some(1), Some(2), None, Some(1)]);
+    }
+
+    #[test]
+    fn ids_are_numbered_in_input_order() {
+        let keys = keys(&["Model"]);
+        let prints: Vec<_> = ["C", "A", "C", "B", "A"].iter().map(|model| print(&keys, &[("Model", model)])).collect();
+        assert_eq!(assign(&prints, 0), [Some(0), Some(1), Some(0), Some(2), Some(1)]);
+    }
+}
@@ -0,0 +1,404 @@
+//! I/O scheduling for batch reads on spinning disks and network mounts
+//!
+//! Reading a large batch in caller order makes a disk head (or an NFS
+//! server) jump between directories for every file. The scheduler here
+//! stats the whole batch up front, splits it into one queue per device and
+//! orders each queue for locality: by inode on local filesystems, where
+//! inode numbers roughly follow on-disk placement, and by directory on
+//! network filesystems, where they do not. Workers take files round-robin
+//! across devices with a cap on reads in flight per device, so one slow
+//! mount cannot tie up every worker, and each read hints the kernel to
+//! start fetching a few files further down the same queue.
+//!
+//! The scheduler can also hold the batch to a memory budget: each file is
+//! charged its size (capped at the per-file limit) while in flight, and no
+//! new file is started while the budget is used up.
+
+use std::collections::{BTreeMap, VecDeque};
+use std::path::Path;
+use std::sync::{Condvar, Mutex, MutexGuard};
+
+/// Number of files ahead of the current one to issue readahead for
+pub const READAHEAD_FILES: usize = 8;
+
+/// Bytes per file to request readahead for; metadata lives near the start
+const READAHEAD_BYTES: i64 = 256 * 1024;
+
+/// Result of the up-front `stat` of a batch entry
+#[derive(Clone, Copy, Debug)]
+pub struct FileInfo {
+    pub dev: u64,
+    pub ino: u64,
+    pub size: u64,
+}
+
+/// Stat one path, returning None when it cannot be stat'ed
+pub fn stat(path: &str) -> Option<FileInfo> {
+    let meta = std::fs::metadata(path).ok()?;
+    #[cfg(unix)]
+    {
+        use std::os::unix::fs::MetadataExt;
+        Some(FileInfo { dev: meta.dev(), ino: meta.ino(), size: meta.len() })
+    }
+    #[cfg(not(unix))]
+    {
+        Some(FileInfo { dev: 0, ino: 0, size: meta.len() })
+    }
+}
+
+/// Split a batch into per-device queues of indices into `paths`
+///
+/// With `locality` set each queue is reordered for sequential access;
+/// otherwise entries keep their input order within a device. Paths that
+/// could not be stat'ed share a final queue so their errors are still
+/// reported.
+pub fn plan(paths: &[String], infos: &[Option<FileInfo>], locality: bool) -> Vec<VecDeque<usize>> {
+    let mut devices: BTreeMap<Option<u64>, Vec<usize>> = BTreeMap::new();
+    for (index, info) in infos.iter().enumerate() {
+        devices.entry(info.map(|i| i.dev)).or_default().push(index);
+    }
+    let mut queues = Vec::with_capacity(devices.len());
+    // BTreeMap orders None first; move the unknown group to the end
+    let mut unknown = None;
+    for (dev, mut indices) in devices {
+        if dev.is_none() {
+            unknown = Some(indices);
+            continue;
+        }
+        if locality {
+            if is_network_fs(&paths[indices[0]]) {
+                sort_by_directory(&mut indices, paths);
+            } else {
+                sort_by_inode(&mut indices, infos);
+            }
+        }
+        queues.push(indices.into());
+    }
+    if let Some(indices) = unknown {
+        queues.push(indices.into());
+    }
+    queues
+}
+
+/// Order batch entries by directory, then by path within a directory
+fn sort_by_directory(indices: &mut [usize], paths: &[String]) {
+    indices.sort_by(|&a, &b| {
+        let (pa, pb) = (Path::new(&paths[a]), Path::new(&paths[b]));
+        pa.parent().cmp(&pb.parent()).then_with(|| pa.cmp(pb))
+    });
+}
+
+/// Order batch entries by inode number
+fn sort_by_inode(indices: &mut [usize], infos: &[Option<FileInfo>]) {
+    indices.sort_by_key(|&i| infos[i].map_or(0, |info| info.ino));
+}
+
+/// Whether `path` lives on a network filesystem
+#[cfg(target_os = "linux")]
+pub fn is_network_fs(path: &str) -> bool {
+    use std::ffi::CString;
+    use std::os::unix::ffi::OsStrExt;
+
+    const NETWORK_MAGICS: &[u32] = &[
+        0x0000_6969, // NFS
+        0x0000_517B, // SMB
+        0xFF53_4D42, // CIFS
+        0xFE53_4D42, // SMB2
+        0x00C3_6400, // Ceph
+        0x6573_5546, // FUSE (sshfs, s3fs, ...)
+        0x5346_414F, // AFS
+        0x0102_1997, // 9P
+    ];
+    let dir = Path::new(path).parent().unwrap_or(Path::new("."));
+    let dir = if dir.as_os_str().is_empty() { Path::new(".") } else { dir };
+    let Ok(c_path) = CString::new(dir.as_os_str().as_bytes()) else {
+        return false;
+    };
+    let mut st: libc::statfs = unsafe { std::mem::zeroed() };
+    if unsafe { libc::statfs(c_path.as_ptr(), &mut st) } != 0 {
+        return false;
+    }
+    NETWORK_MAGICS.contains(&(st.f_type as u32))
+}
+
+#[cfg(not(target_os = "linux"))]
+pub fn is_network_fs(_path: &str) -> bool {
+    false
+}
+
+/// Ask the kernel to start reading the head of `path` in the background
+#[cfg(target_os = "linux")]
+pub fn advise_willneed(path: &str) {
+    use std::os::unix::io::AsRawFd;
+
+    if let Ok(file) = std::fs::File::open(path) {
+        // Closing the descriptor does not cancel the readahead
+        unsafe {
+            libc::posix_fadvise(file.as_raw_fd(), 0, READAHEAD_BYTES, libc::POSIX_FADV_WILLNEED);
+        }
+    }
+}
+
+#[cfg(not(target_os = "linux"))]
+pub fn advise_willneed(_path: &str) {}
+
+/// A file handed to a worker by the scheduler
+pub struct Job {
+    /// Index into the batch
+    pub index: usize,
+    /// File entering the readahead window of the same device, if any
+    pub prefetch: Option<usize>,
+    queue: usize,
+}
+
+struct DeviceQueue {
+    pending: VecDeque<usize>,
+    inflight: usize,
+}
+
+struct SchedState {
+    queues: Vec<DeviceQueue>,
+    /// Queue to try first on the next pick, for round-robin fairness
+    cursor: usize,
+    remaining: usize,
+    inflight_bytes: u64,
+}
+
+/// Hands out batch entries to workers, device by device
+pub struct Scheduler {
+    state: Mutex<SchedState>,
+    ready: Condvar,
+    max_per_device: usize,
+    /// Bytes charged against the budget for each batch entry
+    costs: Vec<u64>,
+    max_inflight_bytes: u64,
+}
+
+impl Scheduler {
+    /// Build a scheduler over per-device queues from [`plan`]
+    ///
+    /// `max_per_device` of None leaves the number of reads in flight on
+    /// each device unlimited. `costs` gives the bytes each batch entry
+    /// holds while in flight; `max_inflight_bytes` of None disables the
+    /// budget. A file larger than the whole budget still runs, alone.
+    pub fn new(
+        queues: Vec<VecDeque<usize>>,
+        max_per_device: Option<usize>,
+        costs: Vec<u64>,
+        max_inflight_bytes: Option<u64>,
+    ) -> Self {
+        let remaining = queues.iter().map(|q| q.len()).sum();
+        Self {
+            state: Mutex::new(SchedState {
+                queues: queues
+                    .into_iter()
+                    .map(|pending| DeviceQueue { pending, inflight: 0 })
+                    .collect(),
+                cursor: 0,
+                remaining,
+                inflight_bytes: 0,
+            }),
+            ready: Condvar::new(),
+            max_per_device: max_per_device.unwrap_or(usize::MAX).max(1),
+            costs,
+            max_inflight_bytes: max_inflight_bytes.unwrap_or(u64::MAX),
+        }
+    }
+
+    fn cost(&self, index: usize) -> u64 {
+        self.costs.get(index).copied().unwrap_or(0)
+    }
+
+    /// Files to issue readahead for before the first job starts
+    pub fn initial_prefetch(&self) -> Vec<usize> {
+        self.lock()
+            .queues
+            .iter()
+            .flat_map(|q| q.pending.iter().take(READAHEAD_FILES).copied())
+            .collect()
+    }
+
+    /// Take the next file, blocking while every device is at its limit or
+    /// the memory budget is used up
+    ///
+    /// Returns None once every file has been handed out.
+    pub fn next(&self) -> Option<Job> {
+        let mut state = self.lock();
+        loop {
+            if state.remaining == 0 {
+                return None;
+            }
+            let count = state.queues.len();
+            let start = state.cursor;
+            let inflight_bytes = state.inflight_bytes;
+            let pick = (0..count).map(|i| (start + i) % count).find(|&q| {
+                let queue = &state.queues[q];
+                let Some(&head) = queue.pending.front() else {
+                    return false;
+                };
+                let fits = inflight_bytes == 0
+                    || inflight_bytes.saturating_add(self.cost(head)) <= self.max_inflight_bytes;
+                queue.inflight < self.max_per_device && fits
+            });
+            if let Some(q) = pick {
+                state.cursor = q + 1;
+                state.remaining -= 1;
+                let queue = &mut state.queues[q];
+                let index = queue.pending.pop_front()?;
+                queue.inflight += 1;
+                let prefetch = queue.pending.get(READAHEAD_FILES - 1).copied();
+                state.inflight_bytes += self.cost(index);
+                return Some(Job { index, prefetch, queue: q });
+            }
+            state = self.ready.wait(state).unwrap_or_else(|e| e.into_inner());
+        }
+    }
+
+    /// Mark a job from [`Scheduler::next`] as finished
+    pub fn finish(&self, job: Job) {
+        let mut state = self.lock();
+        state.queues[job.queue].inflight -= 1;
+        state.inflight_bytes -= self.cost(job.index);
+        drop(state);
+        self.ready.notify_all();
+    }
+
+    fn lock(&self) -> MutexGuard<'_, SchedState> {
+        self.state.lock().unwrap_or_else(|e| e.into_inner())
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use std::sync::atomic::{AtomicUsize, Ordering};
+    use std::sync::Arc;
+    use std::time::Duration;
+
+    fn info(dev: u64, ino: u64, size: u64) -> Option<FileInfo> {
+        Some(FileInfo { dev, ino, size })
+    }
+
+    fn paths(names: &[&str]) -> Vec<String> {
+        let dir = std::env::temp_dir();
+        names.iter().map(|name| dir.join(name).to_string_lossy().into_owned()).collect()
+    }
+
+    fn queue_contents(queues: &[VecDeque<usize>]) -> Vec<Vec<usize>> {
+        queues.iter().map(|q| q.iter().copied().collect()).collect()
+    }
+
+    #[test]
+    fn plan_keeps_input_order_without_locality() {
+        let paths = paths(&["c", "a", "b", "d"]);
+        let infos = [info(1, 30, 0), info(2, 10, 0), None, info(1, 20, 0)];
+        assert_eq!(queue_contents(&plan(&paths, &infos, false)), [vec![0, 3], vec![1], vec![2]]);
+    }
+
+    #[test]
+    fn plan_groups_by_device_and_orders_by_inode() {
+        let paths = paths(&["a", "b", "c", "d", "e"]);
+        let infos = [info(7, 30, 0), None, info(3, 5, 0), info(7, 10, 0), info(7, 20, 0)];
+        // Unknown files come last whatever their position in the batch
+        assert_eq!(queue_contents(&plan(&paths, &infos, true)), [vec![2], vec![3, 4, 0], vec![1]]);
+    }
+
+    #[test]
+    fn directory_order_groups_each_directory() {
+        let paths: Vec<String> = ["/m/b/2.jpg", "/m/a/9.jpg", "/m/b/1.jpg", "/m/a/1.jpg", "/m/c.jpg"]
+            .iter()
+            .map(|p| p.to_string())
+            .collect();
+        let mut indices: Vec<usize> = (0..paths.len()).collect();
+        sort_by_directory(&mut indices, &paths);
+        assert_eq!(indices, [4, 3, 1, 2, 0]);
+    }
+
+    /// Drain `scheduler` on `threads` threads, returning the jobs in the
+    /// order they were handed out and the most jobs ever in flight on each
+    /// queue
+    fn drain(scheduler: Scheduler, queues: usize, threads: usize) -> (Vec<usize>, Vec<usize>) {
+        let scheduler = Arc::new(scheduler);
+        let inflight: Arc<Vec<AtomicUsize>> = Arc::new((0..queues).map(|_| AtomicUsize::new(0)).collect());
+        let peak: Arc<Vec<AtomicUsize>> = Arc::new((0..queues).map(|_| AtomicUsize::new(0)).collect());
+        let order = Arc::new(Mutex::new(Vec::new()));
+        let workers: Vec<_> = (0..threads)
+            .map(|_| {
+                let (scheduler, inflight, peak, order) =
+                    (Arc::clone(&scheduler), Arc::clone(&inflight), Arc::clone(&peak), Arc::clone(&order));
+                std::thread::spawn(move || {
+                    while let Some(job) = scheduler.next() {
+                        let now = inflight[job.queue].fetch_add(1, Ordering::SeqCst) + 1;
+                        peak[job.queue].fetch_max(now, Ordering::SeqCst);
+                        order.lock().unwrap().push(job.index);
+                        std::thread::sleep(Duration::from_millis(5));
+                        inflight[job.queue].fetch_sub(1, Ordering::SeqCst);
+                        scheduler.finish(job);
+                    }
+                })
+            })
+            .collect();
+        for worker in workers {
+            worker.join().unwrap();
+        }
+        let order = order.lock().unwrap().clone();
+        (order, peak.iter().map(|p| p.load(Ordering::SeqCst)).collect())
+    }
+
+    #[test]
+    fn scheduler_bounds_reads_per_device() {
+        let queues: Vec<VecDeque<usize>> = vec![(0..10).collect(), (10..20).collect()];
+        let scheduler = Scheduler::new(queues, Some(2), vec![0; 20], None);
+        let (mut order, peak) = drain(scheduler, 2, 8);
+        assert!(peak.iter().all(|&p| (1..=2).contains(&p)), "peak reads per device: {:?}", peak);
+        order.sort_unstable();
+        assert_eq!(order, (0..20).collect::<Vec<_>>());
+    }
+
+    #[test]
+    fn scheduler_serialises_a_device_limited_to_one() {
+        let queues: Vec<VecDeque<usize>> = vec![VecDeque::from([3, 1, 2, 0])];
+        let scheduler = Scheduler::new(queues, Some(1), vec![0; 4], None);
+        let (order, peak) = drain(scheduler, 1, 4);
+        assert_eq!(peak, [1]);
+        // One read at a time hands the queue out in its planned order
+        assert_eq!(order, [3, 1, 2, 0]);
+    }
+
+    #[test]
+    fn scheduler_alternates_between_devices() {
+        let queues: Vec<VecDeque<usize>> = vec![VecDeque::from([0, 1, 2]), VecDeque::from([3, 4, 5])];
+        let scheduler = Scheduler::new(queues, None, vec![0; 6], None);
+        let picks: Vec<usize> = std::iter::from_fn(|| scheduler.next().map(|job| job.index)).collect();
+        assert_eq!(picks, [0, 3, 1, 4, 2, 5]);
+    }
+
+    #[test]
+    fn scheduler_holds_the_byte_budget() {
+        let queues: Vec<VecDeque<usize>> = vec![(0..6).collect()];
+        let scheduler = Scheduler::new(queues, None, vec![40; 6], Some(100));
+        let first = scheduler.next().unwrap();
+        let second = scheduler.next().unwrap();
+        // A third 40-byte file would exceed the budget until one finishes
+        let scheduler = Arc::new(scheduler);
+        let waiting = {
+            let scheduler = Arc::clone(&scheduler);
+            std::thread::spawn(move || scheduler.next().map(|job| job.index))
+        };
+        std::thread::sleep(Duration::from_millis(50));
+        assert!(!waiting.is_finished());
+        scheduler.finish(first);
+        assert_eq!(waiting.join().unwrap(), Some(2));
+        scheduler.finish(second);
+    }
+
+    #[test]
+    fn scheduler_runs_a_file_larger_than_the_budget_alone() {
+        let queues: Vec<VecDeque<usize>> = vec![VecDeque::from([0, 1])];
+        let scheduler = Scheduler::new(queues, None, vec![500, 10], Some(100));
+        let big = scheduler.next().unwrap();
+        assert_eq!(big.index, 0);
+        scheduler.finish(big);
+        assert_eq!(scheduler.next().map(|job| job.index), Some(1));
+    }
+}
@@ -4,199 +4,1043 @@
 //! allowing Python users to access the high-performance EXIF reading capabilities.
 
 use pyo3::prelude::*;
+use pyo3::buffer::PyBuffer;
+use pyo3::types::{PyByteArray, PyBytes};
+use std::borrow::Cow;
 use std::collections::HashMap;
-use fast_exif_reader::{FastExifReader, FastExifWriter, FastExifCopier, ExifError};
+use std::path::PathBuf;
+use std::sync::{Arc, Mutex, MutexGuard};
+use std::time::{Duration, Instant};
+use fast_exif_reader::{FastExifWriter, FastExifCopier};
+
+#[cfg(feature = "alloc-stats")]
+mod alloc_stats;
+mod batch;
+mod catalog;
+mod depth;
+mod fingerprint;
+mod io;
+mod organize;
+mod output;
+mod ranged;
+mod scratch;
+mod shared;
+mod watch;
+mod workers;
+mod xmp;
+
+use batch::{BatchOptions, IoSchedule, Progress};
+use depth::Depth;
+use ranged::{RangeCache, RangeSource};
+use scratch::ScratchReader;
+use shared::InstancePool;
 
 /// Python wrapper for FastExifReader
+///
+/// Instances are safe to share between threads; concurrent calls each use
+/// their own core reader and run without holding the GIL. Idle readers keep
+/// their scratch buffers for the next call (see `configure_scratch_buffers`).
 #[pyclass]
 pub struct PyFastExifReader {
-    reader: FastExifReader,
+    readers: InstancePool<ScratchReader>,
+    depth: Depth,
+}
+
+impl PyFastExifReader {
+    fn with_depth(depth: Depth) -> Self {
+        Self {
+            readers: InstancePool::new(ScratchReader::new),
+            depth,
+        }
+    }
 }
 
 #[pymethods]
 impl PyFastExifReader {
     /// Create a new FastExifReader instance
+    ///
+    /// `depth` selects the metadata reported: "basic" (IFD0, EXIF and GPS),
+    /// "standard" (plus interoperability and IFD1 tags) or "full"
+    /// (everything, including MakerNotes and vendor blocks). Below "full"
+    /// the blocks outside the level are neither read nor decoded.
     #[new]
-    pub fn new() -> Self {
-        Self {
-            reader: FastExifReader::new(),
-        }
+    #[pyo3(signature = (depth="full"))]
+    pub fn new(depth: &str) -> PyResult<Self> {
+        Ok(Self::with_depth(parse_depth(depth)?))
+    }
+
+    /// Parse depth of this reader
+    #[getter]
+    pub fn depth(&self) -> &'static str {
+        self.depth.name()
     }
 
     /// Read EXIF data from file path
-    pub fn read_file(&mut self, file_path: &str) -> PyResult<HashMap<String, String>> {
-        self.reader.read_file(file_path)
-            .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF reading error: {}", e)))
+    pub fn read_file(&self, py: Python<'_>, file_path: &str) -> PyResult<HashMap<String, String>> {
+        py.allow_threads(|| {
+            let mut metadata = self.readers.with(|reader| reader.read_file_at_depth(file_path, self.depth))
+                .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF reading error: {}", e)))?;
+            self.depth.trim(&mut metadata);
+            Ok(metadata)
+        })
     }
 
     /// Read EXIF data from bytes
-    pub fn read_bytes(&mut self, data: &[u8]) -> PyResult<HashMap<String, String>> {
-        self.reader.read_bytes(data)
-            .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF reading error: {}", e)))
+    pub fn read_bytes(&self, py: Python<'_>, data: &[u8]) -> PyResult<HashMap<String, String>> {
+        py.allow_threads(|| {
+            let mut metadata = self.readers.with(|reader| reader.read_bytes_at_depth(data, self.depth))
+                .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF reading error: {}", e)))?;
+            self.depth.trim(&mut metadata);
+            Ok(metadata)
+        })
+    }
+
+    /// Read EXIF data from a file-like object or `read_range` callable
+    ///
+    /// See `read_exif_fileobj`.
+    pub fn read_fileobj(&self, py: Python<'_>, source: &Bound<'_, PyAny>) -> PyResult<HashMap<String, String>> {
+        let data = fetch_metadata(source, self.depth)?;
+        py.allow_threads(|| {
+            let mut metadata = self.readers.with(|reader| reader.read_bytes(&data))
+                .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF reading error: {}", e)))?;
+            self.depth.trim(&mut metadata);
+            Ok(metadata)
+        })
     }
 
     /// Read EXIF data from multiple files in parallel
-    pub fn read_files_parallel(&mut self, file_paths: Vec<String>) -> PyResult<Vec<HashMap<String, String>>> {
-        self.reader.read_files_parallel(file_paths)
-            .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF reading error: {}", e)))
+    ///
+    /// See `read_exif_files_parallel` for the scheduling and progress options.
+    #[pyo3(signature = (
+        file_paths,
+        io_schedule="default",
+        max_io_per_device=None,
+        max_inflight_bytes=None,
+        max_file_bytes=None,
+        sidecars=false,
+        progress=None,
+        progress_interval=0.1,
+    ))]
+    pub fn read_files_parallel(
+        &self,
+        py: Python<'_>,
+        file_paths: Vec<String>,
+        io_schedule: &str,
+        max_io_per_device: Option<usize>,
+        max_inflight_bytes: Option<u64>,
+        max_file_bytes: Option<u64>,
+        sidecars: bool,
+        progress: Option<&Bound<'_, PyAny>>,
+        progress_interval: f64,
+    ) -> PyResult<Vec<HashMap<String, String>>> {
+        let options = BatchOptions {
+            schedule: parse_io_schedule(io_schedule)?,
+            max_io_per_device,
+            max_inflight_bytes,
+            max_file_bytes,
+            depth: self.depth,
+            sidecars,
+            progress: None,
+        };
+        read_batch(py, &file_paths, options, progress, progress_interval)
     }
 }
 
 impl Default for PyFastExifReader {
     fn default() -> Self {
-        Self::new()
+        Self::with_depth(Depth::Full)
     }
 }
 
 /// Python wrapper for FastExifWriter
+///
+/// Instances are safe to share between threads.
 #[pyclass]
 pub struct PyFastExifWriter {
-    writer: FastExifWriter,
+    writers: InstancePool<FastExifWriter>,
+    depth: Depth,
+}
+
+impl PyFastExifWriter {
+    fn with_depth(depth: Depth) -> Self {
+        Self {
+            writers: InstancePool::new(FastExifWriter::new),
+            depth,
+        }
+    }
 }
 
 #[pymethods]
 impl PyFastExifWriter {
     /// Create a new FastExifWriter instance
+    ///
+    /// Metadata fields outside `depth` ("basic", "standard" or "full") are
+    /// rejected with `ValueError` rather than written.
     #[new]
-    pub fn new() -> Self {
-        Self {
-            writer: FastExifWriter::new(),
-        }
+    #[pyo3(signature = (depth="full"))]
+    pub fn new(depth: &str) -> PyResult<Self> {
+        Ok(Self::with_depth(parse_depth(depth)?))
+    }
+
+    /// Parse depth of this writer
+    #[getter]
+    pub fn depth(&self) -> &'static str {
+        self.depth.name()
     }
 
     /// Write EXIF metadata to an image file
     pub fn write_exif(
         &self,
+        py: Python<'_>,
         input_path: &str,
         output_path: &str,
         metadata: HashMap<String, String>,
     ) -> PyResult<()> {
-        self.writer.write_exif(input_path, output_path, &metadata)
-            .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF writing error: {}", e)))
+        check_depth(self.depth, &metadata)?;
+        py.allow_threads(|| {
+            self.writers.with(|writer| writer.write_exif(input_path, output_path, &metadata))
+                .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF writing error: {}", e)))
+        })
     }
 
     /// Write EXIF metadata to image bytes
+    ///
+    /// Returns a new `bytes` object. With `into`, the image is written into
+    /// that buffer instead and the number of bytes written is returned: a
+    /// `bytearray` is resized to fit, any other writable buffer must be
+    /// large enough. For JPEG input only the marker segments are rewritten
+    /// in memory and the image data is copied straight from `input_data`
+    /// into the buffer; other formats are rewritten whole first.
+    #[pyo3(signature = (input_data, metadata, into=None))]
     pub fn write_exif_to_bytes(
         &self,
+        py: Python<'_>,
         input_data: &[u8],
         metadata: HashMap<String, String>,
-    ) -> PyResult<Vec<u8>> {
-        self.writer.write_exif_to_bytes(input_data, &metadata)
+        into: Option<&Bound<'_, PyAny>>,
+    ) -> PyResult<PyObject> {
+        let Some(target) = into else {
+            let data = self.rewrite(py, input_data, metadata)?;
+            return Ok(PyBytes::new(py, &data).into_any().unbind());
+        };
+        check_depth(self.depth, &metadata)?;
+        let rewritten = py
+            .allow_threads(|| {
+                output::rewrite_split(input_data, |data| self.writers.with(|writer| writer.write_exif_to_bytes(data, &metadata)))
+            })
+            .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF writing error: {}", e)))?;
+        Ok(copy_into(target, &rewritten.parts())?.into_pyobject(py)?.into_any().unbind())
+    }
+
+    /// Write EXIF metadata to image bytes, returning the result without
+    /// copying it into a `bytes` object
+    ///
+    /// The returned `ExifBuffer` supports the buffer protocol, so it can be
+    /// passed to `memoryview`, `file.write` or a socket directly.
+    pub fn write_exif_to_buffer(
+        &self,
+        py: Python<'_>,
+        input_data: &[u8],
+        metadata: HashMap<String, String>,
+    ) -> PyResult<ExifBuffer> {
+        Ok(ExifBuffer { data: self.rewrite(py, input_data, metadata)? })
+    }
+
+    /// Write EXIF metadata to image bytes, streaming the result to a file
+    ///
+    /// `fd` is a file descriptor or an object with `fileno()`; it is left
+    /// open. For JPEG input only the marker segments are rewritten in
+    /// memory and the image data is written straight from `input_data`.
+    /// Returns the number of bytes written.
+    pub fn write_exif_to_fd(
+        &self,
+        py: Python<'_>,
+        input_data: &[u8],
+        fd: &Bound<'_, PyAny>,
+        metadata: HashMap<String, String>,
+    ) -> PyResult<usize> {
+        let fd: i32 = match fd.extract() {
+            Ok(fd) => fd,
+            Err(_) => fd.call_method0("fileno")?.extract()?,
+        };
+        check_depth(self.depth, &metadata)?;
+        py.allow_threads(|| {
+            output::with_fd(fd, |file| {
+                output::write_streamed(
+                    input_data,
+                    |data| self.writers.with(|writer| writer.write_exif_to_bytes(data, &metadata)),
+                    file,
+                )
+            })
             .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF writing error: {}", e)))
+        })
     }
 
     /// Copy high-priority EXIF fields from source to target image
     pub fn copy_high_priority_exif(
         &self,
+        py: Python<'_>,
         source_path: &str,
         target_path: &str,
         output_path: &str,
     ) -> PyResult<()> {
-        self.writer.copy_high_priority_exif(source_path, target_path, output_path)
-            .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF copying error: {}", e)))
+        py.allow_threads(|| {
+            self.writers.with(|writer| writer.copy_high_priority_exif(source_path, target_path, output_path))
+                .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF copying error: {}", e)))
+        })
+    }
+}
+
+impl PyFastExifWriter {
+    fn rewrite(&self, py: Python<'_>, input_data: &[u8], metadata: HashMap<String, String>) -> PyResult<Vec<u8>> {
+        check_depth(self.depth, &metadata)?;
+        py.allow_threads(|| {
+            self.writers.with(|writer| writer.write_exif_to_bytes(input_data, &metadata))
+                .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF writing error: {}", e)))
+        })
     }
 }
 
 impl Default for PyFastExifWriter {
     fn default() -> Self {
-        Self::new()
+        Self::with_depth(Depth::Full)
+    }
+}
+
+/// Image bytes owned by the extension, exposed through the buffer protocol
+#[pyclass(frozen)]
+pub struct ExifBuffer {
+    data: Vec<u8>,
+}
+
+#[pymethods]
+impl ExifBuffer {
+    unsafe fn __getbuffer__(slf: Bound<'_, Self>, view: *mut pyo3::ffi::Py_buffer, flags: std::os::raw::c_int) -> PyResult<()> {
+        if flags & pyo3::ffi::PyBUF_WRITABLE != 0 {
+            return Err(PyErr::new::<pyo3::exceptions::PyBufferError, _>("ExifBuffer is read-only"));
+        }
+        // The data is never mutated, and the view holds a reference to
+        // this object, so the pointer stays valid for the view's lifetime
+        let data = &slf.get().data;
+        let filled = pyo3::ffi::PyBuffer_FillInfo(
+            view,
+            slf.as_ptr(),
+            data.as_ptr() as *mut std::os::raw::c_void,
+            data.len() as pyo3::ffi::Py_ssize_t,
+            1,
+            flags,
+        );
+        if filled == -1 {
+            return Err(PyErr::fetch(slf.py()));
+        }
+        Ok(())
+    }
+
+    fn __len__(&self) -> usize {
+        self.data.len()
+    }
+
+    /// Copy the contents into a `bytes` object
+    fn __bytes__<'py>(&self, py: Python<'py>) -> Bound<'py, PyBytes> {
+        PyBytes::new(py, &self.data)
     }
 }
 
+/// Copy `parts` one after another into a bytearray or writable buffer,
+/// returning their total length
+fn copy_into(target: &Bound<'_, PyAny>, parts: &[&[u8]]) -> PyResult<usize> {
+    let len = parts.iter().map(|part| part.len()).sum();
+    if let Ok(array) = target.downcast::<PyByteArray>() {
+        array.resize(len)?;
+    }
+    // Writing goes through a buffer export even for a bytearray: while it
+    // is held, other threads (which run concurrently on free-threaded
+    // builds) cannot resize the target, and a resize that landed before the
+    // export is caught by the length check
+    let buffer = PyBuffer::<u8>::get(target)?;
+    if buffer.readonly() || !buffer.is_c_contiguous() {
+        return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>("into must be a writable contiguous buffer"));
+    }
+    if buffer.len_bytes() < len {
+        return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
+            "into holds {} bytes but the image needs {}",
+            buffer.len_bytes(),
+            len
+        )));
+    }
+    let mut at = buffer.buf_ptr() as *mut u8;
+    for part in parts {
+        // SAFETY: the buffer is writable, contiguous and at least len bytes
+        unsafe {
+            std::ptr::copy_nonoverlapping(part.as_ptr(), at, part.len());
+            at = at.add(part.len());
+        }
+    }
+    Ok(len)
+}
+
 /// Python wrapper for FastExifCopier
+///
+/// Instances are safe to share between threads; concurrent calls each use
+/// their own core copier and run without holding the GIL.
 #[pyclass]
 pub struct PyFastExifCopier {
-    copier: FastExifCopier,
+    copiers: InstancePool<FastExifCopier>,
+    depth: Depth,
+}
+
+impl PyFastExifCopier {
+    fn with_depth(depth: Depth) -> Self {
+        Self {
+            copiers: InstancePool::new(FastExifCopier::new),
+            depth,
+        }
+    }
 }
 
 #[pymethods]
 impl PyFastExifCopier {
     /// Create a new FastExifCopier instance
+    ///
+    /// Fields outside `depth` ("basic", "standard" or "full") are neither
+    /// reported nor copied by `copy_all_exif`.
     #[new]
-    pub fn new() -> Self {
-        Self {
-            copier: FastExifCopier::new(),
-        }
+    #[pyo3(signature = (depth="full"))]
+    pub fn new(depth: &str) -> PyResult<Self> {
+        Ok(Self::with_depth(parse_depth(depth)?))
+    }
+
+    /// Parse depth of this copier
+    #[getter]
+    pub fn depth(&self) -> &'static str {
+        self.depth.name()
     }
 
     /// Copy high-priority EXIF fields from source to target image
     pub fn copy_high_priority_exif(
-        &mut self,
+        &self,
+        py: Python<'_>,
         source_path: &str,
         target_path: &str,
         output_path: &str,
     ) -> PyResult<()> {
-        self.copier.copy_high_priority_exif(source_path, target_path, output_path)
-            .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF copying error: {}", e)))
+        py.allow_threads(|| {
+            self.copiers.with(|copier| copier.copy_high_priority_exif(source_path, target_path, output_path))
+                .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF copying error: {}", e)))
+        })
     }
 
     /// Copy all EXIF fields from source to target image
     pub fn copy_all_exif(
-        &mut self,
+        &self,
+        py: Python<'_>,
         source_path: &str,
         target_path: &str,
         output_path: &str,
     ) -> PyResult<()> {
-        self.copier.copy_all_exif(source_path, target_path, output_path)
+        py.allow_threads(|| {
+            self.copiers.with(|copier| {
+                if self.depth == Depth::Full {
+                    return copier.copy_all_exif(source_path, target_path, output_path);
+                }
+                let mut field_names = copier.get_available_fields(source_path)?;
+                field_names.retain(|field| self.depth.includes(field));
+                let field_names_str: Vec<&str> = field_names.iter().map(|s| s.as_str()).collect();
+                copier.copy_specific_exif(source_path, target_path, output_path, &field_names_str)
+            })
             .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF copying error: {}", e)))
+        })
     }
 
     /// Copy specific EXIF fields from source to target image
     pub fn copy_specific_exif(
-        &mut self,
+        &self,
+        py: Python<'_>,
         source_path: &str,
         target_path: &str,
         output_path: &str,
         field_names: Vec<String>,
     ) -> PyResult<()> {
         let field_names_str: Vec<&str> = field_names.iter().map(|s| s.as_str()).collect();
-        self.copier.copy_specific_exif(source_path, target_path, output_path, &field_names_str)
-            .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF copying error: {}", e)))
+        py.allow_threads(|| {
+            self.copiers.with(|copier| copier.copy_specific_exif(source_path, target_path, output_path, &field_names_str))
+                .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF copying error: {}", e)))
+        })
     }
 
     /// Get available EXIF fields from source image
-    pub fn get_available_fields(&mut self, source_path: &str) -> PyResult<Vec<String>> {
-        self.copier.get_available_fields(source_path)
-            .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF reading error: {}", e)))
+    pub fn get_available_fields(&self, py: Python<'_>, source_path: &str) -> PyResult<Vec<String>> {
+        py.allow_threads(|| {
+            let mut fields = self.copiers.with(|copier| copier.get_available_fields(source_path))
+                .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF reading error: {}", e)))?;
+            fields.retain(|field| self.depth.includes(field));
+            Ok(fields)
+        })
     }
 
     /// Get high-priority EXIF fields from source image
-    pub fn get_high_priority_fields(&mut self, source_path: &str) -> PyResult<HashMap<String, String>> {
-        self.copier.get_high_priority_fields(source_path)
-            .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF reading error: {}", e)))
+    pub fn get_high_priority_fields(&self, py: Python<'_>, source_path: &str) -> PyResult<HashMap<String, String>> {
+        py.allow_threads(|| {
+            let mut fields = self.copiers.with(|copier| copier.get_high_priority_fields(source_path))
+                .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF reading error: {}", e)))?;
+            self.depth.trim(&mut fields);
+            Ok(fields)
+        })
     }
 }
 
 impl Default for PyFastExifCopier {
     fn default() -> Self {
-        Self::new()
+        Self::with_depth(Depth::Full)
+    }
+}
+
+/// Metadata catalog of a directory tree, kept current incrementally
+///
+/// Opening a catalog extracts metadata for every media file under `root` in
+/// parallel, or, when `db_path` already holds a catalog of `root`, only for
+/// files added or changed since it was last synced. With `watch=True`
+/// changes are then tracked with inotify on Linux, so `sync()` only stats
+/// and parses what changed; otherwise, or when the inotify watch limit is
+/// too low for the tree, each sync compares the tree against the catalog
+/// with `stat`. Renamed files keep their metadata without being parsed.
+#[pyclass(name = "Catalog")]
+pub struct PyCatalog {
+    inner: Mutex<catalog::Catalog>,
+}
+
+impl PyCatalog {
+    /// Lock the catalog; callers release the GIL first so that a long sync
+    /// on another thread cannot stall the interpreter
+    fn lock(&self) -> MutexGuard<'_, catalog::Catalog> {
+        self.inner.lock().unwrap_or_else(|e| e.into_inner())
     }
 }
 
+fn catalog_error(e: String) -> PyErr {
+    PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("Catalog error: {}", e))
+}
+
+fn changes_dict(changes: catalog::Changes) -> HashMap<&'static str, usize> {
+    HashMap::from([
+        ("added", changes.added),
+        ("modified", changes.modified),
+        ("renamed", changes.renamed),
+        ("deleted", changes.deleted),
+        ("failed", changes.failed),
+    ])
+}
+
+#[pymethods]
+impl PyCatalog {
+    /// Open or create the catalog of `root` stored at `db_path`
+    ///
+    /// `depth` selects the metadata kept, as for `PyFastExifReader`.
+    #[new]
+    #[pyo3(signature = (root, db_path, depth="full", watch=true))]
+    pub fn new(py: Python<'_>, root: PathBuf, db_path: PathBuf, depth: &str, watch: bool) -> PyResult<Self> {
+        let depth = parse_depth(depth)?;
+        let (catalog, _) = py
+            .allow_threads(|| catalog::Catalog::open(&root, &db_path, depth, watch))
+            .map_err(catalog_error)?;
+        Ok(Self { inner: Mutex::new(catalog) })
+    }
+
+    /// Pick up added, modified, renamed and deleted files and save them
+    ///
+    /// Returns the number of files in each of those groups, plus `failed`
+    /// for added or modified files whose metadata could not be read.
+    pub fn sync(&self, py: Python<'_>) -> PyResult<HashMap<&'static str, usize>> {
+        py.allow_threads(|| self.lock().sync()).map(changes_dict).map_err(catalog_error)
+    }
+
+    /// Metadata of a cataloged file, by absolute path or path relative to the root
+    ///
+    /// The path is canonicalized like the root, so symlinks and ".." in it
+    /// are resolved before the lookup.
+    pub fn get(&self, py: Python<'_>, path: PathBuf) -> Option<HashMap<String, String>> {
+        py.allow_threads(|| self.lock().get(&path).cloned())
+    }
+
+    /// Paths of files that have `tag`, set to `value` if given
+    #[pyo3(signature = (tag, value=None))]
+    pub fn find(&self, py: Python<'_>, tag: &str, value: Option<&str>) -> Vec<String> {
+        py.allow_threads(|| self.lock().find(tag, value))
+    }
+
+    /// Distinct values of `tag`, with the number of files having each
+    pub fn values(&self, py: Python<'_>, tag: &str) -> HashMap<String, usize> {
+        py.allow_threads(|| self.lock().values(tag).into_iter().collect())
+    }
+
+    /// Paths of all cataloged files
+    pub fn paths(&self, py: Python<'_>) -> Vec<String> {
+        py.allow_threads(|| self.lock().paths().cloned().collect())
+    }
+
+    /// Root directory of the catalog
+    #[getter]
+    pub fn root(&self, py: Python<'_>) -> PathBuf {
+        py.allow_threads(|| self.lock().root().to_path_buf())
+    }
+
+    /// Whether changes are tracked with inotify rather than a rescan
+    #[getter]
+    pub fn watching(&self, py: Python<'_>) -> bool {
+        py.allow_threads(|| self.lock().watching())
+    }
+
+    /// Stop tracking changes; later syncs compare the whole tree
+    pub fn close(&self, py: Python<'_>) {
+        py.allow_threads(|| self.lock().unwatch());
+    }
+
+    pub fn __len__(&self, py: Python<'_>) -> usize {
+        py.allow_threads(|| self.lock().len())
+    }
+
+    pub fn __contains__(&self, py: Python<'_>, path: PathBuf) -> bool {
+        py.allow_threads(|| self.lock().get(&path).is_some())
+    }
+}
+
+fn parse_depth(depth: &str) -> PyResult<Depth> {
+    Depth::parse(depth)
+        .ok_or_else(|| PyErr::new::<pyo3::exceptions::PyValueError, _>(format!("Unknown depth: {}", depth)))
+}
+
+/// Reject metadata fields a writer's depth level does not cover
+fn check_depth(depth: Depth, metadata: &HashMap<String, String>) -> PyResult<()> {
+    let mut outside: Vec<&str> = metadata.keys().map(String::as_str).filter(|field| !depth.includes(field)).collect();
+    if outside.is_empty() {
+        return Ok(());
+    }
+    outside.sort_unstable();
+    Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
+        "Fields outside depth \"{}\": {}",
+        depth.name(),
+        outside.join(", ")
+    )))
+}
+
+fn parse_io_schedule(io_schedule: &str) -> PyResult<IoSchedule> {
+    IoSchedule::parse(io_schedule)
+        .ok_or_else(|| PyErr::new::<pyo3::exceptions::PyValueError, _>(format!("Unknown io_schedule: {}", io_schedule)))
+}
+
+/// Read a batch on a helper thread while the calling thread, without the
+/// GIL, wakes every `interval` seconds to check for signals and report
+/// progress
+///
+/// A pending signal such as Ctrl-C, or an exception from the callback,
+/// cancels the files not yet started and is raised once the batch stops.
+fn read_batch(
+    py: Python<'_>,
+    file_paths: &[String],
+    mut options: BatchOptions,
+    progress: Option<&Bound<'_, PyAny>>,
+    interval: f64,
+) -> PyResult<Vec<HashMap<String, String>>> {
+    let interval = Duration::try_from_secs_f64(interval)
+        .map_err(|e| PyErr::new::<pyo3::exceptions::PyValueError, _>(format!("Invalid progress_interval: {}", e)))?
+        .max(Duration::from_millis(1));
+    let tracker = Arc::new(Progress::default());
+    options.progress = Some(Arc::clone(&tracker));
+    let callback = progress.map(|callback| callback.clone().unbind());
+    let report = |py: Python<'_>| -> PyResult<()> {
+        py.check_signals()?;
+        if let Some(callback) = &callback {
+            let (files, bytes, errors) = tracker.snapshot();
+            callback.call1(py, (files, file_paths.len(), bytes, errors))?;
+        }
+        Ok(())
+    };
+    let (results, interrupted) = py.allow_threads(|| {
+        let caller = std::thread::current();
+        std::thread::scope(|scope| {
+            let batch = scope.spawn(|| {
+                let results = batch::read_files(file_paths, &options);
+                caller.unpark();
+                results
+            });
+            let mut interrupted = None;
+            let mut due = Instant::now() + interval;
+            while !batch.is_finished() {
+                // Parking can end early, so report against a deadline to
+                // keep the callback at most once per interval
+                std::thread::park_timeout(due.saturating_duration_since(Instant::now()));
+                if Instant::now() < due {
+                    continue;
+                }
+                due = Instant::now() + interval;
+                if interrupted.is_none() && !batch.is_finished() {
+                    if let Err(e) = Python::with_gil(&report) {
+                        tracker.cancel();
+                        interrupted = Some(e);
+                    }
+                }
+            }
+            let results = batch.join().unwrap_or_else(|panic| std::panic::resume_unwind(panic));
+            (results, interrupted)
+        })
+    });
+    if let Some(e) = interrupted {
+        return Err(e);
+    }
+    report(py)?;
+    results
+        .and_then(|results| results.into_iter().collect())
+        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF reading error: {}", e)))
+}
+
+/// Range source backed by a Python file-like object or range callable
+struct PyRangeSource<'py> {
+    source: Bound<'py, PyAny>,
+    /// `source` is a `read_range(offset, length)` callable
+    callable: bool,
+    /// `source` has `readinto`
+    readinto: bool,
+    /// Python exception raised by the last failed read
+    error: Option<PyErr>,
+}
+
+impl<'py> PyRangeSource<'py> {
+    fn new(source: Bound<'py, PyAny>) -> PyResult<Self> {
+        let seekable = source.hasattr("seek")?;
+        if !seekable && !source.is_callable() {
+            return Err(PyErr::new::<pyo3::exceptions::PyTypeError, _>(
+                "expected a seekable file-like object or a read_range(offset, length) callable",
+            ));
+        }
+        Ok(Self {
+            readinto: seekable && source.hasattr("readinto")?,
+            callable: !seekable,
+            source,
+            error: None,
+        })
+    }
+
+    fn read_range(&self, offset: u64, len: usize) -> PyResult<Vec<u8>> {
+        if self.callable {
+            let data = self.source.call1((offset, len))?;
+            return Ok(data.extract::<Cow<[u8]>>()?.into_owned());
+        }
+        self.source.call_method1("seek", (offset,))?;
+        let mut out = Vec::with_capacity(len);
+        while out.len() < len {
+            let remaining = len - out.len();
+            let read = if self.readinto {
+                let buffer = PyByteArray::new_with(self.source.py(), remaining, |_| Ok(()))?;
+                let n = self.source.call_method1("readinto", (&buffer,))?.extract::<Option<usize>>()?.unwrap_or(0);
+                // SAFETY: the bytearray is local and not resized while borrowed
+                out.extend_from_slice(unsafe { &buffer.as_bytes()[..n.min(remaining)] });
+                n
+            } else {
+                let chunk = self.source.call_method1("read", (remaining,))?;
+                let chunk = chunk.extract::<Cow<[u8]>>()?;
+                out.extend_from_slice(&chunk);
+                chunk.len()
+            };
+            if read == 0 {
+                break;
+            }
+        }
+        Ok(out)
+    }
+}
+
+impl RangeSource for PyRangeSource<'_> {
+    fn read_at(&mut self, offset: u64, len: usize) -> Result<Vec<u8>, String> {
+        self.read_range(offset, len).map_err(|e| {
+            let message = e.to_string();
+            self.error = Some(e);
+            message
+        })
+    }
+}
+
+/// Fetch the metadata-bearing ranges within `depth` of a file-like object
+/// or range callable
+fn fetch_metadata(source: &Bound<'_, PyAny>, depth: Depth) -> PyResult<Vec<u8>> {
+    let mut cache = RangeCache::new(PyRangeSource::new(source.clone())?);
+    ranged::extract(&mut cache, depth).map_err(|e| {
+        cache.into_source().error.unwrap_or_else(|| {
+            PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF reading error: {}", e))
+        })
+    })
+}
+
 /// Standalone function to read EXIF data from a file
+///
+/// Uses a reader cached on the calling thread, so repeated calls reuse its
+/// scratch buffer.
 #[pyfunction]
-pub fn read_exif_file(file_path: &str) -> PyResult<HashMap<String, String>> {
-    let mut reader = FastExifReader::new();
-    reader.read_file(file_path)
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF reading error: {}", e)))
+pub fn read_exif_file(py: Python<'_>, file_path: &str) -> PyResult<HashMap<String, String>> {
+    py.allow_threads(|| {
+        scratch::with_thread_reader(|reader| reader.read_file(file_path))
+            .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF reading error: {}", e)))
+    })
 }
 
 /// Standalone function to read EXIF data from bytes
 #[pyfunction]
-pub fn read_exif_bytes(data: &[u8]) -> PyResult<HashMap<String, String>> {
-    let mut reader = FastExifReader::new();
-    reader.read_bytes(data)
-        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF reading error: {}", e)))
+pub fn read_exif_bytes(py: Python<'_>, data: &[u8]) -> PyResult<HashMap<String, String>> {
+    py.allow_threads(|| {
+        scratch::with_thread_reader(|reader| reader.read_bytes(data))
+            .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF reading error: {}", e)))
+    })
+}
+
+/// Standalone function to read EXIF data from a file-like object
+///
+/// `source` is either a seekable binary file object (an open file, a
+/// `tarfile`/`zipfile` member, a remote-file wrapper) driven through
+/// `seek`/`readinto`, or a `read_range(offset, length)` callable returning
+/// bytes. Only the container headers and metadata blocks are fetched, with
+/// neighbouring ranges coalesced into one request, so large RAW files and
+/// videos cost a few small reads instead of a full download.
+#[pyfunction]
+pub fn read_exif_fileobj(py: Python<'_>, source: &Bound<'_, PyAny>) -> PyResult<HashMap<String, String>> {
+    let data = fetch_metadata(source, Depth::Full)?;
+    read_exif_bytes(py, &data)
+}
+
+/// Standalone function to read EXIF data from many file-like objects
+///
+/// Ranges are fetched from each source in turn on the calling thread, with
+/// the GIL held, since every fetch calls back into Python (`seek` and
+/// `readinto`, or the callable). Only parsing then runs in parallel on the
+/// worker pool without the GIL. To overlap slow fetches, call
+/// `read_exif_fileobj` from a thread pool instead. Results are returned in
+/// input order.
+#[pyfunction]
+pub fn read_exif_fileobjs(py: Python<'_>, sources: Vec<Bound<'_, PyAny>>) -> PyResult<Vec<HashMap<String, String>>> {
+    let buffers = sources.iter().map(|source| fetch_metadata(source, Depth::Full)).collect::<PyResult<Vec<_>>>()?;
+    py.allow_threads(|| {
+        batch::read_buffers(&buffers, Depth::Full)
+            .and_then(|results| results.into_iter().collect())
+            .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF reading error: {}", e)))
+    })
 }
 
 /// Standalone function to read EXIF data from multiple files in parallel
+///
+/// `io_schedule="locality"` stats the batch first and reads it grouped by
+/// device, ordered by inode on local disks and by directory on network
+/// mounts, with readahead for upcoming files. `max_io_per_device` limits
+/// the reads in flight on any one device. Results are always returned in
+/// input order.
+///
+/// `max_inflight_bytes` caps the file bytes held by all reads in flight;
+/// new files are only started while the budget allows. Files larger than
+/// `max_file_bytes` are not loaded whole: their container is walked by byte
+/// range and only the headers and metadata blocks, up to `max_file_bytes`
+/// in total, are read, wherever they sit in the file. A file whose metadata
+/// does not fit fails with an error rather than returning partial results.
+///
+/// With `sidecars=True`, each file's XMP sidecar ("name.xmp" or
+/// "name.ext.xmp"), if present, is merged over its embedded metadata in the
+/// same pass. Mapped properties replace their EXIF tags; others are
+/// reported under their qualified names, such as "crs:Exposure2012".
+///
+/// Every `progress_interval` seconds the call checks for signals, so Ctrl-C
+/// stops the batch promptly, and calls `progress(done, total, bytes_read,
+/// errors)` if given, plus once more when the batch completes. An exception
+/// from either cancels the files not yet started and is raised.
+#[pyfunction]
+#[pyo3(signature = (
+    file_paths,
+    io_schedule="default",
+    max_io_per_device=None,
+    max_inflight_bytes=None,
+    max_file_bytes=None,
+    sidecars=false,
+    progress=None,
+    progress_interval=0.1,
+))]
+pub fn read_exif_files_parallel(
+    py: Python<'_>,
+    file_paths: Vec<String>,
+    io_schedule: &str,
+    max_io_per_device: Option<usize>,
+    max_inflight_bytes: Option<u64>,
+    max_file_bytes: Option<u64>,
+    sidecars: bool,
+    progress: Option<&Bound<'_, PyAny>>,
+    progress_interval: f64,
+) -> PyResult<Vec<HashMap<String, String>>> {
+    let options = BatchOptions {
+        schedule: parse_io_schedule(io_schedule)?,
+        max_io_per_device,
+        max_inflight_bytes,
+        max_file_bytes,
+        depth: Depth::Full,
+        sidecars,
+        progress: None,
+    };
+    read_batch(py, &file_paths, options, progress, progress_interval)
+}
+
+/// Rename, move, copy or hard-link images into a layout built from their
+/// capture metadata
+///
+/// `paths_or_root` is a list of paths, or a directory that is searched
+/// recursively for media files. `template` is a destination path relative
+/// to `dest` (the root directory, or the current directory for a list of
+/// paths) with placeholders `{year}`, `{month}`, `{day}`, `{hour}`,
+/// `{minute}`, `{second}`, `{make}`, `{model}`, `{name}`, `{ext}` and
+/// `{seq}` (or `{seq:03}` for zero padding).
+///
+/// The capture time comes from DateTimeOriginal with SubSecTimeOriginal,
+/// then the other EXIF and QuickTime dates, then the file's mtime. Files
+/// rendering to the same path are numbered in capture order, and existing
+/// files are never overwritten, so reruns resolve names the same way.
+/// Destinations already linked to the source, or for "copy" holding an
+/// identical copy with the same mtime, are reported as "unchanged", so
+/// rerunning a batch creates nothing new. That holds for a root organized
+/// into itself too: files an earlier run created are collected again, keep
+/// their paths and are reported as "unchanged" (after a "move", a template
+/// that builds on `{name}` renames them again).
+/// `action` is "hardlink", "move", "copy" or "dry-run".
+///
+/// Returns one dict per file with `source`, `destination`, `status`
+/// ("linked", "moved", "copied", "planned", "unchanged" or "failed"),
+/// `error`, `capture_time` and `time_source`.
 #[pyfunction]
-pub fn read_exif_files_parallel(file_paths: Vec<String>) -> PyResult<Vec<HashMap<String, String>>> {
-    let mut reader = FastExifReader::new();
-    reader.read_files_parallel(file_paths)
+#[pyo3(name = "organize", signature = (paths_or_root, template, action="hardlink", dest=None))]
+pub fn organize_files(
+    py: Python<'_>,
+    paths_or_root: &Bound<'_, PyAny>,
+    template: &str,
+    action: &str,
+    dest: Option<PathBuf>,
+) -> PyResult<Vec<HashMap<&'static str, Option<String>>>> {
+    let template = organize::Template::parse(template)
+        .map_err(|e| PyErr::new::<pyo3::exceptions::PyValueError, _>(format!("Invalid template: {}", e)))?;
+    let action = organize::Action::parse(action)
+        .ok_or_else(|| PyErr::new::<pyo3::exceptions::PyValueError, _>(format!("Unknown action: {}", action)))?;
+    let (root, paths) = match paths_or_root.extract::<PathBuf>() {
+        Ok(root) => (Some(root), None),
+        Err(_) => {
+            let paths = paths_or_root.extract::<Vec<PathBuf>>()?;
+            (None, Some(paths.iter().map(|p| p.to_string_lossy().into_owned()).collect::<Vec<_>>()))
+        }
+    };
+    let outcomes = py.allow_threads(|| {
+        let paths = match (&root, paths) {
+            (Some(root), _) => organize::collect(root)?,
+            (None, paths) => paths.unwrap_or_default(),
+        };
+        let dest = dest.or(root).unwrap_or_default();
+        organize::organize(&paths, &template, &dest, action)
+    })
+    .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("Organize error: {}", e)))?;
+    Ok(outcomes
+        .into_iter()
+        .map(|outcome| {
+            HashMap::from([
+                ("source", Some(outcome.source)),
+                ("destination", outcome.destination),
+                ("status", Some(outcome.status.to_string())),
+                ("error", outcome.error),
+                ("capture_time", outcome.capture_time),
+                ("time_source", outcome.time_source.map(str::to_string)),
+            ])
+        })
+        .collect())
+}
+
+/// Write XMP sidecars for a batch of images without touching the originals
+///
+/// `items` holds paths or `(path, overrides)` tuples. Each sidecar is built
+/// from the file's embedded metadata, then any existing sidecar (whose
+/// other properties, such as develop settings, are kept), then the
+/// overrides. Overrides are keyed by EXIF tag ("Artist") or qualified XMP
+/// name ("xmp:Rating"); an empty value removes the property. `naming`
+/// "replace" writes "name.xmp", "append" writes "name.ext.xmp". An item
+/// whose sidecar an earlier item also writes ("IMG.CR2" and "IMG.JPG" with
+/// "replace") is not written and gets an error.
+///
+/// Returns one dict per item with `source`, `sidecar` and `error`.
+#[pyfunction]
+#[pyo3(signature = (items, naming="replace"))]
+pub fn write_xmp_sidecars(
+    py: Python<'_>,
+    items: Vec<Bound<'_, PyAny>>,
+    naming: &str,
+) -> PyResult<Vec<HashMap<&'static str, Option<String>>>> {
+    let naming = xmp::Naming::parse(naming)
+        .ok_or_else(|| PyErr::new::<pyo3::exceptions::PyValueError, _>(format!("Unknown naming: {}", naming)))?;
+    let items = items
+        .iter()
+        .map(|item| match item.extract::<String>() {
+            Ok(path) => Ok((path, HashMap::new())),
+            Err(_) => item.extract::<(String, HashMap<String, String>)>(),
+        })
+        .collect::<PyResult<Vec<_>>>()?;
+    let results = py
+        .allow_threads(|| xmp::write_sidecars(&items, naming))
+        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF writing error: {}", e)))?;
+    Ok(items
+        .into_iter()
+        .zip(results)
+        .map(|((path, _), result)| {
+            let (sidecar, error) = match result {
+                Ok(sidecar) => (Some(sidecar.to_string_lossy().into_owned()), None),
+                Err(e) => (None, Some(e)),
+            };
+            HashMap::from([("source", Some(path)), ("sidecar", sidecar), ("error", error)])
+        })
+        .collect())
+}
+
+/// Group files into bursts or duplicates by a metadata fingerprint
+///
+/// Metadata is parsed on the worker pool and reduced to the tags in `keys`
+/// straight away; when all of them are IFD0, EXIF or GPS tags only those
+/// blocks are read, as with `depth="basic"`. The first date tag in `keys` (such as DateTimeOriginal,
+/// with SubSecTimeOriginal if listed) is the capture time: files join a
+/// group when they match it within `tolerance_ms` of the previous capture in
+/// the group. All other tags must be equal, with a missing tag equal only to
+/// another missing one. Files with none of the other tags, or without a
+/// capture time when one is asked for, get a group of their own.
+///
+/// Returns one group ID per path, numbered from 0 in order of first
+/// appearance, or None for files whose metadata could not be read.
+#[pyfunction]
+#[pyo3(signature = (paths, keys, tolerance_ms=0))]
+pub fn group_by_fingerprint(py: Python<'_>, paths: Vec<String>, keys: Vec<String>, tolerance_ms: u64) -> PyResult<Vec<Option<usize>>> {
+    let keys = fingerprint::Keys::new(&keys);
+    py.allow_threads(|| fingerprint::group(&paths, &keys, tolerance_ms))
         .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("EXIF reading error: {}", e)))
 }
 
+/// Configure the worker pool used by the parallel APIs
+///
+/// `num_threads` of None uses one thread per core. With `use_pool=False`
+/// batches run serially on the calling thread, which suits callers that
+/// already parallelise with multiprocessing. The pool is rebuilt
+/// automatically in a child process after `fork()`.
+#[pyfunction]
+#[pyo3(signature = (num_threads=None, use_pool=true))]
+pub fn configure_parallelism(num_threads: Option<usize>, use_pool: bool) -> PyResult<()> {
+    workers::configure(num_threads, use_pool);
+    Ok(())
+}
+
+/// Configure the scratch buffers kept by readers between files
+///
+/// Each reader, pool worker and thread-local reader behind `read_exif_file`
+/// reads small files into a buffer it reuses for the next file. Files larger
+/// than `max_bytes` are read by the core reader directly and buffers never
+/// grow past it. None restores the default of 8 MiB; 0 disables reuse.
+#[pyfunction]
+#[pyo3(signature = (max_bytes=None))]
+pub fn configure_scratch_buffers(max_bytes: Option<usize>) -> PyResult<()> {
+    scratch::configure(max_bytes);
+    Ok(())
+}
+
 /// Get library version information
 #[pyfunction]
 pub fn get_version() -> PyResult<String> {
@@ -234,17 +1078,31 @@ pub fn get_supported_formats() -> PyResult<Vec<String>> {
 }
 
 /// Python module definition
-#[pymodule]
+///
+/// The module holds no GIL-protected state, so it declares itself safe to
+/// run without the GIL on free-threaded CPython builds.
+#[pymodule(gil_used = false)]
 fn fast_exif_rs_py(_py: Python, m: &Bound<PyModule>) -> PyResult<()> {
     // Add classes
     m.add_class::<PyFastExifReader>()?;
     m.add_class::<PyFastExifWriter>()?;
     m.add_class::<PyFastExifCopier>()?;
+    m.add_class::<ExifBuffer>()?;
+    m.add_class::<PyCatalog>()?;
     
     // Add standalone functions
     m.add_function(wrap_pyfunction!(read_exif_file, m)?)?;
     m.add_function(wrap_pyfunction!(read_exif_bytes, m)?)?;
     m.add_function(wrap_pyfunction!(read_exif_files_parallel, m)?)?;
+    m.add_function(wrap_pyfunction!(read_exif_fileobj, m)?)?;
+    m.add_function(wrap_pyfunction!(read_exif_fileobjs, m)?)?;
+    m.add_function(wrap_pyfunction!(organize_files, m)?)?;
+    m.add_function(wrap_pyfunction!(write_xmp_sidecars, m)?)?;
+    m.add_function(wrap_pyfunction!(group_by_fingerprint, m)?)?;
+    m.add_function(wrap_pyfunction!(configure_parallelism, m)?)?;
+    m.add_function(wrap_pyfunction!(configure_scratch_buffers, m)?)?;
+    #[cfg(feature = "alloc-stats")]
+    m.add_function(wrap_pyfunction!(alloc_stats::allocation_stats, m)?)?;
     m.add_function(wrap_pyfunction!(get_version, m)?)?;
     m.add_function(wrap_pyfunction!(get_supported_formats, m)?)?;
     
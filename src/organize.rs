@@ -0,0 +1,600 @@
+//! Renaming and filing images by capture metadata
+//!
+//! Metadata is read for the whole batch on the worker pool, destinations
+//! are planned serially so that name collisions resolve the same way on
+//! every run, and the filesystem operations then run on the pool again.
+
+use crate::batch::{self, BatchOptions, Metadata};
+use crate::io;
+use crate::workers;
+use rayon::prelude::*;
+use std::collections::{HashMap, HashSet};
+use std::fs;
+use std::path::{Path, PathBuf};
+use std::time::UNIX_EPOCH;
+
+/// Extensions picked up when organizing a directory tree
+const MEDIA_EXTENSIONS: &[&str] = &[
+    "jpg", "jpeg", "tif", "tiff", "cr2", "cr3", "nef", "nrw", "arw", "raf", "srw", "pef", "rw2", "orf",
+    "dng", "heic", "heif", "hif", "avif", "mov", "mp4", "m4v", "3gp", "avi", "wmv", "webm", "mkv", "png",
+    "bmp", "gif", "webp",
+];
+
+/// Capture-time tags in order of preference, with their sub-second tags
+///
+/// QuickTime dates come after the EXIF ones so that stills keep their
+/// camera-local time; they are used as stored.
+pub const TIME_TAGS: &[(&str, Option<&str>)] = &[
+    ("DateTimeOriginal", Some("SubSecTimeOriginal")),
+    ("CreateDate", Some("SubSecTimeDigitized")),
+    ("DateTimeDigitized", Some("SubSecTimeDigitized")),
+    ("CreationDate", None),
+    ("MediaCreateDate", None),
+    ("TrackCreateDate", None),
+    ("DateTime", Some("SubSecTime")),
+    ("ModifyDate", Some("SubSecTime")),
+];
+
+/// What to do with each file
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+pub enum Action {
+    Hardlink,
+    Move,
+    Copy,
+    /// Plan destinations without touching the filesystem
+    DryRun,
+}
+
+impl Action {
+    pub fn parse(name: &str) -> Option<Self> {
+        match name {
+            "hardlink" => Some(Self::Hardlink),
+            "move" => Some(Self::Move),
+            "copy" => Some(Self::Copy),
+            "dry-run" => Some(Self::DryRun),
+            _ => None,
+        }
+    }
+
+    fn done(self) -> &'static str {
+        match self {
+            Self::Hardlink => "linked",
+            Self::Move => "moved",
+            Self::Copy => "copied",
+            Self::DryRun => "planned",
+        }
+    }
+}
+
+/// When a file was captured
+#[derive(Clone, Copy, Debug, PartialEq, Eq, PartialOrd, Ord)]
+pub struct CaptureTime {
+    pub year: i32,
+    pub month: u32,
+    pub day: u32,
+    pub hour: u32,
+    pub minute: u32,
+    pub second: u32,
+    pub nanos: u32,
+}
+
+impl CaptureTime {
+    /// Parse "YYYY:MM:DD HH:MM:SS" or ISO 8601 "YYYY-MM-DDTHH:MM:SS[.fff]"
+    pub fn parse(value: &str) -> Option<Self> {
+        let b = value.trim().as_bytes();
+        if b.len() < 19 {
+            return None;
+        }
+        let num = |range: std::ops::Range<usize>| -> Option<u32> {
+            let digits = b.get(range)?;
+            digits.iter().all(u8::is_ascii_digit).then(|| {
+                digits.iter().fold(0, |acc, d| acc * 10 + (d - b'0') as u32)
+            })
+        };
+        let time = Self {
+            year: num(0..4)? as i32,
+            month: num(5..7)?,
+            day: num(8..10)?,
+            hour: num(11..13)?,
+            minute: num(14..16)?,
+            second: num(17..19)?,
+            nanos: match b.get(19) {
+                Some(b'.') => subsec_nanos(&value.trim()[20..]),
+                _ => 0,
+            },
+        };
+        let valid = time.year > 0
+            && (1..=12).contains(&time.month)
+            && (1..=31).contains(&time.day)
+            && time.hour < 24
+            && time.minute < 60
+            && time.second < 61;
+        valid.then_some(time)
+    }
+
+    /// Milliseconds since 1970-01-01 00:00:00 on the capture's own clock
+    pub fn millis(&self) -> i64 {
+        // Days from civil, from Howard Hinnant's algorithms
+        let year = self.year as i64 - (self.month <= 2) as i64;
+        let era = year.div_euclid(400);
+        let yoe = year - era * 400;
+        let mp = (self.month as i64 + 9) % 12;
+        let doy = (153 * mp + 2) / 5 + self.day as i64 - 1;
+        let doe = yoe * 365 + yoe / 4 - yoe / 100 + doy;
+        let days = era * 146_097 + doe - 719_468;
+        let seconds = days * 86400 + self.hour as i64 * 3600 + self.minute as i64 * 60 + self.second as i64;
+        seconds * 1000 + self.nanos as i64 / 1_000_000
+    }
+
+    fn display(&self) -> String {
+        format!(
+            "{:04}-{:02}-{:02} {:02}:{:02}:{:02}",
+            self.year, self.month, self.day, self.hour, self.minute, self.second
+        )
+    }
+}
+
+/// Nanoseconds from the leading digits of a fractional-seconds string
+pub fn subsec_nanos(digits: &str) -> u32 {
+    let digits: String = digits.chars().take_while(char::is_ascii_digit).take(9).collect();
+    format!("{:0<9}", digits).parse().unwrap_or(0)
+}
+
+/// Capture time from metadata, falling back to the file's mtime
+fn capture_time(path: &str, metadata: &Metadata) -> Option<(CaptureTime, &'static str)> {
+    for &(tag, subsec_tag) in TIME_TAGS {
+        let Some(mut time) = metadata.get(tag).and_then(|v| CaptureTime::parse(v)) else {
+            continue;
+        };
+        if let Some(subsec) = subsec_tag.and_then(|t| metadata.get(t)) {
+            time.nanos = subsec_nanos(subsec.trim());
+        }
+        return Some((time, tag));
+    }
+    let modified = fs::metadata(path).and_then(|m| m.modified()).ok()?;
+    let since_epoch = modified.duration_since(UNIX_EPOCH).ok()?;
+    let mut time = local_time(since_epoch.as_secs() as i64)?;
+    time.nanos = since_epoch.subsec_nanos();
+    Some((time, "mtime"))
+}
+
+#[cfg(unix)]
+fn local_time(secs: i64) -> Option<CaptureTime> {
+    let t = secs as libc::time_t;
+    // SAFETY: tm is plain data and localtime_r only writes to it
+    let mut tm: libc::tm = unsafe { std::mem::zeroed() };
+    if unsafe { libc::localtime_r(&t, &mut tm) }.is_null() {
+        return None;
+    }
+    Some(CaptureTime {
+        year: tm.tm_year + 1900,
+        month: tm.tm_mon as u32 + 1,
+        day: tm.tm_mday as u32,
+        hour: tm.tm_hour as u32,
+        minute: tm.tm_min as u32,
+        second: tm.tm_sec as u32,
+        nanos: 0,
+    })
+}
+
+#[cfg(not(unix))]
+fn local_time(secs: i64) -> Option<CaptureTime> {
+    // UTC, using the days-to-civil conversion from Howard Hinnant's algorithms
+    let (days, rem) = (secs.div_euclid(86400), secs.rem_euclid(86400));
+    let z = days + 719_468;
+    let era = z.div_euclid(146_097);
+    let doe = z - era * 146_097;
+    let yoe = (doe - doe / 1460 + doe / 36524 - doe / 146_096) / 365;
+    let doy = doe - (365 * yoe + yoe / 4 - yoe / 100);
+    let mp = (5 * doy + 2) / 153;
+    let month = if mp < 10 { mp + 3 } else { mp - 9 };
+    Some(CaptureTime {
+        year: (yoe + era * 400 + (month <= 2) as i64) as i32,
+        month: month as u32,
+        day: (doy - (153 * mp + 2) / 5 + 1) as u32,
+        hour: (rem / 3600) as u32,
+        minute: (rem % 3600 / 60) as u32,
+        second: (rem % 60) as u32,
+        nanos: 0,
+    })
+}
+
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+enum Field {
+    Year,
+    Month,
+    Day,
+    Hour,
+    Minute,
+    Second,
+    Make,
+    Model,
+    Name,
+    Ext,
+    /// Sequence number within files that render to the same path
+    Seq(usize),
+}
+
+#[derive(Clone, Debug, PartialEq, Eq)]
+enum Part {
+    Literal(String),
+    Field(Field),
+}
+
+/// A destination path template such as "{year}/{month}/{day}/{model}_{seq:03}{ext}"
+#[derive(Clone, Debug)]
+pub struct Template {
+    parts: Vec<Part>,
+}
+
+impl Template {
+    /// Parse a template; the error names the offending placeholder
+    pub fn parse(template: &str) -> Result<Self, String> {
+        let mut parts = Vec::new();
+        let mut rest = template;
+        while let Some(open) = rest.find('{') {
+            if open > 0 {
+                parts.push(Part::Literal(rest[..open].to_string()));
+            }
+            let close = rest[open..].find('}').ok_or_else(|| format!("unclosed placeholder in {}", template))? + open;
+            let name = &rest[open + 1..close];
+            let field = match name {
+                "year" => Field::Year,
+                "month" => Field::Month,
+                "day" => Field::Day,
+                "hour" => Field::Hour,
+                "minute" => Field::Minute,
+                "second" => Field::Second,
+                "make" => Field::Make,
+                "model" => Field::Model,
+                "name" => Field::Name,
+                "ext" => Field::Ext,
+                "seq" => Field::Seq(1),
+                _ => match name.strip_prefix("seq:").and_then(|w| w.parse().ok()) {
+                    Some(width) => Field::Seq(width),
+                    None => return Err(format!("unknown placeholder {{{}}}", name)),
+                },
+            };
+            parts.push(Part::Field(field));
+            rest = &rest[close + 1..];
+        }
+        if !rest.is_empty() {
+            parts.push(Part::Literal(rest.to_string()));
+        }
+        Ok(Self { parts })
+    }
+
+    fn has_seq(&self) -> bool {
+        self.parts.iter().any(|p| matches!(p, Part::Field(Field::Seq(_))))
+    }
+
+    /// Render for one file; with `seq` of None the sequence placeholder is
+    /// left as a marker, giving the key that files are grouped by
+    fn render(&self, file: &Planned, seq: Option<u32>) -> String {
+        let mut out = String::new();
+        let t = &file.time;
+        for part in &self.parts {
+            match part {
+                Part::Literal(text) => out.push_str(text),
+                Part::Field(field) => match *field {
+                    Field::Year => out.push_str(&format!("{:04}", t.year)),
+                    Field::Month => out.push_str(&format!("{:02}", t.month)),
+                    Field::Day => out.push_str(&format!("{:02}", t.day)),
+                    Field::Hour => out.push_str(&format!("{:02}", t.hour)),
+                    Field::Minute => out.push_str(&format!("{:02}", t.minute)),
+                    Field::Second => out.push_str(&format!("{:02}", t.second)),
+                    Field::Make => out.push_str(&file.make),
+                    Field::Model => out.push_str(&file.model),
+                    Field::Name => out.push_str(&file.name),
+                    Field::Ext => out.push_str(&file.ext),
+                    Field::Seq(width) => match seq {
+                        Some(n) => out.push_str(&format!("{:0width$}", n, width = width)),
+                        None => out.push('\0'),
+                    },
+                },
+            }
+        }
+        out
+    }
+}
+
+/// Make a metadata value safe to use as a path component
+fn sanitize(value: Option<&String>) -> String {
+    let cleaned: String = value
+        .map(|v| v.trim())
+        .unwrap_or("")
+        .chars()
+        .map(|c| if c.is_whitespace() || c == '/' || c == '\\' || c.is_control() { '_' } else { c })
+        .collect();
+    let cleaned = cleaned.trim_matches(|c| c == '_' || c == '.');
+    if cleaned.is_empty() {
+        "Unknown".to_string()
+    } else {
+        cleaned.to_string()
+    }
+}
+
+/// Outcome for one file
+#[derive(Clone, Debug)]
+pub struct Outcome {
+    pub source: String,
+    pub destination: Option<String>,
+    /// "linked", "moved", "copied", "planned", "unchanged" or "failed"
+    pub status: &'static str,
+    pub error: Option<String>,
+    pub capture_time: Option<String>,
+    /// Tag the capture time came from, or "mtime"
+    pub time_source: Option<&'static str>,
+}
+
+/// A file with everything needed to render its destination
+struct Planned {
+    index: usize,
+    time: CaptureTime,
+    make: String,
+    model: String,
+    name: String,
+    ext: String,
+}
+
+/// Whether `path` has one of the media extensions picked up from a tree
+pub fn is_media(path: &Path) -> bool {
+    let ext = path.extension().and_then(|e| e.to_str()).unwrap_or("").to_ascii_lowercase();
+    MEDIA_EXTENSIONS.contains(&ext.as_str())
+}
+
+/// Media files under `root`, sorted for a stable order
+pub fn collect(root: &Path) -> Result<Vec<String>, String> {
+    let mut files = Vec::new();
+    let mut dirs = vec![root.to_path_buf()];
+    while let Some(dir) = dirs.pop() {
+        let entries = fs::read_dir(&dir).map_err(|e| format!("{}: {}", dir.display(), e))?;
+        for entry in entries.flatten() {
+            let path = entry.path();
+            match entry.file_type() {
+                Ok(kind) if kind.is_dir() => dirs.push(path),
+                Ok(kind) if kind.is_file() && is_media(&path) => files.push(path.to_string_lossy().into_owned()),
+                _ => {}
+            }
+        }
+    }
+    files.sort();
+    Ok(files)
+}
+
+/// Organize `paths` into `dest` according to `template`
+pub fn organize(paths: &[String], template: &Template, dest: &Path, action: Action) -> Result<Vec<Outcome>, String> {
+    let metadata = batch::read_files(paths, &BatchOptions::default())?;
+    let mut outcomes: Vec<Outcome> = paths
+        .iter()
+        .map(|path| Outcome {
+            source: path.clone(),
+            destination: None,
+            status: "failed",
+            error: None,
+            capture_time: None,
+            time_source: None,
+        })
+        .collect();
+
+    let empty = Metadata::new();
+    let mut planned = Vec::new();
+    for (index, (path, result)) in paths.iter().zip(&metadata).enumerate() {
+        let metadata = result.as_ref().unwrap_or(&empty);
+        let Some((time, source)) = capture_time(path, metadata) else {
+            outcomes[index].error = Some("no capture time and the file could not be stat'ed".to_string());
+            continue;
+        };
+        outcomes[index].capture_time = Some(time.display());
+        outcomes[index].time_source = Some(source);
+        let path = Path::new(path);
+        planned.push(Planned {
+            index,
+            time,
+            make: sanitize(metadata.get("Make")),
+            model: sanitize(metadata.get("Model")),
+            name: path.file_stem().map_or_else(String::new, |s| s.to_string_lossy().into_owned()),
+            ext: path.extension().map_or_else(String::new, |e| format!(".{}", e.to_string_lossy())),
+        });
+    }
+
+    // Files that render to the same path are numbered in capture order,
+    // ties broken by source path, skipping names already on disk
+    let mut keyed: Vec<(String, &Planned)> = planned.iter().map(|p| (template.render(p, None), p)).collect();
+    keyed.sort_by(|(ka, a), (kb, b)| (ka, a.time, &paths[a.index]).cmp(&(kb, b.time, &paths[b.index])));
+    let with_seq = template.has_seq();
+    let mut claimed = HashSet::new();
+
+    // When a tree is organized into itself, a rerun collects the files an
+    // earlier run created as sources too. Those already sit at a path they
+    // render to: they keep it, and the files they were made from match
+    // against them before any new name is tried.
+    let mut in_place: HashMap<String, Vec<PathBuf>> = HashMap::new();
+    keyed.retain(|(key, file)| {
+        let source = &paths[file.index];
+        if !renders_to(template, file, key, dest, Path::new(source)) {
+            return true;
+        }
+        claimed.insert(PathBuf::from(source));
+        in_place.entry(key.clone()).or_default().push(PathBuf::from(source));
+        outcomes[file.index].destination = Some(source.clone());
+        outcomes[file.index].status = "unchanged";
+        false
+    });
+
+    let mut next_seq: HashMap<&str, u32> = HashMap::new();
+    let mut jobs = Vec::new();
+    for (key, file) in &keyed {
+        let source = &paths[file.index];
+        let source_info = io::stat(source);
+        // A link or copy made by an earlier run counts as done
+        let done = |candidate: &Path| {
+            let linked = match (source_info, io::stat(&candidate.to_string_lossy())) {
+                (Some(a), Some(b)) => a.dev == b.dev && a.ino == b.ino,
+                _ => false,
+            };
+            linked || (action == Action::Copy && is_copy(Path::new(source), candidate))
+        };
+        let existing = in_place.get(key.as_str()).and_then(|found| found.iter().find(|path| done(path)));
+        let destination = match existing {
+            Some(path) => (path.clone(), true),
+            None => {
+                let counter = next_seq.entry(key.as_str()).or_insert(if with_seq { 1 } else { 0 });
+                loop {
+                    let candidate = match (*counter, with_seq) {
+                        (n, true) => template.render(file, Some(n)),
+                        (0, false) => key.clone(),
+                        (n, false) => with_suffix(key, n),
+                    };
+                    *counter += 1;
+                    let candidate = dest.join(candidate);
+                    if claimed.contains(&candidate) {
+                        continue;
+                    }
+                    let same_file = done(&candidate);
+                    if same_file || !candidate.exists() {
+                        break (candidate, same_file);
+                    }
+                }
+            }
+        };
+        claimed.insert(destination.0.clone());
+        outcomes[file.index].destination = Some(destination.0.to_string_lossy().into_owned());
+        if destination.1 {
+            outcomes[file.index].status = "unchanged";
+        } else {
+            jobs.push((file.index, destination.0));
+        }
+    }
+
+    // A source that another source was found already linked or copied to
+    // is itself the output of an earlier run, even where its own name does
+    // not render back to itself (as with "{name}_{seq}{ext}")
+    let organized: HashSet<&str> = outcomes
+        .iter()
+        .filter(|outcome| outcome.status == "unchanged")
+        .filter_map(|outcome| outcome.destination.as_deref())
+        .collect();
+    let (jobs, rerun): (Vec<_>, Vec<_>) = jobs.into_iter().partition(|(index, _)| !organized.contains(paths[*index].as_str()));
+    for (index, _) in rerun {
+        outcomes[index].destination = Some(paths[index].clone());
+        outcomes[index].status = "unchanged";
+    }
+
+    let run = |(index, destination): &(usize, PathBuf)| {
+        (*index, apply(action, Path::new(&paths[*index]), destination))
+    };
+    let results: Vec<(usize, Result<(), String>)> = match workers::pool()? {
+        Some(pool) => pool.install(|| jobs.par_iter().map(run).collect()),
+        None => jobs.iter().map(run).collect(),
+    };
+    for (index, result) in results {
+        match result {
+            Ok(()) => outcomes[index].status = action.done(),
+            Err(e) => outcomes[index].error = Some(e),
+        }
+    }
+    Ok(outcomes)
+}
+
+/// Whether `candidate` is a copy of `source` left by an earlier run
+///
+/// Copies keep the source's modification time, so size and mtime pick out
+/// likely copies cheaply; the contents are compared to confirm, since
+/// burst shots can share both.
+fn is_copy(source: &Path, candidate: &Path) -> bool {
+    let (Ok(a), Ok(b)) = (fs::metadata(source), fs::metadata(candidate)) else {
+        return false;
+    };
+    let same_mtime = matches!((a.modified(), b.modified()), (Ok(x), Ok(y)) if x == y);
+    b.is_file() && a.len() == b.len() && same_mtime && same_contents(source, candidate).unwrap_or(false)
+}
+
+fn same_contents(a: &Path, b: &Path) -> std::io::Result<bool> {
+    use std::io::Read;
+    let (mut a, mut b) = (fs::File::open(a)?, fs::File::open(b)?);
+    let (mut buf_a, mut buf_b) = (vec![0u8; 1 << 16], vec![0u8; 1 << 16]);
+    loop {
+        let n = a.read(&mut buf_a)?;
+        if n == 0 {
+            return Ok(b.read(&mut buf_b[..1])? == 0);
+        }
+        b.read_exact(&mut buf_b[..n])?;
+        if buf_a[..n] != buf_b[..n] {
+            return Ok(false);
+        }
+    }
+}
+
+/// Whether `source` is one of the paths under `dest` that `file` renders to
+///
+/// Sequence numbers and collision suffixes are taken from each run of
+/// digits in the path and checked by rendering with them.
+fn renders_to(template: &Template, file: &Planned, key: &str, dest: &Path, source: &Path) -> bool {
+    let Some(relative) = source.strip_prefix(dest).ok().and_then(Path::to_str) else {
+        return false;
+    };
+    let with_seq = template.has_seq();
+    if !with_seq && Path::new(key) == Path::new(relative) {
+        return true;
+    }
+    let bytes = relative.as_bytes();
+    let mut start = 0;
+    while start < bytes.len() {
+        let run = bytes[start..].iter().take_while(|b| b.is_ascii_digit()).count();
+        for from in start..start + run {
+            for to in from + 1..=(start + run).min(from + 10) {
+                let Ok(n) = relative[from..to].parse::<u32>() else {
+                    continue;
+                };
+                let rendered = match with_seq {
+                    true => template.render(file, Some(n)),
+                    false if n > 0 => with_suffix(key, n),
+                    false => continue,
+                };
+                if Path::new(&rendered) == Path::new(relative) {
+                    return true;
+                }
+            }
+        }
+        start += run.max(1);
+    }
+    false
+}
+
+/// "name.ext" with a numeric suffix: "name_2.ext"
+fn with_suffix(path: &str, n: u32) -> String {
+    let stem_start = path.rfind('/').map_or(0, |i| i + 1);
+    match path[stem_start..].rfind('.') {
+        Some(dot) if dot > 0 => format!("{}_{}{}", &path[..stem_start + dot], n, &path[stem_start + dot..]),
+        _ => format!("{}_{}", path, n),
+    }
+}
+
+/// Perform one filesystem operation, creating parent directories as needed
+fn apply(action: Action, source: &Path, destination: &Path) -> Result<(), String> {
+    if action == Action::DryRun {
+        return Ok(());
+    }
+    let fail = |e: std::io::Error| format!("{} -> {}: {}", source.display(), destination.display(), e);
+    if let Some(parent) = destination.parent() {
+        fs::create_dir_all(parent).map_err(fail)?;
+    }
+    match action {
+        Action::Hardlink => fs::hard_link(source, destination).map_err(fail),
+        // Keep the mtime so that reruns recognise the copy
+        Action::Copy => fs::copy(source, destination)
+            .and_then(|_| {
+                let modified = fs::metadata(source)?.modified()?;
+                fs::File::options().write(true).open(destination)?.set_modified(modified)
+            })
+            .map_err(fail),
+        Action::Move => match fs::rename(source, destination) {
+            Err(e) if e.raw_os_error() == Some(libc::EXDEV) => {
+                fs::copy(source, destination).and_then(|_| fs::remove_file(source)).map_err(fail)
+            }
+            result => result.map_err(fail),
+        },
+        Action::DryRun => Ok(()),
+    }
+}
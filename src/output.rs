@@ -0,0 +1,110 @@
+//! Output paths for rewritten images that avoid full-size copies
+//!
+//! Metadata lives in a JPEG's marker segments ahead of the entropy-coded
+//! scan, which is usually almost all of the file. Only the segments are
+//! handed to the core writer; the scan is written straight from the
+//! caller's input to a file or into a caller's buffer.
+
+use std::fmt::Display;
+use std::io::Write;
+
+/// Offset and type of the marker that ends a JPEG's marker segments:
+/// start of scan (0xDA) or end of image (0xD9)
+fn segments_end(data: &[u8]) -> Option<(usize, u8)> {
+    if !data.starts_with(&[0xFF, 0xD8]) {
+        return None;
+    }
+    let mut pos = 2;
+    while pos + 2 <= data.len() {
+        if data[pos] != 0xFF {
+            return None;
+        }
+        match data[pos + 1] {
+            0xFF => pos += 1,
+            0x01 | 0xD0..=0xD8 => pos += 2,
+            marker @ (0xDA | 0xD9) => return Some((pos, marker)),
+            _ if pos + 4 > data.len() => return None,
+            _ => pos += 2 + u16::from_be_bytes([data[pos + 2], data[pos + 3]]) as usize,
+        }
+    }
+    None
+}
+
+/// Offset of the first start-of-scan marker in a JPEG, if there is one
+pub fn jpeg_scan_start(data: &[u8]) -> Option<usize> {
+    segments_end(data).filter(|&(_, marker)| marker == 0xDA).map(|(pos, _)| pos)
+}
+
+/// A rewritten image in two parts: bytes from the core writer, then for a
+/// JPEG the scan, borrowed unchanged from the input
+pub struct Rewritten<'a> {
+    pub head: Vec<u8>,
+    pub tail: &'a [u8],
+}
+
+impl Rewritten<'_> {
+    pub fn len(&self) -> usize {
+        self.head.len() + self.tail.len()
+    }
+
+    pub fn parts(&self) -> [&[u8]; 2] {
+        [&self.head, self.tail]
+    }
+}
+
+/// Rewrite the metadata of `data` without copying a JPEG's scan
+///
+/// `rewrite` is the core writer. For a JPEG it only sees the marker
+/// segments, closed with an end-of-image marker, and the scan is left in
+/// `data`. Other formats, and JPEGs whose rewritten segments do not come
+/// back in the same shape, are rewritten whole.
+pub fn rewrite_split<'a, E: Display>(
+    data: &'a [u8],
+    rewrite: impl Fn(&[u8]) -> Result<Vec<u8>, E>,
+) -> Result<Rewritten<'a>, String> {
+    if let Some(scan) = jpeg_scan_start(data) {
+        let mut head = Vec::with_capacity(scan + 2);
+        head.extend_from_slice(&data[..scan]);
+        head.extend_from_slice(&[0xFF, 0xD9]);
+        let mut rewritten = rewrite(&head).map_err(|e| e.to_string())?;
+        if rewritten.len() >= 2 && segments_end(&rewritten) == Some((rewritten.len() - 2, 0xD9)) {
+            rewritten.truncate(rewritten.len() - 2);
+            return Ok(Rewritten { head: rewritten, tail: &data[scan..] });
+        }
+    }
+    let rewritten = rewrite(data).map_err(|e| e.to_string())?;
+    Ok(Rewritten { head: rewritten, tail: &[] })
+}
+
+/// Write `data` with rewritten metadata to `out`, returning bytes written
+///
+/// See [`rewrite_split`]; a JPEG's scan is written straight from `data`.
+pub fn write_streamed<E: Display>(
+    data: &[u8],
+    rewrite: impl Fn(&[u8]) -> Result<Vec<u8>, E>,
+    out: &mut impl Write,
+) -> Result<usize, String> {
+    let rewritten = rewrite_split(data, rewrite)?;
+    for part in rewritten.parts() {
+        out.write_all(part).map_err(|e| e.to_string())?;
+    }
+    out.flush().map_err(|e| e.to_string())?;
+    Ok(rewritten.len())
+}
+
+/// Run `f` with a writer on a file descriptor the caller keeps ownership of
+#[cfg(unix)]
+pub fn with_fd<R>(fd: i32, f: impl FnOnce(&mut std::fs::File) -> Result<R, String>) -> Result<R, String> {
+    use std::os::unix::io::FromRawFd;
+    if fd < 0 {
+        return Err(format!("invalid file descriptor: {}", fd));
+    }
+    // SAFETY: the File is never dropped, so the caller's descriptor stays open
+    let mut file = std::mem::ManuallyDrop::new(unsafe { std::fs::File::from_raw_fd(fd) });
+    f(&mut file)
+}
+
+#[cfg(not(unix))]
+pub fn with_fd<R>(_fd: i32, _f: impl FnOnce(&mut std::fs::File) -> Result<R, String>) -> Result<R, String> {
+    Err("writing to file descriptors is only supported on Unix".to_string())
+}
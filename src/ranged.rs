@@ -0,0 +1,1056 @@
+//! Metadata extraction from sources that can only be read by byte range
+//!
+//! Objects behind a range-request gateway, or members of tar and zip
+//! archives, are expensive to read whole. The core parser needs a byte
+//! buffer, so instead of downloading everything this module walks the
+//! container structure of each format, fetching only the headers and the
+//! metadata blocks they point to, and rebuilds a buffer the parser can read:
+//!
+//! - JPEG, TIFF-based RAW and RAF keep metadata at fixed offsets, so the
+//!   fetched ranges are placed at their original offsets in a sparse buffer
+//!   whose unfetched bytes are zero.
+//! - ISO BMFF (MP4, MOV, HEIF, CR3), PNG, RIFF (WebP, AVI) and Matroska are
+//!   compacted: bulk media boxes, chunks and clusters are dropped and the
+//!   remaining structure is concatenated. HEIF Exif and XMP items, which
+//!   live inside the media data, are gathered into one small media data box
+//!   and their `iloc` entries rewritten to point at it.
+//!
+//! Below full depth, TIFF walkers (including the one for the EXIF block of
+//! a JPEG) skip the blocks outside the level, and the IFD entries pointing
+//! at them are removed from the buffer so the core parser does not decode
+//! them either.
+//!
+//! A sparse buffer is as long as the furthest fetched range, so a TIFF
+//! whose last IFD sits at the end of the file still costs a buffer of the
+//! file's size, though only the metadata is fetched into it.
+//!
+//! Formats without a walker are read whole. All reads go through
+//! [`RangeCache`], which reads ahead and merges adjacent ranges so that
+//! small neighbouring requests cost one fetch. A cache given a byte limit
+//! fails rather than fetch, or build a buffer, beyond it; batch reads use
+//! that with [`FileSource`] to parse files too large to load whole.
+
+use crate::depth::Depth;
+use std::collections::{BTreeMap, HashMap, HashSet};
+use std::fs::File;
+use std::io::{Read, Seek, SeekFrom};
+
+/// Minimum bytes requested from the source per fetch
+const MIN_FETCH: u64 = 64 * 1024;
+
+/// Largest single metadata value, box or element that will be fetched
+const MAX_BLOCK: u64 = 256 << 20;
+
+/// Upper bound on IFDs followed in one TIFF structure
+const MAX_IFDS: usize = 64;
+
+/// Chunk size used when a source has to be read whole
+const WHOLE_READ_CHUNK: usize = 1 << 20;
+
+/// Something that can be read by byte range
+pub trait RangeSource {
+    /// Read up to `len` bytes at `offset`; fewer bytes means end of data
+    fn read_at(&mut self, offset: u64, len: usize) -> Result<Vec<u8>, String>;
+}
+
+/// A local file read by byte range
+pub struct FileSource(pub File);
+
+impl RangeSource for FileSource {
+    fn read_at(&mut self, offset: u64, len: usize) -> Result<Vec<u8>, String> {
+        let mut data = Vec::with_capacity(len);
+        self.0.seek(SeekFrom::Start(offset)).map_err(|e| e.to_string())?;
+        (&mut self.0).take(len as u64).read_to_end(&mut data).map_err(|e| e.to_string())?;
+        Ok(data)
+    }
+}
+
+/// File data already in memory
+impl RangeSource for &[u8] {
+    fn read_at(&mut self, offset: u64, len: usize) -> Result<Vec<u8>, String> {
+        let start = offset.min(self.len() as u64) as usize;
+        Ok(self[start..][..len.min(self.len() - start)].to_vec())
+    }
+}
+
+/// Cache of fetched byte ranges over a [`RangeSource`]
+pub struct RangeCache<S> {
+    source: S,
+    /// Fetched extents by start offset; never overlapping or adjacent
+    extents: BTreeMap<u64, Vec<u8>>,
+    eof: Option<u64>,
+    /// Total bytes fetched from the source
+    pub fetched: u64,
+    /// Most bytes to fetch, and longest buffer to build
+    limit: u64,
+}
+
+impl<S: RangeSource> RangeCache<S> {
+    pub fn new(source: S) -> Self {
+        Self {
+            source,
+            extents: BTreeMap::new(),
+            eof: None,
+            fetched: 0,
+            limit: u64::MAX,
+        }
+    }
+
+    /// Fail instead of fetching more than `limit` bytes in total or
+    /// building a sparse buffer longer than `limit`
+    pub fn with_limit(mut self, limit: u64) -> Self {
+        self.limit = limit;
+        self
+    }
+
+    fn over_limit(&self) -> String {
+        format!("metadata does not fit in {} bytes", self.limit)
+    }
+
+    /// The wrapped source
+    pub fn into_source(self) -> S {
+        self.source
+    }
+
+    /// Bytes `[offset, offset + len)`, shorter if the data ends first
+    pub fn read(&mut self, offset: u64, len: u64) -> Result<Vec<u8>, String> {
+        self.read_ahead(offset, len, MIN_FETCH)
+    }
+
+    /// Like [`read`](Self::read), fetching at most `ahead` bytes in total
+    /// when the range is not cached
+    ///
+    /// Walkers pass 0 for headers that follow bulk data they skipped, where
+    /// reading ahead would only pull in more bulk data.
+    pub fn read_ahead(&mut self, offset: u64, len: u64, ahead: u64) -> Result<Vec<u8>, String> {
+        let end = offset.saturating_add(len);
+        self.fetch_ahead(offset, len, ahead)?;
+        let Some((&start, data)) = self.extents.range(..=offset).next_back() else {
+            return Ok(Vec::new());
+        };
+        let data_end = start + data.len() as u64;
+        if data_end <= offset {
+            return Ok(Vec::new());
+        }
+        Ok(data[(offset - start) as usize..(end.min(data_end) - start) as usize].to_vec())
+    }
+
+    /// Make sure `[offset, offset + len)` is cached
+    pub fn fetch(&mut self, offset: u64, len: u64) -> Result<(), String> {
+        self.fetch_ahead(offset, len, MIN_FETCH)
+    }
+
+    fn fetch_ahead(&mut self, offset: u64, len: u64, ahead: u64) -> Result<(), String> {
+        let mut end = offset.saturating_add(len);
+        if let Some(eof) = self.eof {
+            end = end.min(eof);
+        }
+        if offset >= end {
+            return Ok(());
+        }
+        let gaps = self.gaps(offset, end);
+        let (Some(&(first, _)), Some(&(_, last))) = (gaps.first(), gaps.last()) else {
+            return Ok(());
+        };
+        // Read ahead, but not into data that is already cached
+        let mut fetch_end = last.max(first + ahead);
+        if let Some((&next, _)) = self.extents.range(last..).next() {
+            fetch_end = fetch_end.min(next).max(last);
+        }
+        if self.fetched.saturating_add(last - first) > self.limit {
+            return Err(self.over_limit());
+        }
+        let want = (fetch_end - first).min(self.limit - self.fetched);
+        let data = self.source.read_at(first, want as usize)?;
+        self.fetched += data.len() as u64;
+        if (data.len() as u64) < want {
+            self.eof = Some(first + data.len() as u64);
+        }
+        self.insert(first, data);
+        Ok(())
+    }
+
+    /// Uncached sub-ranges of `[offset, end)`, in order
+    fn gaps(&self, offset: u64, end: u64) -> Vec<(u64, u64)> {
+        let mut gaps = Vec::new();
+        let mut pos = offset;
+        if let Some((&start, data)) = self.extents.range(..=offset).next_back() {
+            pos = pos.max(start + data.len() as u64);
+        }
+        for (&start, data) in self.extents.range(offset..end) {
+            if start > pos {
+                gaps.push((pos, start));
+            }
+            pos = pos.max(start + data.len() as u64);
+        }
+        if pos < end {
+            gaps.push((pos, end));
+        }
+        gaps
+    }
+
+    /// Add a fetched range, merging it with overlapping or adjacent extents
+    fn insert(&mut self, start: u64, data: Vec<u8>) {
+        if data.is_empty() {
+            return;
+        }
+        let (mut lo, mut hi) = (start, start + data.len() as u64);
+        let touching: Vec<u64> = self
+            .extents
+            .range(..=hi)
+            .filter(|(&s, d)| s + d.len() as u64 >= lo)
+            .map(|(&s, _)| s)
+            .collect();
+        for s in &touching {
+            lo = lo.min(*s);
+            hi = hi.max(s + self.extents[s].len() as u64);
+        }
+        if touching.is_empty() {
+            self.extents.insert(start, data);
+            return;
+        }
+        let mut merged = vec![0u8; (hi - lo) as usize];
+        for s in touching {
+            if let Some(old) = self.extents.remove(&s) {
+                merged[(s - lo) as usize..][..old.len()].copy_from_slice(&old);
+            }
+        }
+        merged[(start - lo) as usize..][..data.len()].copy_from_slice(&data);
+        self.extents.insert(lo, merged);
+    }
+
+    /// All cached bytes at their original offsets, zero-filled in between
+    fn sparse_image(&self) -> Result<Vec<u8>, String> {
+        let len = self
+            .extents
+            .iter()
+            .next_back()
+            .map_or(0, |(&s, d)| s + d.len() as u64);
+        if len > self.limit {
+            return Err(self.over_limit());
+        }
+        let mut image = vec![0u8; len as usize];
+        for (&start, data) in &self.extents {
+            image[start as usize..][..data.len()].copy_from_slice(data);
+        }
+        Ok(image)
+    }
+
+    /// Read the source to the end
+    fn read_all(&mut self) -> Result<Vec<u8>, String> {
+        let mut pos = 0u64;
+        loop {
+            let chunk = self.read(pos, WHOLE_READ_CHUNK as u64)?;
+            pos += chunk.len() as u64;
+            if chunk.len() < WHOLE_READ_CHUNK {
+                break;
+            }
+        }
+        self.sparse_image()
+    }
+}
+
+/// Readahead for the header that follows `skipped` bytes of dropped data
+fn ahead_after(skipped: u64) -> u64 {
+    if skipped > MIN_FETCH {
+        0
+    } else {
+        MIN_FETCH
+    }
+}
+
+/// Fetch the metadata-bearing ranges of a source and build a parser buffer
+/// holding the blocks within `depth`
+pub fn extract<S: RangeSource>(cache: &mut RangeCache<S>, depth: Depth) -> Result<Vec<u8>, String> {
+    let head = cache.read(0, 16)?;
+    let mut edits = Vec::new();
+    if head.starts_with(&[0xFF, 0xD8]) {
+        walk_jpeg(cache, 0, depth, &mut edits)?;
+        return edited_image(cache, &edits);
+    }
+    if tiff_order(&head).is_some() {
+        walk_tiff(cache, 0, depth, &mut edits)?;
+        return edited_image(cache, &edits);
+    }
+    if head.starts_with(b"FUJIFILMCCD-RAW") {
+        walk_raf(cache, depth, &mut edits)?;
+        return edited_image(cache, &edits);
+    }
+    if head.len() >= 8 && &head[4..8] == b"ftyp" {
+        return walk_bmff(cache);
+    }
+    if head.starts_with(b"\x89PNG\r\n\x1a\n") {
+        return walk_png(cache);
+    }
+    if head.starts_with(b"RIFF") {
+        return walk_riff(cache);
+    }
+    if head.starts_with(&[0x1A, 0x45, 0xDF, 0xA3]) {
+        return walk_ebml(cache);
+    }
+    cache.read_all()
+}
+
+fn be16(b: &[u8]) -> u64 {
+    u16::from_be_bytes([b[0], b[1]]) as u64
+}
+
+fn be32(b: &[u8]) -> u64 {
+    u32::from_be_bytes([b[0], b[1], b[2], b[3]]) as u64
+}
+
+fn be64(b: &[u8]) -> u64 {
+    u64::from_be_bytes([b[0], b[1], b[2], b[3], b[4], b[5], b[6], b[7]])
+}
+
+fn le32(b: &[u8]) -> u64 {
+    u32::from_le_bytes([b[0], b[1], b[2], b[3]]) as u64
+}
+
+fn rd16(b: &[u8], le: bool) -> u64 {
+    if le {
+        u16::from_le_bytes([b[0], b[1]]) as u64
+    } else {
+        be16(b)
+    }
+}
+
+fn rd32(b: &[u8], le: bool) -> u64 {
+    if le {
+        le32(b)
+    } else {
+        be32(b)
+    }
+}
+
+/// Walk JPEG marker segments from `base` up to the start of scan
+///
+/// Below full depth the TIFF structure of the EXIF segment is walked too,
+/// to find the entries to remove.
+fn walk_jpeg<S: RangeSource>(
+    cache: &mut RangeCache<S>,
+    base: u64,
+    depth: Depth,
+    edits: &mut Vec<IfdEdit>,
+) -> Result<(), String> {
+    let mut pos = base + 2;
+    loop {
+        let header = cache.read(pos, 4)?;
+        if header.len() < 4 || header[0] != 0xFF {
+            return Ok(());
+        }
+        match header[1] {
+            0xFF => pos += 1,
+            0x01 | 0xD0..=0xD8 => pos += 2,
+            0xD9 | 0xDA => return Ok(()),
+            _ => {
+                let len = be16(&header[2..4]);
+                if len < 2 {
+                    return Ok(());
+                }
+                cache.fetch(pos + 2, len)?;
+                if depth != Depth::Full && header[1] == 0xE1 && cache.read(pos + 4, 6)? == b"Exif\0\0" {
+                    walk_tiff(cache, pos + 10, depth, edits)?;
+                }
+                pos += 2 + len;
+            }
+        }
+    }
+}
+
+/// Byte order of a TIFF header: Some(true) for little-endian
+fn tiff_order(head: &[u8]) -> Option<bool> {
+    // The magic number varies between TIFF-based RAW formats (ORF, RW2)
+    match head.get(..2)? {
+        b"II" => Some(true),
+        b"MM" => Some(false),
+        _ => None,
+    }
+}
+
+fn tiff_type_size(kind: u64) -> u64 {
+    match kind {
+        1 | 2 | 6 | 7 => 1,
+        3 | 8 => 2,
+        4 | 9 | 11 | 13 => 4,
+        5 | 10 | 12 => 8,
+        _ => 0,
+    }
+}
+
+/// Removal of entries from an IFD, and of its link to the next IFD, in
+/// the buffer handed to the core parser
+struct IfdEdit {
+    /// Absolute position of the IFD
+    pos: u64,
+    le: bool,
+    count: u64,
+    /// Indices of the entries to remove
+    drop: Vec<usize>,
+    clear_next: bool,
+}
+
+impl IfdEdit {
+    /// Rewrite the IFD in `image` with the kept entries moved up; the bytes
+    /// freed at its end are no longer referenced
+    fn apply(&self, image: &mut [u8]) {
+        let start = self.pos as usize;
+        let entries_end = start + 2 + self.count as usize * 12;
+        if entries_end + 4 > image.len() {
+            return;
+        }
+        let next = if self.clear_next { [0; 4] } else { image[entries_end..entries_end + 4].try_into().unwrap() };
+        let kept: Vec<u8> = image[start + 2..entries_end]
+            .chunks_exact(12)
+            .enumerate()
+            .filter(|(i, _)| !self.drop.contains(i))
+            .flat_map(|(_, entry)| entry.iter().copied())
+            .collect();
+        let count = (kept.len() / 12) as u16;
+        image[start..start + 2].copy_from_slice(&if self.le { count.to_le_bytes() } else { count.to_be_bytes() });
+        image[start + 2..start + 2 + kept.len()].copy_from_slice(&kept);
+        image[start + 2 + kept.len()..start + 6 + kept.len()].copy_from_slice(&next);
+    }
+}
+
+/// The sparse image with `edits` applied
+fn edited_image<S: RangeSource>(cache: &RangeCache<S>, edits: &[IfdEdit]) -> Result<Vec<u8>, String> {
+    let mut image = cache.sparse_image()?;
+    for edit in edits {
+        edit.apply(&mut image);
+    }
+    Ok(image)
+}
+
+/// Follow a TIFF structure whose header is at `base`, fetching every IFD
+/// and out-of-line value but none of the image data they point to
+///
+/// Blocks outside `depth` are neither fetched nor followed, and an edit
+/// removing the entries that point at them is added to `edits`.
+fn walk_tiff<S: RangeSource>(
+    cache: &mut RangeCache<S>,
+    base: u64,
+    depth: Depth,
+    edits: &mut Vec<IfdEdit>,
+) -> Result<(), String> {
+    let header = cache.read(base, 8)?;
+    let Some(le) = tiff_order(&header) else {
+        return Ok(());
+    };
+    if header.len() < 8 {
+        return Ok(());
+    }
+    // (base the offsets are relative to, IFD offset, little-endian, position
+    // in the main IFD chain or None for a sub-IFD)
+    let mut queue = vec![(base, rd32(&header[4..8], le), le, Some(0))];
+    let mut seen = HashSet::new();
+    while let Some((base, ifd, le, chain)) = queue.pop() {
+        if ifd == 0 || seen.len() >= MAX_IFDS || !seen.insert(base + ifd) {
+            continue;
+        }
+        let count = cache.read(base + ifd, 2)?;
+        if count.len() < 2 {
+            continue;
+        }
+        let count = rd16(&count, le);
+        if count == 0 || count > 1000 {
+            continue;
+        }
+        let entries = cache.read(base + ifd + 2, count * 12 + 4)?;
+        let mut drop = Vec::new();
+        for (index, entry) in entries.chunks_exact(12).take(count as usize).enumerate() {
+            let tag = rd16(&entry[0..2], le);
+            if depth.skips_tiff_tag(tag as u16) {
+                drop.push(index);
+                continue;
+            }
+            let n = rd32(&entry[4..8], le);
+            let size = tiff_type_size(rd16(&entry[2..4], le)).saturating_mul(n);
+            let value = rd32(&entry[8..12], le);
+            if size > 4 && size <= MAX_BLOCK {
+                cache.fetch(base + value, size)?;
+            }
+            match tag {
+                // ExifIFD, GPS IFD, interoperability IFD
+                0x8769 | 0x8825 | 0xA005 => queue.push((base, value, le, None)),
+                // SubIFDs
+                0x014A if n == 1 => queue.push((base, value, le, None)),
+                0x014A if n > 1 && n <= 64 => {
+                    let offsets = cache.read(base + value, n * 4)?;
+                    queue.extend(offsets.chunks_exact(4).map(|o| (base, rd32(o, le), le, None)));
+                }
+                // MakerNote
+                0x927C if size > 4 => {
+                    let start = base + value;
+                    let head = cache.read(start, 18)?;
+                    if let Some((inner_base, inner_ifd, inner_le)) = makernote_ifd(&head, start, base, le) {
+                        queue.push((inner_base, inner_ifd, inner_le, None));
+                    }
+                }
+                _ => {}
+            }
+        }
+        let next_chain = chain.map(|n| n + 1);
+        let clear_next = next_chain.is_some_and(|n| n >= depth.chain_ifds());
+        if entries.len() as u64 >= count * 12 + 4 && !clear_next {
+            let next = rd32(&entries[(count * 12) as usize..], le);
+            queue.push((base, next, le, next_chain));
+        }
+        if !drop.is_empty() || clear_next {
+            edits.push(IfdEdit { pos: base + ifd, le, count, drop, clear_next });
+        }
+    }
+    Ok(())
+}
+
+/// Locate the IFD inside a MakerNote from its vendor header
+///
+/// Returns (offset base, IFD offset, little-endian). Headerless MakerNotes
+/// (Canon and others) are an IFD at the start, relative to the outer base.
+fn makernote_ifd(head: &[u8], start: u64, base: u64, le: bool) -> Option<(u64, u64, bool)> {
+    let relative = start - base;
+    if head.starts_with(b"Nikon\0") && head.len() >= 18 {
+        // A complete TIFF header of its own follows the 10-byte preamble
+        let inner_le = tiff_order(&head[10..])?;
+        return Some((start + 10, rd32(&head[14..18], inner_le), inner_le));
+    }
+    if head.starts_with(b"OLYMPUS\0") && head.len() >= 12 {
+        return Some((start, 12, head[8] == b'I'));
+    }
+    if head.starts_with(b"OM SYSTEM\0") && head.len() >= 16 {
+        return Some((start, 16, head[12] == b'I'));
+    }
+    if head.starts_with(b"FUJIFILM") && head.len() >= 12 {
+        return Some((start, le32(&head[8..12]), true));
+    }
+    if head.starts_with(b"SONY DSC ") || head.starts_with(b"SONY CAM ") || head.starts_with(b"Panasonic\0") {
+        return Some((base, relative + 12, le));
+    }
+    if head.starts_with(b"AOC\0") && head.len() >= 6 {
+        let inner_le = match &head[4..6] {
+            b"II" => true,
+            b"MM" => false,
+            _ => le,
+        };
+        return Some((base, relative + 6, inner_le));
+    }
+    Some((base, relative, le))
+}
+
+/// Fujifilm RAF: a fixed header pointing at an embedded JPEG with the EXIF
+fn walk_raf<S: RangeSource>(cache: &mut RangeCache<S>, depth: Depth, edits: &mut Vec<IfdEdit>) -> Result<(), String> {
+    let header = cache.read(0, 104)?;
+    if header.len() < 104 {
+        return Ok(());
+    }
+    let (jpeg_offset, cfa_header_offset, cfa_header_len) =
+        (be32(&header[84..88]), be32(&header[92..96]), be32(&header[96..100]));
+    if jpeg_offset != 0 {
+        walk_jpeg(cache, jpeg_offset, depth, edits)?;
+    }
+    if cfa_header_offset != 0 && cfa_header_len <= MAX_BLOCK {
+        cache.fetch(cfa_header_offset, cfa_header_len)?;
+    }
+    Ok(())
+}
+
+/// One piece of a compacted buffer
+enum Piece {
+    /// Bytes copied from the source
+    Range(u64, u64),
+    /// Bytes written by the walker
+    Bytes(Vec<u8>),
+}
+
+fn assemble<S: RangeSource>(cache: &mut RangeCache<S>, pieces: &[Piece]) -> Result<Vec<u8>, String> {
+    let mut out = Vec::new();
+    for piece in pieces {
+        match piece {
+            Piece::Range(offset, len) => out.extend_from_slice(&cache.read(*offset, *len)?),
+            Piece::Bytes(bytes) => out.extend_from_slice(bytes),
+        }
+    }
+    Ok(out)
+}
+
+/// ISO base media file: keep every top-level box except the media data
+///
+/// HEIF/AVIF store the Exif and XMP items inside `mdat`; when the `meta`
+/// box points at such items the file is kept sparse instead so the item
+/// offsets stay valid.
+fn walk_bmff<S: RangeSource>(cache: &mut RangeCache<S>) -> Result<Vec<u8>, String> {
+    // (start, size, header length, type); size None runs to end of data
+    let is_bulk = |kind: &[u8; 4]| matches!(kind, b"mdat" | b"free" | b"skip" | b"wide");
+    let mut boxes = Vec::new();
+    let mut pos = 0u64;
+    let mut skipped = 0;
+    loop {
+        let header = cache.read_ahead(pos, 16, ahead_after(skipped))?;
+        if header.len() < 8 {
+            break;
+        }
+        let kind: [u8; 4] = [header[4], header[5], header[6], header[7]];
+        let (size, header_len) = match be32(&header[0..4]) {
+            0 => (None, 8),
+            1 if header.len() >= 16 => (Some(be64(&header[8..16])), 16),
+            1 => break,
+            size => (Some(size), 8),
+        };
+        if size.is_some_and(|s| s < header_len) {
+            break;
+        }
+        boxes.push((pos, size, header_len, kind));
+        skipped = if is_bulk(&kind) { size.unwrap_or(0) } else { 0 };
+        match size {
+            Some(size) => pos += size,
+            None => break,
+        }
+    }
+
+    for &(start, size, _, kind) in &boxes {
+        if !is_bulk(&kind) {
+            cache.fetch(start, size.unwrap_or(MAX_BLOCK).min(MAX_BLOCK))?;
+        }
+    }
+
+    // (start of the `meta` box, its header length, item extent)
+    let mut items = Vec::new();
+    for &(start, size, header_len, kind) in &boxes {
+        if &kind == b"meta" {
+            let meta = cache.read(start + header_len, size.unwrap_or(MAX_BLOCK).min(MAX_BLOCK) - header_len)?;
+            items.extend(heif_metadata_items(&meta).into_iter().map(|item| (start, header_len, item)));
+        }
+    }
+    if !items.is_empty() {
+        for (_, _, item) in &items {
+            cache.fetch(item.offset, item.len)?;
+        }
+        if let Some(relocated) = relocate_items(cache, &boxes, &items)? {
+            return Ok(relocated);
+        }
+        // No iloc field can hold the new offsets: keep the originals
+        let mut image = cache.sparse_image()?;
+        // Shrink media data boxes that run past the fetched data so the
+        // parser does not treat the buffer as truncated
+        let image_len = image.len() as u64;
+        for &(start, size, header_len, kind) in &boxes {
+            let end = size.map_or(u64::MAX, |s| start + s);
+            if &kind == b"mdat" && start + header_len <= image_len && end > image_len {
+                let shrunk = image_len - start;
+                let at = start as usize;
+                if header_len == 16 {
+                    image[at + 8..at + 16].copy_from_slice(&shrunk.to_be_bytes());
+                } else {
+                    image[at..at + 4].copy_from_slice(&(shrunk as u32).to_be_bytes());
+                }
+            }
+        }
+        return Ok(image);
+    }
+
+    let mut pieces = Vec::new();
+    for &(start, size, _, kind) in &boxes {
+        if &kind == b"mdat" {
+            // Keep an empty media data box so the structure stays familiar
+            pieces.push(Piece::Bytes([&8u32.to_be_bytes()[..], b"mdat"].concat()));
+        } else if !is_bulk(&kind) {
+            pieces.push(Piece::Range(start, size.unwrap_or(MAX_BLOCK).min(MAX_BLOCK)));
+        }
+    }
+    assemble(cache, &pieces)
+}
+
+/// Compact a HEIF file whose Exif and XMP items live in the media data
+///
+/// The non-bulk top-level boxes are kept in order and the item data is
+/// gathered into one `mdat` after them, with the items' `iloc` entries
+/// rewritten to point into it. Returns None when an entry has no offset
+/// field wide enough for its new position.
+fn relocate_items<S: RangeSource>(
+    cache: &mut RangeCache<S>,
+    boxes: &[(u64, Option<u64>, u64, [u8; 4])],
+    items: &[(u64, u64, ItemExtent)],
+) -> Result<Option<Vec<u8>>, String> {
+    let is_bulk = |kind: &[u8; 4]| matches!(kind, b"mdat" | b"free" | b"skip" | b"wide");
+    let mut out = Vec::new();
+    // Output position of each kept box, by its position in the source
+    let mut moved = HashMap::new();
+    for &(start, size, _, kind) in boxes {
+        if !is_bulk(&kind) {
+            moved.insert(start, out.len());
+            out.extend_from_slice(&cache.read(start, size.unwrap_or(MAX_BLOCK).min(MAX_BLOCK))?);
+        }
+    }
+
+    let mdat_at = out.len();
+    out.extend_from_slice(&[0, 0, 0, 0]);
+    out.extend_from_slice(b"mdat");
+    for (meta_start, header_len, item) in items {
+        let Some(&meta_at) = moved.get(meta_start) else {
+            return Ok(None);
+        };
+        let payload = meta_at + *header_len as usize;
+        let new_offset = out.len() as u64;
+        let (base_pos, base_size) = item.base_field;
+        let (offset_pos, offset_size) = item.offset_field;
+        let patched = if offset_size > 0 {
+            // Any base offset is zeroed so the extent offset alone locates the data
+            (base_size == 0 || write_sized(&mut out, payload + base_pos, base_size, 0))
+                && write_sized(&mut out, payload + offset_pos, offset_size, new_offset)
+        } else {
+            write_sized(&mut out, payload + base_pos, base_size, new_offset)
+        };
+        if !patched {
+            return Ok(None);
+        }
+        let data = cache.read(item.offset, item.len)?;
+        out.extend_from_slice(&data);
+        // A short read leaves the item truncated at the end of data
+        if (data.len() as u64) < item.len {
+            break;
+        }
+    }
+    let Ok(mdat_size) = u32::try_from(out.len() - mdat_at) else {
+        return Ok(None);
+    };
+    out[mdat_at..mdat_at + 4].copy_from_slice(&mdat_size.to_be_bytes());
+    Ok(Some(out))
+}
+
+/// Child boxes of a box payload as (type, payload)
+fn child_boxes(data: &[u8]) -> Vec<([u8; 4], &[u8])> {
+    let mut children = Vec::new();
+    let mut pos = 0usize;
+    while pos + 8 <= data.len() {
+        let size = be32(&data[pos..]) as usize;
+        let kind = [data[pos + 4], data[pos + 5], data[pos + 6], data[pos + 7]];
+        let (size, header_len) = match size {
+            0 => (data.len() - pos, 8),
+            1 if pos + 16 <= data.len() => (be64(&data[pos + 8..]) as usize, 16),
+            _ => (size, 8),
+        };
+        if size < header_len || pos + size > data.len() {
+            break;
+        }
+        children.push((kind, &data[pos + header_len..pos + size]));
+        pos += size;
+    }
+    children
+}
+
+/// Read a big-endian integer of `size` bytes (0, 2, 4 or 8)
+fn read_sized(data: &[u8], pos: &mut usize, size: usize) -> Option<u64> {
+    let bytes = data.get(*pos..*pos + size)?;
+    *pos += size;
+    Some(bytes.iter().fold(0u64, |acc, &b| (acc << 8) | b as u64))
+}
+
+/// Write `value` as a big-endian integer of `size` bytes, if it fits
+fn write_sized(data: &mut [u8], pos: usize, size: usize, value: u64) -> bool {
+    if size == 0 || (size < 8 && value >> (8 * size) != 0) {
+        return false;
+    }
+    let Some(field) = data.get_mut(pos..pos + size) else {
+        return false;
+    };
+    field.copy_from_slice(&value.to_be_bytes()[8 - size..]);
+    true
+}
+
+/// Position of `inner`, a subslice of `outer`, within it
+fn offset_in(outer: &[u8], inner: &[u8]) -> usize {
+    inner.as_ptr() as usize - outer.as_ptr() as usize
+}
+
+/// An extent of a HEIF Exif or XMP item
+struct ItemExtent {
+    /// Position and length in the file
+    offset: u64,
+    len: u64,
+    /// Position and width of the item's `base_offset` field in the `meta`
+    /// payload; width 0 when the box has none
+    base_field: (usize, usize),
+    /// Position and width of the extent's `extent_offset` field
+    offset_field: (usize, usize),
+}
+
+/// Extents of the Exif and XMP items listed in a HEIF `meta` box payload
+fn heif_metadata_items(meta: &[u8]) -> Vec<ItemExtent> {
+    // `meta` is a full box: skip version and flags
+    let children = child_boxes(meta.get(4..).unwrap_or(&[]));
+    let mut wanted = HashSet::new();
+    for (kind, payload) in &children {
+        if kind == b"iinf" {
+            let version = payload.first().copied().unwrap_or(0);
+            let skip = if version == 0 { 6 } else { 8 };
+            for (kind, infe) in child_boxes(payload.get(skip..).unwrap_or(&[])) {
+                if &kind != b"infe" || infe.len() < 4 {
+                    continue;
+                }
+                let mut pos = 4;
+                let id = match infe[0] {
+                    2 => read_sized(infe, &mut pos, 2),
+                    3 => read_sized(infe, &mut pos, 4),
+                    _ => None,
+                };
+                pos += 2; // item_protection_index
+                if let (Some(id), Some(item_type)) = (id, infe.get(pos..pos + 4)) {
+                    if item_type == b"Exif" || item_type == b"mime" {
+                        wanted.insert(id);
+                    }
+                }
+            }
+        }
+    }
+    let mut extents = Vec::new();
+    for (kind, iloc) in &children {
+        if kind != b"iloc" || iloc.len() < 8 {
+            continue;
+        }
+        let iloc_start = offset_in(meta, iloc);
+        let version = iloc[0];
+        let (offset_size, length_size) = ((iloc[4] >> 4) as usize, (iloc[4] & 0xF) as usize);
+        let base_offset_size = (iloc[5] >> 4) as usize;
+        let index_size = if version >= 1 { (iloc[5] & 0xF) as usize } else { 0 };
+        let mut pos = 6;
+        let count = if version < 2 { read_sized(iloc, &mut pos, 2) } else { read_sized(iloc, &mut pos, 4) };
+        for _ in 0..count.unwrap_or(0) {
+            let parsed = (|| {
+                let id = read_sized(iloc, &mut pos, if version < 2 { 2 } else { 4 })?;
+                let method = if version >= 1 { read_sized(iloc, &mut pos, 2)? & 0xF } else { 0 };
+                read_sized(iloc, &mut pos, 2)?; // data_reference_index
+                let base_field = (iloc_start + pos, base_offset_size);
+                let base = read_sized(iloc, &mut pos, base_offset_size)?;
+                let extent_count = read_sized(iloc, &mut pos, 2)?;
+                for _ in 0..extent_count {
+                    read_sized(iloc, &mut pos, index_size)?;
+                    let offset_field = (iloc_start + pos, offset_size);
+                    let offset = read_sized(iloc, &mut pos, offset_size)?;
+                    let len = read_sized(iloc, &mut pos, length_size)?;
+                    if method == 0 && wanted.contains(&id) && len > 0 && len <= MAX_BLOCK {
+                        extents.push(ItemExtent { offset: base + offset, len, base_field, offset_field });
+                    }
+                }
+                Some(())
+            })();
+            if parsed.is_none() {
+                break;
+            }
+        }
+    }
+    extents
+}
+
+/// PNG: keep every chunk except image data
+fn walk_png<S: RangeSource>(cache: &mut RangeCache<S>) -> Result<Vec<u8>, String> {
+    let mut pieces = vec![Piece::Range(0, 8)];
+    let mut pos = 8u64;
+    let mut skipped = 0;
+    loop {
+        let header = cache.read_ahead(pos, 8, ahead_after(skipped))?;
+        if header.len() < 8 {
+            break;
+        }
+        let total = be32(&header[0..4]) + 12;
+        let kind = &header[4..8];
+        skipped = if kind != b"IDAT" && total <= MAX_BLOCK {
+            pieces.push(Piece::Range(pos, total));
+            0
+        } else {
+            skipped + total
+        };
+        if kind == b"IEND" {
+            break;
+        }
+        pos += total;
+    }
+    assemble(cache, &pieces)
+}
+
+/// RIFF (WebP, AVI): drop movie data, indexes and animation frames
+fn walk_riff<S: RangeSource>(cache: &mut RangeCache<S>) -> Result<Vec<u8>, String> {
+    let header = cache.read(0, 12)?;
+    if header.len() < 12 {
+        return cache.read_all();
+    }
+    let riff_end = 8 + le32(&header[4..8]);
+    let mut pieces = Vec::new();
+    let mut pos = 12u64;
+    let mut skipped = 0;
+    while pos + 8 <= riff_end {
+        let chunk = cache.read_ahead(pos, 12, ahead_after(skipped))?;
+        if chunk.len() < 8 {
+            break;
+        }
+        let size = le32(&chunk[4..8]);
+        let total = 8 + size + (size & 1);
+        let kind = &chunk[0..4];
+        let bulk = matches!(kind, b"idx1" | b"ANMF") || (kind == b"LIST" && chunk.get(8..12) == Some(b"movi"));
+        skipped = if !bulk && total <= MAX_BLOCK {
+            pieces.push(Piece::Range(pos, total));
+            0
+        } else {
+            skipped + total
+        };
+        pos += total;
+    }
+    let mut out = assemble(cache, &pieces)?;
+    let mut riff = Vec::with_capacity(12 + out.len());
+    riff.extend_from_slice(b"RIFF");
+    riff.extend_from_slice(&((out.len() + 4) as u32).to_le_bytes());
+    riff.extend_from_slice(&header[8..12]);
+    riff.append(&mut out);
+    Ok(riff)
+}
+
+/// Decode an EBML variable-length integer: (width, value without marker)
+fn ebml_vint(bytes: &[u8]) -> Option<(usize, u64)> {
+    let first = *bytes.first()?;
+    let width = first.leading_zeros() as usize + 1;
+    if width > 8 || bytes.len() < width {
+        return None;
+    }
+    let mut value = (first as u64) & (0xFF >> width);
+    for &b in &bytes[1..width] {
+        value = (value << 8) | b as u64;
+    }
+    Some((width, value))
+}
+
+/// Matroska/WebM: keep the segment's metadata elements, drop clusters and cues
+fn walk_ebml<S: RangeSource>(cache: &mut RangeCache<S>) -> Result<Vec<u8>, String> {
+    const SEGMENT: u64 = 0x0853_8067;
+    const CLUSTER: u64 = 0x0F43_B675;
+    const CUES: u64 = 0x0C53_BB6B;
+
+    // (id, id width, size width, size); size None when unknown
+    let element = |cache: &mut RangeCache<S>, pos: u64, ahead: u64| -> Result<Option<(u64, usize, usize, Option<u64>)>, String> {
+        let header = cache.read_ahead(pos, 12, ahead)?;
+        let Some((id_width, id)) = ebml_vint(&header) else {
+            return Ok(None);
+        };
+        let Some((size_width, size)) = ebml_vint(&header[id_width..]) else {
+            return Ok(None);
+        };
+        let unknown = size == (1u64 << (7 * size_width)) - 1;
+        Ok(Some((id, id_width, size_width, if unknown { None } else { Some(size) })))
+    };
+
+    let mut pieces = Vec::new();
+    let mut pos = 0u64;
+    while let Some((id, id_width, size_width, size)) = element(cache, pos, MIN_FETCH)? {
+        let header_len = (id_width + size_width) as u64;
+        if id != SEGMENT {
+            let Some(size) = size else { break };
+            if header_len + size <= MAX_BLOCK {
+                pieces.push(Piece::Range(pos, header_len + size));
+            }
+            pos += header_len + size;
+            continue;
+        }
+        // Rewrite the segment size as "unknown", keeping the field width,
+        // since dropping clusters changes its length
+        let mut segment_header = cache.read(pos, id_width as u64)?;
+        segment_header.push(0x80 >> (size_width - 1) | ((1u16 << (8 - size_width)) - 1) as u8);
+        segment_header.extend(std::iter::repeat(0xFF).take(size_width - 1));
+        pieces.push(Piece::Bytes(segment_header));
+        let segment_end = size.map_or(u64::MAX, |s| pos + header_len + s);
+        let mut child = pos + header_len;
+        let mut skipped = 0;
+        while child < segment_end {
+            let Some((child_id, child_id_width, child_size_width, child_size)) =
+                element(cache, child, ahead_after(skipped))?
+            else {
+                break;
+            };
+            let child_header = (child_id_width + child_size_width) as u64;
+            let Some(child_size) = child_size else { break };
+            let total = child_header + child_size;
+            skipped = if child_id != CLUSTER && child_id != CUES && total <= MAX_BLOCK {
+                pieces.push(Piece::Range(child, total));
+                0
+            } else {
+                skipped + total
+            };
+            child += total;
+        }
+        break;
+    }
+    assemble(cache, &pieces)
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    /// Little-endian IFD with `entries` of (tag, type, count, value)
+    fn ifd(entries: &[(u16, u16, u32, u32)], next: u32) -> Vec<u8> {
+        let mut out = (entries.len() as u16).to_le_bytes().to_vec();
+        for &(tag, kind, count, value) in entries {
+            out.extend_from_slice(&tag.to_le_bytes());
+            out.extend_from_slice(&kind.to_le_bytes());
+            out.extend_from_slice(&count.to_le_bytes());
+            out.extend_from_slice(&value.to_le_bytes());
+        }
+        out.extend_from_slice(&next.to_le_bytes());
+        out
+    }
+
+    /// IFD0 (Make, ExifIFD) linked to IFD1; the EXIF IFD holds an
+    /// exposure time and a MakerNote that is itself an IFD
+    fn tiff() -> Vec<u8> {
+        let (exif, ifd1, makernote) = (38, 68, 86);
+        let mut out = b"II*\0".to_vec();
+        out.extend_from_slice(&8u32.to_le_bytes());
+        out.extend(ifd(&[(0x010F, 3, 1, 1), (0x8769, 4, 1, exif)], ifd1));
+        out.extend(ifd(&[(0x829A, 3, 1, 5), (0x927C, 7, 18, makernote)], 0));
+        out.extend(ifd(&[(0x0201, 4, 1, 0)], 0));
+        out.extend(ifd(&[(0x0001, 3, 1, 7)], 0));
+        out.resize(makernote as usize + 18, 0);
+        assert_eq!(out.len(), 104, "IFD offsets out of date");
+        out
+    }
+
+    fn extract_bytes(data: &[u8], depth: Depth) -> Vec<u8> {
+        extract(&mut RangeCache::new(data), depth).unwrap()
+    }
+
+    /// (tags, next IFD offset) of the IFD at `offset`
+    fn read_ifd(data: &[u8], offset: usize) -> (Vec<u16>, u32) {
+        let count = u16::from_le_bytes([data[offset], data[offset + 1]]) as usize;
+        let tags = (0..count)
+            .map(|i| u16::from_le_bytes([data[offset + 2 + 12 * i], data[offset + 3 + 12 * i]]))
+            .collect();
+        let next = &data[offset + 2 + 12 * count..][..4];
+        (tags, u32::from_le_bytes([next[0], next[1], next[2], next[3]]))
+    }
+
+    #[test]
+    fn full_depth_keeps_every_block() {
+        let data = tiff();
+        let image = extract_bytes(&data, Depth::Full);
+        assert_eq!(image, data);
+    }
+
+    #[test]
+    fn basic_depth_drops_makernote_and_ifd1() {
+        let image = extract_bytes(&tiff(), Depth::Basic);
+        assert_eq!(read_ifd(&image, 8), (vec![0x010F, 0x8769], 0));
+        assert_eq!(read_ifd(&image, 38), (vec![0x829A], 0));
+    }
+
+    #[test]
+    fn standard_depth_keeps_ifd1() {
+        let image = extract_bytes(&tiff(), Depth::Standard);
+        assert_eq!(read_ifd(&image, 8), (vec![0x010F, 0x8769], 68));
+        assert_eq!(read_ifd(&image, 38), (vec![0x829A], 0));
+    }
+
+    #[test]
+    fn limit_rejects_a_file_read_whole() {
+        let data = vec![0x55u8; 1 << 20];
+        let mut cache = RangeCache::new(&data[..]).with_limit(100_000);
+        assert!(extract(&mut cache, Depth::Full).unwrap_err().contains("does not fit"));
+        assert!(cache.fetched <= 100_000);
+    }
+}
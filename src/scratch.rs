@@ -0,0 +1,135 @@
+//! Reusable per-thread read buffers
+//!
+//! The core reader allocates a fresh buffer for every file it reads, and for
+//! small JPEGs that allocation costs more than the parse. A [`ScratchReader`]
+//! reads each file into a buffer it keeps between files and hands the bytes
+//! to the core parser. The buffer grows to the largest file seen, up to a
+//! configurable limit; larger files go through the core reader directly so
+//! that one stray video does not pin its size in every thread.
+
+use crate::batch::Metadata;
+use crate::depth::Depth;
+use crate::ranged::{self, FileSource, RangeCache};
+use fast_exif_reader::FastExifReader;
+use std::cell::RefCell;
+use std::fs::File;
+use std::io::Read;
+use std::sync::atomic::{AtomicUsize, Ordering};
+
+/// Default upper bound on a kept scratch buffer
+pub const DEFAULT_LIMIT: usize = 8 << 20;
+
+static LIMIT: AtomicUsize = AtomicUsize::new(DEFAULT_LIMIT);
+
+/// Set the largest buffer a reader keeps between files; None restores the
+/// default and 0 disables reuse
+pub fn configure(limit: Option<usize>) {
+    LIMIT.store(limit.unwrap_or(DEFAULT_LIMIT), Ordering::Relaxed);
+}
+
+/// Core reader with a scratch buffer that outlives each call
+pub struct ScratchReader {
+    reader: FastExifReader,
+    buffer: Vec<u8>,
+    /// File bytes read so far
+    read: u64,
+}
+
+impl Default for ScratchReader {
+    fn default() -> Self {
+        Self::new()
+    }
+}
+
+impl ScratchReader {
+    pub fn new() -> Self {
+        Self {
+            reader: FastExifReader::new(),
+            buffer: Vec::new(),
+            read: 0,
+        }
+    }
+
+    /// Total file bytes this reader has read
+    pub fn bytes_read(&self) -> u64 {
+        self.read
+    }
+
+    /// Read and parse a whole file
+    pub fn read_file(&mut self, path: &str) -> Result<Metadata, String> {
+        let limit = LIMIT.load(Ordering::Relaxed);
+        let size = std::fs::metadata(path).map(|m| m.len()).unwrap_or(u64::MAX);
+        if size > limit as u64 {
+            let result = self.reader.read_file(path).map_err(|e| e.to_string());
+            if result.is_ok() {
+                self.read += size;
+            }
+            return result;
+        }
+        self.fill(path, size, limit)
+    }
+
+    /// Read and parse the blocks of a file within `depth`
+    ///
+    /// Below full depth only the container headers and metadata blocks
+    /// within the level are read; the result still needs trimming.
+    pub fn read_file_at_depth(&mut self, path: &str, depth: Depth) -> Result<Metadata, String> {
+        match depth {
+            Depth::Full => self.read_file(path),
+            _ => self.read_ranged(path, u64::MAX, depth),
+        }
+    }
+
+    /// Parse a file's metadata within `depth` from at most `max_bytes` of it
+    ///
+    /// Only the container headers and metadata blocks are read, wherever
+    /// they sit in the file; a file whose metadata does not fit in
+    /// `max_bytes` fails rather than being parsed in part.
+    pub fn read_ranged(&mut self, path: &str, max_bytes: u64, depth: Depth) -> Result<Metadata, String> {
+        let file = File::open(path).map_err(|e| e.to_string())?;
+        let mut cache = RangeCache::new(FileSource(file)).with_limit(max_bytes);
+        let data = ranged::extract(&mut cache, depth);
+        self.read += cache.fetched;
+        self.reader.read_bytes(&data?).map_err(|e| e.to_string())
+    }
+
+    pub fn read_bytes(&mut self, data: &[u8]) -> Result<Metadata, String> {
+        self.reader.read_bytes(data).map_err(|e| e.to_string())
+    }
+
+    /// Parse the blocks of in-memory file data within `depth`
+    pub fn read_bytes_at_depth(&mut self, data: &[u8], depth: Depth) -> Result<Metadata, String> {
+        if depth == Depth::Full {
+            return self.read_bytes(data);
+        }
+        let data = ranged::extract(&mut RangeCache::new(data), depth)?;
+        self.read_bytes(&data)
+    }
+
+    /// Read up to `max_bytes` of `path` into the buffer and parse them
+    fn fill(&mut self, path: &str, max_bytes: u64, limit: usize) -> Result<Metadata, String> {
+        self.buffer.clear();
+        let read = File::open(path).and_then(|file| {
+            // The size is a hint; a file that grew is still read to the end
+            self.buffer.reserve(max_bytes.min(isize::MAX as u64) as usize);
+            file.take(max_bytes).read_to_end(&mut self.buffer)
+        });
+        self.read += self.buffer.len() as u64;
+        let result = match read {
+            Ok(_) => self.reader.read_bytes(&self.buffer).map_err(|e| e.to_string()),
+            Err(e) => Err(e.to_string()),
+        };
+        if self.buffer.capacity() > limit {
+            self.buffer = Vec::new();
+        }
+        result
+    }
+}
+
+/// Run `f` with this thread's cached reader
+pub fn with_thread_reader<R>(f: impl FnOnce(&mut ScratchReader) -> R) -> R {
+    thread_local! {
+        static READER: RefCell<ScratchReader> = RefCell::new(ScratchReader::new());
+    }
+    READER.with(|reader| f(&mut reader.borrow_mut()))
+}
@@ -0,0 +1,44 @@
+//! Thread-safe sharing of core reader, writer and copier instances
+//!
+//! The core `fast-exif-reader` types take `&mut self`, so a single instance
+//! cannot serve two Python threads at once. Instead of locking one instance
+//! for the duration of a call, each Python wrapper keeps a small pool of idle
+//! core instances: a call checks one out, uses it without holding any lock,
+//! and hands it back afterwards. Concurrent callers simply get separate
+//! instances, which lets free-threaded CPython scale across cores.
+
+use std::sync::{Mutex, MutexGuard};
+
+/// Pool of idle instances handed out to one caller at a time
+pub struct InstancePool<T> {
+    idle: Mutex<Vec<T>>,
+    make: fn() -> T,
+}
+
+impl<T> InstancePool<T> {
+    /// Create an empty pool that builds new instances with `make`
+    pub fn new(make: fn() -> T) -> Self {
+        Self {
+            idle: Mutex::new(Vec::new()),
+            make,
+        }
+    }
+
+    /// Run `f` with exclusive access to a pooled instance
+    pub fn with<R>(&self, f: impl FnOnce(&mut T) -> R) -> R {
+        let mut instance = self.take();
+        let result = f(&mut instance);
+        self.lock().push(instance);
+        result
+    }
+
+    fn take(&self) -> T {
+        self.lock().pop().unwrap_or_else(self.make)
+    }
+
+    fn lock(&self) -> MutexGuard<'_, Vec<T>> {
+        // A panic while the lock is held cannot leave the Vec inconsistent,
+        // so a poisoned lock is safe to keep using.
+        self.idle.lock().unwrap_or_else(|e| e.into_inner())
+    }
+}
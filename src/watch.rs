@@ -0,0 +1,292 @@
+//! Change notification for a directory tree
+//!
+//! On Linux a background thread blocks on an inotify descriptor and folds
+//! events into the set of paths that may have changed since the last
+//! [`Watcher::drain`]. New directories are watched as they appear and their
+//! files reported, so nothing created inside them before the watch was added
+//! is missed. A kernel queue overflow, or more pending paths than
+//! [`MAX_PENDING`], is reported instead of the paths so that the caller can
+//! rescan. Other platforms have no watcher and callers rescan with `stat`.
+
+use std::collections::BTreeSet;
+use std::path::PathBuf;
+
+/// Pending paths kept before reporting an overflow instead
+pub const MAX_PENDING: usize = 1 << 20;
+
+/// Paths that may have changed since the last drain
+#[derive(Debug, Default)]
+pub struct Pending {
+    /// Files created, written, renamed or removed
+    pub paths: BTreeSet<PathBuf>,
+    /// Directories removed or moved away; anything below them may be gone
+    pub gone: Vec<PathBuf>,
+    /// Events were lost and the whole tree must be rescanned
+    pub overflow: bool,
+}
+
+#[cfg(target_os = "linux")]
+mod inotify {
+    use super::{Pending, MAX_PENDING};
+    use libc::c_int;
+    use std::collections::HashMap;
+    use std::ffi::{CString, OsStr};
+    use std::fs;
+    use std::io;
+    use std::os::unix::ffi::OsStrExt;
+    use std::path::{Path, PathBuf};
+    use std::sync::atomic::{AtomicBool, Ordering};
+    use std::sync::{Arc, Mutex, MutexGuard};
+    use std::thread::JoinHandle;
+
+    const MASK: u32 = libc::IN_CREATE
+        | libc::IN_CLOSE_WRITE
+        | libc::IN_ATTRIB
+        | libc::IN_MOVED_FROM
+        | libc::IN_MOVED_TO
+        | libc::IN_DELETE
+        | libc::IN_ONLYDIR
+        | libc::IN_EXCL_UNLINK;
+
+    fn lock<T>(mutex: &Mutex<T>) -> MutexGuard<'_, T> {
+        // Both guarded values stay consistent if a holder panics
+        mutex.lock().unwrap_or_else(|e| e.into_inner())
+    }
+
+    struct Shared {
+        fd: c_int,
+        dirs: Mutex<HashMap<c_int, PathBuf>>,
+        pending: Mutex<Pending>,
+        alive: AtomicBool,
+    }
+
+    impl Drop for Shared {
+        fn drop(&mut self) {
+            unsafe { libc::close(self.fd) };
+        }
+    }
+
+    impl Shared {
+        /// Watch `root` and every directory below it, returning the files
+        /// found when `report` is set
+        fn watch_tree(&self, root: &Path, report: bool) -> Result<Vec<PathBuf>, String> {
+            let mut files = Vec::new();
+            let mut stack = vec![root.to_path_buf()];
+            while let Some(dir) = stack.pop() {
+                if !self.watch(&dir)? {
+                    continue;
+                }
+                let Ok(entries) = fs::read_dir(&dir) else { continue };
+                for entry in entries.flatten() {
+                    match entry.file_type() {
+                        Ok(kind) if kind.is_dir() => stack.push(entry.path()),
+                        Ok(kind) if kind.is_file() && report => files.push(entry.path()),
+                        _ => {}
+                    }
+                }
+            }
+            Ok(files)
+        }
+
+        /// Add a watch for `dir`, returning false if it no longer exists
+        fn watch(&self, dir: &Path) -> Result<bool, String> {
+            let name = CString::new(dir.as_os_str().as_bytes()).map_err(|e| e.to_string())?;
+            let wd = unsafe { libc::inotify_add_watch(self.fd, name.as_ptr(), MASK) };
+            if wd < 0 {
+                let err = io::Error::last_os_error();
+                return match err.raw_os_error() {
+                    Some(libc::ENOENT) | Some(libc::ENOTDIR) => Ok(false),
+                    _ => Err(format!("{}: {}", dir.display(), err)),
+                };
+            }
+            lock(&self.dirs).insert(wd, dir.to_path_buf());
+            Ok(true)
+        }
+
+        /// Drop the watches on `dir` and everything below it
+        fn unwatch(&self, dir: &Path) {
+            for (wd, path) in lock(&self.dirs).iter() {
+                if path.starts_with(dir) {
+                    unsafe { libc::inotify_rm_watch(self.fd, *wd) };
+                }
+            }
+        }
+
+        fn push(&self, files: impl IntoIterator<Item = PathBuf>) {
+            let mut pending = lock(&self.pending);
+            pending.paths.extend(files);
+            if pending.paths.len() > MAX_PENDING {
+                pending.paths.clear();
+                pending.overflow = true;
+            }
+        }
+
+        /// Stop tracking; the owner rescans from now on
+        fn fail(&self) {
+            self.alive.store(false, Ordering::Relaxed);
+            lock(&self.pending).overflow = true;
+        }
+
+        fn handle(&self, events: &[u8]) {
+            let header = std::mem::size_of::<libc::inotify_event>();
+            let mut offset = 0;
+            while offset + header <= events.len() {
+                let event: libc::inotify_event =
+                    unsafe { std::ptr::read_unaligned(events[offset..].as_ptr() as *const libc::inotify_event) };
+                let start = offset + header;
+                offset = start + event.len as usize;
+                let name = events.get(start..offset).unwrap_or(&[]);
+                let name = &name[..name.iter().position(|&b| b == 0).unwrap_or(name.len())];
+                self.event(event.wd, event.mask, name);
+            }
+        }
+
+        fn event(&self, wd: c_int, mask: u32, name: &[u8]) {
+            if mask & libc::IN_Q_OVERFLOW != 0 {
+                lock(&self.pending).overflow = true;
+                return;
+            }
+            if mask & libc::IN_IGNORED != 0 {
+                lock(&self.dirs).remove(&wd);
+                return;
+            }
+            let Some(dir) = lock(&self.dirs).get(&wd).cloned() else { return };
+            if name.is_empty() {
+                return;
+            }
+            let path = dir.join(OsStr::from_bytes(name));
+            if mask & libc::IN_ISDIR == 0 {
+                self.push([path]);
+            } else if mask & (libc::IN_CREATE | libc::IN_MOVED_TO) != 0 {
+                match self.watch_tree(&path, true) {
+                    Ok(files) => self.push(files),
+                    Err(_) => self.fail(),
+                }
+            } else if mask & (libc::IN_DELETE | libc::IN_MOVED_FROM) != 0 {
+                if mask & libc::IN_MOVED_FROM != 0 {
+                    self.unwatch(&path);
+                }
+                lock(&self.pending).gone.push(path);
+            }
+        }
+
+        fn run(&self, stop: c_int) {
+            let mut buffer = vec![0u8; 64 * 1024];
+            loop {
+                let mut fds = [
+                    libc::pollfd { fd: self.fd, events: libc::POLLIN, revents: 0 },
+                    libc::pollfd { fd: stop, events: libc::POLLIN, revents: 0 },
+                ];
+                if unsafe { libc::poll(fds.as_mut_ptr(), 2, -1) } < 0 {
+                    if io::Error::last_os_error().kind() == io::ErrorKind::Interrupted {
+                        continue;
+                    }
+                    break;
+                }
+                if fds[1].revents != 0 {
+                    return;
+                }
+                let len = unsafe { libc::read(self.fd, buffer.as_mut_ptr() as *mut libc::c_void, buffer.len()) };
+                if len < 0 {
+                    match io::Error::last_os_error().kind() {
+                        io::ErrorKind::Interrupted | io::ErrorKind::WouldBlock => continue,
+                        _ => break,
+                    }
+                }
+                self.handle(&buffer[..len as usize]);
+            }
+            self.fail();
+        }
+    }
+
+    /// inotify watch on a directory tree, serviced by a background thread
+    pub struct Watcher {
+        shared: Arc<Shared>,
+        stop: [c_int; 2],
+        thread: Option<JoinHandle<()>>,
+    }
+
+    impl Watcher {
+        /// Watch every directory under `root`
+        ///
+        /// Fails when inotify is unavailable or the per-user watch limit is
+        /// too low for the tree.
+        pub fn new(root: &Path) -> Result<Self, String> {
+            let fd = unsafe { libc::inotify_init1(libc::IN_NONBLOCK | libc::IN_CLOEXEC) };
+            if fd < 0 {
+                return Err(format!("inotify: {}", io::Error::last_os_error()));
+            }
+            let shared = Arc::new(Shared {
+                fd,
+                dirs: Mutex::new(HashMap::new()),
+                pending: Mutex::new(Pending::default()),
+                alive: AtomicBool::new(true),
+            });
+            shared.watch_tree(root, false)?;
+            let mut stop = [0; 2];
+            if unsafe { libc::pipe2(stop.as_mut_ptr(), libc::O_CLOEXEC) } < 0 {
+                return Err(format!("pipe: {}", io::Error::last_os_error()));
+            }
+            let worker = Arc::clone(&shared);
+            let stop_read = stop[0];
+            let thread = std::thread::Builder::new()
+                .name("fast-exif-watch".to_string())
+                .spawn(move || worker.run(stop_read));
+            match thread {
+                Ok(thread) => Ok(Self { shared, stop, thread: Some(thread) }),
+                Err(e) => {
+                    unsafe {
+                        libc::close(stop[0]);
+                        libc::close(stop[1]);
+                    }
+                    Err(e.to_string())
+                }
+            }
+        }
+
+        /// Whether events are still being tracked
+        pub fn alive(&self) -> bool {
+            self.shared.alive.load(Ordering::Relaxed)
+        }
+
+        /// Take the paths collected since the last drain
+        pub fn drain(&self) -> Pending {
+            std::mem::take(&mut *lock(&self.shared.pending))
+        }
+    }
+
+    impl Drop for Watcher {
+        fn drop(&mut self) {
+            unsafe { libc::write(self.stop[1], b"x".as_ptr() as *const libc::c_void, 1) };
+            if let Some(thread) = self.thread.take() {
+                let _ = thread.join();
+            }
+            unsafe {
+                libc::close(self.stop[0]);
+                libc::close(self.stop[1]);
+            }
+        }
+    }
+}
+
+#[cfg(target_os = "linux")]
+pub use inotify::Watcher;
+
+/// Placeholder on platforms without inotify; never constructed
+#[cfg(not(target_os = "linux"))]
+pub struct Watcher;
+
+#[cfg(not(target_os = "linux"))]
+impl Watcher {
+    pub fn new(_root: &std::path::Path) -> Result<Self, String> {
+        Err("change notification is only available on Linux".to_string())
+    }
+
+    pub fn alive(&self) -> bool {
+        false
+    }
+
+    pub fn drain(&self) -> Pending {
+        Pending::default()
+    }
+}
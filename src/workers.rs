@@ -0,0 +1,83 @@
+//! Worker pool behind the parallel batch APIs
+//!
+//! The pool is owned by this crate rather than borrowed from rayon's global
+//! pool so that it can be rebuilt after `fork()`. A forked child inherits the
+//! parent's pool object but none of its threads, so any work submitted to it
+//! would hang. Every lookup compares the current process id against the one
+//! the pool was built in and builds a fresh pool when they differ.
+//!
+//! Callers that already parallelise at the process level can switch the pool
+//! off entirely, in which case batches run serially on the calling thread.
+
+use rayon::{ThreadPool, ThreadPoolBuilder};
+use std::sync::{Arc, Mutex, MutexGuard};
+
+struct PoolState {
+    /// Process the pool was built in
+    pid: u32,
+    pool: Option<Arc<ThreadPool>>,
+    /// Requested thread count, 0 for one thread per core
+    num_threads: usize,
+    enabled: bool,
+}
+
+static STATE: Mutex<PoolState> = Mutex::new(PoolState {
+    pid: 0,
+    pool: None,
+    num_threads: 0,
+    enabled: true,
+});
+
+fn lock() -> MutexGuard<'static, PoolState> {
+    STATE.lock().unwrap_or_else(|e| e.into_inner())
+}
+
+/// Change the pool size or switch the pool off
+///
+/// The current pool is dropped and a new one is built lazily on the next
+/// batch, so this is cheap to call from a process initializer.
+pub fn configure(num_threads: Option<usize>, enabled: bool) {
+    let mut state = lock();
+    discard(&mut state);
+    state.num_threads = num_threads.unwrap_or(0);
+    state.enabled = enabled;
+}
+
+/// Get the pool for the current process, building it if necessary
+///
+/// Returns `Ok(None)` when the pool has been switched off.
+pub fn pool() -> Result<Option<Arc<ThreadPool>>, String> {
+    let mut state = lock();
+    if !state.enabled {
+        return Ok(None);
+    }
+    let pid = std::process::id();
+    if state.pid != pid {
+        discard(&mut state);
+        state.pid = pid;
+    }
+    if let Some(pool) = &state.pool {
+        return Ok(Some(Arc::clone(pool)));
+    }
+    let pool = ThreadPoolBuilder::new()
+        .num_threads(state.num_threads)
+        .thread_name(|i| format!("fast-exif-{}", i))
+        .build()
+        .map_err(|e| format!("failed to start worker pool: {}", e))?;
+    let pool = Arc::new(pool);
+    state.pool = Some(Arc::clone(&pool));
+    Ok(Some(pool))
+}
+
+fn discard(state: &mut PoolState) {
+    if let Some(pool) = state.pool.take() {
+        if state.pid == std::process::id() {
+            drop(pool);
+        } else {
+            // Inherited across fork: the worker threads do not exist here,
+            // and shutting the pool down would wait on locks they may have
+            // held at the time of the fork. Leak it instead.
+            std::mem::forget(pool);
+        }
+    }
+}
@@ -0,0 +1,687 @@
+//! XMP sidecar files
+//!
+//! RAW originals must not be modified, so edits and catalog metadata live
+//! in `.xmp` sidecars next to them. This module renders parsed EXIF as an
+//! XMP packet, parses existing sidecars, and merges the two. Properties it
+//! does not understand (develop settings, face regions) are carried through
+//! a rewrite verbatim.
+
+use crate::batch::Metadata;
+use crate::scratch::ScratchReader;
+use crate::workers;
+use quick_xml::escape::escape;
+use quick_xml::events::Event;
+use quick_xml::reader::Reader;
+use rayon::prelude::*;
+use std::collections::hash_map::Entry;
+use std::collections::{BTreeMap, HashMap};
+use std::fs;
+use std::path::{Path, PathBuf};
+use std::sync::atomic::{AtomicU64, Ordering};
+
+/// Namespaces known by prefix
+const NAMESPACES: &[(&str, &str)] = &[
+    ("dc", "http://purl.org/dc/elements/1.1/"),
+    ("xmp", "http://ns.adobe.com/xap/1.0/"),
+    ("tiff", "http://ns.adobe.com/tiff/1.0/"),
+    ("exif", "http://ns.adobe.com/exif/1.0/"),
+    ("exifEX", "http://cipa.jp/exif/1.0/"),
+    ("aux", "http://ns.adobe.com/exif/1.0/aux/"),
+    ("photoshop", "http://ns.adobe.com/photoshop/1.0/"),
+    ("xmpMM", "http://ns.adobe.com/xap/1.0/mm/"),
+    ("crs", "http://ns.adobe.com/camera-raw-settings/1.0/"),
+    ("lr", "http://ns.adobe.com/lightroom/1.0/"),
+];
+
+const RDF: &str = "http://www.w3.org/1999/02/22-rdf-syntax-ns#";
+
+/// How an EXIF value is written as XMP
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+enum Kind {
+    Text,
+    /// A date, with the tags holding its sub-second part and UTC offset
+    Date(&'static str, &'static str),
+    Seq,
+    /// Unordered list, split from a ';'-separated value
+    Bag,
+    /// Language alternatives; only the default language is written
+    Alt,
+    /// GPS coordinate, with the tag holding its N/S/E/W reference
+    Gps(&'static str),
+}
+
+/// EXIF tag to XMP property; the first tag listed for a property is the
+/// one reported when reading a sidecar
+const PROPERTIES: &[(&str, &str, Kind)] = &[
+    ("Make", "tiff:Make", Kind::Text),
+    ("Model", "tiff:Model", Kind::Text),
+    ("Orientation", "tiff:Orientation", Kind::Text),
+    ("ImageWidth", "tiff:ImageWidth", Kind::Text),
+    ("ImageHeight", "tiff:ImageLength", Kind::Text),
+    ("ImageLength", "tiff:ImageLength", Kind::Text),
+    ("XResolution", "tiff:XResolution", Kind::Text),
+    ("YResolution", "tiff:YResolution", Kind::Text),
+    ("ResolutionUnit", "tiff:ResolutionUnit", Kind::Text),
+    ("Software", "xmp:CreatorTool", Kind::Text),
+    ("ModifyDate", "xmp:ModifyDate", Kind::Date("SubSecTime", "OffsetTime")),
+    ("DateTime", "xmp:ModifyDate", Kind::Date("SubSecTime", "OffsetTime")),
+    ("CreateDate", "xmp:CreateDate", Kind::Date("SubSecTimeDigitized", "OffsetTimeDigitized")),
+    ("DateTimeDigitized", "xmp:CreateDate", Kind::Date("SubSecTimeDigitized", "OffsetTimeDigitized")),
+    ("Rating", "xmp:Rating", Kind::Text),
+    ("Artist", "dc:creator", Kind::Seq),
+    ("Copyright", "dc:rights", Kind::Alt),
+    ("ImageDescription", "dc:description", Kind::Alt),
+    ("XPTitle", "dc:title", Kind::Alt),
+    ("XPKeywords", "dc:subject", Kind::Bag),
+    ("DateTimeOriginal", "exif:DateTimeOriginal", Kind::Date("SubSecTimeOriginal", "OffsetTimeOriginal")),
+    ("ExposureTime", "exif:ExposureTime", Kind::Text),
+    ("FNumber", "exif:FNumber", Kind::Text),
+    ("ExposureProgram", "exif:ExposureProgram", Kind::Text),
+    ("ISO", "exif:ISOSpeedRatings", Kind::Seq),
+    ("ISOSpeedRatings", "exif:ISOSpeedRatings", Kind::Seq),
+    ("ExifVersion", "exif:ExifVersion", Kind::Text),
+    ("ShutterSpeedValue", "exif:ShutterSpeedValue", Kind::Text),
+    ("ApertureValue", "exif:ApertureValue", Kind::Text),
+    ("BrightnessValue", "exif:BrightnessValue", Kind::Text),
+    ("ExposureBiasValue", "exif:ExposureBiasValue", Kind::Text),
+    ("ExposureCompensation", "exif:ExposureBiasValue", Kind::Text),
+    ("MaxApertureValue", "exif:MaxApertureValue", Kind::Text),
+    ("SubjectDistance", "exif:SubjectDistance", Kind::Text),
+    ("MeteringMode", "exif:MeteringMode", Kind::Text),
+    ("LightSource", "exif:LightSource", Kind::Text),
+    ("FocalLength", "exif:FocalLength", Kind::Text),
+    ("FocalLengthIn35mmFormat", "exif:FocalLengthIn35mmFilm", Kind::Text),
+    ("FocalLengthIn35mmFilm", "exif:FocalLengthIn35mmFilm", Kind::Text),
+    ("ColorSpace", "exif:ColorSpace", Kind::Text),
+    ("PixelXDimension", "exif:PixelXDimension", Kind::Text),
+    ("ExifImageWidth", "exif:PixelXDimension", Kind::Text),
+    ("PixelYDimension", "exif:PixelYDimension", Kind::Text),
+    ("ExifImageHeight", "exif:PixelYDimension", Kind::Text),
+    ("ExposureMode", "exif:ExposureMode", Kind::Text),
+    ("WhiteBalance", "exif:WhiteBalance", Kind::Text),
+    ("DigitalZoomRatio", "exif:DigitalZoomRatio", Kind::Text),
+    ("SceneCaptureType", "exif:SceneCaptureType", Kind::Text),
+    ("Contrast", "exif:Contrast", Kind::Text),
+    ("Saturation", "exif:Saturation", Kind::Text),
+    ("Sharpness", "exif:Sharpness", Kind::Text),
+    ("SubjectDistanceRange", "exif:SubjectDistanceRange", Kind::Text),
+    ("ImageUniqueID", "exif:ImageUniqueID", Kind::Text),
+    ("GPSLatitude", "exif:GPSLatitude", Kind::Gps("GPSLatitudeRef")),
+    ("GPSLongitude", "exif:GPSLongitude", Kind::Gps("GPSLongitudeRef")),
+    ("GPSAltitude", "exif:GPSAltitude", Kind::Text),
+    ("GPSAltitudeRef", "exif:GPSAltitudeRef", Kind::Text),
+    ("GPSImgDirection", "exif:GPSImgDirection", Kind::Text),
+    ("GPSImgDirectionRef", "exif:GPSImgDirectionRef", Kind::Text),
+    ("GPSSpeed", "exif:GPSSpeed", Kind::Text),
+    ("GPSSpeedRef", "exif:GPSSpeedRef", Kind::Text),
+    ("LensModel", "exifEX:LensModel", Kind::Text),
+    ("LensMake", "exifEX:LensMake", Kind::Text),
+    ("LensSerialNumber", "exifEX:LensSerialNumber", Kind::Text),
+    ("BodySerialNumber", "exifEX:BodySerialNumber", Kind::Text),
+    ("SerialNumber", "exifEX:BodySerialNumber", Kind::Text),
+    ("CameraOwnerName", "exifEX:CameraOwnerName", Kind::Text),
+    ("OwnerName", "exifEX:CameraOwnerName", Kind::Text),
+];
+
+/// A property value in an XMP packet
+#[derive(Clone, Debug, PartialEq, Eq)]
+pub enum Value {
+    Text(String),
+    Seq(Vec<String>),
+    Bag(Vec<String>),
+    /// Default-language value of a language alternative
+    Alt(String),
+    /// A structure or other form kept as its original XML
+    Raw(String),
+}
+
+impl Value {
+    fn display(&self) -> Option<String> {
+        match self {
+            Self::Text(text) | Self::Alt(text) => Some(text.clone()),
+            Self::Seq(items) | Self::Bag(items) => Some(items.join("; ")),
+            Self::Raw(_) => None,
+        }
+    }
+}
+
+/// Properties of an XMP packet keyed by qualified name ("exif:FNumber")
+#[derive(Clone, Debug, Default)]
+pub struct Packet {
+    /// Prefixes declared in a parsed packet beyond the known ones
+    namespaces: BTreeMap<String, String>,
+    pub properties: BTreeMap<String, Value>,
+}
+
+/// Sidecar file name convention
+#[derive(Clone, Copy, Debug, Default, PartialEq, Eq)]
+pub enum Naming {
+    /// "IMG_0001.CR2" -> "IMG_0001.xmp" (Lightroom, Camera Raw)
+    #[default]
+    Replace,
+    /// "IMG_0001.CR2" -> "IMG_0001.CR2.xmp" (darktable, digiKam)
+    Append,
+}
+
+impl Naming {
+    pub fn parse(name: &str) -> Option<Self> {
+        match name {
+            "replace" => Some(Self::Replace),
+            "append" => Some(Self::Append),
+            _ => None,
+        }
+    }
+
+    pub fn sidecar(self, path: &str) -> PathBuf {
+        match self {
+            Self::Replace => Path::new(path).with_extension("xmp"),
+            Self::Append => PathBuf::from(format!("{}.xmp", path)),
+        }
+    }
+}
+
+/// An existing sidecar for `path` under either naming convention
+pub fn find_sidecar(path: &str) -> Option<PathBuf> {
+    [Naming::Replace, Naming::Append]
+        .into_iter()
+        .map(|naming| naming.sidecar(path))
+        .find(|sidecar| sidecar.is_file())
+}
+
+fn property(tag: &str) -> Option<(&'static str, Kind)> {
+    PROPERTIES.iter().find(|(t, _, _)| *t == tag).map(|&(_, p, k)| (p, k))
+}
+
+/// Whether a tag only qualifies another one (sub-seconds, offsets, GPS refs)
+fn is_companion(tag: &str) -> bool {
+    PROPERTIES.iter().any(|&(_, _, kind)| match kind {
+        Kind::Date(subsec, offset) => tag == subsec || tag == offset,
+        Kind::Gps(reference) => tag == reference,
+        _ => false,
+    })
+}
+
+/// "2024:01:02 03:04:05" -> "2024-01-02T03:04:05", with optional
+/// fractional seconds and UTC offset
+fn xmp_date(value: &str, subsec: Option<&String>, offset: Option<&String>) -> String {
+    let value = value.trim();
+    let b = value.as_bytes();
+    if b.len() < 19 || b[4] != b':' || b[7] != b':' {
+        return value.to_string();
+    }
+    let mut date = format!("{}-{}-{}T{}", &value[0..4], &value[5..7], &value[8..10], &value[11..19]);
+    if let Some(subsec) = subsec.map(|s| s.trim()).filter(|s| !s.is_empty() && s.bytes().all(|c| c.is_ascii_digit())) {
+        date.push('.');
+        date.push_str(subsec);
+    }
+    if let Some(offset) = offset.map(|s| s.trim()).filter(|s| !s.is_empty()) {
+        date.push_str(offset);
+    }
+    date
+}
+
+/// "2024-01-02T03:04:05.5+01:00" -> "2024:01:02 03:04:05"
+fn exif_date(value: &str) -> String {
+    let b = value.as_bytes();
+    match b.len() {
+        n if n >= 19 && b[4] == b'-' => format!("{}:{}:{} {}", &value[0..4], &value[5..7], &value[8..10], &value[11..19]),
+        10 if b[4] == b'-' => format!("{}:{}:{} 00:00:00", &value[0..4], &value[5..7], &value[8..10]),
+        _ => value.to_string(),
+    }
+}
+
+/// Numbers in a coordinate string, e.g. "37 deg 46' 29.64\"" or "-122.42"
+fn numbers(value: &str) -> Vec<f64> {
+    value
+        .split(|c: char| !(c.is_ascii_digit() || c == '.' || c == '-'))
+        .filter_map(|s| s.parse().ok())
+        .collect()
+}
+
+/// GPS coordinate in XMP form "DDD,MM.mmmmmmR"
+fn xmp_gps(value: &str, reference: Option<&String>, tag: &str) -> Option<String> {
+    let parts = numbers(value);
+    let degrees = match parts.as_slice() {
+        [d] => *d,
+        [d, m] => d.abs() + m / 60.0,
+        [d, m, s, ..] => d.abs() + m / 60.0 + s / 3600.0,
+        [] => return None,
+    };
+    let latitude = tag == "GPSLatitude";
+    let reference = reference
+        .and_then(|r| r.trim().chars().next())
+        .map(|c| c.to_ascii_uppercase())
+        .filter(|c| "NSEW".contains(*c))
+        .or_else(|| value.chars().rev().find(|c| "NSEW".contains(*c)))
+        .unwrap_or(match (latitude, degrees < 0.0) {
+            (true, false) => 'N',
+            (true, true) => 'S',
+            (false, false) => 'E',
+            (false, true) => 'W',
+        });
+    let degrees = degrees.abs();
+    Some(format!("{},{:.6}{}", degrees.trunc(), degrees.fract() * 60.0, reference))
+}
+
+/// XMP "DDD,MM.mmmR" -> (decimal degrees, reference)
+fn gps_degrees(value: &str) -> Option<(String, char)> {
+    let reference = value.trim().chars().last().filter(|c| "NSEW".contains(*c))?;
+    let parts = numbers(value);
+    let degrees = match parts.as_slice() {
+        [d, m] => d + m / 60.0,
+        [d, m, s] => d + m / 60.0 + s / 3600.0,
+        _ => return None,
+    };
+    Some((format!("{:.6}", degrees), reference))
+}
+
+impl Packet {
+    /// Packet holding the mapped properties of parsed EXIF metadata
+    pub fn from_metadata(metadata: &Metadata) -> Self {
+        let mut packet = Self::default();
+        // Iterate in table order so the first tag for a property wins
+        for &(tag, name, kind) in PROPERTIES {
+            let Some(value) = metadata.get(tag).filter(|v| !v.trim().is_empty()) else {
+                continue;
+            };
+            if packet.properties.contains_key(name) {
+                continue;
+            }
+            let value = match kind {
+                Kind::Text => Value::Text(value.trim().to_string()),
+                Kind::Date(subsec, offset) => Value::Text(xmp_date(value, metadata.get(subsec), metadata.get(offset))),
+                Kind::Seq => Value::Seq(vec![value.trim().to_string()]),
+                Kind::Bag => Value::Bag(split_list(value)),
+                Kind::Alt => Value::Alt(value.trim().to_string()),
+                Kind::Gps(reference) => match xmp_gps(value, metadata.get(reference), tag) {
+                    Some(coordinate) => Value::Text(coordinate),
+                    None => continue,
+                },
+            };
+            packet.properties.insert(name.to_string(), value);
+        }
+        packet
+    }
+
+    /// Apply caller overrides keyed by EXIF tag or qualified XMP name; an
+    /// empty value removes the property
+    pub fn apply_overrides(&mut self, overrides: &Metadata) -> Result<(), String> {
+        let mut mapped = Metadata::new();
+        for (key, value) in overrides {
+            if key.contains(':') {
+                let prefix = &key[..key.find(':').unwrap_or(0)];
+                if self.namespace_uri(prefix).is_none() {
+                    return Err(format!("unknown XMP namespace prefix in {}", key));
+                }
+                if value.is_empty() {
+                    self.properties.remove(key);
+                    continue;
+                }
+                let kind = PROPERTIES.iter().find(|(_, p, _)| p == key).map(|&(_, _, k)| k);
+                let value = match kind {
+                    Some(Kind::Seq) => Value::Seq(split_list(value)),
+                    Some(Kind::Bag) => Value::Bag(split_list(value)),
+                    Some(Kind::Alt) => Value::Alt(value.clone()),
+                    _ => Value::Text(value.clone()),
+                };
+                self.properties.insert(key.clone(), value);
+            } else if let Some((name, _)) = property(key) {
+                if value.is_empty() {
+                    self.properties.remove(name);
+                } else {
+                    mapped.insert(key.clone(), value.clone());
+                }
+            } else if is_companion(key) {
+                mapped.insert(key.clone(), value.clone());
+            } else {
+                return Err(format!("no XMP property for tag {}", key));
+            }
+        }
+        // Plain tags go through the same conversion as embedded metadata,
+        // so companion tags (SubSecTime, GPS references) are honoured
+        let converted = Self::from_metadata(&mapped);
+        self.properties.extend(converted.properties);
+        Ok(())
+    }
+
+    /// Overlay another packet's properties onto this one
+    pub fn merge(&mut self, other: Packet) {
+        self.namespaces.extend(other.namespaces);
+        self.properties.extend(other.properties);
+    }
+
+    /// Metadata entries for this packet: mapped properties under their EXIF
+    /// tag names, others under their qualified names
+    pub fn to_metadata(&self) -> Metadata {
+        let mut metadata = Metadata::new();
+        for (name, value) in &self.properties {
+            let Some(text) = value.display() else { continue };
+            match PROPERTIES.iter().find(|(_, p, _)| p == name) {
+                Some(&(tag, _, Kind::Date(..))) => {
+                    metadata.insert(tag.to_string(), exif_date(&text));
+                }
+                Some(&(tag, _, Kind::Gps(reference))) => match gps_degrees(&text) {
+                    Some((degrees, r)) => {
+                        metadata.insert(tag.to_string(), degrees);
+                        metadata.insert(reference.to_string(), r.to_string());
+                    }
+                    None => {
+                        metadata.insert(tag.to_string(), text);
+                    }
+                },
+                Some(&(tag, _, _)) => {
+                    metadata.insert(tag.to_string(), text);
+                }
+                None => {
+                    metadata.insert(name.clone(), text);
+                }
+            }
+        }
+        metadata
+    }
+
+    fn namespace_uri(&self, prefix: &str) -> Option<&str> {
+        NAMESPACES
+            .iter()
+            .find(|(p, _)| *p == prefix)
+            .map(|(_, uri)| *uri)
+            .or_else(|| self.namespaces.get(prefix).map(String::as_str))
+    }
+
+    /// Render the packet as a sidecar document
+    pub fn render(&self) -> String {
+        let mut prefixes: Vec<&str> = self
+            .properties
+            .keys()
+            .filter_map(|name| name.split_once(':').map(|(prefix, _)| prefix))
+            .collect();
+        // Verbatim properties may use any prefix the original declared
+        prefixes.extend(self.namespaces.keys().map(String::as_str));
+        prefixes.sort_unstable();
+        prefixes.dedup();
+
+        let mut out = String::new();
+        out.push_str(&format!(
+            "<x:xmpmeta xmlns:x=\"adobe:ns:meta/\" x:xmptk=\"fast-exif-rs-py {}\">\n",
+            env!("CARGO_PKG_VERSION")
+        ));
+        out.push_str(&format!(" <rdf:RDF xmlns:rdf=\"{}\">\n", RDF));
+        out.push_str("  <rdf:Description rdf:about=\"\"");
+        for prefix in prefixes {
+            if let Some(uri) = self.namespace_uri(prefix) {
+                out.push_str(&format!("\n    xmlns:{}=\"{}\"", prefix, escape(uri)));
+            }
+        }
+        out.push_str(">\n");
+        for (name, value) in &self.properties {
+            let list = |kind: &str, items: &[String]| {
+                let items: String = items.iter().map(|i| format!("     <rdf:li>{}</rdf:li>\n", escape(i.as_str()))).collect();
+                format!("   <{0}>\n    <rdf:{1}>\n{2}    </rdf:{1}>\n   </{0}>\n", name, kind, items)
+            };
+            match value {
+                Value::Text(text) => out.push_str(&format!("   <{0}>{1}</{0}>\n", name, escape(text.as_str()))),
+                Value::Seq(items) => out.push_str(&list("Seq", items)),
+                Value::Bag(items) => out.push_str(&list("Bag", items)),
+                Value::Alt(text) => out.push_str(&format!(
+                    "   <{0}>\n    <rdf:Alt>\n     <rdf:li xml:lang=\"x-default\">{1}</rdf:li>\n    </rdf:Alt>\n   </{0}>\n",
+                    name,
+                    escape(text.as_str())
+                )),
+                Value::Raw(xml) => {
+                    out.push_str("   ");
+                    out.push_str(xml.trim());
+                    out.push('\n');
+                }
+            }
+        }
+        out.push_str("  </rdf:Description>\n </rdf:RDF>\n</x:xmpmeta>\n");
+        out
+    }
+
+    /// Parse an XMP document
+    pub fn parse(xml: &str) -> Result<Self, String> {
+        let root = parse_tree(xml)?;
+        let mut packet = Self::default();
+        // Prefixes may be declared on any element, commonly x:xmpmeta or
+        // rdf:RDF; rendering declares them all on rdf:Description
+        root.visit(&mut |node| {
+            for (key, value) in &node.attrs {
+                if let Some(prefix) = key.strip_prefix("xmlns:") {
+                    if NAMESPACES.iter().all(|(p, _)| *p != prefix) && prefix != "rdf" && prefix != "x" {
+                        packet.namespaces.insert(prefix.to_string(), value.clone());
+                    }
+                }
+            }
+        });
+        let mut descriptions = Vec::new();
+        root.find_all("rdf:Description", &mut descriptions);
+        for description in descriptions {
+            for (key, value) in &description.attrs {
+                if key.contains(':') && !key.starts_with("xmlns:") && !key.starts_with("rdf:") && !key.starts_with("xml:") {
+                    packet.properties.insert(key.clone(), Value::Text(value.clone()));
+                }
+            }
+            for child in &description.children {
+                packet.properties.insert(child.name.clone(), child.value(xml));
+            }
+        }
+        Ok(packet)
+    }
+}
+
+/// Split a list value on ';' (or ',' when there is no ';')
+fn split_list(value: &str) -> Vec<String> {
+    let separator = if value.contains(';') { ';' } else { ',' };
+    value.split(separator).map(str::trim).filter(|s| !s.is_empty()).map(str::to_string).collect()
+}
+
+/// Element of a parsed document, with its byte span in the source
+#[derive(Debug, Default)]
+struct Node {
+    name: String,
+    attrs: Vec<(String, String)>,
+    text: String,
+    children: Vec<Node>,
+    start: usize,
+    end: usize,
+}
+
+impl Node {
+    fn find_all<'a>(&'a self, name: &str, found: &mut Vec<&'a Node>) {
+        for child in &self.children {
+            if child.name == name {
+                found.push(child);
+            } else {
+                child.find_all(name, found);
+            }
+        }
+    }
+
+    /// Call `f` on this node and every node below it
+    fn visit<'a>(&'a self, f: &mut impl FnMut(&'a Node)) {
+        f(self);
+        for child in &self.children {
+            child.visit(f);
+        }
+    }
+
+    fn attr(&self, name: &str) -> Option<&str> {
+        self.attrs.iter().find(|(k, _)| k == name).map(|(_, v)| v.as_str())
+    }
+
+    /// Interpret a property element; anything beyond text, plain arrays and
+    /// a default-language alternative is kept verbatim
+    fn value(&self, source: &str) -> Value {
+        let raw = || Value::Raw(source[self.start..self.end].to_string());
+        if self.attr("rdf:parseType").is_some() || self.attr("rdf:resource").is_some() {
+            return raw();
+        }
+        let [container] = self.children.as_slice() else {
+            return if self.children.is_empty() { Value::Text(self.text.trim().to_string()) } else { raw() };
+        };
+        if container.children.iter().any(|li| li.name != "rdf:li" || !li.children.is_empty() || li.attrs.iter().any(|(k, _)| k != "xml:lang")) {
+            return raw();
+        }
+        let items = || container.children.iter().map(|li| li.text.trim().to_string()).collect();
+        match container.name.as_str() {
+            "rdf:Seq" => Value::Seq(items()),
+            "rdf:Bag" => Value::Bag(items()),
+            "rdf:Alt" => match container.children.as_slice() {
+                [li] if li.attr("xml:lang").map_or(true, |lang| lang == "x-default") => Value::Alt(li.text.trim().to_string()),
+                _ => raw(),
+            },
+            _ => raw(),
+        }
+    }
+}
+
+fn parse_tree(xml: &str) -> Result<Node, String> {
+    let mut reader = Reader::from_str(xml);
+    let mut stack = vec![Node::default()];
+    let attrs = |e: &quick_xml::events::BytesStart| -> Result<Vec<(String, String)>, String> {
+        e.attributes()
+            .map(|a| {
+                let a = a.map_err(|e| e.to_string())?;
+                let value = a.unescape_value().map_err(|e| e.to_string())?;
+                Ok((String::from_utf8_lossy(a.key.as_ref()).into_owned(), value.into_owned()))
+            })
+            .collect()
+    };
+    loop {
+        let start = reader.buffer_position() as usize;
+        match reader.read_event().map_err(|e| format!("invalid XMP at byte {}: {}", reader.error_position(), e))? {
+            Event::Start(e) => stack.push(Node {
+                name: String::from_utf8_lossy(e.name().as_ref()).into_owned(),
+                attrs: attrs(&e)?,
+                start,
+                ..Node::default()
+            }),
+            Event::Empty(e) => {
+                let node = Node {
+                    name: String::from_utf8_lossy(e.name().as_ref()).into_owned(),
+                    attrs: attrs(&e)?,
+                    start,
+                    end: reader.buffer_position() as usize,
+                    ..Node::default()
+                };
+                if let Some(parent) = stack.last_mut() {
+                    parent.children.push(node);
+                }
+            }
+            Event::End(_) => {
+                let mut node = stack.pop().filter(|_| !stack.is_empty()).ok_or("unbalanced XMP")?;
+                node.end = reader.buffer_position() as usize;
+                if let Some(parent) = stack.last_mut() {
+                    parent.children.push(node);
+                }
+            }
+            Event::Text(text) => {
+                if let Some(node) = stack.last_mut() {
+                    node.text.push_str(&text.unescape().map_err(|e| e.to_string())?);
+                }
+            }
+            Event::CData(data) => {
+                if let Some(node) = stack.last_mut() {
+                    node.text.push_str(&String::from_utf8_lossy(&data));
+                }
+            }
+            Event::Eof => break,
+            _ => {}
+        }
+    }
+    match stack.pop() {
+        Some(root) if stack.is_empty() => Ok(root),
+        _ => Err("unbalanced XMP".to_string()),
+    }
+}
+
+/// Read and parse a sidecar file
+pub fn read_sidecar(path: &Path) -> Result<Packet, String> {
+    let xml = fs::read_to_string(path).map_err(|e| format!("{}: {}", path.display(), e))?;
+    // Sidecars written by some tools start with a byte order mark
+    Packet::parse(xml.trim_start_matches('\u{feff}')).map_err(|e| format!("{}: {}", path.display(), e))
+}
+
+/// Merge an existing sidecar for `path` over its embedded metadata
+pub fn merge_sidecar(path: &str, metadata: &mut Metadata) -> Result<(), String> {
+    if let Some(sidecar) = find_sidecar(path) {
+        metadata.extend(read_sidecar(&sidecar)?.to_metadata());
+    }
+    Ok(())
+}
+
+/// Write the sidecar for `path` from its embedded metadata, any existing
+/// sidecar and `overrides`, in increasing order of precedence
+///
+/// The file is written to a temporary name unique to this call and renamed
+/// into place.
+pub fn write_sidecar(path: &str, metadata: &Metadata, overrides: &Metadata, naming: Naming) -> Result<PathBuf, String> {
+    let sidecar = naming.sidecar(path);
+    let mut packet = Packet::from_metadata(metadata);
+    if sidecar.is_file() {
+        packet.merge(read_sidecar(&sidecar)?);
+    }
+    packet.apply_overrides(overrides).map_err(|e| format!("{}: {}", path, e))?;
+    static WRITES: AtomicU64 = AtomicU64::new(0);
+    let temporary = PathBuf::from(format!(
+        "{}.{}-{}.tmp",
+        sidecar.display(),
+        std::process::id(),
+        WRITES.fetch_add(1, Ordering::Relaxed)
+    ));
+    fs::write(&temporary, packet.render())
+        .and_then(|_| fs::rename(&temporary, &sidecar))
+        .map_err(|e| {
+            let _ = fs::remove_file(&temporary);
+            format!("{}: {}", sidecar.display(), e)
+        })?;
+    Ok(sidecar)
+}
+
+/// A sidecar path in a form shared by every spelling of its location
+fn target_key(sidecar: &Path) -> PathBuf {
+    let parent = sidecar.parent().filter(|p| !p.as_os_str().is_empty()).unwrap_or(Path::new("."));
+    match (fs::canonicalize(parent), sidecar.file_name()) {
+        (Ok(dir), Some(name)) => dir.join(name),
+        _ => sidecar.to_path_buf(),
+    }
+}
+
+/// Write sidecars for a batch of (path, overrides) on the worker pool,
+/// returning one result per item in input order
+///
+/// Items whose sidecar an earlier item in the batch also writes, such as
+/// "IMG.CR2" and "IMG.JPG" with `Naming::Replace`, fail instead of racing
+/// for the same file and losing one item's overrides.
+pub fn write_sidecars(items: &[(String, Metadata)], naming: Naming) -> Result<Vec<Result<PathBuf, String>>, String> {
+    let mut targets = HashMap::new();
+    let first_writer: Vec<Option<&str>> = items
+        .iter()
+        .map(|(path, _)| match targets.entry(target_key(&naming.sidecar(path))) {
+            Entry::Occupied(first) => Some(*first.get()),
+            Entry::Vacant(slot) => {
+                slot.insert(path.as_str());
+                None
+            }
+        })
+        .collect();
+    let write = |reader: &mut ScratchReader, ((path, overrides), first): (&(String, Metadata), &Option<&str>)| {
+        if let Some(first) = first {
+            return Err(format!(
+                "{}: sidecar {} is also written for {}",
+                path,
+                naming.sidecar(path).display(),
+                first
+            ));
+        }
+        let metadata = reader.read_file(path).map_err(|e| format!("{}: {}", path, e))?;
+        write_sidecar(path, &metadata, overrides, naming)
+    };
+    Ok(match workers::pool()? {
+        Some(pool) => pool.install(|| items.par_iter().zip(first_writer.par_iter()).map_init(ScratchReader::new, write).collect()),
+        None => {
+            let mut reader = ScratchReader::new();
+            items.iter().zip(&first_writer).map(|item| write(&mut reader, item)).collect()
+        }
+    })
+}
@@ -0,0 +1,176 @@
+"""Shared fixtures: small synthetic images carrying a known EXIF block
+
+The images are built byte by byte so the tests need no image library and no
+binary files in the repository.
+"""
+
+import random
+import struct
+import zlib
+
+import pytest
+
+ASCII, SHORT, LONG = 2, 3, 4
+
+
+def ascii_value(text):
+    return (ASCII, len(text) + 1, text.encode() + b"\0")
+
+
+def short_value(value):
+    return (SHORT, 1, struct.pack("<H", value))
+
+
+def long_value(value):
+    return (LONG, 1, struct.pack("<I", value))
+
+
+def ifd(entries, start):
+    """A little-endian IFD at offset `start`, followed by its out-of-line values"""
+    values_start = start + 2 + 12 * len(entries) + 4
+    table = struct.pack("<H", len(entries))
+    values = b""
+    for tag, (kind, count, payload) in sorted(entries.items()):
+        if len(payload) <= 4:
+            inline = payload.ljust(4, b"\0")
+        else:
+            inline = struct.pack("<I", values_start + len(values))
+            values += payload + b"\0" * (len(payload) % 2)
+        table += struct.pack("<HHI", tag, kind, count) + inline
+    return table + struct.pack("<I", 0) + values
+
+
+def exif_tiff(extra_ifd0=None):
+    """A TIFF structure with IFD0 and an EXIF sub-IFD
+
+    `extra_ifd0` adds entries to IFD0, such as strip offsets for a TIFF file.
+    """
+    ifd0_entries = {
+        0x010F: ascii_value("TestCam"),
+        0x0110: ascii_value("Model 1"),
+        0x0131: ascii_value("fixture"),
+        0x8769: long_value(0),
+    }
+    ifd0_entries.update(extra_ifd0 or {})
+    exif_offset = 8 + len(ifd(ifd0_entries, 8))
+    ifd0_entries[0x8769] = long_value(exif_offset)
+    exif_entries = {
+        0x8827: short_value(200),
+        0x9003: ascii_value("2024:01:02 03:04:05"),
+    }
+    return b"II*\0" + struct.pack("<I", 8) + ifd(ifd0_entries, 8) + ifd(exif_entries, exif_offset)
+
+
+def segment(marker, payload):
+    return bytes([0xFF, marker]) + struct.pack(">H", len(payload) + 2) + payload
+
+
+def jpeg(scan_bytes=64, ifd0=None):
+    """A 1x1 greyscale JPEG with an APP1 EXIF block and `scan_bytes` of scan data
+
+    `ifd0` adds or replaces IFD0 entries, such as a distinct Software tag.
+    """
+    sof = struct.pack(">BHHB", 8, 1, 1, 1) + bytes([1, 0x11, 0])
+    dht = bytes([0x00]) + bytes([1] + [0] * 15) + bytes([0])
+    sos = struct.pack(">B", 1) + bytes([1, 0x00, 0, 63, 0])
+    return (
+        b"\xFF\xD8"
+        + segment(0xE1, b"Exif\0\0" + exif_tiff(ifd0))
+        + segment(0xDB, bytes([0]) + bytes([1] * 64))
+        + segment(0xC0, sof)
+        + segment(0xC4, dht)
+        + segment(0xDA, sos)
+        + b"\0" * scan_bytes
+        + b"\xFF\xD9"
+    )
+
+
+def tiff(strip_bytes=64):
+    """A 1-pixel-wide greyscale TIFF whose strip follows the IFDs"""
+    entries = {
+        0x0100: long_value(1),
+        0x0101: long_value(strip_bytes),
+        0x0102: short_value(8),
+        0x0103: short_value(1),
+        0x0106: short_value(1),
+        0x0111: long_value(0),
+        0x0115: short_value(1),
+        0x0116: long_value(strip_bytes),
+        0x0117: long_value(strip_bytes),
+    }
+    strip_offset = len(exif_tiff(entries))
+    entries[0x0111] = long_value(strip_offset)
+    return exif_tiff(entries) + b"\0" * strip_bytes
+
+
+def png_chunk(kind, payload):
+    return struct.pack(">I", len(payload)) + kind + payload + struct.pack(">I", zlib.crc32(kind + payload))
+
+
+def png(idat_bytes=64):
+    """A greyscale PNG with an eXIf chunk and about `idat_bytes` of image data"""
+    width = 256
+    height = max(1, idat_bytes // (width + 1))
+    # Noise does not compress, so the image data keeps its size
+    noise = random.Random(0)
+    rows = b"".join(b"\0" + bytes(noise.getrandbits(8) for _ in range(width)) for _ in range(height))
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+        + png_chunk(b"eXIf", exif_tiff())
+        + png_chunk(b"IDAT", zlib.compress(rows, 0))
+        + png_chunk(b"IEND", b"")
+    )
+
+
+def bmff_box(kind, payload):
+    return struct.pack(">I", len(payload) + 8) + kind + payload
+
+
+def full_box(kind, payload, version=0):
+    return bmff_box(kind, bytes([version, 0, 0, 0]) + payload)
+
+
+def heif(image_bytes=64):
+    """A HEIF with one image item followed in `mdat` by an Exif item
+
+    The Exif item comes after `image_bytes` of image data, so a large value
+    puts the metadata near the end of a large file.
+    """
+    exif_item = struct.pack(">I", 6) + b"Exif\0\0" + exif_tiff()
+
+    def meta(image_offset, exif_offset):
+        infe = [
+            full_box(b"infe", struct.pack(">HH", item_id, 0) + kind + b"\0", version=2)
+            for item_id, kind in ((1, b"hvc1"), (2, b"Exif"))
+        ]
+        iloc = struct.pack(">BBH", 0x44, 0x00, 2)
+        for item_id, offset, length in ((1, image_offset, image_bytes), (2, exif_offset, len(exif_item))):
+            iloc += struct.pack(">HHHII", item_id, 0, 1, offset, length)
+        return full_box(
+            b"meta",
+            full_box(b"hdlr", struct.pack(">I", 0) + b"pict" + b"\0" * 13)
+            + full_box(b"pitm", struct.pack(">H", 1))
+            + full_box(b"iinf", struct.pack(">H", len(infe)) + b"".join(infe))
+            + full_box(b"iloc", iloc),
+        )
+
+    ftyp = bmff_box(b"ftyp", b"heic" + struct.pack(">I", 0) + b"mif1heic")
+    data_start = len(ftyp) + len(meta(0, 0)) + 8
+    return (
+        ftyp
+        + meta(data_start, data_start + image_bytes)
+        + bmff_box(b"mdat", b"\0" * image_bytes + exif_item)
+    )
+
+
+@pytest.fixture
+def jpeg_bytes():
+    return jpeg()
+
+
+@pytest.fixture
+def jpeg_path(tmp_path, jpeg_bytes):
+    path = tmp_path / "fixture.jpg"
+    path.write_bytes(jpeg_bytes)
+    return path
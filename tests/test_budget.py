@@ -0,0 +1,30 @@
+"""Batch reads of files larger than max_file_bytes"""
+
+import pytest
+
+import fast_exif_rs_py
+from conftest import heif, jpeg, png, tiff
+
+BULK = 4 << 20
+MAX_FILE_BYTES = 256 << 10
+
+BUILDERS = {"jpeg": jpeg, "tiff": tiff, "png": png, "heif": heif}
+
+
+@pytest.mark.parametrize("kind", sorted(BUILDERS))
+def test_large_files_report_all_metadata(tmp_path, kind):
+    # The HEIF Exif item sits after the image data, near the end of the file
+    path = tmp_path / f"large.{kind}"
+    path.write_bytes(BUILDERS[kind](BULK))
+    expected = fast_exif_rs_py.read_exif_file(str(path))
+
+    results = fast_exif_rs_py.read_exif_files_parallel([str(path)], max_file_bytes=MAX_FILE_BYTES)
+    assert results == [expected]
+
+
+def test_metadata_beyond_the_cap_fails(tmp_path):
+    # No walker knows this format, so it could only be read whole
+    path = tmp_path / "unknown.bin"
+    path.write_bytes(b"\x00\x01" * BULK)
+    with pytest.raises(RuntimeError, match="does not fit"):
+        fast_exif_rs_py.read_exif_files_parallel([str(path)], max_file_bytes=MAX_FILE_BYTES)
@@ -0,0 +1,115 @@
+"""Catalog scans, incremental syncs and lookups"""
+
+import os
+
+import pytest
+
+import fast_exif_rs_py
+from conftest import ascii_value, jpeg
+
+NO_CHANGES = {"added": 0, "modified": 0, "renamed": 0, "deleted": 0, "failed": 0}
+
+
+def image(software):
+    return jpeg(ifd0={0x0131: ascii_value(software)})
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "photos"
+    (root / "2024").mkdir(parents=True)
+    (root / "a.jpg").write_bytes(image("one"))
+    (root / "2024" / "b.jpg").write_bytes(image("two"))
+    (root / "2024" / "c.jpg").write_bytes(image("two"))
+    (root / "notes.txt").write_text("not media")
+    return root
+
+
+def open_catalog(tree, tmp_path):
+    return fast_exif_rs_py.Catalog(str(tree), str(tmp_path / "catalog.db"), watch=False)
+
+
+def test_initial_scan(tree, tmp_path):
+    catalog = open_catalog(tree, tmp_path)
+    assert len(catalog) == 3
+    assert sorted(catalog.paths()) == sorted(
+        str(tree.resolve() / name) for name in ("a.jpg", "2024/b.jpg", "2024/c.jpg")
+    )
+    assert catalog.get("a.jpg") == fast_exif_rs_py.read_exif_file(str(tree / "a.jpg"))
+    assert catalog.get("notes.txt") is None
+    assert catalog.sync() == NO_CHANGES
+
+
+def test_paths_are_canonical(tree, tmp_path, monkeypatch):
+    link = tmp_path / "link"
+    link.symlink_to(tree)
+    monkeypatch.chdir(tmp_path)
+    catalog = fast_exif_rs_py.Catalog("photos/2024/..", "catalog.db", watch=False)
+    assert catalog.root == tree.resolve()
+    path = str(tree.resolve() / "a.jpg")
+    assert path in catalog.paths()
+    for query in ("a.jpg", "./2024/../a.jpg", path, str(link / "a.jpg")):
+        assert query in catalog
+        assert catalog.get(query)["Software"] == "one"
+    assert "missing.jpg" not in catalog
+
+    # The same tree reached through the symlink shares the catalog
+    again = fast_exif_rs_py.Catalog(str(link), "catalog.db", watch=False)
+    assert again.root == tree.resolve()
+    assert len(again) == 3
+
+
+def test_sync_picks_up_changes(tree, tmp_path):
+    catalog = open_catalog(tree, tmp_path)
+    metadata = catalog.get("2024/b.jpg")
+
+    (tree / "a.jpg").write_bytes(image("one, edited"))
+    os.utime(tree / "a.jpg", (1_800_000_000, 1_800_000_000))
+    os.rename(tree / "2024" / "b.jpg", tree / "b-renamed.jpg")
+    os.remove(tree / "2024" / "c.jpg")
+    (tree / "2024" / "d.jpg").write_bytes(image("three"))
+
+    assert catalog.sync() == {"added": 1, "modified": 1, "renamed": 1, "deleted": 1, "failed": 0}
+    assert catalog.get("a.jpg")["Software"] == "one, edited"
+    assert catalog.get("b-renamed.jpg") == metadata
+    assert "2024/b.jpg" not in catalog
+    assert "2024/c.jpg" not in catalog
+    assert catalog.get("2024/d.jpg")["Software"] == "three"
+    assert catalog.sync() == NO_CHANGES
+
+
+def test_reopen_reads_only_changes(tree, tmp_path):
+    first = open_catalog(tree, tmp_path)
+    expected = {path: first.get(path) for path in first.paths()}
+    del first
+
+    (tree / "e.jpg").write_bytes(image("four"))
+    reopened = open_catalog(tree, tmp_path)
+    assert len(reopened) == 4
+    assert reopened.get("e.jpg")["Software"] == "four"
+    assert {path: reopened.get(path) for path in expected} == expected
+    assert reopened.sync() == NO_CHANGES
+
+
+def test_reopen_for_another_root_fails(tree, tmp_path):
+    open_catalog(tree, tmp_path)
+    other = tmp_path / "other"
+    other.mkdir()
+    with pytest.raises(RuntimeError, match="catalog of"):
+        open_catalog(other, tmp_path)
+
+
+def test_find_and_values(tree, tmp_path):
+    catalog = open_catalog(tree, tmp_path)
+    root = tree.resolve()
+    assert catalog.find("Software", "two") == [str(root / "2024/b.jpg"), str(root / "2024/c.jpg")]
+    assert catalog.find("Software", "none") == []
+    assert catalog.find("Software") == sorted(catalog.paths())
+    assert catalog.find("NoSuchTag") == []
+    assert catalog.values("Software") == {"one": 1, "two": 2}
+
+    # The index follows later syncs
+    os.remove(tree / "2024" / "c.jpg")
+    catalog.sync()
+    assert catalog.find("Software", "two") == [str(root / "2024/b.jpg")]
+    assert catalog.values("Software") == {"one": 1, "two": 1}
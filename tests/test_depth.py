@@ -0,0 +1,51 @@
+"""Depth levels on the reader and writer"""
+
+import pytest
+
+import fast_exif_rs_py
+from conftest import tiff
+
+
+def test_writer_rejects_fields_outside_depth(jpeg_bytes):
+    writer = fast_exif_rs_py.PyFastExifWriter(depth="basic")
+    with pytest.raises(ValueError, match="MakerNote, ThumbnailOffset"):
+        writer.write_exif_to_bytes(jpeg_bytes, {"Artist": "a", "ThumbnailOffset": "0", "MakerNote": "x"})
+
+
+def test_writer_writes_fields_inside_depth(jpeg_bytes):
+    basic = fast_exif_rs_py.PyFastExifWriter(depth="basic")
+    full = fast_exif_rs_py.PyFastExifWriter()
+    metadata = {"Artist": "depth test"}
+    assert basic.write_exif_to_bytes(jpeg_bytes, metadata) == full.write_exif_to_bytes(jpeg_bytes, metadata)
+
+
+@pytest.fixture
+def large_tiff(tmp_path):
+    path = tmp_path / "large.tif"
+    path.write_bytes(tiff(4 << 20))
+    return path
+
+
+def bytes_read(reader, path):
+    reports = []
+    reader.read_files_parallel([str(path)], progress=lambda *report: reports.append(report))
+    return reports[-1][2]
+
+
+@pytest.mark.parametrize("depth", ["basic", "standard"])
+def test_reader_reports_a_subset_of_full(jpeg_path, large_tiff, depth):
+    full = fast_exif_rs_py.PyFastExifReader()
+    reader = fast_exif_rs_py.PyFastExifReader(depth=depth)
+    for path in (jpeg_path, large_tiff):
+        metadata = reader.read_file(str(path))
+        assert metadata.items() <= full.read_file(str(path)).items()
+        assert metadata["Make"] == "TestCam"
+        assert reader.read_bytes(path.read_bytes()) == metadata
+        assert reader.read_files_parallel([str(path)]) == [metadata]
+
+
+def test_basic_reads_only_the_metadata(large_tiff):
+    full = bytes_read(fast_exif_rs_py.PyFastExifReader(), large_tiff)
+    basic = bytes_read(fast_exif_rs_py.PyFastExifReader(depth="basic"), large_tiff)
+    assert full >= 4 << 20
+    assert basic < 256 << 10
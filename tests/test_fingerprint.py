@@ -0,0 +1,53 @@
+"""group_by_fingerprint on files
+
+The sweep itself is unit-tested in src/fingerprint.rs; these tests run it
+on real files, including ones that cannot be read.
+"""
+
+import fast_exif_rs_py
+from conftest import ascii_value, jpeg
+
+
+def shot(tmp_path, name, **ifd0):
+    tags = {"Model": 0x0110, "DateTime": 0x0132, "Artist": 0x013B}
+    path = tmp_path / name
+    path.write_bytes(jpeg(ifd0={tags[tag]: ascii_value(value) for tag, value in ifd0.items()}))
+    return str(path)
+
+
+def test_bursts_chain_within_the_tolerance(tmp_path):
+    paths = [
+        shot(tmp_path, "1.jpg", DateTime="2024:01:02 03:04:05"),
+        shot(tmp_path, "2.jpg", DateTime="2024:01:02 03:04:07"),
+        # 4 s after the first shot but 2 s after the previous one
+        shot(tmp_path, "3.jpg", DateTime="2024:01:02 03:04:09"),
+        shot(tmp_path, "4.jpg", DateTime="2024:01:02 03:04:20"),
+        shot(tmp_path, "5.jpg", Model="Other", DateTime="2024:01:02 03:04:06"),
+    ]
+    keys = ["Model", "DateTime"]
+    assert fast_exif_rs_py.group_by_fingerprint(paths, keys, 2000) == [0, 0, 0, 1, 2]
+    assert fast_exif_rs_py.group_by_fingerprint(paths, keys, 1000) == [0, 1, 2, 3, 4]
+
+
+def test_missing_tags_match_each_other(tmp_path):
+    paths = [
+        shot(tmp_path, "a.jpg", Artist="someone"),
+        shot(tmp_path, "b.jpg"),
+        shot(tmp_path, "c.jpg", Artist="someone"),
+        shot(tmp_path, "d.jpg"),
+    ]
+    assert fast_exif_rs_py.group_by_fingerprint(paths, ["Model", "Artist"]) == [0, 1, 0, 1]
+
+
+def test_unreadable_files_have_no_group(tmp_path):
+    garbage = tmp_path / "garbage.jpg"
+    garbage.write_bytes(b"not an image")
+    paths = [
+        str(tmp_path / "missing.jpg"),
+        shot(tmp_path, "a.jpg"),
+        str(garbage),
+        shot(tmp_path, "b.jpg", Model="Other"),
+        shot(tmp_path, "c.jpg"),
+    ]
+    # IDs stay compact and follow input order around the gaps
+    assert fast_exif_rs_py.group_by_fingerprint(paths, ["Model"]) == [None, 0, None, 1, 0]
@@ -0,0 +1,106 @@
+"""Parallel reads in processes forked after the parent used the worker pool
+
+A forked child inherits the parent's pool without its threads, so these
+tests fail by timing out rather than by an assertion if the pool is not
+rebuilt. Every child is killed when its timeout expires so that a hang
+fails the test instead of blocking the run.
+"""
+
+import multiprocessing
+import os
+import pickle
+import signal
+import time
+import traceback
+
+import pytest
+
+import fast_exif_rs_py
+
+TIMEOUT = 60
+
+pytestmark = [
+    pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork()"),
+    # Forking with the worker pool running is exactly the case under test
+    pytest.mark.filterwarnings("ignore:.*fork.*:DeprecationWarning"),
+]
+
+
+@pytest.fixture
+def paths(tmp_path, jpeg_bytes):
+    paths = []
+    for i in range(32):
+        path = tmp_path / f"image_{i}.jpg"
+        path.write_bytes(jpeg_bytes)
+        paths.append(str(path))
+    return paths
+
+
+@pytest.fixture(autouse=True)
+def restore_pool():
+    yield
+    fast_exif_rs_py.configure_parallelism()
+
+
+def read_parallel(paths):
+    return fast_exif_rs_py.read_exif_files_parallel(paths)
+
+
+def run_forked(func, result_path):
+    """Run `func` in a forked child and return its result, or fail on a hang"""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            with open(result_path, "wb") as out:
+                pickle.dump(func(), out)
+            os._exit(0)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(1)
+    deadline = time.monotonic() + TIMEOUT
+    while True:
+        done, status = os.waitpid(pid, os.WNOHANG)
+        if done:
+            break
+        if time.monotonic() > deadline:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            pytest.fail(f"forked child did not finish within {TIMEOUT} s")
+        time.sleep(0.05)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+    with open(result_path, "rb") as f:
+        return pickle.load(f)
+
+
+def test_parallel_read_after_fork(tmp_path, paths):
+    expected = read_parallel(paths)
+    assert len(expected) == len(paths)
+
+    child = run_forked(lambda: (read_parallel(paths), read_parallel(paths)), tmp_path / "result.pickle")
+    assert child == (expected, expected)
+    # The parent's pool is untouched by the child
+    assert read_parallel(paths) == expected
+
+
+def test_fork_pool_workers(paths):
+    expected = read_parallel(paths)
+
+    pool = multiprocessing.get_context("fork").Pool(2)
+    try:
+        results = [pool.apply_async(read_parallel, (paths,)) for _ in range(4)]
+        for result in results:
+            assert result.get(timeout=TIMEOUT) == expected
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def test_pool_free_mode_after_fork(tmp_path, paths):
+    expected = read_parallel(paths)
+
+    def read_without_pool():
+        fast_exif_rs_py.configure_parallelism(use_pool=False)
+        return read_parallel(paths)
+
+    assert run_forked(read_without_pool, tmp_path / "result.pickle") == expected
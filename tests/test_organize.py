@@ -0,0 +1,52 @@
+"""organize() reruns"""
+
+import os
+
+import pytest
+
+import fast_exif_rs_py
+
+TEMPLATE = "{year}/{month}/{model}_{seq:03}{ext}"
+
+
+@pytest.fixture
+def incoming(tmp_path, jpeg_bytes):
+    root = tmp_path / "incoming"
+    root.mkdir()
+    # Same size and mtime but different contents, like a burst off a card
+    for name, marker in (("a.jpg", b"a"), ("b.jpg", b"b")):
+        path = root / name
+        path.write_bytes(jpeg_bytes[:-2] + marker + b"\xFF\xD9")
+        os.utime(path, (1_700_000_000, 1_700_000_000))
+    return root
+
+
+@pytest.mark.parametrize("action, done", [("copy", "copied"), ("hardlink", "linked")])
+def test_rerun_is_idempotent(tmp_path, incoming, action, done):
+    dest = tmp_path / "archive"
+    first = fast_exif_rs_py.organize(str(incoming), TEMPLATE, action=action, dest=dest)
+    assert [r["status"] for r in first] == [done, done]
+    destinations = {r["source"]: r["destination"] for r in first}
+    assert len(set(destinations.values())) == 2
+
+    second = fast_exif_rs_py.organize(str(incoming), TEMPLATE, action=action, dest=dest)
+    assert [r["status"] for r in second] == ["unchanged", "unchanged"]
+    assert {r["source"]: r["destination"] for r in second} == destinations
+    assert sum(len(files) for _, _, files in os.walk(dest)) == 2
+
+
+@pytest.mark.parametrize(
+    "action, done", [("copy", "copied"), ("hardlink", "linked"), ("move", "moved")]
+)
+@pytest.mark.parametrize("template", [TEMPLATE, "{year}/{name}{ext}"])
+def test_rerun_into_the_root(incoming, template, action, done):
+    first = fast_exif_rs_py.organize(str(incoming), template, action=action)
+    assert [r["status"] for r in first] == [done, done]
+    destinations = sorted(r["destination"] for r in first)
+    files = sorted(str(p) for p in incoming.rglob("*") if p.is_file())
+
+    for _ in range(2):
+        again = fast_exif_rs_py.organize(str(incoming), template, action=action)
+        assert {r["status"] for r in again} == {"unchanged"}
+        assert sorted({r["destination"] for r in again}) == destinations
+        assert sorted(str(p) for p in incoming.rglob("*") if p.is_file()) == files
@@ -0,0 +1,118 @@
+"""Writer outputs that avoid a full-size bytes copy"""
+
+import gc
+import os
+import threading
+
+import pytest
+
+import fast_exif_rs_py
+from conftest import jpeg
+
+METADATA = {"Artist": "output test"}
+
+
+@pytest.fixture(scope="module")
+def image():
+    # Enough scan data that the image is mostly bulk, like a real JPEG
+    return jpeg(1 << 20)
+
+
+@pytest.fixture(scope="module")
+def writer():
+    return fast_exif_rs_py.PyFastExifWriter()
+
+
+@pytest.fixture(scope="module")
+def expected(writer, image):
+    return writer.write_exif_to_bytes(image, METADATA)
+
+
+def test_buffer_matches_bytes(writer, image, expected):
+    buffer = writer.write_exif_to_buffer(image, METADATA)
+    assert len(buffer) == len(expected)
+    assert bytes(buffer) == expected
+    view = memoryview(buffer)
+    assert view.readonly
+    assert view.nbytes == len(expected)
+    assert view.tobytes() == expected
+
+
+def test_buffer_is_read_only(writer, image):
+    view = memoryview(writer.write_exif_to_buffer(image, METADATA))
+    with pytest.raises(TypeError):
+        view[0] = 0
+
+
+def test_view_outlives_the_buffer(writer, image, expected):
+    buffer = writer.write_exif_to_buffer(image, METADATA)
+    view = memoryview(buffer)
+    del buffer
+    gc.collect()
+    assert view.tobytes() == expected
+    view.release()
+
+
+def test_buffer_writes_to_a_file(tmp_path, writer, image, expected):
+    path = tmp_path / "buffer.jpg"
+    with open(path, "wb") as f:
+        f.write(writer.write_exif_to_buffer(image, METADATA))
+    assert path.read_bytes() == expected
+
+
+def test_fd_output_matches_bytes(tmp_path, writer, image, expected):
+    path = tmp_path / "fd.jpg"
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    try:
+        assert writer.write_exif_to_fd(image, fd, METADATA) == len(expected)
+        # The descriptor is left open and still usable
+        os.fstat(fd)
+        os.write(fd, b"trailer")
+    finally:
+        os.close(fd)
+    assert path.read_bytes() == expected + b"trailer"
+
+
+def test_file_object_output_matches_bytes(tmp_path, writer, image, expected):
+    path = tmp_path / "file.jpg"
+    with open(path, "wb") as f:
+        f.write(b"prefix")
+        f.flush()
+        assert writer.write_exif_to_fd(image, f, METADATA) == len(expected)
+        assert not f.closed
+    assert path.read_bytes() == b"prefix" + expected
+
+
+def test_fd_output_to_a_pipe(writer, image, expected):
+    read_end, write_end = os.pipe()
+    chunks = []
+    reader = threading.Thread(
+        target=lambda: chunks.extend(iter(lambda: os.read(read_end, 65536), b""))
+    )
+    reader.start()
+    try:
+        writer.write_exif_to_fd(image, write_end, METADATA)
+    finally:
+        os.close(write_end)
+    reader.join()
+    os.close(read_end)
+    assert b"".join(chunks) == expected
+
+
+def test_into_bytearray_is_resized(writer, image, expected):
+    out = bytearray(b"x" * (len(expected) + 100))
+    assert writer.write_exif_to_bytes(image, METADATA, into=out) == len(expected)
+    assert out == expected
+    out = bytearray()
+    writer.write_exif_to_bytes(image, METADATA, into=out)
+    assert out == expected
+
+
+def test_into_fixed_buffer(writer, image, expected):
+    out = memoryview(bytearray(len(expected) + 10))
+    assert writer.write_exif_to_bytes(image, METADATA, into=out) == len(expected)
+    assert out[: len(expected)] == expected
+    with pytest.raises(ValueError, match="needs"):
+        writer.write_exif_to_bytes(image, METADATA, into=memoryview(bytearray(10)))
+    with pytest.raises(ValueError, match="writable"):
+        writer.write_exif_to_bytes(image, METADATA, into=b"\0" * len(expected))
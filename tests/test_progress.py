@@ -0,0 +1,88 @@
+"""Progress reporting and cancellation of parallel batches"""
+
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+import fast_exif_rs_py
+from conftest import jpeg
+
+INTERVAL = 0.02
+
+
+@pytest.fixture(scope="module")
+def large_files(tmp_path_factory):
+    """Files whose scan data makes each read take a little while"""
+    directory = tmp_path_factory.mktemp("large")
+    data = jpeg(scan_bytes=1 << 20)
+    paths = []
+    for i in range(16):
+        path = directory / f"image_{i}.jpg"
+        path.write_bytes(data)
+        paths.append(str(path))
+    return paths
+
+
+def test_reports_at_most_once_per_interval(large_files):
+    paths = large_files * 40
+    calls = []
+
+    def progress(done, total, bytes_read, errors):
+        calls.append((time.monotonic(), done, total, bytes_read, errors))
+
+    fast_exif_rs_py.read_exif_files_parallel(paths, progress=progress, progress_interval=INTERVAL)
+    assert calls
+    times = [call[0] for call in calls]
+    # Every report but the final one waits for its interval
+    assert all(b - a >= INTERVAL * 0.9 for a, b in zip(times, times[1:-1]))
+    for (_, done, total, bytes_read, errors), (_, later_done, _, later_bytes, _) in zip(calls, calls[1:]):
+        assert total == len(paths)
+        assert errors == 0
+        assert done <= later_done and bytes_read <= later_bytes
+    assert calls[-1][1:] == (len(paths), len(paths), sum(os.path.getsize(p) for p in paths), 0)
+
+
+def test_reports_errors(tmp_path, large_files):
+    paths = large_files + [str(tmp_path / "missing.jpg")] * 3
+    calls = []
+    with pytest.raises(RuntimeError):
+        fast_exif_rs_py.read_exif_files_parallel(
+            paths, progress=lambda *report: calls.append(report), progress_interval=INTERVAL
+        )
+    assert calls[-1][:2] == (len(paths), len(paths))
+    assert calls[-1][3] == 3
+
+
+def test_callback_exception_cancels(large_files):
+    paths = large_files * 2000
+    calls = []
+
+    def progress(done, total, bytes_read, errors):
+        calls.append(done)
+        raise ValueError("stop")
+
+    start = time.monotonic()
+    with pytest.raises(ValueError, match="stop"):
+        fast_exif_rs_py.read_exif_files_parallel(paths, progress=progress, progress_interval=INTERVAL)
+    # Only the files already started finish; the rest would take far longer
+    assert time.monotonic() - start < 5
+    assert len(calls) == 1
+    assert calls[0] < len(paths)
+
+
+@pytest.mark.skipif(not hasattr(signal, "pthread_kill"), reason="needs pthread_kill")
+def test_keyboard_interrupt_cancels(large_files):
+    paths = large_files * 2000
+    main = threading.main_thread().ident
+    timer = threading.Timer(0.1, signal.pthread_kill, (main, signal.SIGINT))
+    start = time.monotonic()
+    timer.start()
+    try:
+        with pytest.raises(KeyboardInterrupt):
+            fast_exif_rs_py.read_exif_files_parallel(paths, progress_interval=INTERVAL)
+    finally:
+        timer.cancel()
+    assert time.monotonic() - start < 5
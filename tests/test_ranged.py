@@ -0,0 +1,83 @@
+"""Reading metadata from file objects and read_range callables
+
+Each fixture puts a few MiB of image data next to its metadata, the way
+real RAW and HEIF files do, and checks that only a small part of the file
+is fetched while the result matches a read of the whole file.
+"""
+
+import io
+import tarfile
+
+import pytest
+
+import fast_exif_rs_py
+from conftest import heif, jpeg, png, tiff
+
+BULK = 4 << 20
+# Container headers plus readahead, far below the file size
+MAX_FETCHED = 256 << 10
+
+BUILDERS = {"jpeg": jpeg, "tiff": tiff, "png": png, "heif": heif}
+
+
+@pytest.fixture(scope="module", params=sorted(BUILDERS))
+def image(request):
+    return BUILDERS[request.param](BULK)
+
+
+class RangeReader:
+    """read_range callable that records how much was fetched"""
+
+    def __init__(self, data):
+        self.data = data
+        self.fetched = 0
+        self.calls = 0
+
+    def __call__(self, offset, length):
+        self.calls += 1
+        chunk = self.data[offset:offset + length]
+        self.fetched += len(chunk)
+        return chunk
+
+
+def test_callable_fetches_only_metadata(image):
+    expected = fast_exif_rs_py.read_exif_bytes(image)
+    assert expected
+
+    source = RangeReader(image)
+    assert fast_exif_rs_py.read_exif_fileobj(source) == expected
+    assert source.fetched < MAX_FETCHED
+
+
+def test_file_object(image):
+    expected = fast_exif_rs_py.read_exif_bytes(image)
+    assert fast_exif_rs_py.read_exif_fileobj(io.BytesIO(image)) == expected
+    assert fast_exif_rs_py.PyFastExifReader().read_fileobj(io.BytesIO(image)) == expected
+
+
+def test_tar_member(image):
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w") as tar:
+        info = tarfile.TarInfo("image")
+        info.size = len(image)
+        tar.addfile(info, io.BytesIO(image))
+    archive.seek(0)
+    with tarfile.open(fileobj=archive) as tar:
+        member = tar.extractfile("image")
+        assert fast_exif_rs_py.read_exif_fileobj(member) == fast_exif_rs_py.read_exif_bytes(image)
+
+
+def test_batch_keeps_input_order():
+    images = [BUILDERS[name](BULK) for name in sorted(BUILDERS)]
+    expected = [fast_exif_rs_py.read_exif_bytes(image) for image in images]
+    sources = [RangeReader(image) for image in images]
+    assert fast_exif_rs_py.read_exif_fileobjs(sources) == expected
+    assert all(source.fetched < MAX_FETCHED for source in sources)
+
+
+def test_callable_errors_propagate():
+    def failing(offset, length):
+        raise OSError("gateway unavailable")
+
+    with pytest.raises(OSError, match="gateway unavailable"):
+        fast_exif_rs_py.read_exif_fileobj(failing)
@@ -0,0 +1,42 @@
+"""Batch reads through the I/O scheduler
+
+The queue planning and per-device limits are unit-tested in src/io.rs;
+these tests check that scheduled batches still report every file in input
+order.
+"""
+
+import pytest
+
+import fast_exif_rs_py
+from conftest import ascii_value, jpeg
+
+SCHEDULES = [
+    {"io_schedule": "locality"},
+    {"max_io_per_device": 1},
+    {"io_schedule": "locality", "max_io_per_device": 2, "max_inflight_bytes": 4096},
+]
+
+
+@pytest.fixture
+def batch(tmp_path):
+    """Files with distinct metadata, spread over directories and created in
+    the reverse of their batch order so that inode order differs from it"""
+    paths = []
+    for i in reversed(range(24)):
+        directory = tmp_path / f"dir_{i % 3}"
+        directory.mkdir(exist_ok=True)
+        path = directory / f"image_{i:02}.jpg"
+        path.write_bytes(jpeg(ifd0={0x0131: ascii_value(f"file {i}")}))
+        paths.append(str(path))
+    paths.reverse()
+    # Interleave the directories in the input
+    return paths[::2] + paths[1::2]
+
+
+@pytest.mark.parametrize("options", SCHEDULES)
+def test_results_follow_input_order(batch, options):
+    expected = [fast_exif_rs_py.read_exif_file(path) for path in batch]
+    assert len({tuple(sorted(m.items())) for m in expected}) == len(batch)
+
+    assert fast_exif_rs_py.read_exif_files_parallel(batch, **options) == expected
+    assert fast_exif_rs_py.PyFastExifReader().read_files_parallel(batch, **options) == expected
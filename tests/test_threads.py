@@ -0,0 +1,79 @@
+"""One reader, writer and copier shared between threads
+
+On free-threaded CPython (3.13t) these calls run truly in parallel; on a
+GIL build they still overlap because every call releases the GIL.
+"""
+
+import sys
+import sysconfig
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import fast_exif_rs_py
+
+THREADS = 8
+CALLS = 200
+
+
+def run_shared(call, args):
+    """Run `call` over `args` on THREADS threads, returning results in order"""
+    with ThreadPoolExecutor(max_workers=THREADS) as pool:
+        return list(pool.map(call, args))
+
+
+def test_gil_stays_disabled():
+    if not sysconfig.get_config_var("Py_GIL_DISABLED"):
+        pytest.skip("not a free-threaded build")
+    # Importing an extension that needs the GIL would have re-enabled it
+    assert not sys._is_gil_enabled()
+
+
+def test_shared_reader(jpeg_path, jpeg_bytes):
+    reader = fast_exif_rs_py.PyFastExifReader()
+    expected = reader.read_file(str(jpeg_path))
+    assert expected
+
+    results = run_shared(lambda _: reader.read_file(str(jpeg_path)), range(CALLS))
+    assert all(result == expected for result in results)
+    results = run_shared(lambda _: reader.read_bytes(jpeg_bytes), range(CALLS))
+    assert all(result == expected for result in results)
+
+
+def test_shared_writer(jpeg_bytes):
+    writer = fast_exif_rs_py.PyFastExifWriter()
+    artists = [f"thread test {i % THREADS}" for i in range(CALLS)]
+    expected = {artist: writer.write_exif_to_bytes(jpeg_bytes, {"Artist": artist}) for artist in set(artists)}
+
+    results = run_shared(lambda artist: writer.write_exif_to_bytes(jpeg_bytes, {"Artist": artist}), artists)
+    assert results == [expected[artist] for artist in artists]
+
+
+def test_shared_writer_into_bytearrays(jpeg_bytes):
+    writer = fast_exif_rs_py.PyFastExifWriter()
+    expected = writer.write_exif_to_bytes(jpeg_bytes, {"Artist": "into"})
+
+    def write(_):
+        out = bytearray(b"stale contents")
+        size = writer.write_exif_to_bytes(jpeg_bytes, {"Artist": "into"}, into=out)
+        return bytes(out[:size]), len(out)
+
+    for data, length in run_shared(write, range(CALLS)):
+        assert data == expected
+        assert length == len(expected)
+
+
+def test_shared_copier(tmp_path, jpeg_path):
+    copier = fast_exif_rs_py.PyFastExifCopier()
+    expected_fields = copier.get_available_fields(str(jpeg_path))
+    reference = tmp_path / "reference.jpg"
+    copier.copy_all_exif(str(jpeg_path), str(jpeg_path), str(reference))
+
+    def copy(i):
+        output = tmp_path / f"copy_{i}.jpg"
+        copier.copy_all_exif(str(jpeg_path), str(jpeg_path), str(output))
+        return copier.get_available_fields(str(jpeg_path)), output.read_bytes()
+
+    for fields, data in run_shared(copy, range(CALLS)):
+        assert fields == expected_fields
+        assert data == reference.read_bytes()
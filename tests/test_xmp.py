@@ -0,0 +1,53 @@
+"""XMP sidecar writing and sidecar-aware reads"""
+
+import fast_exif_rs_py
+
+LIGHTROOM_SIDECAR = """<x:xmpmeta xmlns:x="adobe:ns:meta/" xmlns:lrx="http://example.com/lrx/1.0/">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+   xmlns:mwg-rs="http://www.metadataworkinggroup.com/schemas/regions/">
+  <rdf:Description rdf:about="" xmlns:xmp="http://ns.adobe.com/xap/1.0/" xmp:Rating="3" lrx:Flag="1">
+   <mwg-rs:Regions rdf:parseType="Resource">
+    <mwg-rs:AppliedToDimensions rdf:parseType="Resource"/>
+   </mwg-rs:Regions>
+  </rdf:Description>
+ </rdf:RDF>
+</x:xmpmeta>
+"""
+
+
+def test_rewrite_keeps_prefixes_declared_on_ancestors(jpeg_path):
+    sidecar = jpeg_path.with_suffix(".xmp")
+    sidecar.write_text(LIGHTROOM_SIDECAR)
+
+    [result] = fast_exif_rs_py.write_xmp_sidecars([(str(jpeg_path), {"Artist": "Someone"})])
+    assert result["error"] is None
+    text = sidecar.read_text()
+    assert 'xmlns:lrx="http://example.com/lrx/1.0/"' in text
+    assert 'xmlns:mwg-rs="http://www.metadataworkinggroup.com/schemas/regions/"' in text
+
+    # The rewritten sidecar must still parse, both for reads and rewrites
+    [metadata] = fast_exif_rs_py.read_exif_files_parallel([str(jpeg_path)], sidecars=True)
+    assert metadata["lrx:Flag"] == "1"
+    assert metadata["Rating"] == "3"
+    assert metadata["Artist"] == "Someone"
+    [result] = fast_exif_rs_py.write_xmp_sidecars([str(jpeg_path)])
+    assert result["error"] is None
+
+
+def test_shared_sidecar_target_is_written_once(tmp_path, jpeg_bytes):
+    raw, jpeg = tmp_path / "IMG_0001.CR2", tmp_path / "IMG_0001.JPG"
+    raw.write_bytes(jpeg_bytes)
+    jpeg.write_bytes(jpeg_bytes)
+
+    first, second = fast_exif_rs_py.write_xmp_sidecars(
+        [(str(raw), {"xmp:Rating": "5"}), (str(jpeg), {"xmp:Rating": "1"})]
+    )
+    assert first["error"] is None
+    assert first["sidecar"] == str(tmp_path / "IMG_0001.xmp")
+    assert second["sidecar"] is None
+    assert "also written for" in second["error"]
+    assert "<xmp:Rating>5</xmp:Rating>" in (tmp_path / "IMG_0001.xmp").read_text()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["IMG_0001.CR2", "IMG_0001.JPG", "IMG_0001.xmp"]
+
+    results = fast_exif_rs_py.write_xmp_sidecars([str(raw), str(jpeg)], naming="append")
+    assert [r["error"] for r in results] == [None, None]